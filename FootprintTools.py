@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+import sys
+
+import os, glob, optparse, re, shutil, subprocess, string, tempfile, time, math
+
+import IsisTools
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Computes the ground footprint of one or more spiceinit'ed cubes and the overlap between them.
+Footprints are cached next to each cube so later calls are nearly free.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+#--------------------------------------------------------------------------------
+
+MEAN_MOON_RADIUS = 1737400 # In meters
+
+# Default distance in pixels between samples taken along the cube border
+DEFAULT_BORDER_STEP = 500
+
+# Cached footprints are written to the cube path plus this extension
+FOOTPRINT_CACHE_EXTENSION = '.footprint.csv'
+
+
+def getBorderPixels(numSamples, numLines, step):
+    """Returns a closed walk of one-based (sample, line) pixels around the edge of an image"""
+
+    step = max(1, int(step))
+
+    # Each edge includes its first pixel but not its last so corners are not repeated
+    def edgeRange(start, stop):
+        return range(start, stop, step if stop > start else -step)
+
+    pixels = []
+    for s in edgeRange(1, numSamples): # Top edge, left to right
+        pixels.append((s, 1))
+    for l in edgeRange(1, numLines): # Right edge, top to bottom
+        pixels.append((numSamples, l))
+    for s in edgeRange(numSamples, 1): # Bottom edge, right to left
+        pixels.append((s, numLines))
+    for l in edgeRange(numLines, 1): # Left edge, bottom to top
+        pixels.append((1, l))
+
+    return pixels
+
+
+def runCamptBatch(cubePath, coordList, coordType='image', workDir='', allowOutside=False):
+    """Calls campt once on a whole list of coordinates.
+       - coordType is 'image' for (sample, line) inputs or 'ground' for (lat, lon) inputs.
+       - Set allowOutside to get pixel locations for ground points just outside the image.
+       - Returns a list of [sample, line, lat, lon] entries, one per coordinate that projected.
+    """
+
+    # Make sure the input file exists
+    if not os.path.exists(cubePath):
+        raise Exception('Cube file ' + cubePath + ' not found!')
+
+    # Default working directory is the cubePath folder
+    outputFolder = workDir
+    if workDir == '':
+        outputFolder = os.path.dirname(cubePath)
+    if not os.path.exists(outputFolder):
+        os.mkdir(outputFolder)
+
+    # Write out all of the input coordinates so campt can process them in one pass
+    # - Each call gets its own files so concurrent calls sharing the folder do not overwrite each other.
+    #   The output name is derived from the unique coordinate list name.
+    coordFileHandle, coordListPath = tempfile.mkstemp(prefix='camptCoordList-', suffix='.txt', dir=outputFolder)
+    tempTextPath = coordListPath[:-len('.txt')] + '-output.csv'
+    if os.path.exists(tempTextPath):
+        os.remove(tempTextPath) # Make sure any existing file is removed!
+    coordFile = os.fdopen(coordFileHandle, 'w')
+    for coord in coordList:
+        coordFile.write(str(coord[0]) + ', ' + str(coord[1]) + '\n')
+    coordFile.close()
+
+    # Use subprocess to suppress the command output
+    cmd = ['campt', 'from=', cubePath, 'to=', tempTextPath, 'format=', 'flat',
+           'usecoordlist=', 'true', 'coordlist=', coordListPath, 'coordtype=', coordType]
+    if allowOutside:
+        cmd = cmd + ['allowoutside=', 'true']
+    FNULL = open(os.devnull, 'w')
+    subprocess.call(cmd, stdout=FNULL, stderr=subprocess.STDOUT)
+
+    # Check that we created the temporary file
+    if not os.path.exists(tempTextPath):
+        os.remove(coordListPath)
+        raise Exception('campt failed to create temporary file ' + tempTextPath)
+
+    # The flat format is a header line followed by one comma separated line per coordinate
+    results   = []
+    infoFile  = open(tempTextPath, 'r')
+    header    = infoFile.readline().strip().split(',')
+    try:
+        sampleIndex = header.index('Sample')
+        lineIndex   = header.index('Line')
+        latIndex    = header.index('PlanetocentricLatitude')
+        lonIndex    = header.index('PositiveEast360Longitude')
+    except ValueError:
+        infoFile.close()
+        os.remove(coordListPath)
+        raise Exception('Unexpected campt output format in file ' + tempTextPath)
+
+    for line in infoFile:
+        strings = line.strip().split(',')
+        try: # Coordinates that missed the body leave these fields blank
+            results.append([float(strings[sampleIndex]), float(strings[lineIndex]),
+                            float(strings[latIndex]),    float(strings[lonIndex])])
+        except (ValueError, IndexError):
+            continue
+    infoFile.close()
+
+    # Remove the files to clean up, the coordinate list is kept until now so its name is not reused
+    os.remove(tempTextPath)
+    os.remove(coordListPath)
+
+    return results
+
+
+def readFootprintCache(cachePath, cubePath, step):
+    """Returns the cached footprint of a cube, or None if the cache is missing or stale"""
+
+    if not os.path.exists(cachePath):
+        return None
+
+    # The first line records what the footprint was generated from
+    f = open(cachePath, 'r')
+    header = f.readline()
+    m = re.search('step=([0-9]+) mtime=([0-9.]+)', header)
+    if (not m) or (int(m.group(1)) != int(step)) or (float(m.group(2)) != os.path.getmtime(cubePath)):
+        f.close()
+        return None
+
+    polygon = []
+    for line in f:
+        if line.find('#') >= 0:
+            continue
+        strings = line.split(',')
+        polygon.append((float(strings[0]), float(strings[1]))) # lat, lon
+    f.close()
+
+    return polygon
+
+
+def writeFootprintCache(cachePath, cubePath, step, polygon):
+    """Records a footprint polygon next to its cube"""
+
+    f = open(cachePath, 'w')
+    f.write('# step=' + str(int(step)) + ' mtime=' + repr(os.path.getmtime(cubePath)) + '\n')
+    f.write('# lat, lon\n')
+    for point in polygon:
+        f.write('%.10f, %.10f\n' % (point[0], point[1]))
+    f.close()
+
+
+def getCubeFootprint(cubePath, step=DEFAULT_BORDER_STEP, workDir='', forceOperation=False):
+    """Returns the ground footprint of a cube as a list of (lat, lon) vertices.
+       - The camera model is sampled every step pixels along the cube border in one campt call.
+       - The result is cached next to the cube and reused until the cube changes.
+    """
+
+    cachePath = cubePath + FOOTPRINT_CACHE_EXTENSION
+    if not forceOperation:
+        polygon = readFootprintCache(cachePath, cubePath, step)
+        if polygon:
+            return polygon
+
+    # Project the border pixels of the cube to the ground
+    numSamples, numLines = IsisTools.getCubeSize(cubePath)
+    borderPixels = getBorderPixels(numSamples, numLines, step)
+    projections  = runCamptBatch(cubePath, borderPixels, 'image', workDir)
+    if len(projections) < 3:
+        raise Exception('Unable to compute a footprint for cube ' + cubePath)
+
+    polygon = [(p[2], p[3]) for p in projections]
+    writeFootprintCache(cachePath, cubePath, step, polygon)
+
+    return polygon
+
+
+#--------------------------------------------------------------------------------
+# Polygon operations
+# - All of these work in a local planar projection (meters) centered on the input polygons,
+#   which is accurate enough for the few-kilometer extents of an LRONAC observation.
+
+
+def _unwrapLongitude(lon, referenceLon):
+    """Returns lon shifted by multiples of 360 to be within 180 degrees of referenceLon"""
+    while lon - referenceLon > 180.0:
+        lon -= 360.0
+    while lon - referenceLon < -180.0:
+        lon += 360.0
+    return lon
+
+
+def _getProjectionCenter(polygons):
+    """Returns the (lat, lon) point used as the origin of the local planar projection"""
+    referenceLon = polygons[0][0][1]
+    lats = [p[0] for poly in polygons for p in poly]
+    lons = [_unwrapLongitude(p[1], referenceLon) for poly in polygons for p in poly]
+    return (sum(lats) / len(lats), sum(lons) / len(lons))
+
+
+def _toLocal(polygon, center):
+    """Converts (lat, lon) vertices into (x, y) meters around the center point"""
+    scale  = math.pi / 180.0 * MEAN_MOON_RADIUS
+    cosLat = math.cos(center[0] * math.pi / 180.0)
+    return [((_unwrapLongitude(p[1], center[1]) - center[1]) * scale * cosLat,
+             (p[0] - center[0]) * scale) for p in polygon]
+
+
+def _fromLocal(points, center):
+    """Inverse of _toLocal, returns (lat, lon) vertices"""
+    scale  = math.pi / 180.0 * MEAN_MOON_RADIUS
+    cosLat = math.cos(center[0] * math.pi / 180.0)
+    return [(center[0] + p[1] / scale,
+             (center[1] + p[0] / (scale * cosLat)) % 360.0) for p in points]
+
+
+def _signedArea(points):
+    """Shoelace formula, positive for counter-clockwise polygons"""
+    area = 0.0
+    for i in range(len(points)):
+        x1, y1 = points[i]
+        x2, y2 = points[(i+1) % len(points)]
+        area += x1*y2 - x2*y1
+    return area / 2.0
+
+
+def _clipPolygon(subject, clip):
+    """Sutherland-Hodgman clipping of subject against a convex counter-clockwise clip polygon"""
+
+    def inside(p, a, b):
+        return (b[0]-a[0])*(p[1]-a[1]) - (b[1]-a[1])*(p[0]-a[0]) >= 0
+
+    def intersect(p, q, a, b):
+        dx1, dy1 = q[0]-p[0], q[1]-p[1]
+        dx2, dy2 = b[0]-a[0], b[1]-a[1]
+        denom = dx1*dy2 - dy1*dx2
+        if denom == 0: # Parallel edges, just keep the end point
+            return q
+        t = ((a[0]-p[0])*dy2 - (a[1]-p[1])*dx2) / denom
+        return (p[0] + t*dx1, p[1] + t*dy1)
+
+    output = subject
+    for i in range(len(clip)):
+        if not output:
+            break
+        a = clip[i]
+        b = clip[(i+1) % len(clip)]
+        inputList = output
+        output    = []
+        previous  = inputList[-1]
+        for current in inputList:
+            if inside(current, a, b):
+                if not inside(previous, a, b):
+                    output.append(intersect(previous, current, a, b))
+                output.append(current)
+            elif inside(previous, a, b):
+                output.append(intersect(previous, current, a, b))
+            previous = current
+
+    return output
+
+
+def getPolygonArea(polygon):
+    """Returns the area of a (lat, lon) polygon in square meters"""
+    if len(polygon) < 3:
+        return 0.0
+    center = _getProjectionCenter([polygon])
+    return abs(_signedArea(_toLocal(polygon, center)))
+
+
+def getFootprintIntersection(polygonA, polygonB):
+    """Returns the (lat, lon) polygon where two footprints overlap, empty if they do not.
+       - Footprints are treated as convex, which holds for single LRONAC observations.
+    """
+    if (len(polygonA) < 3) or (len(polygonB) < 3):
+        return []
+
+    center = _getProjectionCenter([polygonA, polygonB])
+    localA = _toLocal(polygonA, center)
+    localB = _toLocal(polygonB, center)
+
+    # The clipping algorithm needs a consistent winding order
+    if _signedArea(localA) < 0:
+        localA.reverse()
+    if _signedArea(localB) < 0:
+        localB.reverse()
+
+    clipped = _clipPolygon(localA, localB)
+    if len(clipped) < 3:
+        return []
+    return _fromLocal(clipped, center)
+
+
+def getFootprintBoundingBox(polygon, buffer=0.0):
+    """Returns [minLat, maxLat, minLon, maxLon] of a footprint, expanded by buffer degrees"""
+    referenceLon = polygon[0][1]
+    lats = [p[0] for p in polygon]
+    lons = [_unwrapLongitude(p[1], referenceLon) for p in polygon]
+    return [min(lats) - buffer, max(lats) + buffer, min(lons) - buffer, max(lons) + buffer]
+
+
+def getCubeOverlap(cubePathA, cubePathB, step=DEFAULT_BORDER_STEP, workDir=''):
+    """Returns [overlapPolygon, overlapArea] for the ground footprints of two cubes"""
+    footprintA = getCubeFootprint(cubePathA, step, workDir)
+    footprintB = getCubeFootprint(cubePathB, step, workDir)
+    overlap    = getFootprintIntersection(footprintA, footprintB)
+    return [overlap, getPolygonArea(overlap)]
+
+
+#--------------------------------------------------------------------------------
+
+def main():
+
+    try:
+        try:
+            usage = "usage: FootprintTools.py <cube> [<cube> ...] [--step <pixels>][--manual]\n  "
+            parser = optparse.OptionParser(usage=usage)
+            parser.add_option("--step", dest="step", type="int", default=DEFAULT_BORDER_STEP,
+                              help="Distance in pixels between border samples.")
+            parser.add_option("--buffer", dest="buffer", type="float", default=0.0,
+                              help="Degrees to add around the printed bounding boxes.")
+            parser.add_option("--workDir", dest="workDir", default='',
+                              help="Folder to store temporary files in")
+            parser.add_option("--force", action="store_true", dest="force",
+                              help="Recompute footprints even if a cached copy exists.")
+            parser.add_option("--manual", action="callback", callback=man,
+                              help="Read the manual.")
+            (options, args) = parser.parse_args()
+
+            if not args:
+                parser.error("Need at least one input cube")
+
+        except optparse.OptionError, msg:
+            raise Usage(msg)
+
+        # Print the footprint bounding box of each cube
+        footprints = []
+        for cubePath in args:
+            footprint = getCubeFootprint(cubePath, options.step, options.workDir, options.force)
+            footprints.append(footprint)
+            bbox = getFootprintBoundingBox(footprint, options.buffer)
+            print cubePath
+            print '  Min lat = %.6f' % bbox[0]
+            print '  Max lat = %.6f' % bbox[1]
+            print '  Min lon = %.6f' % bbox[2]
+            print '  Max lon = %.6f' % bbox[3]
+            print '  Area    = %.1f km^2' % (getPolygonArea(footprint) / 1.0e6)
+
+        # Print the overlap between each pair of cubes
+        for i in range(len(args)):
+            for j in range(i+1, len(args)):
+                overlap = getFootprintIntersection(footprints[i], footprints[j])
+                print ('Overlap of %s and %s = %.1f km^2' %
+                       (args[i], args[j], getPolygonArea(overlap) / 1.0e6))
+
+        return 0
+
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -21,6 +21,9 @@
 #include <iTime.h>
 #include <vw/Math/EulerAngles.h>
 
+#include <algorithm>
+#include <limits>
+
 using namespace vw;
 
 
@@ -31,114 +34,429 @@ IsisInterfaceLineScanRot::IsisInterfaceLineScanRot(const std::string &filename )
   m_distortmap = m_camera->DistortionMap();
   m_focalmap   = m_camera->FocalPlaneMap();
   m_detectmap  = m_camera->DetectorMap();
+
+  m_focal_length = m_camera->FocalLength(); // Constant for the camera
+}
+
+boost::mutex& IsisInterfaceLineScanRot::spice_mutex() {
+  static boost::mutex mutex;
+  return mutex;
+}
+
+void IsisInterfaceLineScanRot::share_state_table( IsisInterfaceLineScanRot const& other ) {
+  other.build_state_table();
+  m_state_table = other.m_state_table;
+}
+
+/// Number of extra state table entries before the first line and after the last line
+const int STATE_TABLE_PAD_LINES = 100;
+
+/// Spherical linear interpolation between two rotations
+Quat slerpRotation( Quat const& a, Quat const& b, double alpha ) {
+  double cosTheta = a.w()*b.w() + a.x()*b.x() + a.y()*b.y() + a.z()*b.z();
+  double sign = 1.0;
+  if (cosTheta < 0) { // Take the short way around
+    cosTheta = -cosTheta;
+    sign     = -1.0;
+  }
+  double weightA = 1.0 - alpha;
+  double weightB = alpha;
+  if (cosTheta < 0.9999) { // Linear interpolation is fine for very close rotations
+    const double theta    = acos(cosTheta);
+    const double sinTheta = sin(theta);
+    weightA = sin((1.0 - alpha)*theta) / sinTheta;
+    weightB = sin(alpha*theta)         / sinTheta;
+  }
+  weightB *= sign;
+  Quat result( weightA*a.w() + weightB*b.w(), weightA*a.x() + weightB*b.x(),
+               weightA*a.y() + weightB*b.y(), weightA*a.z() + weightB*b.z() );
+  return normalize(result);
+}
+
+// Record the camera position and rotations once per line so that the projection
+//  solver does not need to go through SPICE for every step.
+void IsisInterfaceLineScanRot::build_state_table() const {
+  if (m_state_table)
+    return;
+
+  boost::mutex::scoped_lock lock(spice_mutex());
+  boost::shared_ptr<StateTable> table(new StateTable());
+  table->et_start = 0;
+  table->et_step  = 0;
+  table->has_focal_model   = false;
+  table->radial_distortion = false;
+  table->distortion_k1     = 0;
+
+  // The camera time is about to change so the SetTime cache is no longer valid
+  m_c_location = Vector2(-1,-1);
+
+  // The table spacing is the time between lines
+  m_detectmap->SetParent( 1, m_alphacube.AlphaLine(1) );
+  const double firstEt = m_camera->time().Et();
+  m_detectmap->SetParent( 1, m_alphacube.AlphaLine(lines()) );
+  const double lastEt = m_camera->time().Et();
+  m_spice_call_count += 2;
+  if ((lines() < 2) || (lastEt == firstEt)) {
+    m_state_table = table; // Leave the table empty, all lookups will go to SPICE
+    return;
+  }
+  table->et_step  = (lastEt - firstEt) / (lines() - 1);
+  table->et_start = firstEt - STATE_TABLE_PAD_LINES*table->et_step;
+
+  const int numEntries = lines() + 2*STATE_TABLE_PAD_LINES;
+  table->positions.resize     (numEntries);
+  table->inst_rotations.resize(numEntries);
+  table->body_rotations.resize(numEntries);
+  for (int i=0; i<numEntries; ++i) {
+    m_camera->setTime(Isis::iTime( table->et_start + i*table->et_step ));
+
+    m_camera->instrumentPosition(&(table->positions[i][0]));
+    table->positions[i] *= 1000; // Convert from km to meters
+
+    std::vector<double> rot_inst = m_camera->instrumentRotation()->Matrix();
+    std::vector<double> rot_body = m_camera->bodyRotation()->Matrix();
+    table->inst_rotations[i] = Quat(Matrix3x3(&(rot_inst[0])));
+    table->body_rotations[i] = Quat(Matrix3x3(&(rot_body[0])));
+    m_spice_call_count += 4;
+  }
+
+  // The detector does not move in the focal plane so the middle line is as good as any
+  if (samples() > 1) {
+    table->sample_looks.resize(samples());
+    std::vector<Vector2> distorted(samples()), undistorted(samples());
+    for (int s=0; s<samples(); ++s) {
+      m_detectmap->SetParent( m_alphacube.AlphaSample(s+1),
+                              m_alphacube.AlphaLine(lines()/2) );
+      m_focalmap->SetDetector( m_detectmap->DetectorSample(),
+                               m_detectmap->DetectorLine() );
+      m_distortmap->SetFocalPlane( m_focalmap->FocalPlaneX(),
+                                   m_focalmap->FocalPlaneY() );
+      table->sample_looks[s] = Vector3(m_distortmap->UndistortedFocalPlaneX(),
+                                       m_distortmap->UndistortedFocalPlaneY(),
+                                       m_distortmap->UndistortedFocalPlaneZ());
+      distorted  [s] = Vector2(m_focalmap->FocalPlaneX(), m_focalmap->FocalPlaneY());
+      undistorted[s] = Vector2(table->sample_looks[s][0], table->sample_looks[s][1]);
+      ++m_spice_call_count;
+    }
+    fit_focal_plane_model(*table, distorted, undistorted);
+  }
+  m_state_table = table;
+}
+
+// The LRO NAC distortion is a one term polynomial, undistorted = distorted / (1 + k1*r^2).  Depending on
+//  the ISIS version r is the full radius or only the y coordinate, which is along the detector.  The model
+//  that reproduces the ISIS map along the whole detector is used, if neither does the projection partials
+//  fall back to differences of the ISIS maps.
+// - The focal plane and detector maps after the distortion are affine, so their partials are constant.
+void IsisInterfaceLineScanRot::fit_focal_plane_model( StateTable &table, std::vector<Vector2> const& distorted,
+                                                      std::vector<Vector2> const& undistorted ) const {
+  const double MODEL_TOLERANCE = 1.0e-9; // Millimeters
+  const double AFFINE_STEP     = 0.1;    // Millimeters, any step is exact for an affine map
+
+  // The coefficient is best determined at the end of the detector farthest from the center
+  size_t far = 0;
+  for (size_t i=1; i<distorted.size(); ++i)
+    if (fabs(distorted[i][1]) > fabs(distorted[far][1]))
+      far = i;
+  if ((distorted[far][1] == 0) || (undistorted[far][1] == 0))
+    return;
+
+  for (int radial=0; radial<2; ++radial) {
+    const double r2 = radial ? norm_2_sqr(distorted[far]) : distorted[far][1]*distorted[far][1];
+    const double k1 = (distorted[far][1] / undistorted[far][1] - 1.0) / r2;
+    bool matches = true;
+    for (size_t i=0; matches && (i<distorted.size()); ++i) {
+      Vector2 const& d = distorted[i];
+      const double den = 1.0 + k1*(radial ? norm_2_sqr(d) : d[1]*d[1]);
+      const Vector2 modeled(radial ? d[0]/den : d[0], d[1]/den);
+      matches = (norm_2(modeled - undistorted[i]) < MODEL_TOLERANCE);
+    }
+    if (matches) {
+      table.has_focal_model   = true;
+      table.radial_distortion = (radial == 1);
+      table.distortion_k1     = k1;
+      break;
+    }
+  }
+  if (!table.has_focal_model)
+    return;
+
+  // Partials of the affine maps from the distorted focal plane, the line comes from the table timing
+  Vector2 const& center = distorted[distorted.size()/2];
+  Vector3 values[3];
+  for (int i=0; i<3; ++i) {
+    Vector2 d = center;
+    if (i > 0)
+      d[i-1] += AFFINE_STEP;
+    m_focalmap->SetFocalPlane( d[0], d[1] );
+    m_detectmap->SetDetector( m_focalmap->DetectorSample(), m_focalmap->DetectorLine() );
+    values[i] = Vector3(m_alphacube.BetaSample( m_detectmap->ParentSample() ), 0,
+                        m_focalmap->DetectorLineOffset() - m_focalmap->DetectorLine());
+  }
+  select_col(table.projection_distorted_partials, 0) = (values[1] - values[0]) / AFFINE_STEP;
+  select_col(table.projection_distorted_partials, 1) = (values[2] - values[0]) / AFFINE_STEP;
+  m_c_location = Vector2(-1,-1); // The maps moved
+}
+
+Matrix<double,3,2> IsisInterfaceLineScanRot::focal_plane_partials() const {
+  StateTable const& table = *m_state_table;
+
+  // Jacobian of the undistorted location with respect to the distorted one
+  const double dx = m_distortmap->FocalPlaneX();
+  const double dy = m_distortmap->FocalPlaneY();
+  const double k1 = table.distortion_k1;
+  Matrix2x2 undistorted_partials;
+  if (table.radial_distortion) {
+    const double den = 1.0 + k1*(dx*dx + dy*dy);
+    undistorted_partials(0,0) = 1.0/den - 2*k1*dx*dx/(den*den);
+    undistorted_partials(0,1) =         - 2*k1*dx*dy/(den*den);
+    undistorted_partials(1,0) =         - 2*k1*dy*dx/(den*den);
+    undistorted_partials(1,1) = 1.0/den - 2*k1*dy*dy/(den*den);
+  } else {
+    const double den = 1.0 + k1*dy*dy;
+    undistorted_partials(0,0) = 1;
+    undistorted_partials(0,1) = 0;
+    undistorted_partials(1,0) = 0;
+    undistorted_partials(1,1) = (1.0 - k1*dy*dy)/(den*den);
+  }
+
+  // The distorted location is the inverse map, so its partials are the inverse matrix
+  return table.projection_distorted_partials * inverse(undistorted_partials);
+}
+
+void IsisInterfaceLineScanRot::get_state_at_time( double et, Vector3 &position,
+                                                  Matrix3x3 &R_inst, Matrix3x3 &R_body ) const {
+  build_state_table();
+  StateTable const& table = *m_state_table;
+
+  // Use SPICE if the time is not inside the table (need one entry on each side for the tangents)
+  const double index = table.positions.empty() ? -1 : (et - table.et_start) / table.et_step;
+  const int    i1    = static_cast<int>(floor(index));
+  if ((i1 < 1) || (i1+2 >= static_cast<int>(table.positions.size()))) {
+    boost::mutex::scoped_lock lock(spice_mutex());
+    m_camera->setTime(Isis::iTime(et));
+    m_camera->instrumentPosition(&position[0]);
+    position *= 1000; // Convert from km to meters
+    std::vector<double> rot_inst = m_camera->instrumentRotation()->Matrix();
+    std::vector<double> rot_body = m_camera->bodyRotation()->Matrix();
+    R_inst = Matrix3x3(&(rot_inst[0]));
+    R_body = Matrix3x3(&(rot_body[0]));
+    m_spice_call_count += 4;
+    return;
+  }
+  const double alpha = index - i1;
+
+  // Cubic Hermite interpolation of the position with central difference tangents
+  Vector3 const& p0 = table.positions[i1-1];
+  Vector3 const& p1 = table.positions[i1  ];
+  Vector3 const& p2 = table.positions[i1+1];
+  Vector3 const& p3 = table.positions[i1+2];
+  const double a2 = alpha*alpha;
+  const double a3 = a2*alpha;
+  position = ( 2*a3 - 3*a2 + 1)*p1 + (a3 - 2*a2 + alpha)*0.5*(p2 - p0) +
+             (-2*a3 + 3*a2    )*p2 + (a3 - a2          )*0.5*(p3 - p1);
+
+  // The rotations change slowly so spherical linear interpolation is enough
+  R_inst = slerpRotation(table.inst_rotations[i1], table.inst_rotations[i1+1], alpha).rotation_matrix();
+  R_body = slerpRotation(table.body_rotations[i1], table.body_rotations[i1+1], alpha).rotation_matrix();
 }
 
 // Custom Function to help avoid over invoking the deeply buried
 // functions of Isis::Sensor
+// - Once the state table is built everything comes from the table, so SPICE is not needed.
 void IsisInterfaceLineScanRot::SetTime( Vector2 const& px, bool calc ) const {
-  if ( px != m_c_location ) {
-    m_c_location = px;
-    m_detectmap->SetParent( m_alphacube.AlphaSample(px[0]),
-                            m_alphacube.AlphaLine(px[1]) );
+  if ( px == m_c_location )
+    return;
 
+  build_state_table();
+  StateTable const& table = *m_state_table;
+  if ( !table.positions.empty() && !table.sample_looks.empty() ) {
+    m_c_location = px;
+    m_look       = sample_look( px[0] );
     if ( calc ) {
-      // Calculating Spacecraft position and pose
-      m_camera->instrumentPosition(&m_center[0]); // Get the instrument position from ISIS (in km)
-      m_center *= 1000; // Convert from km to meters
-
-      // Generate a pose in body-centered coordinates
-      std::vector<double> rot_inst = m_camera->instrumentRotation()->Matrix();
-      std::vector<double> rot_body = m_camera->bodyRotation()->Matrix();
-      MatrixProxy<double,3,3> R_inst(&(rot_inst[0])); // SC   from J2000
-      MatrixProxy<double,3,3> R_body(&(rot_body[0])); // Body from J2000
+      Matrix3x3 R_inst, R_body;
+      get_state_at_time( line_to_time(px[1]), m_center, R_inst, R_body );
       m_pose = Quat(R_body*transpose(R_inst)); // Get Body from SC
-      
-      //std::cout << "pixel  = " << px << std::endl;
-      //std::cout << "ET     = " << m_camera->time().Et() << std::endl;
-      //std::cout << "R_inst = " << R_inst << std::endl;
-      //std::cout << "R_body = " << R_body << std::endl;   
-      //std::cout << "m_pose = " << m_pose.rotation_matrix() << std::endl; 
     }
+    return;
   }
-}
 
+  boost::mutex::scoped_lock lock(spice_mutex());
+  m_c_location = px;
+  m_detectmap->SetParent( m_alphacube.AlphaSample(px[0]),
+                          m_alphacube.AlphaLine(px[1]) );
+  ++m_spice_call_count;
+  m_focalmap->SetDetector( m_detectmap->DetectorSample(),
+                           m_detectmap->DetectorLine() );
+  m_distortmap->SetFocalPlane( m_focalmap->FocalPlaneX(),
+                               m_focalmap->FocalPlaneY() );
+  m_look = Vector3(m_distortmap->UndistortedFocalPlaneX(),
+                   m_distortmap->UndistortedFocalPlaneY(),
+                   m_distortmap->UndistortedFocalPlaneZ());
+
+  if ( calc ) {
+    // Calculating Spacecraft position and pose
+    m_camera->instrumentPosition(&m_center[0]); // Get the instrument position from ISIS (in km)
+    m_center *= 1000; // Convert from km to meters
+
+    // Generate a pose in body-centered coordinates
+    std::vector<double> rot_inst = m_camera->instrumentRotation()->Matrix();
+    std::vector<double> rot_body = m_camera->bodyRotation()->Matrix();
+    MatrixProxy<double,3,3> R_inst(&(rot_inst[0])); // SC   from J2000
+    MatrixProxy<double,3,3> R_body(&(rot_body[0])); // Body from J2000
+    m_pose = Quat(R_body*transpose(R_inst)); // Get Body from SC
+    m_spice_call_count += 3;
+  }
+}
 
-/// Helper class for computing the projection line
-class EphemerisLMA : public vw::math::LeastSquaresModelBase<EphemerisLMA> {
-  vw::Vector3 m_point;
-  Isis::Camera* m_camera;
-  Isis::CameraDistortionMap *m_distortmap;
-  Isis::CameraFocalPlaneMap *m_focalmap;
-public:
-  typedef vw::Vector<double> result_type; // Back project result
-  typedef vw::Vector<double> domain_type; // Ephemeris time
-  typedef vw::Matrix<double> jacobian_type;
+void IsisInterfaceLineScanRot::cache_pixel( Vector2 const& px ) const {
+  m_c_location = px;
+  m_look = Vector3(m_distortmap->UndistortedFocalPlaneX(),
+                   m_distortmap->UndistortedFocalPlaneY(),
+                   m_distortmap->UndistortedFocalPlaneZ());
+}
 
-  inline EphemerisLMA( vw::Vector3 const& point,
-                       Isis::Camera* camera,
-                       Isis::CameraDistortionMap* distortmap,
-                       Isis::CameraFocalPlaneMap* focalmap ) 
-                        : m_point(point), m_camera(camera), m_distortmap(distortmap), m_focalmap(focalmap) {}
+/// Linear interpolation between the sample look vectors, the distortion is smooth
+Vector3 IsisInterfaceLineScanRot::sample_look( double sample ) const {
+  std::vector<Vector3> const& looks = m_state_table->sample_looks;
+  const int i0 = std::min(std::max(static_cast<int>(floor(sample)) - 1, 0),
+                          static_cast<int>(looks.size()) - 2);
+  const double alpha = sample - 1 - i0;
+  return looks[i0] + alpha*(looks[i0+1] - looks[i0]);
+}
 
-  inline result_type operator()( domain_type const& x ) const;
-};
 
+/// Returns the ephemeris time at the center of a (one-based) cube line
+double
+IsisInterfaceLineScanRot::line_to_time( double line ) const {
+  build_state_table();
+  StateTable const& table = *m_state_table;
+  if (table.positions.empty()) { // Ask ISIS if the table could not be built
+    boost::mutex::scoped_lock lock(spice_mutex());
+    m_c_location = Vector2(-1,-1); // The camera time changes
+    m_detectmap->SetParent( 1, m_alphacube.AlphaLine(line) );
+    ++m_spice_call_count;
+    return m_camera->time().Et();
+  }
+  return table.et_start + (line - 1 + STATE_TABLE_PAD_LINES)*table.et_step;
+}
 
-// LMA for projecting point to linescan camera
-EphemerisLMA::result_type
-EphemerisLMA::operator()( EphemerisLMA::domain_type const& x ) const {
+/// Returns the detector line offset of a point seen at the given time, in pixels.
+/// - This is zero at the time the point is imaged.
+double
+IsisInterfaceLineScanRot::line_residual( Vector3 const& point, Matrix3x3 const& R_offset, double et ) const {
 
-  // Setting Ephemeris Time
-  m_camera->setTime(Isis::iTime(x[0]));
+  ++m_time_solve_iteration_count;
 
-  // Calculating the look direction in camera frame
+  // Get the camera state at this Ephemeris Time (interpolated, in meters)
   Vector3 instru;
-  m_camera->instrumentPosition(&instru[0]);
-  instru *= 1000;  // Spice gives in km
-  Vector3 lookB = normalize( m_point - instru );
-  std::vector<double> lookB_copy(3);
-  std::copy( lookB.begin(), lookB.end(), lookB_copy.begin() );
-  std::vector<double> lookJ = m_camera->bodyRotation()->J2000Vector(lookB_copy);
-  std::vector<double> lookC = m_camera->instrumentRotation()->ReferenceVector(lookJ);
-  Vector3 look;
-  std::copy( lookC.begin(), lookC.end(), look.begin() );
+  Matrix3x3 R_inst, R_body;
+  get_state_at_time(et, instru, R_inst, R_body);
+
+  // Body -> J2000 -> camera, then the extra rotation: R_offset = instrument(good)_from_instrument
+  Vector3 look = R_offset*R_inst*transpose(R_body)*(point - instru);
 
   // Projecting to mm focal plane
-  look = m_camera->FocalLength() * (look / look[2]);
+  look = m_focal_length * (look / look[2]);
   m_distortmap->SetUndistortedFocalPlane(look[0], look[1]);
   m_focalmap->SetFocalPlane( m_distortmap->FocalPlaneX(),
                              m_distortmap->FocalPlaneY() );
-  result_type result(1);
   // Not exactly sure about lineoffset .. but ISIS does it
-  result[0] = m_focalmap->DetectorLineOffset() - m_focalmap->DetectorLine();
+  return m_focalmap->DetectorLineOffset() - m_focalmap->DetectorLine();
+}
 
-  return result;
+/// Finds the time at which the line residual is zero using the secant method.
+/// - Steps are limited to the time range of the cube (plus the state table padding) and
+///   fall back to bisection once the root has been bracketed.
+/// - Returns false if the residual did not get below the tolerance.
+bool
+IsisInterfaceLineScanRot::solve_line_time( Vector3 const& point, Matrix3x3 const& R_offset,
+                                           double start_e, double &solution_e ) const {
+  const double LINE_TOLERANCE = 1.0e-5; // Pixels
+  const int    MAX_ITERATIONS = 30;
+
+  // Allowed time range, the table covers all of the cube lines
+  build_state_table();
+  StateTable const& table = *m_state_table;
+  double lineTime = table.et_step;
+  double minEt    = -std::numeric_limits<double>::max();
+  double maxEt    =  std::numeric_limits<double>::max();
+  if (!table.positions.empty()) {
+    const double tableEndEt = table.et_start + (table.positions.size()-1)*table.et_step;
+    minEt = std::min(table.et_start, tableEndEt);
+    maxEt = std::max(table.et_start, tableEndEt);
+  }
+  else
+    lineTime = line_to_time(2) - line_to_time(1);
+
+  // The first two points are the guess and one line later
+  double et0 = start_e;
+  double r0  = line_residual(point, R_offset, et0);
+  solution_e = et0;
+  if (fabs(r0) < LINE_TOLERANCE)
+    return true;
+  double et1 = std::min(maxEt, std::max(minEt, et0 + lineTime));
+  double r1  = line_residual(point, R_offset, et1);
+
+  bool   bracketed = false;
+  double bracketA = 0, bracketB = 0, residualA = 0;
+  for (int i=0; i<MAX_ITERATIONS; ++i) {
+    solution_e = et1;
+    if (fabs(r1) < LINE_TOLERANCE)
+      return true;
+
+    // Keep track of an interval that contains the root
+    if (!bracketed && (r0*r1 < 0)) {
+      bracketed = true;
+      bracketA  = et0;
+      residualA = r0;
+      bracketB  = et1;
+    }
+
+    // Secant step, bisect if it leaves the bracket
+    double next = (r1 != r0) ? et1 - r1*(et1 - et0)/(r1 - r0) : et1 + lineTime;
+    if (bracketed && ((next <= std::min(bracketA, bracketB)) || (next >= std::max(bracketA, bracketB))))
+      next = 0.5*(bracketA + bracketB);
+    next = std::min(maxEt, std::max(minEt, next));
+    if (next == et1) // Stuck against the edge of the time range
+      break;
+
+    et0 = et1;
+    r0  = r1;
+    et1 = next;
+    r1  = line_residual(point, R_offset, et1);
+
+    if (bracketed) { // Shrink the bracket
+      if (r1*residualA > 0) {
+        bracketA  = et1;
+        residualA = r1;
+      }
+      else
+        bracketB = et1;
+    }
+  }
+  std::cout << "Line time solver stopped with a residual of " << r1 << " pixels" << std::endl;
+  return false;
 }
 
 Vector2
 IsisInterfaceLineScanRot::point_to_pixel( Vector3 const& point ) const {
 
-  // First seed LMA with an ephemeris time in the middle of the image
-  double middle = lines() / 2;
-  m_detectmap->SetParent( 1, m_alphacube.AlphaLine(middle) );
-  double start_e = m_camera->time().Et();
-
-  // Build LMA
-  EphemerisLMA model( point, m_camera.get(), m_distortmap, m_focalmap );
-  int status;
-  Vector<double> objective(1), start(1);
-  start[0] = start_e;
-  Vector<double> solution_e = math::levenberg_marquardt( model,
-                                                         start,
-                                                         objective,
-                                                         status );
+  // Solve for the time starting in the middle of the image
+  Matrix3x3 noRotation;
+  noRotation.set_identity();
+  double solution_e;
+  bool   solved = solve_line_time( point, noRotation, line_to_time(lines() / 2), solution_e );
 
   // Make sure we found ideal time
-  VW_ASSERT( status > 0,
+  VW_ASSERT( solved,
              MathErr() << " Unable to project point into linescan camera " );
 
   // Converting now to pixel
-  m_camera->setTime(Isis::iTime( solution_e[0] ));
+  boost::mutex::scoped_lock lock(spice_mutex());
+  ++m_projection_count;
+  m_camera->setTime(Isis::iTime( solution_e ));
+  m_spice_call_count += 4; // Time, position and the two rotations
 
   // Working out pointing
   m_camera->instrumentPosition(&m_center[0]);
@@ -156,7 +474,7 @@ IsisInterfaceLineScanRot::point_to_pixel( Vector3 const& point ) const {
   look = inverse(m_pose).rotate( look ); 
   
   // Now that the look vector is in camera coordinates, project it to a pixel
-  look = m_camera->FocalLength() * ( look / look[2] );
+  look = m_focal_length * ( look / look[2] );
   m_distortmap->SetUndistortedFocalPlane( look[0], look[1] );
   m_focalmap->SetFocalPlane( m_distortmap->FocalPlaneX(),
                              m_distortmap->FocalPlaneY() );
@@ -166,133 +484,54 @@ IsisInterfaceLineScanRot::point_to_pixel( Vector3 const& point ) const {
                  m_detectmap->ParentLine() );
   pixel[0] = m_alphacube.BetaSample( pixel[0] );
   pixel[1] = m_alphacube.BetaLine( pixel[1] );
-  SetTime( pixel, false );
+  cache_pixel( pixel ); // The camera is already at this pixel
 
   pixel -= Vector2(1,1); // Convert from one-based to zero-based pixels
   return pixel;
 }
 
 
+/// Solves for the ephemeris time at which the rotated camera sees the point
+double
+IsisInterfaceLineScanRot::solve_projection_time( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine,
+                                                 double *guessTime) const
+{
 
-/// Helper class for computing the projection line - With added rotation argument!
-class EphemerisLMA_rot : public vw::math::LeastSquaresModelBase<EphemerisLMA_rot> {
-  vw::Vector3 m_point;
-  Isis::Camera* m_camera;
-  Isis::CameraDistortionMap *m_distortmap;
-  Isis::CameraFocalPlaneMap *m_focalmap;
-  vw::Vector3 m_rotation;
-public:
-  typedef vw::Vector<double> result_type; // Back project result
-  typedef vw::Vector<double> domain_type; // Ephemeris time
-  typedef vw::Matrix<double> jacobian_type;
-
-  inline EphemerisLMA_rot( vw::Vector3 const& point, vw::Vector3 const& rotation,
-                       Isis::Camera* camera,
-                       Isis::CameraDistortionMap* distortmap,
-                       Isis::CameraFocalPlaneMap* focalmap ) 
-                        : m_point(point), m_camera(camera), m_distortmap(distortmap), 
-                          m_focalmap(focalmap), m_rotation(rotation) 
-                          //m_rotation(rotation[0], rotation[1], 0) // Only use certain rotations
-                          {
-                          }
-
-  inline result_type operator()( domain_type const& x ) const;
-};
-
-
-// LMA for projecting point to linescan camera
-EphemerisLMA_rot::result_type
-EphemerisLMA_rot::operator()( EphemerisLMA::domain_type const& x ) const {
-
-  // Setting Ephemeris Time
-  m_camera->setTime(Isis::iTime(x[0]));
-
-  // Calculating the look direction in camera frame
-  Vector3 instru;
-  m_camera->instrumentPosition(&instru[0]);
-  instru *= 1000;  // Spice gives in km, convert to meters
-  
-  Vector3 lookB = normalize( m_point - instru ); // Point to camera vector in body coordinate frame
-  std::vector<double> lookB_copy(3);
-  std::copy( lookB.begin(), lookB.end(), lookB_copy.begin() );
-  
-  std::vector<double> lookJ = m_camera->bodyRotation()->J2000Vector(lookB_copy); // Get body look vector in J2000 (Earth) frame
-  std::vector<double> lookC = m_camera->instrumentRotation()->ReferenceVector(lookJ); // Get J2000 look vector in camera frame
-  
-  // Convert vector format
-  Vector3 lookI;
-  std::copy( lookC.begin(), lookC.end(), lookI.begin() );
+  // First guess is the middle of the image
+  double middle = lines() / 2;
+  if (guessLine >= 0) // Use the input line as a guess if it was passed in
+    middle = guessLine;
+  // The time from the previous solve is a better guess than any line
+  const double start_e = (guessTime && (*guessTime != 0)) ? *guessTime : line_to_time(middle);
 
-  //std::cout << "lookI = " << lookI << std::endl;
-  
-  // Apply extra rotation to the look vector (equal to the one in the function below)
   // R_offset = instrument(good)_from_instrument
-  vw::math::Matrix<double,3,3> R_offset = vw::math::euler_to_rotation_matrix(m_rotation[0], m_rotation[1], m_rotation[2], "xyz");
-  Vector3 look = R_offset * lookI;
-  
-  //std::cout << "look = " << look << std::endl;
-  
-  // Projecting to mm focal plane
-  look = m_camera->FocalLength() * (look / look[2]);
-  m_distortmap->SetUndistortedFocalPlane(look[0], look[1]);
-  m_focalmap->SetFocalPlane( m_distortmap->FocalPlaneX(),
-                             m_distortmap->FocalPlaneY() );
-  result_type result(1);
-  // Not exactly sure about lineoffset .. but ISIS does it
-  result[0] = m_focalmap->DetectorLineOffset() - m_focalmap->DetectorLine();
+  vw::math::Matrix<double,3,3> R_offset = vw::math::euler_to_rotation_matrix(rotAngles[0], rotAngles[1], rotAngles[2], "xyz");
 
-  //std::cout << result << " ";
-  return result;
-}
+  double solution_e;
+  if (!solve_line_time(point, R_offset, start_e, solution_e))
+    std::cout << "Warning: Solver failed to find a solution!" << std::endl;
+  else if (guessTime)
+    *guessTime = solution_e;
 
+  return solution_e;
+}
 
 
 /// Hack function to insert an additional camera rotation into this function 
 Vector2
-IsisInterfaceLineScanRot::point_to_pixel_rotated( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine) const
+IsisInterfaceLineScanRot::point_to_pixel_rotated( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine,
+                                                  double *guessTime) const
 {
-
-  // First seed LMA with an ephemeris time in the middle of the image
-  double middle = lines() / 2;
-  if (guessLine >= 0) // Use the input line as a guess if it was passed in
-    middle = guessLine;
-  m_detectmap->SetParent( 1, m_alphacube.AlphaLine(middle) );
-  double start_e = m_camera->time().Et();
-
-  // Build LMA
-  EphemerisLMA_rot model( point, rotAngles, m_camera.get(), m_distortmap, m_focalmap );
-  int status;
-  Vector<double> objective(1), start(1);
-  start[0] = start_e;
-  Vector<double> solution_e = math::levenberg_marquardt( model,
-                                                         start,
-                                                         objective,
-                                                         status );
-  // Make sure we found ideal time
-  if (status < 0)
-  {
-    //std::cout << "status = " << status << std::endl;
-    //std::cout << "start_e   = " << start_e   << " solution = " << solution_e[0]        << std::endl;
-    std::cout << "objective = " << objective << " result = "   << model(solution_e) << std::endl;
-    std::cout << "Warning: Solver failed to find a solution!" << std::endl;
-  }
-  //VW_ASSERT( status >= 0,
-  //           MathErr() << "Unable to project point into linescan camera , status = " << status );
+  const double solution_e = solve_projection_time(point, rotAngles, guessLine, guessTime);
 
   // Converting now to pixel
-  m_camera->setTime(Isis::iTime( solution_e[0] ));
+  ++m_projection_count;
 
   // Working out pointing
-  m_camera->instrumentPosition(&m_center[0]); // Get camera position in GCC coordinates
-  m_center *= 1000; // Convert to meters
+  Matrix3x3 R_inst, R_body; // Rotations of spacecraft/instrument and of the planet relative to J2000
+  get_state_at_time(solution_e, m_center, R_inst, R_body); // Camera position in GCC coordinates
   Vector3 look = normalize(point-m_center); // Vector from point to camera in GCC coordinates
 
-  // Calculating Rotation to camera frame
-  std::vector<double> rot_inst = m_camera->instrumentRotation()->Matrix();
-  std::vector<double> rot_body = m_camera->bodyRotation()->Matrix();
-  MatrixProxy<double,3,3> R_inst(&(rot_inst[0])); // Rotation of spacecraft/instrument relative to J2000
-  MatrixProxy<double,3,3> R_body(&(rot_body[0])); // Rotation of planet relative to J2000 (earth-centered) frame
-
   //double rad2deg = 180/M_PI;
   
   
@@ -307,26 +546,180 @@ IsisInterfaceLineScanRot::point_to_pixel_rotated( vw::Vector3 const& point, vw::
   look = inverse(m_pose).rotate( look ); 
   
   // Now that look vector is in camera coordinates, project to a pixel.
-  look = m_camera->FocalLength() * ( look / look[2] );
-  m_distortmap->SetUndistortedFocalPlane( look[0], look[1] );
+  look = m_focal_length * ( look / look[2] );
+  Vector3 projection = focal_plane_to_pixel( look[0], look[1], solution_e );
+  Vector2 pixel( projection[0], projection[1] );
+  cache_pixel( pixel ); // The maps are left at this pixel
+
+  pixel -= Vector2(1,1); // Convert back to zero-based indexing (ISIS uses one-based indexing)
+  return pixel;
+}
+
+
+/// Returns the vector to the point in instrument coordinates at the given time
+Vector3
+IsisInterfaceLineScanRot::instrument_look( vw::Vector3 const& point, double et, Matrix3x3 &R_look ) const
+{
+  Matrix3x3 R_inst, R_body; // Rotations of spacecraft/instrument and of the planet relative to J2000
+  get_state_at_time(et, m_center, R_inst, R_body); // Camera position in GCC coordinates
+  R_look = R_inst*transpose(R_body); // Instrument_from_Body
+
+  // The look vector does not need to be normalized, it is divided by its Z component later.
+  return R_look*(point - m_center);
+}
+
+/// Maps an undistorted focal plane location to [sample, line, detector line residual] at the given time
+/// - The sample and line are one-based like the ISIS functions.
+/// - The line comes from the state table timing if there is one, so SPICE is not needed.
+Vector3
+IsisInterfaceLineScanRot::focal_plane_to_pixel( double x, double y, double et ) const
+{
+  build_state_table();
+  StateTable const& table = *m_state_table;
+
+  m_distortmap->SetUndistortedFocalPlane( x, y );
   m_focalmap->SetFocalPlane( m_distortmap->FocalPlaneX(),
                              m_distortmap->FocalPlaneY() );
+  // Same residual the time solver drives to zero
+  const double lineResidual = m_focalmap->DetectorLineOffset() - m_focalmap->DetectorLine();
+  if (!table.positions.empty()) { // The lines are evenly spaced in time
+    m_detectmap->SetDetector( m_focalmap->DetectorSample(),
+                              m_focalmap->DetectorLine() );
+    return Vector3(m_alphacube.BetaSample( m_detectmap->ParentSample() ),
+                   (et - table.et_start) / table.et_step - STATE_TABLE_PAD_LINES + 1,
+                   lineResidual);
+  }
+
+  // Otherwise the detector map finds the line from the camera time
+  boost::mutex::scoped_lock lock(spice_mutex());
+  m_camera->setTime(Isis::iTime( et ));
+  ++m_spice_call_count;
   m_detectmap->SetDetector( m_focalmap->DetectorSample(),
                             m_focalmap->DetectorLine() );
-  Vector2 pixel( m_detectmap->ParentSample(),
-                 m_detectmap->ParentLine() );
-  pixel[0] = m_alphacube.BetaSample( pixel[0] );
-  pixel[1] = m_alphacube.BetaLine( pixel[1] );
-  SetTime( pixel, false );
+  return Vector3(m_alphacube.BetaSample( m_detectmap->ParentSample() ),
+                 m_alphacube.BetaLine  ( m_detectmap->ParentLine()   ),
+                 lineResidual);
+}
+
+/// Projection with partial derivatives.
+/// - The iterative time solve is done once.  The derivatives with respect to the point and the
+///   angles are found at the solved time and then corrected for the change in the solved time
+///   using the implicit function theorem on the detector line residual.
+/// - The euler angle matrix and the focal plane maps are differentiated in closed form.  The only finite
+///   difference is the time step (one more state table lookup).  Without a state table, or if the
+///   distortion does not match the closed form model, the focal plane maps are differenced instead.
+Vector2
+IsisInterfaceLineScanRot::point_to_pixel_rotated_partials( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine,
+                                                           vw::Matrix<double,2,3> &pixel_point_partials,
+                                                           vw::Matrix<double,2,3> &pixel_angle_partials,
+                                                           double *guessTime ) const
+{
+  const double TIME_STEP        = 1.0e-5; // Seconds, a small fraction of one line
+  const double FOCAL_PLANE_STEP = 1.0e-4; // Millimeters, a small fraction of one pixel
+
+  const double solution_e  = solve_projection_time(point, rotAngles, guessLine, guessTime);
+  const double focalLength = m_focal_length;
+
+  // Get the offset rotation and its derivative with respect to each of the angles
+  vw::math::Matrix<double,3,3> R_offset = vw::math::euler_to_rotation_matrix(rotAngles[0], rotAngles[1], rotAngles[2], "xyz");
+  vw::math::Matrix<double,3,3> R_offset_partials[3];
+  euler_xyz_partials(rotAngles, R_offset_partials);
+
+  // Project with everything but the time held constant to get the time derivative
+  Matrix3x3 R_look;
+  ++m_projection_count;
+  Vector3 look = R_offset*instrument_look(point, solution_e + TIME_STEP, R_look);
+  Vector3 laterProjection = focal_plane_to_pixel(focalLength*look[0]/look[2], focalLength*look[1]/look[2],
+                                                 solution_e + TIME_STEP);
+
+  // Now project at the solved time
+  Vector3 instLook = instrument_look(point, solution_e, R_look);
+  look = R_offset*instLook;
+  Vector2 focal(focalLength*look[0]/look[2], focalLength*look[1]/look[2]);
+
+  // Derivative of the ISIS distortion and detector maps with respect to the focal plane location
+  Matrix<double,3,2> projection_focal_partials;
+  Vector3 projection;
+  if (m_state_table->has_focal_model && !m_state_table->positions.empty()) {
+    projection = focal_plane_to_pixel(focal[0], focal[1], solution_e);
+    projection_focal_partials = focal_plane_partials();
+  } else {
+    Vector3 projectionX = focal_plane_to_pixel(focal[0] + FOCAL_PLANE_STEP, focal[1], solution_e);
+    Vector3 projectionY = focal_plane_to_pixel(focal[0], focal[1] + FOCAL_PLANE_STEP, solution_e);
+    projection = focal_plane_to_pixel(focal[0], focal[1], solution_e); // Called last to leave the maps at this point
+    select_col(projection_focal_partials, 0) = (projectionX - projection) / FOCAL_PLANE_STEP;
+    select_col(projection_focal_partials, 1) = (projectionY - projection) / FOCAL_PLANE_STEP;
+  }
+  Vector3 projection_time_partials = (laterProjection - projection) / TIME_STEP;
+
+  // Analytic derivative of the pinhole projection onto the focal plane
+  Matrix<double,2,3> focal_look_partials;
+  focal_look_partials(0,0) = focalLength/look[2];
+  focal_look_partials(0,1) = 0;
+  focal_look_partials(0,2) = -focalLength*look[0]/(look[2]*look[2]);
+  focal_look_partials(1,0) = 0;
+  focal_look_partials(1,1) = focalLength/look[2];
+  focal_look_partials(1,2) = -focalLength*look[1]/(look[2]*look[2]);
+
+  Matrix3x3 look_point_partials = R_offset*R_look;
+  Matrix3x3 look_angle_partials;
+  for (int i=0; i<3; ++i)
+    select_col(look_angle_partials, i) = R_offset_partials[i]*instLook;
+
+  Matrix<double,3,3> projection_point_partials = projection_focal_partials*focal_look_partials*look_point_partials;
+  Matrix<double,3,3> projection_angle_partials = projection_focal_partials*focal_look_partials*look_angle_partials;
+
+  // The time solve holds the line residual (row 2) at zero, so dTime = -dResidual / (dResidual/dTime).
+  const double residual_time_partial = projection_time_partials[2];
+  for (int r=0; r<2; ++r)
+  {
+    for (int c=0; c<3; ++c)
+    {
+      pixel_point_partials(r,c) = projection_point_partials(r,c);
+      pixel_angle_partials(r,c) = projection_angle_partials(r,c);
+      if (residual_time_partial != 0)
+      {
+        pixel_point_partials(r,c) -= projection_time_partials[r]*projection_point_partials(2,c)/residual_time_partial;
+        pixel_angle_partials(r,c) -= projection_time_partials[r]*projection_angle_partials(2,c)/residual_time_partial;
+      }
+    }
+  }
+
+  // Leave the camera in the same state point_to_pixel_rotated does
+  m_pose = Quat(transpose(R_offset*R_look)); // Body_from_CorrectedInstrument
+  Vector2 pixel(projection[0], projection[1]);
+  cache_pixel( pixel ); // The maps are left at this pixel
 
   pixel -= Vector2(1,1); // Convert back to zero-based indexing (ISIS uses one-based indexing)
   return pixel;
 }
 
+void
+IsisInterfaceLineScanRot::tabulate_geometry( std::vector<Vector3> &positions, std::vector<Quat> &look_rotations,
+                                             std::vector<Vector3> &sample_looks ) const
+{
+  positions.resize     (lines());
+  look_rotations.resize(lines());
+  Matrix3x3 R_inst, R_body;
+  for (int i=0; i<lines(); ++i) {
+    get_state_at_time(line_to_time(i+1), positions[i], R_inst, R_body);
+    look_rotations[i] = Quat(R_inst*transpose(R_body)); // Instrument_from_Body
+  }
+
+  // The detector does not move in the focal plane so the middle line is as good as any
+  sample_looks.resize(samples());
+  for (int s=0; s<samples(); ++s) {
+    SetTime( Vector2(s+1, lines()/2), false );
+    sample_looks[s] = m_look;
+  }
+}
+
 bool 
 IsisInterfaceLineScanRot::getMatricesAtTime(const double et, Matrix3x3 &R_inst, Matrix3x3 &R_body)
 {
   // Converting now to pixel
+  boost::mutex::scoped_lock lock(spice_mutex());
+  m_c_location = Vector2(-1,-1); // The camera time changes
   m_camera->setTime(Isis::iTime(et));
 
   // Calculating Rotation to camera frame
@@ -334,6 +727,7 @@ IsisInterfaceLineScanRot::getMatricesAtTime(const double et, Matrix3x3 &R_inst,
   std::vector<double> rot_body = m_camera->bodyRotation()->Matrix();
   R_inst = Matrix3x3(&(rot_inst[0])); // Rotation of spacecraft and instrument relative to J2000
   R_body = Matrix3x3(&(rot_body[0])); // Rotation of planet relative to J2000 (earth-centered) frame
+  m_spice_call_count += 3;
   return true;
 } 
   
@@ -345,15 +739,7 @@ IsisInterfaceLineScanRot::pixel_to_vector( Vector2 const& pix ) const {
   SetTime( px, true );
 
   // Projecting to get look direction
-  Vector3 result;
-  m_focalmap->SetDetector( m_detectmap->DetectorSample(),
-                           m_detectmap->DetectorLine() );
-  m_distortmap->SetFocalPlane( m_focalmap->FocalPlaneX(),
-                               m_focalmap->FocalPlaneY() );
-  result[0] = m_distortmap->UndistortedFocalPlaneX();
-  result[1] = m_distortmap->UndistortedFocalPlaneY();
-  result[2] = m_distortmap->UndistortedFocalPlaneZ();
-  result = normalize( result );
+  Vector3 result = normalize( m_look );
   result = m_pose.rotate(result);
   
   return result;
@@ -28,14 +28,19 @@
 #include <vw/Camera/CameraModel.h>
 #include <asp/IsisIO/IsisInterface.h>
 
+#include <solverCamera.h>
+
 // Isis
 #include <CameraDetectorMap.h>
 #include <CameraDistortionMap.h>
 #include <CameraFocalPlaneMap.h>
 #include <AlphaCube.h>
 
+#include <boost/shared_ptr.hpp>
+#include <boost/thread/mutex.hpp>
+
 
-  class IsisInterfaceLineScanRot : public asp::isis::IsisInterface, public vw::camera::CameraModel {
+  class IsisInterfaceLineScanRot : public asp::isis::IsisInterface, public SolverLineScanCamera {
 
   public:
     IsisInterfaceLineScanRot(const std::string &file );
@@ -58,12 +63,45 @@
       camera_pose( vw::Vector2 const& pix = vw::Vector2(1,1) ) const;
 
     /// Additional function to apply an in-camera rotation during this operation
-    vw::Vector2
-      point_to_pixel_rotated( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine=-1) const;
+    /// - If guessTime is provided and not zero it is used as the starting time instead of guessLine.
+    ///   The solved time is written back to it.
+    virtual vw::Vector2
+      point_to_pixel_rotated( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine=-1,
+                              double *guessTime=0) const;
+
+    /// Same as point_to_pixel_rotated, but also computes the partial derivatives of the
+    /// pixel with respect to the point and with respect to the rotation angles.
+    virtual vw::Vector2
+      point_to_pixel_rotated_partials( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine,
+                                       vw::Matrix<double,2,3> &pixel_point_partials,
+                                       vw::Matrix<double,2,3> &pixel_angle_partials,
+                                       double *guessTime=0 ) const;
 
     /// Returns the instrument and body matrices at the given time
     bool getMatricesAtTime(const double et, vw::Matrix3x3 &R_inst, vw::Matrix3x3 &R_body);
 
+    /// Returns the instrument position (meters) and the instrument and body rotations at the given time
+    /// - Interpolated from per-line tables, SPICE is only used outside the range of the image.
+    void get_state_at_time( double et, vw::Vector3 &position, vw::Matrix3x3 &R_inst, vw::Matrix3x3 &R_body ) const;
+
+    /// Builds the per-line camera state table now instead of on first use.
+    /// - Do this before the camera is used from worker threads so that they do not need SPICE.
+    virtual void prepare_state_table() const { build_state_table(); }
+
+    /// Uses the state table of another camera model of the same cube instead of building one
+    /// - Builds the table in the other model if needed.  Tables are not changed once they are built.
+    void share_state_table( IsisInterfaceLineScanRot const& other );
+
+    /// Held by every call that goes through ISIS to SPICE, which is not thread safe
+    static boost::mutex& spice_mutex();
+
+    /// Tabulates the camera geometry so it can be used without ISIS
+    /// - positions and look_rotations have an entry for each cube line: the instrument position in meters
+    ///   and the Instrument_from_Body rotation at the center of the line.
+    /// - sample_looks has an entry for each cube sample: the undistorted focal plane look vector.
+    void tabulate_geometry( std::vector<vw::Vector3> &positions, std::vector<vw::Quat> &look_rotations,
+                            std::vector<vw::Vector3> &sample_looks ) const;
+
   protected:
 
     // Custom Variables
@@ -71,6 +109,7 @@
     Isis::CameraFocalPlaneMap *m_focalmap;
     Isis::CameraDetectorMap   *m_detectmap;
     mutable Isis::AlphaCube   m_alphacube; // Doesn't use const
+    double m_focal_length;
 
   private:
 
@@ -78,8 +117,65 @@
     mutable vw::Vector2 m_c_location;
     mutable vw::Vector3 m_center;
     mutable vw::Quat m_pose;
+    mutable vw::Vector3 m_look; // Undistorted focal plane look vector at m_c_location
     void SetTime( vw::Vector2 const& px,
                   bool calc=false ) const;
+
+    /// Records that the ISIS maps were left at this (one-based) pixel, so SetTime( px, false ) is not needed
+    void cache_pixel( vw::Vector2 const& px ) const;
+
+    /// Returns the undistorted focal plane look vector of a (one-based) sample from the state table
+    vw::Vector3 sample_look( double sample ) const;
+
+    /// Camera state with one entry per image line
+    struct StateTable {
+      double et_start;
+      double et_step;
+      std::vector<vw::Vector3> positions; // Empty if the table could not be built
+      std::vector<vw::Quat>    inst_rotations;
+      std::vector<vw::Quat>    body_rotations;
+      std::vector<vw::Vector3> sample_looks;   // Undistorted focal plane look vector for each cube sample
+
+      // Closed form of the focal plane maps, used for the projection partials
+      bool   has_focal_model;           // False if the distortion did not match either model
+      bool   radial_distortion;         // True if x and y are both distorted, otherwise only y is
+      double distortion_k1;             // Undistorted = distorted / (1 + k1*r^2)
+      vw::Matrix<double,3,2> projection_distorted_partials; // [sample, line, line residual] from distorted x, y
+    };
+
+    // Built on first use, possibly shared with other models of the same cube
+    mutable boost::shared_ptr<const StateTable> m_state_table;
+    void build_state_table() const;
+
+    /// Fits the closed form focal plane model of the table to pairs of distorted and undistorted
+    ///  focal plane locations along the detector, the SPICE lock must be held.
+    void fit_focal_plane_model( StateTable &table, std::vector<vw::Vector2> const& distorted,
+                                std::vector<vw::Vector2> const& undistorted ) const;
+
+    /// Returns the partials of [sample, line, line residual] with respect to the undistorted focal
+    ///  plane location, from the closed form model.  The maps must be at that location.
+    vw::Matrix<double,3,2> focal_plane_partials() const;
+
+    /// Returns the ephemeris time at the center of a (one-based) cube line
+    double line_to_time( double line ) const;
+
+    /// Returns the detector line offset in pixels of a point seen at the given time
+    double line_residual( vw::Vector3 const& point, vw::Matrix3x3 const& R_offset, double et ) const;
+
+    /// Finds the time at which the line residual is zero, returns false if it fails
+    bool solve_line_time( vw::Vector3 const& point, vw::Matrix3x3 const& R_offset,
+                          double start_e, double &solution_e ) const;
+
+    /// Solves for the ephemeris time at which the rotated camera sees the point
+    double solve_projection_time( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine,
+                                  double *guessTime ) const;
+
+    /// Returns the vector to the point in instrument coordinates at the given time
+    /// - Also updates m_center and returns the Instrument_from_Body rotation.
+    vw::Vector3 instrument_look( vw::Vector3 const& point, double et, vw::Matrix3x3 &R_look ) const;
+
+    /// Maps an undistorted focal plane location to [sample, line, detector line residual] at the given time
+    vw::Vector3 focal_plane_to_pixel( double x, double y, double et ) const;
   };
 
 
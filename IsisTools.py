@@ -402,14 +402,15 @@ def getCubeElevationEstimate(cubePath, workDir=''):
 
     DEFAULT_MOON_RADIUS = 1737400 # In meters
 
-    # TODO: Get these values from the file!
-    sample = 2500
-    line   = 25000
-
     # Make sure the input file exists
     if not os.path.exists(cubePath):
         raise Exception('Cube file ' + cubePath + ' not found!')
 
+    # Sample the center pixel of the cube
+    numSamples, numLines = getCubeSize(cubePath)
+    sample = (numSamples + 1) / 2
+    line   = (numLines   + 1) / 2
+
     # Default working directory is the cubePath folder
     outputFolder = workDir
     if workDir == '':
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+import sys
+
+import os, optparse, struct
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Reads binary pixel pair files written by pixelPairsFromStereo.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+#--------------------------------------------------------------------------------
+
+# Must match PixelPairFileHeader in pixelPairFile.h
+PIXEL_PAIR_MAGIC         = 'PIXPAIRS'
+PIXEL_PAIR_HEADER_FORMAT = '<8sIIQQiiii464s'
+PIXEL_PAIR_HEADER_SIZE   = struct.calcsize(PIXEL_PAIR_HEADER_FORMAT) # 512
+PIXEL_PAIR_RECORD_FORMAT = '<4f'
+PIXEL_PAIR_RECORD_SIZE   = struct.calcsize(PIXEL_PAIR_RECORD_FORMAT)
+
+
+def isPixelPairFile(path):
+    """Returns True if the file is a binary pixel pair file rather than CSV"""
+    f = open(path, 'rb')
+    magic = f.read(len(PIXEL_PAIR_MAGIC))
+    f.close()
+    return magic == PIXEL_PAIR_MAGIC
+
+
+def readPixelPairHeader(path):
+    """Returns the header of a binary pixel pair file as a dictionary"""
+    f = open(path, 'rb')
+    data = f.read(PIXEL_PAIR_HEADER_SIZE)
+    f.close()
+    if len(data) < PIXEL_PAIR_HEADER_SIZE:
+        raise Exception('Pixel pair file ' + path + ' is too short to contain a header')
+
+    (magic, version, headerSize, numPairs, numSampled,
+     pointSpacing, imageCols, imageRows, reserved, sourcePath) = struct.unpack(PIXEL_PAIR_HEADER_FORMAT, data)
+    if magic != PIXEL_PAIR_MAGIC:
+        raise Exception('File ' + path + ' is not a binary pixel pair file')
+
+    return {'version'      : version,
+            'headerSize'   : headerSize,
+            'numPairs'     : numPairs,
+            'numSampled'   : numSampled,
+            'pointSpacing' : pointSpacing,
+            'imageCols'    : imageCols,
+            'imageRows'    : imageRows,
+            'sourcePath'   : sourcePath.split('\0')[0]}
+
+
+def getPixelPairCount(path):
+    """Returns the number of pairs in a binary or CSV pixel pair file"""
+    if isPixelPairFile(path):
+        return readPixelPairHeader(path)['numPairs']
+
+    numLines = 0
+    for line in open(path, 'r'):
+        if line.strip():
+            numLines = numLines + 1
+    return numLines
+
+
+def readPixelPairs(path):
+    """Yields [sample1, line1, sample2, line2] for each pair in a binary or CSV pixel pair file"""
+    if not isPixelPairFile(path):
+        for line in open(path, 'r'):
+            strings = line.split(',')
+            if len(strings) >= 4:
+                yield [float(s) for s in strings[0:4]]
+        return
+
+    header = readPixelPairHeader(path)
+    f = open(path, 'rb')
+    f.seek(header['headerSize'])
+    for i in range(header['numPairs']):
+        yield list(struct.unpack(PIXEL_PAIR_RECORD_FORMAT, f.read(PIXEL_PAIR_RECORD_SIZE)))
+    f.close()
+
+
+def exportPixelPairsCsv(inputPath, outputPath):
+    """Writes any pixel pair file out in the text format: sample1,line1,sample2,line2"""
+    outputFile = open(outputPath, 'w')
+    for pair in readPixelPairs(inputPath):
+        outputFile.write('%f,%f,%f,%f\n' % tuple(pair))
+    outputFile.close()
+
+
+#--------------------------------------------------------------------------------
+
+def main():
+
+    try:
+        try:
+            usage = "usage: PixelPairTools.py <input path> [--csv <output path>][--manual]\n  "
+            parser = optparse.OptionParser(usage=usage)
+            parser.add_option("--csv", dest="csvPath", default="",
+                              help="Export the pairs to this CSV file.")
+            parser.add_option("--manual", action="callback", callback=man,
+                              help="Read the manual.")
+            (options, args) = parser.parse_args()
+
+            if not args:
+                parser.error("need input path")
+
+        except optparse.OptionError, msg:
+            raise Usage(msg)
+
+        inputPath = args[0]
+        if isPixelPairFile(inputPath):
+            header = readPixelPairHeader(inputPath)
+            for key in sorted(header.keys()):
+                print key + ' = ' + str(header[key])
+        else:
+            print 'numPairs = ' + str(getPixelPairCount(inputPath))
+
+        if options.csvPath:
+            exportPixelPairsCsv(inputPath, options.csvPath)
+
+        return 0
+
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
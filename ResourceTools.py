@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+import sys
+
+import os, glob, optparse, re, shutil, subprocess, string, time, logging, multiprocessing
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Chooses parallel_stereo process, thread and tile settings to fit the current node.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+#--------------------------------------------------------------------------------
+
+# Number of threads each parallel_stereo process is given when there are enough cores
+THREADS_PER_PROCESS = 4
+
+# Approximate memory used by one stereo_corr process, in gigabytes
+MEMORY_PER_PROCESS_GB = 4.0
+
+# Names of processes that count as concurrently running stereo stages
+STEREO_PROCESS_NAMES = ['parallel_stereo']
+
+
+def _readFirstLine(path):
+    """Returns the stripped first line of a file or an empty string if it can't be read"""
+    try:
+        f = open(path, 'r')
+        line = f.readline().strip()
+        f.close()
+        return line
+    except IOError:
+        return ''
+
+
+def getCgroupCpuLimit():
+    """Returns the number of cores allowed by the cgroup CPU quota, or None if there is no quota"""
+
+    # cgroup v2 stores "quota period" in a single file
+    line = _readFirstLine('/sys/fs/cgroup/cpu.max')
+    if line:
+        strings = line.split()
+        if (len(strings) == 2) and (strings[0] != 'max'):
+            return float(strings[0]) / float(strings[1])
+        return None
+
+    # cgroup v1 uses two files and a negative quota for no limit
+    quota  = _readFirstLine('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = _readFirstLine('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and (int(quota) > 0):
+        return float(quota) / float(period)
+    return None
+
+
+def getCgroupMemoryLimit():
+    """Returns the cgroup memory limit in bytes, or None if there is no limit"""
+    for path in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        line = _readFirstLine(path)
+        if line and (line != 'max'):
+            limit = int(line)
+            if limit < (1 << 60): # v1 reports a huge number when there is no limit
+                return limit
+    return None
+
+
+def getPhysicalMemory():
+    """Returns the total memory of the node in bytes"""
+    for line in open('/proc/meminfo', 'r'):
+        if line.find('MemTotal') >= 0:
+            return int(line.split()[1]) * 1024 # Value is in kB
+    raise Exception('Unable to find MemTotal in /proc/meminfo')
+
+
+def getNodeResources():
+    """Returns [numCores, memoryGb] available to this process after cgroup limits"""
+
+    numCores = multiprocessing.cpu_count()
+    cpuLimit = getCgroupCpuLimit()
+    if cpuLimit:
+        numCores = min(numCores, max(1, int(cpuLimit)))
+
+    memory      = getPhysicalMemory()
+    memoryLimit = getCgroupMemoryLimit()
+    if memoryLimit:
+        memory = min(memory, memoryLimit)
+
+    return [numCores, memory / float(1024**3)]
+
+
+def _readCmdline(pid):
+    """Returns the command line arguments of a process, empty if it can't be read"""
+    return [arg for arg in _readFirstLine('/proc/' + str(pid) + '/cmdline').split('\0') if arg]
+
+
+def _getParentPid(pid):
+    """Returns the parent process id of a process, or None if it can't be read"""
+    # The command name in parentheses may contain spaces, the fields after it are fixed
+    line = _readFirstLine('/proc/' + str(pid) + '/stat')
+    strings = line[line.rfind(')')+1:].split()
+    if len(strings) < 2:
+        return None
+    return int(strings[1])
+
+
+def _isStereoCommand(cmdline):
+    """Returns True if a command line runs one of the stereo programs, directly or through an interpreter"""
+    if not cmdline:
+        return False
+    if os.path.basename(cmdline[0]) in STEREO_PROCESS_NAMES:
+        return True
+    return (len(cmdline) > 1) and (os.path.basename(cmdline[1]) in STEREO_PROCESS_NAMES)
+
+
+def countRunningStereoJobs():
+    """Returns the number of stereo stages currently running on this node.
+       - parallel_stereo starts per-tile parallel_stereo workers, only the top level invocations are counted.
+    """
+    count = 0
+    for procPath in glob.glob('/proc/[0-9]*'):
+        pid     = os.path.basename(procPath)
+        cmdline = _readCmdline(pid)
+        if (not _isStereoCommand(cmdline)) or ('--tile-id' in cmdline):
+            continue
+        parentPid = _getParentPid(pid)
+        if parentPid and _isStereoCommand(_readCmdline(parentPid)):
+            continue
+        count = count + 1
+    return count
+
+
+def planParallelStereoResources(numConcurrentStages=1):
+    """Chooses parallel_stereo settings for the share of this node given to one stage.
+       - numConcurrentStages is the total number of stereo stages expected to share the node, including
+         this one and any that are already running.  Use it for stages that are started together and
+         can't see each other yet.
+       - Stereo stages already running on the node are counted, the node is split between the larger
+         of the two counts so stages that were announced and are also running are not counted twice.
+       - Returns a dictionary with processes, threadsMultiprocess, threadsSingleprocess and tileSize.
+    """
+
+    numCores, memoryGb = getNodeResources()
+    numStages = max(max(1, numConcurrentStages), countRunningStereoJobs() + 1)
+
+    # Split the node evenly between all the stages
+    stageCores  = max(1,   numCores / numStages)
+    stageMemory = max(1.0, memoryGb / numStages)
+
+    # Use as many processes as both the cores and the memory allow
+    threadsPerProcess = min(THREADS_PER_PROCESS, stageCores)
+    numProcesses      = max(1, min(stageCores / threadsPerProcess,
+                                   int(stageMemory / MEMORY_PER_PROCESS_GB)))
+
+    # Larger tiles have less overhead but need more memory per process
+    memoryPerProcess = stageMemory / numProcesses
+    if memoryPerProcess >= 4 * MEMORY_PER_PROCESS_GB:
+        tileSize = 4096
+    elif memoryPerProcess >= MEMORY_PER_PROCESS_GB:
+        tileSize = 2048
+    else:
+        tileSize = 1024
+
+    plan = {'processes'            : numProcesses,
+            'threadsMultiprocess'  : threadsPerProcess,
+            'threadsSingleprocess' : stageCores,
+            'tileSize'             : tileSize}
+
+    message = ('parallel_stereo plan: %d cores, %.1f GB, %d stages -> ' % (numCores, memoryGb, numStages) +
+               '%(processes)d processes, %(threadsMultiprocess)d threads per process, ' % plan +
+               '%(threadsSingleprocess)d single process threads, %(tileSize)d pixel tiles' % plan)
+    print message
+    logging.info(message)
+
+    return plan
+
+
+def getParallelStereoResourceOptions(numConcurrentStages=1):
+    """Returns the parallel_stereo command line options for the current node"""
+    plan = planParallelStereoResources(numConcurrentStages)
+    return (' --processes '              + str(plan['processes']) +
+            ' --threads-multiprocess '   + str(plan['threadsMultiprocess']) +
+            ' --threads-singleprocess '  + str(plan['threadsSingleprocess']) +
+            ' --job-size-w '             + str(plan['tileSize']) +
+            ' --job-size-h '             + str(plan['tileSize']) + ' ')
+
+
+#--------------------------------------------------------------------------------
+
+def main():
+
+    try:
+        try:
+            usage = "usage: ResourceTools.py [--stages <count>][--manual]\n  "
+            parser = optparse.OptionParser(usage=usage)
+            parser.add_option("--stages", dest="stages", type="int", default=1,
+                              help="Total number of stereo stages expected to share this node, including this one.")
+            parser.add_option("--manual", action="callback", callback=man,
+                              help="Read the manual.")
+            (options, args) = parser.parse_args()
+
+        except optparse.OptionError, msg:
+            raise Usage(msg)
+
+        print getParallelStereoResourceOptions(options.stages)
+        return 0
+
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -22,6 +22,8 @@
 #include <boost/shared_ptr.hpp>
 #include <boost/serialization/shared_ptr.hpp> 
 
+#include <algorithm>
+#include <cmath>
 #include <list>
 #include <vector>
 #include <string>
@@ -57,6 +59,10 @@ struct Parameters : asp::BaseOptions
   std::vector<std::string>  kernelPaths;
   std::string  transformFile;
   int          transformType;
+  double       positionTolerance; ///< Maximum SPK interpolation error in meters
+  double       rotationTolerance; ///< Maximum CK interpolation error in microradians
+  double       minStep;           ///< Minimum seconds between kernel samples
+  double       maxStep;           ///< Maximum seconds between kernel samples
   
   bool debug;
   std::string sourceCubePath; // Used to obtain body position
@@ -73,7 +79,11 @@ bool handle_arguments(int argc, char* argv[], Parameters &opt)
     ("outputPrefix",  po::value(&outputPrefix)->default_value(""), "Output prefix")
     ("kernels", po::value<std::vector<std::string> >(&opt.kernelPaths)->multitoken(), "Paths to all required kernel files")
     ("transformFile", po::value<std::string>(&opt.transformFile)->default_value(""), "Path to 3x4 matrix containing transform to apply (pc_align-style)")
-    ("transformType", po::value<int>(&opt.transformType)->default_value(0), "Code to indicate how the transform is applied (0 = global, 1 = local = translation only!)");
+    ("transformType", po::value<int>(&opt.transformType)->default_value(0), "Code to indicate how the transform is applied (0 = global, 1 = local = translation only!)")
+    ("positionTolerance", po::value<double>(&opt.positionTolerance)->default_value(0.01), "Add SPK samples until interpolating the positions is within this many meters")
+    ("rotationTolerance", po::value<double>(&opt.rotationTolerance)->default_value(0.1), "Add CK samples until interpolating the orientations is within this many microradians")
+    ("minStep", po::value<double>(&opt.minStep)->default_value(0.001), "Minimum time in seconds between kernel samples")
+    ("maxStep", po::value<double>(&opt.maxStep)->default_value(10.0), "Maximum time in seconds between kernel samples, reduced to the record spacing of the source kernel");
     
 
   general_options.add( asp::BaseOptionsDescription(opt) );
@@ -100,6 +110,16 @@ bool handle_arguments(int argc, char* argv[], Parameters &opt)
   return true;
 }
 
+const SpiceInt    MOON_CODE           = 301;
+const SpiceInt    LRO_CLOCK_ID        = -85;
+const SpiceInt    LRO_SPACECRAFT_CODE = -85000; // Instrument ID code
+const std::string J2000_FRAME_STRING  = "J2000";
+const std::string MOON_FRAME_STRING   = "IAU_MOON";
+
+// mkspk needs (POLYNOM_DEGREE+1)/2 states for each type 13 window, use enough for two windows
+const int MIN_NUM_SAMPLES = 12;
+
+
 /// Loads a transform file from pc_align into a rotation and translation matrix
 bool loadThreeByFourTransform(const std::string &path, SpiceDouble R[][3], SpiceDouble *T)
 {
@@ -126,21 +146,388 @@ bool loadThreeByFourTransform(const std::string &path, SpiceDouble R[][3], Spice
 }
 
 
+/// Returns the smallest average time in seconds between the records of the kernel segments for a body
+///  that overlap a time span, or zero if no segment with a known layout covers it.
+/// - Only CK type 3 and SPK types 9 and 13 are read, these store the record count at the end of the segment.
+/// - CK segment times are in encoded spacecraft clock ticks, SPK segment times are ephemeris times.
+double findSourceRecordSpacing(const std::string &kernelPath, bool isCk, SpiceInt bodyId,
+                               SpiceDouble startEt, SpiceDouble stopEt)
+{
+  const SpiceInt ND = 2, NI = 6; // Summary sizes shared by CK and SPK files
+  SpiceInt handle;
+  dafopr_c(kernelPath.c_str(), &handle);
+  if (failed_c())
+    return 0;
+
+  double       spacing = 0;
+  SpiceBoolean found;
+  dafbfs_c(handle);
+  daffna_c(&found);
+  while (found && !failed_c())
+  {
+    SpiceDouble summary[5], dc[ND];
+    SpiceInt    ic[NI];
+    dafgs_c(summary);
+    dafus_c(summary, ND, NI, dc, ic);
+
+    const SpiceInt type = isCk ? ic[2] : ic[3];
+    SpiceDouble segmentStartEt = dc[0], segmentStopEt = dc[1];
+    if (isCk)
+    {
+      sct2e_c(LRO_CLOCK_ID, dc[0], &segmentStartEt);
+      sct2e_c(LRO_CLOCK_ID, dc[1], &segmentStopEt);
+    }
+    const bool knownType = isCk ? (type == 3) : ((type == 9) || (type == 13));
+    if ((ic[0] == bodyId) && knownType && (segmentStopEt > startEt) && (segmentStartEt < stopEt))
+    {
+      SpiceDouble numRecords;
+      dafgda_c(handle, ic[5], ic[5], &numRecords); // Last word of the segment
+      if (numRecords > 1)
+      {
+        const double segmentSpacing = (segmentStopEt - segmentStartEt) / (numRecords - 1);
+        if ((spacing == 0) || (segmentSpacing < spacing))
+          spacing = segmentSpacing;
+      }
+    }
+    daffna_c(&found);
+  }
+  dafcls_c(handle);
+  return failed_c() ? 0 : spacing;
+}
+
+/// Returns the maximum sample step to use for a span of a source kernel
+double limitMaxStep(const std::string &kernelPath, bool isCk, SpiceInt bodyId,
+                    SpiceDouble startEt, SpiceDouble stopEt, double maxStep)
+{
+  const double spacing = findSourceRecordSpacing(kernelPath, isCk, bodyId, startEt, stopEt);
+  if ((spacing > 0) && (spacing < maxStep))
+  {
+    printf("Limiting the maximum step to the source record spacing of %lf seconds\n", spacing);
+    return spacing;
+  }
+  if (spacing <= 0)
+    printf("Warning: Could not read the source record spacing, interpolation errors between the checked points are not bounded\n");
+  return maxStep;
+}
+
+
+//-------------------------------------------------------------------------------------------
+// Adaptive kernel sampling
+// - The output kernels interpolate between the samples we write, so samples are only added where
+//   interpolating between the neighboring samples misses the corrected source data by more than
+//   the tolerance.
+
+/// Chooses kernel sample times between two times so that interpolation stays within a tolerance.
+/// - SampleFuncT computes the sample at a time:  bool operator()(SpiceDouble et, SampleT &sample) const
+/// - ErrorFuncT returns the interpolation error at a fraction of the way between two samples:
+///     double operator()(const SampleT &a, const SampleT &b, const SampleT &actual,
+///                       double fraction, SpiceDouble step) const
+/// - The error is only checked at the quarter points and the middle of each interval, maxError is the
+///   largest error at these points and not a bound on the error between them.  Keep the maximum step no
+///   coarser than the records of the source kernel so that the checks see everything it contains.
+template <typename SampleT, typename SampleFuncT, typename ErrorFuncT>
+class AdaptiveSampler
+{
+public:
+
+  AdaptiveSampler(const SampleFuncT &sampleFunc, const ErrorFuncT &errorFunc,
+                  double tolerance, double minStep, double maxStep)
+    : _sampleFunc(sampleFunc), _errorFunc(errorFunc),
+      _tolerance(tolerance), _minStep(minStep), _maxStep(maxStep),
+      maxError(0), numUnresolved(0) {}
+
+  /// Samples from startEt to stopEt, returns false if a sample could not be computed
+  bool sample(SpiceDouble startEt, SpiceDouble stopEt)
+  {
+    times.clear();
+    samples.clear();
+    maxError      = 0;
+    numUnresolved = 0;
+
+    // Start from an even grid no coarser than the maximum step
+    const int numIntervals = std::max(MIN_NUM_SAMPLES-1, static_cast<int>(ceil((stopEt - startEt) / _maxStep)));
+    const SpiceDouble stepSize = (stopEt - startEt) / numIntervals;
+
+    SampleT first;
+    if (!_sampleFunc(startEt, first))
+      return false;
+    times.push_back(startEt);
+    samples.push_back(first);
+    for (int i=1; i<=numIntervals; ++i)
+    {
+      const SpiceDouble et = (i == numIntervals) ? stopEt : startEt + stepSize*i;
+      SampleT next, middle;
+      if (!_sampleFunc(et, next))
+        return false;
+      const SpiceDouble lastEt     = times.back();
+      const SampleT     lastSample = samples.back();
+      if (!_sampleFunc(0.5*(lastEt + et), middle))
+        return false;
+      if (!refine(lastEt, lastSample, et, next, middle))
+        return false;
+    }
+    return true;
+  }
+
+  std::vector<SpiceDouble> times;
+  std::vector<SampleT>     samples;
+  double maxError;      ///< Largest interpolation error at the checked points
+  size_t numUnresolved; ///< Number of intervals still above the tolerance at the minimum step
+
+private:
+
+  SampleFuncT _sampleFunc;
+  ErrorFuncT  _errorFunc;
+  double      _tolerance;
+  double      _minStep;
+  double      _maxStep;
+
+  /// Appends the samples after t0 up to and including t1, splitting the interval in half until
+  ///  it is accurate enough or too short to split.
+  /// - middle is the sample halfway between t0 and t1, the quarter point samples become the
+  ///   middle samples of the halves.
+  bool refine(SpiceDouble t0, const SampleT &s0, SpiceDouble t1, const SampleT &s1, const SampleT &middle)
+  {
+    const SpiceDouble middleEt = 0.5*(t0 + t1);
+    const SpiceDouble step     = t1 - t0;
+    SampleT firstQuarter, lastQuarter;
+    if (!_sampleFunc(t0 + 0.25*step, firstQuarter) || !_sampleFunc(t0 + 0.75*step, lastQuarter))
+      return false;
+
+    const double error = std::max(_errorFunc(s0, s1, middle, 0.5, step),
+                                  std::max(_errorFunc(s0, s1, firstQuarter, 0.25, step),
+                                           _errorFunc(s0, s1, lastQuarter,  0.75, step)));
+    if ((error > _tolerance) && (middleEt - t0 >= _minStep))
+      return refine(t0, s0, middleEt, middle, firstQuarter) && refine(middleEt, middle, t1, s1, lastQuarter);
+
+    maxError = std::max(maxError, error);
+    if (error > _tolerance)
+      ++numUnresolved;
+    times.push_back(t1);
+    samples.push_back(s1);
+    return true;
+  }
+};
+
+
+/// One line of the CK data file
+struct CkSample
+{
+  SpiceDouble spacecraftFixed_from_J2000_R[3][3];
+};
+
+/// One line of the SPK data file, position in km then velocity in km/sec
+struct SpkSample
+{
+  SpiceDouble state[6];
+};
+
+/// Computes the corrected spacecraft orientation at a time
+struct CkSampleFunction
+{
+  IsisInterfaceLineScanRot *sourceCube; ///< Used for the planet orientation between the cube times
+  double minSourceCubeEt;
+  double maxSourceCubeEt;
+  const SpiceDouble (*planetFixed_from_planet_R)[3];
+
+  bool operator()(SpiceDouble et, CkSample &sample) const
+  {
+    SpiceDouble  tol = 0; // Make sure we can do this 
+
+    // Convert ephemeris time to spacecraft clock time
+    SpiceDouble sclkdp;
+    sce2c_c(LRO_CLOCK_ID, et, &sclkdp);
+
+    // Try to get the spacecraft orientation at that time (spacecraft_from_J2000)
+    SpiceDouble  spacecraft_from_J2000_R[3][3];
+    SpiceDouble  clkout;
+    SpiceBoolean orientationFound;
+    ckgp_c(LRO_SPACECRAFT_CODE, sclkdp, tol, J2000_FRAME_STRING.c_str(), spacecraft_from_J2000_R, &clkout, &orientationFound);
+    if (!orientationFound)
+    {
+      printf("SpiceEditor Error: Failed to obtain spacecraft J2000 orientation data at et %lf!!!!!!!!!!!!!!!!\n", et);
+      return false;
+    }
+
+    // Try to get the planet orientation at that time (planet_from_J2000)
+    // - [this matrix] * [j2000 vector] = [moon vector]
+    SpiceDouble  planet_from_J2000_R[3][3];
+    if ((et >= minSourceCubeEt) && (et <= maxSourceCubeEt)) // If this time falls within the cube time
+    {
+      // Get the planet orientation from the source cube
+      // - For some reason this produces different results than going straight to the NAIF functions
+      vw::Matrix3x3 R_inst, R_body;
+      sourceCube->getMatricesAtTime(et, R_inst, R_body);
+      for (int r=0; r<3; ++r)
+      {
+        for (int c=0; c<3; ++c)
+        {
+          planet_from_J2000_R[r][c] = R_body[r][c];
+        }
+      }
+    }
+    else // Get the planet orientation from NAIF calls
+    {
+      pxform_c(J2000_FRAME_STRING.c_str(), MOON_FRAME_STRING.c_str(), et, planet_from_J2000_R);
+      if ( failed_c() )
+      {
+        printf("SpiceEditor Error: Failed to obtain planet J2000 orientation data at et %lf!!!!!!!!!!!!!!!!\n", et);
+        return false;
+      }
+    }
+
+    // Apply the transform
+    SpiceDouble spacecraft_from_Planet_R     [3][3];
+    SpiceDouble spacecraftFixed_from_Planet_R[3][3];
+    mxmt_c(planet_from_J2000_R,      spacecraft_from_J2000_R,      spacecraft_from_Planet_R);       // Convert to moon frame
+    mxm_c(planetFixed_from_planet_R,  spacecraft_from_Planet_R,     spacecraftFixed_from_Planet_R);  // Apply correction
+
+    // Convert back to J2000 frame
+    SpiceDouble temp_R[3][3];
+    mtxm_c(planet_from_J2000_R,      spacecraftFixed_from_Planet_R,  temp_R);
+    xpose_c(temp_R, sample.spacecraftFixed_from_J2000_R);
+    return true;
+  }
+};
+
+/// Computes the corrected spacecraft position at a time, the velocity is copied from the source kernel
+struct SpkSampleFunction
+{
+  SpiceInt           bodyId;
+  const char        *absCorr;
+  bool               localTransform;
+  const SpiceDouble *lronacOffset;              ///< Meters in the spacecraft frame, for local transforms
+  const SpiceDouble *planetFixed_from_planet_T; ///< Meters in the planet frame, for global transforms
+
+  bool operator()(SpiceDouble et, SpkSample &sample) const
+  {
+    // Retrieve the position of the spacecraft at this time
+    SpiceDouble state[6];
+    SpiceDouble lightTime;
+    spkez_c(bodyId,  et,  J2000_FRAME_STRING.c_str(), absCorr, MOON_CODE, state, &lightTime); // LRO relative to Moon in J2000 frame, units are kilometers and km/sec
+    if ( failed_c() )
+    {
+      printf("SpiceEditor Error: Failed to obtain SC J2000 position data at et %lf!!!!!!!!!!!!!!!!\n", et);
+      return false;
+    }
+
+    SpiceDouble tol = 0; // Make sure we can do this 
+
+    // Convert ephemeris time to spacecraft clock time
+    SpiceDouble sclkdp;
+    sce2c_c(LRO_CLOCK_ID, et, &sclkdp);
+
+    // Try to get the spacecraft orientation at that time (spacecraft_from_J2000)
+    SpiceDouble  spacecraft_from_J2000_R[3][3];
+    SpiceDouble  clkout;
+    SpiceBoolean orientationFound;
+    ckgp_c(LRO_SPACECRAFT_CODE, sclkdp, tol, J2000_FRAME_STRING.c_str(), spacecraft_from_J2000_R, &clkout, &orientationFound);
+    if (!orientationFound)
+    {
+      printf("SpiceEditor Error: Failed to obtain SC J2000 orientation data at et %lf!!!!!!!!!!!!!!!!\n", et);
+      return false;
+    }
+
+    // Try to get the planet orientation at that time (planet_from_J2000)
+    SpiceDouble  planet_from_J2000_R[3][3];
+    pxform_c(J2000_FRAME_STRING.c_str(), MOON_FRAME_STRING.c_str(), et, planet_from_J2000_R);
+    // This matrix converts J2000 orientations to LRO orientations at et
+    if ( failed_c() )
+    {
+      printf("SpiceEditor Error: Failed to obtain planet J2000 orientation data at et %lf!!!!!!!!!!!!!!!!\n", et);
+      return false;
+    }
+
+    if (localTransform) // Apply existing lronac position offset
+    {
+      // Convert the LRONAC offset from meters to kilometers
+      SpiceDouble lronacOffsetKm[3];
+      lronacOffsetKm[0] = lronacOffset[0] / 1000.0;
+      lronacOffsetKm[1] = lronacOffset[1] / 1000.0;
+      lronacOffsetKm[2] = lronacOffset[2] / 1000.0;
+      
+      SpiceDouble instOffset_J2000Frame[3];
+      // Now need to convert the LRONAC offset (spacecraft to frame) into J2000 coordinates
+      // - Multiply by the inverted rotation matrix to go from spacecraft frame to J2000 frame
+      mtxv_c(spacecraft_from_J2000_R, lronacOffsetKm, instOffset_J2000Frame);
+      for (int r=0; r<3; ++r) // Add the rotated offset to the original coordinate
+        sample.state[r] = state[r] + instOffset_J2000Frame[r]; // Adding km to km here
+    }
+    else // Apply global transform from file
+    {
+      // Convert the state into units of meters
+      SpiceDouble stateMeters[3]; // J2000 frame
+      for (int r=0; r<3; ++r)
+        stateMeters[r] = state[r]*1000;
+
+      // Apply the corrective planet-based transform to the vector currently represented in J2000 space
+      SpiceDouble stateMoon[3], stateMoonFixed[3], stateJ2000Fixed[3];
+      mxv_c(planet_from_J2000_R,       stateMeters, stateMoon);       // Convert to moon frame
+      for (int r=0; r<3; ++r) // Add in the translation
+        stateMoonFixed[r] = stateMoon[r] + planetFixed_from_planet_T[r]; // !AdjustedCameraModel applies transform about camera, not about the planet!
+      mtxv_c(planet_from_J2000_R, stateMoonFixed, stateJ2000Fixed); // Return to J2000 frame
+      for (int r=0; r<3; ++r) // Convert from meters back to kilometers
+        sample.state[r] = stateJ2000Fixed[r] / 1000.0;
+    } // End of global transform case
+
+    for (int r=3; r<6; ++r) // Write input velocity from offset
+      sample.state[r] = state[r];
+    return true;
+  }
+};
+
+/// Angle in microradians between the true orientation and the constant rate interpolation used by CK type 3
+struct CkInterpolationError
+{
+  double operator()(const CkSample &a, const CkSample &b, const CkSample &actual,
+                    double fraction, SpiceDouble step) const
+  {
+    // Rotate part of the way from a to b
+    SpiceDouble a_to_b_R[3][3], partial_R[3][3], interpolated_R[3][3], difference_R[3][3];
+    SpiceDouble axis[3], angle;
+    mtxm_c(a.spacecraftFixed_from_J2000_R, b.spacecraftFixed_from_J2000_R, a_to_b_R);
+    raxisa_c(a_to_b_R, axis, &angle);
+    axisar_c(axis, fraction*angle, partial_R);
+    mxm_c(a.spacecraftFixed_from_J2000_R, partial_R, interpolated_R);
+
+    mtxm_c(interpolated_R, actual.spacecraftFixed_from_J2000_R, difference_R);
+    raxisa_c(difference_R, axis, &angle);
+    return angle * 1.0e6;
+  }
+};
+
+/// Distance in meters between the true position and a cubic Hermite interpolation of the two states.
+/// - mkspk fits a degree 11 Hermite polynomial over six states which is at least as accurate.
+struct SpkInterpolationError
+{
+  double operator()(const SpkSample &a, const SpkSample &b, const SpkSample &actual,
+                    double fraction, SpiceDouble step) const
+  {
+    // Hermite basis functions
+    const double s  = fraction;
+    const double h00 =  2*s*s*s - 3*s*s + 1;
+    const double h10 =    s*s*s - 2*s*s + s;
+    const double h01 = -2*s*s*s + 3*s*s;
+    const double h11 =    s*s*s -   s*s;
+    double sumSquared = 0;
+    for (int r=0; r<3; ++r)
+    {
+      const double interpolated = h00*a.state[r] + h10*step*a.state[r+3]
+                                + h01*b.state[r] + h11*step*b.state[r+3];
+      sumSquared += (interpolated - actual.state[r])*(interpolated - actual.state[r]);
+    }
+    return sqrt(sumSquared) * 1000.0; // Kilometers to meters
+  }
+};
+
+//-------------------------------------------------------------------------------------------
+
+
 bool editSpiceFile(const Parameters &params)  
 {
-  const SpiceInt    MOON_CODE           = 301;
-  const SpiceInt    LRO_CLOCK_ID        = -85;
-  const SpiceInt    LRO_SPACECRAFT_CODE = -85000; // Instrument ID code
-  const std::string J2000_FRAME_STRING  = "J2000";
-  const std::string MOON_FRAME_STRING   = "IAU_MOON";
-  
   const std::string MOON_STRING         = "moon";
   const std::string EARTH_STRING        = "earth";
 
-  // Output kernel files have this many entries
-  // - Could definately do something better than hard-coding this number
-  const int NUM_STEPS = 5000; 
-  
   // Interpolation buffer in seconds added to each end of cube time
   const double CUBE_INTERP_ET_BUFFER = 100; 
   
@@ -409,7 +796,7 @@ bool editSpiceFile(const Parameters &params)
       if (localTransform)
         continue;
         
-      // Correct the rotation at even intervals
+      // Correct the rotation at adaptively chosen times
       SpiceDouble startEt = b+2; // Hack to avoid different start times
       SpiceDouble stopEt  = e-2;
 
@@ -431,126 +818,35 @@ bool editSpiceFile(const Parameters &params)
         
         //printf("startEt = %lf, stopEt = %lf\n", startEt, stopEt);
       }
-      SpiceDouble stepSize = (stopEt - startEt) / NUM_STEPS;
-    
+      CkSampleFunction ckSampleFunction;
+      ckSampleFunction.sourceCube                = sourceCubePtr.get();
+      ckSampleFunction.minSourceCubeEt           = minSourceCubeEt;
+      ckSampleFunction.maxSourceCubeEt           = maxSourceCubeEt;
+      ckSampleFunction.planetFixed_from_planet_R = planetFixed_from_planet_R;
+      AdaptiveSampler<CkSample, CkSampleFunction, CkInterpolationError>
+          ckSampler(ckSampleFunction, CkInterpolationError(), params.rotationTolerance, params.minStep,
+                    limitMaxStep(ckFile, true, bodyId, startEt, stopEt, params.maxStep));
+      if (!ckSampler.sample(startEt, stopEt))
+        return false;
+      printf("Sampled %lu CK orientations, maximum interpolation error at the checked points %lf microradians\n",
+             (unsigned long)ckSampler.times.size(), ckSampler.maxError);
+      if (ckSampler.numUnresolved > 0)
+        printf("Warning: %lu CK intervals exceed the rotation tolerance at the minimum step size\n",
+               (unsigned long)ckSampler.numUnresolved);
+
       std::ofstream outputFile;
       printf("Writing file %s\n", params.ckDataOutputPath.c_str());
       outputFile.open(params.ckDataOutputPath.c_str());
-
-      // For the number of specified steps
-      SpiceDouble lastEt;
-      for (int i=0; i<NUM_STEPS; ++i)
+      outputFile.precision(16);
+      for (size_t i=0; i<ckSampler.times.size(); ++i)
       {
-
-        SpiceDouble state[6];
-        SpiceDouble lightTime;
-        SpiceDouble et = startEt + stepSize*(SpiceDouble)i;
-        lastEt = et;
-
-        SpiceDouble  tol = 0; // Make sure we can do this 
-
-        // Convert ephemeris time to spacecraft clock time
-        SpiceDouble sclkdp;
-        sce2c_c(LRO_CLOCK_ID, et, &sclkdp);
-
-        // Try to get the spacecraft orientation at that time (spacecraft_from_J2000)
-        SpiceDouble  spacecraft_from_J2000_R[3][3];
-        SpiceDouble  clkout;
-        SpiceBoolean orientationFound;
-        ckgp_c(LRO_SPACECRAFT_CODE, sclkdp, tol, J2000_FRAME_STRING.c_str(), spacecraft_from_J2000_R, &clkout, &orientationFound);
-        if (!orientationFound)
-        {
-          printf("SpiceEditor Error: Failed to obtain spacecraft J2000 orientation data at et %lf!!!!!!!!!!!!!!!!\n", et);
-          return false;
-        }
-
-        // Try to get the planet orientation at that time (planet_from_J2000)
-        // - [this matrix] * [j2000 vector] = [moon vector]
-        SpiceDouble  planet_from_J2000_R[3][3];
-//        SpiceDouble  J2000_from_planet_R[3][3];
-        if ((et >= minSourceCubeEt) && (et <= maxSourceCubeEt)) // If this time falls within the cube time
-        {
-          // Get the planet orientation from the source cube
-          // - For some reason this produces different results than going straight to the NAIF functions
-          vw::Matrix3x3 R_inst, R_body;
-          sourceCubePtr->getMatricesAtTime(et, R_inst, R_body);
-          for (int r=0; r<3; ++r)
-          {
-            for (int c=0; c<3; ++c)
-            {
-              planet_from_J2000_R[r][c] = R_body[r][c];
-            }
-          }
-        }
-        else // Get the planet orientation from NAIF calls
-        {
-          pxform_c(J2000_FRAME_STRING.c_str(), MOON_FRAME_STRING.c_str(), et, planet_from_J2000_R);
-          if ( failed_c() )
-          {
-            printf("SpiceEditor Error: Failed to obtain planet J2000 orientation data at et %lf!!!!!!!!!!!!!!!!\n", et);
-            return false;
-          }
-        }
-
-
-        // Convert the planet transform to the correct coordinate space
-        SpiceDouble planetFixed_from_J2000_R[3][3];
-
-        // Have fixedPlanet_from_planet (or reverse), sc and planet from J2000
-
-//        // Convert correcting rotation and translation into J2000 frame from planet frame
-//        mxm_c(planetFixed_from_planet_R, planet_from_J2000_R, planetFixed_from_J2000_R);
-
-        // Apply the transform
-        SpiceDouble spacecraftFixed_from_J2000_R [3][3];
-        SpiceDouble spacecraft_from_Planet_R     [3][3];
-        SpiceDouble spacecraftFixed_from_Planet_R[3][3];
-        
-        
-        mxmt_c(planet_from_J2000_R,      spacecraft_from_J2000_R,      spacecraft_from_Planet_R);       // Convert to moon frame
-        
-        mxm_c(planetFixed_from_planet_R,  spacecraft_from_Planet_R,     spacecraftFixed_from_Planet_R);  // Apply correction
-        
-        // Convert back to J2000 frame
-        SpiceDouble temp_R[3][3];
-        mtxm_c(planet_from_J2000_R,      spacecraftFixed_from_Planet_R,  temp_R);
-        xpose_c(temp_R, spacecraftFixed_from_J2000_R);
-
-/*
-    printf("\nET = %lf, Old rotation matrix (SC in J2000)\n", et);
-    for (int q=0; q<3; ++q)
-    {
-      for (int s=0; s<3; ++s)
-        std::cout << " " << spacecraft_from_J2000_R[q][s]; // Write out the new rotation
-      //std::cout << std::endl;
-    }
-    printf("\nConversion rotation matrix (planet in J2000)\n");
-    for (int q=0; q<3; ++q)
-    {
-      for (int s=0; s<3; ++s)
-        std::cout << " " << planet_from_J2000_R[q][s]; // Write out the new rotation
-      //std::cout << std::endl;
-    }
-    printf("\nNew rotation matrix (fixed SC in J2000)\n");
-    for (int q=0; q<3; ++q)
-    {
-      for (int s=0; s<3; ++s)
-        std::cout << " " << spacecraftFixed_from_J2000_R[q][s]; // Write out the new rotation
-      //std::cout << std::endl;
-    }
-    std::cout << std::endl;
-*/
-    
-
         // Dump ET, new rotation... line to a text file
-        outputFile.precision(16);
-        outputFile << et;
+        outputFile << ckSampler.times[i];
         for (int q=0; q<3; ++q)
           for (int s=0; s<3; ++s)
-            outputFile << " " << spacecraftFixed_from_J2000_R[q][s]; // Write out the new rotation
+            outputFile << " " << ckSampler.samples[i].spacecraftFixed_from_J2000_R[q][s]; // Write out the new rotation
         outputFile << std::endl;
-      } // End of steps loop
-
+      }
       outputFile.close(); // Close read data file
 
     } // End of loop through intervals
@@ -594,7 +890,7 @@ bool editSpiceFile(const Parameters &params)
       printf("Stop:      %s\n", timeString);
 
       //printf("b = %lf, e = %lf\n", b, e); 
-      // Modify the position at even intervals
+      // Modify the position at adaptively chosen times
       SpiceDouble startEt = b+2; // Hack to avoid different start times
       SpiceDouble stopEt  = e-2;
 
@@ -616,118 +912,36 @@ bool editSpiceFile(const Parameters &params)
         
         //printf("startEt = %lf, stopEt = %lf\n", startEt, stopEt);
       }
-      SpiceDouble stepSize = (stopEt - startEt) / NUM_STEPS;
+      SpkSampleFunction spkSampleFunction;
+      spkSampleFunction.bodyId                    = bodyId;
+      spkSampleFunction.absCorr                   = absCorr.c_str();
+      spkSampleFunction.localTransform            = localTransform;
+      spkSampleFunction.lronacOffset              = lronacOffset;
+      spkSampleFunction.planetFixed_from_planet_T = planetFixed_from_planet_T;
+      AdaptiveSampler<SpkSample, SpkSampleFunction, SpkInterpolationError>
+          spkSampler(spkSampleFunction, SpkInterpolationError(), params.positionTolerance, params.minStep,
+                     limitMaxStep(spkFile, false, bodyId, startEt, stopEt, params.maxStep));
+      if (!spkSampler.sample(startEt, stopEt))
+        return false;
+      printf("Sampled %lu SPK states, maximum interpolation error at the checked points %lf meters\n",
+             (unsigned long)spkSampler.times.size(), spkSampler.maxError);
+      if (spkSampler.numUnresolved > 0)
+        printf("Warning: %lu SPK intervals exceed the position tolerance at the minimum step size\n",
+               (unsigned long)spkSampler.numUnresolved);
 
       std::ofstream outputFile;
       printf("Writing file %s\n", params.spkDataOutputPath.c_str());
       outputFile.open(params.spkDataOutputPath.c_str());
-
-      // For the number of specified steps
-      SpiceDouble lastEt;
-      for (int i=0; i<NUM_STEPS; ++i)
+      outputFile.precision(16);
+      for (size_t i=0; i<spkSampler.times.size(); ++i)
       {
-
-        SpiceDouble state[6];
-        SpiceDouble lightTime;
-        SpiceDouble et = startEt + stepSize*(SpiceDouble)i;
-        lastEt = et;
-
-        // Retrieve the position of the spacecraft at this time
-        spkez_c(bodyId,  et,  J2000_FRAME_STRING.c_str(), absCorr.c_str(), MOON_CODE, state, &lightTime); // LRO relative to Moon in J2000 frame, units are kilometers and km/sec
-        if ( failed_c() )
-        {
-          printf("SpiceEditor Error: Failed to obtain SC J2000 position data at et %lf!!!!!!!!!!!!!!!!\n", et);
-          return false;
-        }
-
-        SpiceDouble tol = 0; // Make sure we can do this 
-
-        // Convert ephemeris time to spacecraft clock time
-        SpiceDouble sclkdp;
-        sce2c_c(LRO_CLOCK_ID, et, &sclkdp);
-
-        // Try to get the spacecraft orientation at that time (spacecraft_from_J2000)
-        SpiceDouble  spacecraft_from_J2000_R[3][3];
-        SpiceDouble  clkout;
-        SpiceBoolean orientationFound;
-        ckgp_c(LRO_SPACECRAFT_CODE, sclkdp, tol, J2000_FRAME_STRING.c_str(), spacecraft_from_J2000_R, &clkout, &orientationFound);
-        if (!orientationFound)
-        {
-          printf("SpiceEditor Error: Failed to obtain SC J2000 orientation data at et %lf!!!!!!!!!!!!!!!!\n", et);
-          return false;
-        }
-
-        // Try to get the planet orientation at that time (planet_from_J2000)
-        SpiceDouble  planet_from_J2000_R[3][3];
-        pxform_c(J2000_FRAME_STRING.c_str(), MOON_FRAME_STRING.c_str(), et, planet_from_J2000_R);
-        // This matrix converts J2000 orientations to LRO orientations at et
-        if ( failed_c() )
-        {
-          printf("SpiceEditor Error: Failed to obtain planet J2000 orientation data at et %lf!!!!!!!!!!!!!!!!\n", et);
-          return false;
-        }
-
-        SpiceDouble  newPosition[3];
-        if (localTransform) // Apply existing lronac position offset
-        {
-          // Convert the LRONAC offset from meters to kilometers
-          SpiceDouble lronacOffsetKm[3];
-          lronacOffsetKm[0] = lronacOffset[0] / 1000.0;
-          lronacOffsetKm[1] = lronacOffset[1] / 1000.0;
-          lronacOffsetKm[2] = lronacOffset[2] / 1000.0;
-          
-          SpiceDouble instOffset_J2000Frame[3];
-          // Now need to convert the LRONAC offset (spacecraft to frame) into J2000 coordinates
-          // - Multiply by the inverted rotation matrix to go from spacecraft frame to J2000 frame
-          mtxv_c(spacecraft_from_J2000_R, lronacOffsetKm, instOffset_J2000Frame);
-          for (int r=0; r<3; ++r) // Add the rotated offset to the original coordinate
-            newPosition[r] = state[r] + instOffset_J2000Frame[r]; // Adding km to km here
-        }
-        else // Apply global transform from file
-        {
-          // Convert the planet transform to the correct coordinate space
-          SpiceDouble fixedPlanet_from_J2000_R[3][3];
-          SpiceDouble fixedPlanet_in_J2000_T[3];
-
-          // Convert correcting rotation and translation into J2000 frame from planet frame
-          mxm_c(planetFixed_from_planet_R, planet_from_J2000_R, fixedPlanet_from_J2000_R);
-
-          // Convert the state into units of meters
-          SpiceDouble stateMeters[3]; // J2000 frame
-          for (int r=0; r<3; ++r)
-            stateMeters[r] = state[r]*1000;
-
-          // Apply the corrective planet-based transform to the vector currently represented in J2000 space
-          SpiceDouble stateMoon[3], stateMoonFixed[3], stateJ2000Fixed[3];
-          mxv_c(planet_from_J2000_R,       stateMeters, stateMoon);       // Convert to moon frame
-          //mxv_c(planetFixed_from_planet_R, stateMoon,   stateMoonFixed);  // Apply correction --> Unused if transform is in local planet coordinates!
-          for (int r=0; r<3; ++r) // Add in the translation
-          {
-//            double temp = stateMoonFixed[r];
-            //stateMoonFixed[r] += planetFixed_from_planet_T[r]; 
-            stateMoonFixed[r] = stateMoon[r] + planetFixed_from_planet_T[r]; // !AdjustedCameraModel applies transform about camera, not about the planet!
-          }
-          mtxv_c(planet_from_J2000_R, stateMoonFixed, stateJ2000Fixed); // Return to J2000 frame
-          for (int r=0; r<3; ++r) // Convert from meters back to kilometers
-          {
-            newPosition[r] = stateJ2000Fixed[r] / 1000.0;
-          }
-
-        } // End of global transform case
-
-
         // Dump ET, state... line to a text file
         if (i > 0)
           outputFile << std::endl; // Add line breaks as needed
-        outputFile.precision(16);
-        outputFile << et;
-        for (int q=0; q<3; ++q)
-          outputFile << ", " << newPosition[q]; // Write out the new state
-        for (int q=3; q<6; ++q)
-          outputFile << ", " << state[q]; // Write input state from offset
-
-      } // End of loop through steps
-
+        outputFile << spkSampler.times[i];
+        for (int q=0; q<6; ++q)
+          outputFile << ", " << spkSampler.samples[i].state[q]; // New position then the input velocity
+      }
       outputFile.close(); // Close read data file
 
 
@@ -0,0 +1,153 @@
+// __BEGIN_LICENSE__
+//  Copyright (c) 2009-2013, United States Government as represented by the
+//  Administrator of the National Aeronautics and Space Administration. All
+//  rights reserved.
+//
+//  The NGT platform is licensed under the Apache License, Version 2.0 (the
+//  "License"); you may not use this file except in compliance with the
+//  License. You may obtain a copy of the License at
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+// __END_LICENSE__
+
+#ifndef LINEAR_SOLVER_CHOICE_H
+#define LINEAR_SOLVER_CHOICE_H
+
+/// \file linearSolverChoice.h Chooses the Ceres linear solver settings for the SBA problem from its size.
+///
+/// Used by lronacAngleDoubleSolver and lronacSolverReplay.  The points only ever share residuals with
+///  the camera parameters, so eliminating the points first leaves a reduced camera matrix with one row
+///  and column per camera parameter.  With the current 12 camera parameters that matrix is tiny and
+///  dense at any point count, the other choices are for problems with many more camera parameters.
+
+#include <algorithm>
+#include <sstream>
+#include <string>
+
+#include "ceres/ceres.h"
+
+const size_t DENSE_QR_MAX_PARAMETERS             = 300;     ///< Problems this small are factored directly
+const size_t DENSE_SCHUR_MAX_CAMERA_PARAMETERS   = 1000;    ///< Largest reduced camera matrix stored densely
+const size_t ITERATIVE_SCHUR_MIN_POINTS          = 1000000; ///< Above this a large reduced camera matrix is not formed
+const size_t MIN_POINTS_PER_LINEAR_SOLVER_THREAD = 2000;    ///< Fewer points per thread costs more than it saves
+
+/// Linear solver settings for one solve
+struct LinearSolverChoice
+{
+  ceres::LinearSolverType   linearSolverType;
+  ceres::PreconditionerType preconditionerType; ///< Only used by the iterative solvers
+  bool        schurOrdering; ///< If true the points are eliminated first, otherwise Ceres picks the ordering
+  int         numThreads;    ///< Number of linear solver threads
+  bool        automatic;     ///< False if the linear solver type was given by the user
+  std::string reason;        ///< Why the linear solver type was chosen
+};
+
+inline bool isSchurLinearSolver(ceres::LinearSolverType type)
+{
+  return (type == ceres::DENSE_SCHUR) || (type == ceres::SPARSE_SCHUR) || (type == ceres::ITERATIVE_SCHUR);
+}
+
+/// Chooses linear solver settings for a problem.
+/// - linearSolverName, preconditionerName and orderingName override the choice unless they are "auto".
+///   The ordering can be "schur" to eliminate the points first or "ceres" to let Ceres pick.
+/// - Returns false if one of the names is not recognized.
+inline bool chooseLinearSolver(const std::string &linearSolverName, const std::string &preconditionerName,
+                               const std::string &orderingName, size_t numPoints, size_t numCameraParams,
+                               int numThreads, LinearSolverChoice &choice)
+{
+  const size_t numParams = numCameraParams + 3*numPoints;
+
+  choice.automatic = (linearSolverName == "auto");
+  if (!choice.automatic)
+  {
+    if (!ceres::StringToLinearSolverType(linearSolverName, &choice.linearSolverType))
+      return false;
+    choice.reason = "set by the user";
+  }
+  else if (numParams <= DENSE_QR_MAX_PARAMETERS)
+  {
+    choice.linearSolverType = ceres::DENSE_QR;
+    choice.reason = "small enough to factor the whole problem";
+  }
+  else if (numCameraParams <= DENSE_SCHUR_MAX_CAMERA_PARAMETERS)
+  {
+    choice.linearSolverType = ceres::DENSE_SCHUR;
+    choice.reason = "reduced camera matrix is small";
+  }
+  else if (numPoints < ITERATIVE_SCHUR_MIN_POINTS)
+  {
+    choice.linearSolverType = ceres::SPARSE_SCHUR;
+    choice.reason = "reduced camera matrix is large";
+  }
+  else
+  {
+    choice.linearSolverType = ceres::ITERATIVE_SCHUR;
+    choice.reason = "reduced camera matrix is large and there are too many points to form it";
+  }
+
+  if (preconditionerName != "auto")
+  {
+    if (!ceres::StringToPreconditionerType(preconditionerName, &choice.preconditionerType))
+      return false;
+  }
+  else // Block diagonal of the reduced camera matrix for ITERATIVE_SCHUR
+    choice.preconditionerType = (choice.linearSolverType == ceres::ITERATIVE_SCHUR) ? ceres::SCHUR_JACOBI
+                                                                                    : ceres::JACOBI;
+
+  if (orderingName == "auto")
+    choice.schurOrdering = isSchurLinearSolver(choice.linearSolverType);
+  else if ((orderingName == "schur") || (orderingName == "ceres"))
+    choice.schurOrdering = (orderingName == "schur");
+  else
+    return false;
+
+  // The Schur elimination is split between threads by point
+  choice.numThreads = 1;
+  if (choice.linearSolverType != ceres::DENSE_QR)
+    choice.numThreads = static_cast<int>(std::min(static_cast<size_t>(std::max(numThreads, 1)),
+                                                  std::max(static_cast<size_t>(1),
+                                                           numPoints / MIN_POINTS_PER_LINEAR_SOLVER_THREAD)));
+  return true;
+}
+
+/// Returns a one line description of the choice for the log
+inline std::string describeLinearSolverChoice(const LinearSolverChoice &choice)
+{
+  std::ostringstream text;
+  text << ceres::LinearSolverTypeToString(choice.linearSolverType)
+       << (choice.schurOrdering ? " with points eliminated first, " : " with Ceres ordering, ")
+       << ceres::PreconditionerTypeToString(choice.preconditionerType) << " preconditioner, "
+       << choice.numThreads << " threads (" << choice.reason << ")";
+  return text.str();
+}
+
+/// Stores a new parameter ordering in the solver options.
+/// - The type of this option changed from a raw pointer to a shared pointer between Ceres versions,
+///   both take ownership of the ordering.
+template <typename OrderingPtrT>
+void setOrdering(OrderingPtrT &option, ceres::ParameterBlockOrdering *ordering)
+{
+  option = OrderingPtrT(ordering);
+}
+
+/// Copies the choice into the solver options.
+/// - ordering should hold the points in group 0 and the camera parameters in group 1, it is used if the
+///   choice asks for it and deleted otherwise.  If it is null Ceres picks the ordering.
+inline void applyLinearSolverChoice(const LinearSolverChoice &choice, ceres::ParameterBlockOrdering *ordering,
+                                    ceres::Solver::Options &options)
+{
+  options.linear_solver_type        = choice.linearSolverType;
+  options.preconditioner_type       = choice.preconditionerType;
+  options.num_linear_solver_threads = choice.numThreads;
+  if (ordering && choice.schurOrdering)
+    setOrdering(options.linear_solver_ordering, ordering);
+  else
+    delete ordering;
+}
+
+#endif
@@ -19,6 +19,7 @@
 import sys, os, glob, optparse, re, shutil, subprocess, string, time, logging
 
 import IsisTools
+import ResourceTools
 
 def man(option, opt, value, parser):
     print >>sys.stderr, parser.usage
@@ -188,6 +189,9 @@ def main():
             parser.add_option("--crop",  dest="cropAmount", 
                               help="Crops the output image to reduce processing time.")
 
+            parser.add_option("--stereo-stages", dest="stereoStages", type="int", default=1,
+                              help="Total number of stereo stages expected to share this node, including this one, used to size parallel_stereo.")
+
             parser.add_option("--manual", action="callback", callback=man,
                               help="Read the manual.")
             #parser.add_option("--keep", action="store_true", dest="keep",
@@ -280,6 +284,7 @@ def main():
                                                         ' --outputSL ' + leftStereoCorrectedPath + 
                                                         ' --outputSR ' + rightStereoCorrectedPath + 
                                                         ' --workDir '  + options.workDir + 
+                                                        ' --stereo-stages ' + str(options.stereoStages) + 
                                                         ' --log-path ' + logPath)
                 print cmd
                 #os.system(cmd)
@@ -383,8 +388,8 @@ def main():
         if not os.path.exists(pointCloudPath):
             cmd = ('parallel_stereo --corr-timeout 400 --alignment affineepipolar --subpixel-mode 1' +
                                   ' --disable-fill-holes ' +  stereoInputLeft + ' ' + stereoInputRight + 
-                                  ' ' + stereoOutputPrefix + ' --processes 8 --threads-multiprocess 4' +
-                                  ' --threads-singleprocess 32 --compute-error-vector')
+                                  ' ' + stereoOutputPrefix + ResourceTools.getParallelStereoResourceOptions(options.stereoStages) +
+                                  ' --compute-error-vector')
             print cmd
             os.system(cmd)
             #--nodes-list PBS_NODEFILE --processes 4 --threads-multiprocess 16 --threads-singleprocess 32
@@ -19,13 +19,20 @@
 /// \file lronacAngleDoubleSolver.cc
 ///
 
+#include <algorithm>
 #include <iostream>
 #include <iomanip>
+#include <limits>
+#include <sstream>
+#include <unistd.h>
 
 #include <iTime.h> // Isis time class
 
 #include <boost/shared_ptr.hpp>
 #include <boost/serialization/shared_ptr.hpp> // for null_deleter
+#include <boost/thread.hpp>
+#include <boost/bind.hpp>
+#include <boost/random/mersenne_twister.hpp>
 
 #include <vw/InterestPoint.h>
 #include <vw/Image/MaskViews.h>
@@ -48,6 +55,9 @@
 
 #include <lronacSolverSupport.h>
 #include <lronacSolverModelDouble.h>
+#include <pixelPairFile.h>
+#include <solverSnapshot.h>
+#include <linearSolverChoice.h>
 
 using namespace vw;
 using namespace vw::stereo;
@@ -69,18 +79,40 @@ struct Parameters : asp::BaseOptions
   
   
   std::string outputPrefix;
+  std::string jobFilePath; ///< If set, run each line of this file as a separate job.
   
   std::string matchingLeftPointsPath; 
   std::string matchingRightPointsPath;
   std::string matchingLeftCrossPointsPath;
   std::string matchingRightCrossPointsPath;
+
+  /// Pixel offsets of the cropped cubes used to generate the cross pairs: leftSample, leftLine, rightSample, rightLine
+  std::vector<double> leftCrossCropOffsets;
+  std::vector<double> rightCrossCropOffsets;
   
   bool initialOnly; ///< If true only compute starting state, don't run the solver.
+  bool checkOnly; ///< If true only triangulate the overlap matches to check the cube alignment.
+  bool numericJacobians; ///< If true use central differences instead of the analytic jacobians.
+  bool streamPoints; ///< If true triangulate the pixel pair files in chunks instead of loading them all.
+  int  streamChunkSize; ///< Number of pixel pairs read at once when streaming.
+  double pairFilterThreshold;  ///< RANSAC epipolar line distance in pixels for the stereo pixel pairs, zero disables the filter.
+  int    pairFilterBandHeight; ///< Height in lines of the image bands the RANSAC filter fits separately.
+  int    progressiveLevels;    ///< Number of coarse to fine solver passes, each using four times the points of the last.
+  double progressiveTolerance;         ///< Stop the progressive solve once no rotation changes more than this many radians
+  double progressivePositionTolerance; ///<  and no position changes more than this many meters.
   
   std::string initialValuePath;
+  bool   resetGlobalTransform; ///< If true the global rotation and position start at zero even with initial values.
+  int    maxIterations;        ///< Maximum number of solver iterations per solve.
+  double functionTolerance;    ///< The solver stops when the relative change in cost drops below this.
+  std::string linearSolverName;   ///< Ceres linear solver type, or auto to choose from the problem size.
+  std::string preconditionerName; ///< Ceres preconditioner type, or auto.
+  std::string orderingName;       ///< auto, schur (points eliminated first) or ceres.
 
   double expectedSurfaceElevation;
   int cropWidth; ///< Specifies image overlap for use with ipfind
+  std::string ipCacheDir; ///< If set, interest point matches in the image overlaps are cached in this folder.
+  std::string snapshotPath; ///< If set, write the solver problem to this file for lronacSolverReplay.
   
   bool debug;
 };
@@ -93,15 +125,35 @@ bool handle_arguments(int argc, char* argv[],
   po::options_description general_options("Options");
   general_options.add_options()
     ("debug",                  po::bool_switch(&opt.debug                 )->default_value(false),  "DEBUG mode")
-    ("outputPrefix",                 po::value      (&opt.outputPrefix                )->required(),            "Output prefix to use")
+    ("outputPrefix",                 po::value      (&opt.outputPrefix                )->default_value(""),     "Output prefix to use")
+    ("jobFile",                      po::value      (&opt.jobFilePath                 )->default_value(""),     "Run each line of this file as a job with its own options, loading each camera only once")
     ("initialOnly",                  po::bool_switch(&opt.initialOnly                 )->default_value(false),  "Just compute initial state (don't solve)")
-    ("initialValues",                po::value      (&opt.initialValuePath            )->default_value(""),     "Path to file containing state parameter values (probably from previous output)")
+    ("checkOnly",                    po::bool_switch(&opt.checkOnly                   )->default_value(false),  "Just triangulate the LE/RE overlap matches to check alignment (no solver)")
+    ("numericJacobians",             po::bool_switch(&opt.numericJacobians            )->default_value(false),  "Use central difference jacobians in the solver (much slower)")
+    ("streamPoints",                 po::bool_switch(&opt.streamPoints                )->default_value(false),  "With --initialOnly, triangulate the pixel pair files in parallel chunks without loading them all")
+    ("streamChunkSize",              po::value      (&opt.streamChunkSize             )->default_value(100000), "Number of pixel pairs to triangulate at once with --streamPoints")
+    ("pairFilterThreshold",          po::value      (&opt.pairFilterThreshold         )->default_value(3.0),    "Drop stereo pixel pairs farther than this many pixels from their epipolar lines, found by a per-band RANSAC fit (0 disables the filter)")
+    ("pairFilterBandHeight",         po::value      (&opt.pairFilterBandHeight        )->default_value(2000),   "Height in lines of the image bands used by the pixel pair filter")
+    ("progressiveLevels",            po::value      (&opt.progressiveLevels           )->default_value(1),      "Solve on progressively denser subsets of the points, starting with one in 4^(levels-1)")
+    ("progressiveTolerance",         po::value      (&opt.progressiveTolerance        )->default_value(1e-5),   "Skip the remaining progressive levels once no camera rotation changes more than this many radians")
+    ("progressivePositionTolerance", po::value      (&opt.progressivePositionTolerance)->default_value(0.1),    "Skip the remaining progressive levels once no camera position changes more than this many meters")
+    ("initialValues",                po::value      (&opt.initialValuePath            )->default_value(""),     "Path to file containing state parameter values (probably from previous output).  The points are reused if its .obsHash file matches the loaded pixel pairs")
+    ("resetGlobalTransform",         po::bool_switch(&opt.resetGlobalTransform        )->default_value(false),  "Start the global rotation and position at zero, for stereo cubes that already have the initial values applied")
+    ("maxIterations",                po::value      (&opt.maxIterations               )->default_value(100),    "Maximum number of solver iterations")
+    ("functionTolerance",            po::value      (&opt.functionTolerance           )->default_value(1e-6),   "Stop solving when the relative cost change of an iteration is below this")
+    ("linearSolver",                 po::value      (&opt.linearSolverName            )->default_value("auto"), "Ceres linear solver type (DENSE_SCHUR, SPARSE_SCHUR, ITERATIVE_SCHUR, DENSE_QR, ...) or auto to choose from the problem size")
+    ("preconditioner",               po::value      (&opt.preconditionerName          )->default_value("auto"), "Ceres preconditioner type for the iterative linear solvers (JACOBI, SCHUR_JACOBI, ...) or auto")
+    ("ordering",                     po::value      (&opt.orderingName                )->default_value("auto"), "Parameter ordering: auto, schur (points eliminated first) or ceres (chosen by Ceres)")
+    ("ipCacheDir",                   po::value      (&opt.ipCacheDir                  )->default_value(""),     "Folder to cache interest point matches in the image overlaps, shared between runs")
+    ("snapshot",                     po::value      (&opt.snapshotPath                )->default_value(""),     "Write the solver problem with tabulated cameras to this file, it can be solved by lronacSolverReplay")
     ("crop-width",                   po::value      (&opt.cropWidth                   )->default_value(200),    "Crop images to this width before disparity search")
     ("elevation",                    po::value      (&opt.expectedSurfaceElevation    )->default_value(0.0),    "Start solver estimate at this surface elevation")
     ("matchingPixelsLeftPath",       po::value      (&opt.matchingLeftPointsPath      )->default_value(""),     "Path to left-leftS stereo pixel file")
     ("matchingPixelsRightPath",      po::value      (&opt.matchingRightPointsPath     )->default_value(""),     "Path to right-rightS stereo pixel file")
     ("matchingPixelsLeftCrossPath",  po::value      (&opt.matchingLeftCrossPointsPath )->default_value(""),     "Path to left-rightS stereo pixel file")
     ("matchingPixelsRightCrossPath", po::value      (&opt.matchingRightCrossPointsPath)->default_value(""),     "Path to right-leftS stereo pixel file")
+    ("leftCrossCropOffsets",         po::value<std::vector<double> >(&opt.leftCrossCropOffsets )->multitoken(), "Crop offsets of the left-rightS pixel file: sample line rightSample rightLine")
+    ("rightCrossCropOffsets",        po::value<std::vector<double> >(&opt.rightCrossCropOffsets)->multitoken(), "Crop offsets of the right-leftS pixel file: sample line rightSample rightLine")
     ("leftCubePath",                 po::value      (&opt.leftFilePath                )->default_value(""),     "Path to left input cube")
     ("rightCubePath",                po::value      (&opt.rightFilePath               )->default_value(""),     "Path to right input cube")
     ("leftStereoCubePath",           po::value      (&opt.leftStereoFilePath          )->default_value(""),     "Path to left stereo input cube")
@@ -118,67 +170,245 @@ bool handle_arguments(int argc, char* argv[],
     asp::check_command_line( argc, argv, opt, general_options, general_options,
                              positional, positional_desc, usage );
 
-//  if ()
-//    vw_throw( ArgumentErr() << "Missing required input arguments!.\n\n"
-//              << usage << general_options );
+  if (opt.outputPrefix.empty() && opt.jobFilePath.empty())
+    vw_throw( ArgumentErr() << "Either --outputPrefix or --jobFile is required!\n\n"
+              << usage << general_options );
 
   return true;
 }
 
 //-------------------------------------------------------------------------------------------
 
-// Load matching points from a file
-bool loadMatchingPixels(const std::string &pointPath, PointObsList &pixelVals)
+/// Reads up to maxPairs matching points from an open file
+/// - The input file is a line for each point: sample1, line1, sample2, line2
+/// - Returns the number of points read, which is less than maxPairs once the end of the file is reached.
+size_t readMatchingPixels(std::ifstream &file, const size_t maxPairs, PointObsList &pixelVals)
 {
-  // The input file is a line for each point: sample1, line1, sample2, line2
-  std::ifstream file(pointPath.c_str());
-  if (file.fail())
-  {
-    printf("Failed to open point file %s\n", pointPath.c_str());
-    return false;
-  }
-  
+  pixelVals.leftObsList.clear();
+  pixelVals.rightObsList.clear();
+
   char comma;
   std::string line;
   double sample1, line1, sample2, line2;
-  std::vector<double> row1, row2, col1, col2;
-  row1.reserve(50);
-  row2.reserve(50);
-  col1.reserve(50);
-  col2.reserve(50);
-  int p=0;
-  while (std::getline(file, line)) // Read in each line and append to vectors
+  while ((pixelVals.size() < maxPairs) && std::getline(file, line)) // Read in each line and append to vectors
   {
     if (line.size() < 8) // Stop if we hit a blank line
+    {
+      file.setstate(std::ios::eofbit);
       break;
+    }
     std::stringstream s(line);
     s >> sample1 >> comma >> line1 >> comma >> sample2 >> comma >> line2;
-    col1.push_back(sample1);
-    row1.push_back(line1);
-    col2.push_back(sample2);
-    row2.push_back(line2);
-    //printf("p: %d, --> %lf, %lf, %lf, %lf\n", p, sample1, line1, sample2, line2);
-    ++p;
+    pixelVals.leftObsList.push_back (PixelObservation(sample1, line1));
+    pixelVals.rightObsList.push_back(PixelObservation(sample2, line2));
   }
-  file.close();
-  
-  // Convert from std::vector to packed pixel objects
-  pixelVals.leftObsList.resize (p);
-  pixelVals.rightObsList.resize(p);
-  for (int i=0; i<p; ++i)
+  return pixelVals.size();
+}
+
+/// Reads matching points in chunks from either a binary pixel pair file or a CSV file
+class PixelPairSource
+{
+public:
+
+  PixelPairSource() : _isBinary(false), _nextIndex(0) {}
+
+  /// Opens the file, checking which format it is in
+  bool open(const std::string &pointPath)
   {
-    pixelVals.leftObsList [i]  = Vector2(col1[i], row1[i]);
-    pixelVals.rightObsList[i] = Vector2(col2[i], row2[i]);
+    _isBinary  = isPixelPairFile(pointPath);
+    _nextIndex = 0;
+    if (_isBinary)
+    {
+      if (!_binaryFile.open(pointPath))
+      {
+        printf("Failed to read pixel pair file %s\n", pointPath.c_str());
+        return false;
+      }
+      return true;
+    }
+    _textFile.open(pointPath.c_str());
+    if (_textFile.fail())
+    {
+      printf("Failed to open point file %s\n", pointPath.c_str());
+      return false;
+    }
+    return true;
   }
-  
+
+  /// Returns the number of pairs in the file if it is known without reading it, otherwise zero
+  size_t knownSize() const { return _isBinary ? _binaryFile.size() : 0; }
+
+  /// Reads up to maxPairs points, returns the number read
+  size_t read(const size_t maxPairs, PointObsList &pixelVals)
+  {
+    if (!_isBinary)
+      return readMatchingPixels(_textFile, maxPairs, pixelVals);
+
+    // Binary records are copied straight out of the mapped file
+    const size_t numPairs = std::min(maxPairs, _binaryFile.size() - _nextIndex);
+    pixelVals.leftObsList.resize (numPairs);
+    pixelVals.rightObsList.resize(numPairs);
+    for (size_t i=0; i<numPairs; ++i)
+    {
+      const float *pair = _binaryFile.pair(_nextIndex + i);
+      pixelVals.leftObsList [i] = PixelObservation(pair[0], pair[1]);
+      pixelVals.rightObsList[i] = PixelObservation(pair[2], pair[3]);
+    }
+    _nextIndex += numPairs;
+    return numPairs;
+  }
+
+private:
+  bool                _isBinary;
+  PixelPairFileReader _binaryFile;
+  std::ifstream       _textFile;
+  size_t              _nextIndex; ///< Next binary record to read
+};
+
+// Load matching points from a binary pixel pair file or a CSV file
+bool loadMatchingPixels(const std::string &pointPath, PointObsList &pixelVals)
+{
+  PixelPairSource source;
+  if (!source.open(pointPath))
+    return false;
+  if (source.knownSize() > 0)
+  {
+    pixelVals.leftObsList.reserve (source.knownSize());
+    pixelVals.rightObsList.reserve(source.knownSize());
+  }
+  source.read(std::numeric_limits<size_t>::max(), pixelVals);
   return true;
 }
 
 //-------------------------------------------------------------------------------------------
 
 
+/// Height in lines of the along-track tiles the overlap strips are split into for interest point matching
+const int IP_TILE_HEIGHT = 4096;
+
+/// Interest point matches found in one along-track tile of the overlap strips
+struct TileMatches
+{
+  std::vector<ip::InterestPoint> left;
+  std::vector<ip::InterestPoint> right;
+};
+
+const boost::uint64_t FNV_OFFSET_BASIS = 14695981039346656037ULL; ///< Starting value of a FNV-1a hash
+
+/// Adds some bytes to a 64 bit FNV-1a hash
+boost::uint64_t addToHash(boost::uint64_t hash, const void *data, size_t numBytes)
+{
+  const unsigned char *bytes = reinterpret_cast<const unsigned char*>(data);
+  for (size_t i=0; i<numBytes; ++i)
+  {
+    hash ^= bytes[i];
+    hash *= 1099511628211ULL;
+  }
+  return hash;
+}
+
+/// Returns a 64 bit FNV-1a hash of the pixel values in an image
+boost::uint64_t hashPixels(const ImageView<PixelGray<float> > &image)
+{
+  return addToHash(FNV_OFFSET_BASIS, image.data(), image.cols()*image.rows()*sizeof(PixelGray<float>));
+}
+
+/// Detects and matches interest points in along-track tiles of the overlap strips
+/// - Processes tiles firstTile, firstTile+tileStride, ... so several threads can split the tiles.
+/// - Each call opens its own copy of the images.
+/// - The right tile is taller than the left tile so matches near the tile edges are not lost.
+/// - If cacheDir is set the matches for each tile are stored there, keyed by the pixel contents and
+///   location of both tiles and the detector settings.  Nav corrections don't change the pixels so
+///   later runs on corrected cubes load the matches instead of detecting them again.
+/// - The matched points are returned in ROI coordinates.
+void matchOverlapTiles(const std::string *leftFilePath, const std::string *rightFilePath,
+                       const BBox2i *leftRoi, const BBox2i *rightRoi, const std::string *cacheDir,
+                       size_t firstTile, size_t tileStride, std::vector<TileMatches> *tileMatches)
+{
+  const int    TILE_MARGIN      = 256;  // Extra lines added to each side of the right tile
+  const int    MAX_POINTS_TILE  = 100;  // Caps the detection work and spreads the points along the strip
+  const double MATCH_THRESHOLD  = 0.5;
+  const int    CACHE_VERSION    = 1;    // Change this if the detection code changes
+
+  DiskImageView<PixelGray<float> > left_disk_image (*leftFilePath );
+  DiskImageView<PixelGray<float> > right_disk_image(*rightFilePath);
+
+  for (size_t t=firstTile; t<tileMatches->size(); t+=tileStride)
+  {
+    const int tileTop       = t*IP_TILE_HEIGHT;
+    const int leftHeight    = std::min(IP_TILE_HEIGHT, leftRoi->height() - tileTop);
+    const int rightTop      = std::max(0, tileTop - TILE_MARGIN);
+    const int rightHeight   = std::min(rightRoi->height(), tileTop + leftHeight + TILE_MARGIN) - rightTop;
+    const BBox2i leftTile (leftRoi->min().x(),  leftRoi->min().y()  + tileTop,  leftRoi->width(),  leftHeight );
+    const BBox2i rightTile(rightRoi->min().x(), rightRoi->min().y() + rightTop, rightRoi->width(), rightHeight);
+
+    // Both tiles are read into memory once, they are used for the cache key and for detection
+    ImageView<PixelGray<float> > leftPixels  = crop(left_disk_image,  leftTile );
+    ImageView<PixelGray<float> > rightPixels = crop(right_disk_image, rightTile);
+
+    TileMatches &matches = (*tileMatches)[t];
+    std::string cachePath;
+    if (!cacheDir->empty())
+    {
+      std::ostringstream key;
+      key << std::hex << hashPixels(leftPixels) << "-" << hashPixels(rightPixels) << std::dec
+          << "-" << leftTile.min().x()  << "_" << leftTile.min().y()  << "_" << leftTile.width()  << "_" << leftTile.height()
+          << "-" << rightTile.min().x() << "_" << rightTile.min().y() << "_" << rightTile.width() << "_" << rightTile.height()
+          << "-" << MAX_POINTS_TILE << "_" << MATCH_THRESHOLD << "_v" << CACHE_VERSION;
+      cachePath = (boost::filesystem::path(*cacheDir) / ("overlap-" + key.str() + ".match")).string();
+    }
+
+    if (!cachePath.empty() && boost::filesystem::exists(cachePath))
+    {
+      ip::read_binary_match_file(cachePath, matches.left, matches.right);
+    }
+    else
+    {
+      asp::IntegralAutoGainDetector detector( MAX_POINTS_TILE );
+      ip::InterestPointList ip1 = ip::detect_interest_points( vw::create_mask_less_or_equal(leftPixels,  0), detector );
+      ip::InterestPointList ip2 = ip::detect_interest_points( vw::create_mask_less_or_equal(rightPixels, 0), detector );
+      if (!ip1.empty() && !ip2.empty())
+      {
+        ip::SGradDescriptorGenerator descriptor;
+        describe_interest_points( vw::create_mask_less_or_equal(leftPixels,  0), descriptor, ip1 );
+        describe_interest_points( vw::create_mask_less_or_equal(rightPixels, 0), descriptor, ip2 );
+
+        ip::DefaultMatcher matcher(MATCH_THRESHOLD);
+        matcher(ip1, ip2, matches.left, matches.right );
+      }
+
+      // Write to a temporary file first so other processes never see a partial file
+      // - The name is unique to this process and thread so concurrent writers of the same tile
+      //   do not write into each other's temporary file.
+      if (!cachePath.empty())
+      {
+        std::ostringstream tempName;
+        tempName << cachePath << "." << getpid() << "." << boost::this_thread::get_id() << ".tmp";
+        const std::string tempPath = tempName.str();
+        ip::write_binary_match_file(tempPath, matches.left, matches.right);
+        boost::filesystem::rename(tempPath, cachePath);
+      }
+    }
+
+    // Shift from tile coordinates to ROI coordinates
+    for (size_t i=0; i<matches.left.size(); ++i)
+    {
+      matches.left [i].x  += leftTile.min().x()  - leftRoi->min().x();
+      matches.left [i].ix += leftTile.min().x()  - leftRoi->min().x();
+      matches.left [i].y  += tileTop;
+      matches.left [i].iy += tileTop;
+      matches.right[i].x  += rightTile.min().x() - rightRoi->min().x();
+      matches.right[i].ix += rightTile.min().x() - rightRoi->min().x();
+      matches.right[i].y  += rightTop;
+      matches.right[i].iy += rightTop;
+    }
+  }
+}
+
 // Search for matching pixels in the LE/RE overlap
-bool findMatchingPixels(const std::string &leftFilePath, const std::string &rightFilePath, const std::string &logFilePath, const int overlapWidth, PointObsList &pixelVals)
+// - The overlap strips are split into along-track tiles which are matched in parallel.
+bool findMatchingPixels(const std::string &leftFilePath, const std::string &rightFilePath, const std::string &logFilePath,
+                        const int overlapWidth, const int numThreads, const std::string &cacheDir, PointObsList &pixelVals)
 {
  
   // Load both images  
@@ -209,20 +439,28 @@ bool findMatchingPixels(const std::string &leftFilePath, const std::string &righ
   // Now use interest point finding/matching functions to estimate the search offset between the images
   printf("Gathering interest points...\n");
 
-  // Gather interest points
-  asp::IntegralAutoGainDetector detector( 500 );
-  ip::InterestPointList ip1 = ip::detect_interest_points( vw::create_mask_less_or_equal(crop(left_disk_image,  leftRoi ), 0), detector );
-  ip::InterestPointList ip2 = ip::detect_interest_points( vw::create_mask_less_or_equal(crop(right_disk_image, rightRoi), 0), detector );
-  printf("Found %lu, %lu interest points.\n", ip1.size(), ip2.size());
-      
-  ip::SGradDescriptorGenerator descriptor;
-  describe_interest_points( vw::create_mask_less_or_equal(crop(left_disk_image,  leftRoi ), 0), descriptor, ip1 );
-  describe_interest_points( vw::create_mask_less_or_equal(crop(right_disk_image, rightRoi), 0), descriptor, ip2 );
+  // Gather and match interest points one tile at a time
+  std::vector<TileMatches> tileMatches((imageHeight + IP_TILE_HEIGHT - 1) / IP_TILE_HEIGHT);
+  const size_t numTileThreads = std::max(1, std::min(numThreads, static_cast<int>(tileMatches.size())));
+  printf("Matching %lu tiles with %lu threads\n", (unsigned long)tileMatches.size(), (unsigned long)numTileThreads);
+  if (!cacheDir.empty())
+  {
+    printf("Using interest point match cache folder %s\n", cacheDir.c_str());
+    boost::filesystem::create_directories(cacheDir);
+  }
+  boost::thread_group threads;
+  for (size_t t=0; t<numTileThreads; ++t)
+    threads.create_thread(boost::bind(&matchOverlapTiles, &leftFilePath, &rightFilePath, &leftRoi, &rightRoi, &cacheDir,
+                                      t, numTileThreads, &tileMatches));
+  threads.join_all();
 
-  // Match interest points
-  ip::DefaultMatcher matcher(0.5);
+  // Combine the tiles in along-track order
   std::vector<ip::InterestPoint> matched_ip1, matched_ip2;
-  matcher(ip1, ip2, matched_ip1, matched_ip2 );
+  for (size_t t=0; t<tileMatches.size(); ++t)
+  {
+    matched_ip1.insert(matched_ip1.end(), tileMatches[t].left.begin(),  tileMatches[t].left.end() );
+    matched_ip2.insert(matched_ip2.end(), tileMatches[t].right.begin(), tileMatches[t].right.end());
+  }
   ip::remove_duplicates( matched_ip1, matched_ip2 );
 
   if (matched_ip1.empty() || matched_ip2.empty())
@@ -285,7 +523,7 @@ bool findMatchingPixels(const std::string &leftFilePath, const std::string &righ
   const int TARGET_NUM_POINTS = 200;
 
   // Convert the matching points into the correct format
-  const int pointSkip = ransac_ip1.size() / TARGET_NUM_POINTS; // Pick skip to get about the desired number of points
+  const int pointSkip = std::max(1, static_cast<int>(ransac_ip1.size() / TARGET_NUM_POINTS)); // Pick skip to get about the desired number of points
 
   // Initialize random seed to generate random starting offset
   srand(time(0));
@@ -330,8 +568,180 @@ bool findMatchingPixels(const std::string &leftFilePath, const std::string &righ
   return true;
 }
 
+/// Shift pixel pairs from cropped cubes back into full cube coordinates
+/// - offsets contains leftSample, leftLine, rightSample, rightLine
+/// - If no offsets were passed in, use the crop that was hard coded in older versions of the pipeline.
+///   That crop starts at one-based ISIS sample 2531, which is a zero-based offset of 2530.
+bool applyCropOffsets(const std::vector<double> &offsets, PointObsList &pixelVals)
+{
+  std::vector<double> cropOffsets(offsets);
+  if (cropOffsets.empty())
+  {
+    cropOffsets.resize(4, 0.0);
+    cropOffsets[0] = 2530;
+  }
+  if (cropOffsets.size() != 4)
+  {
+    printf("Error: Expected 4 crop offset values, got %lu\n", cropOffsets.size());
+    return false;
+  }
+  printf("Applying crop offsets %lf, %lf, %lf, %lf\n", cropOffsets[0], cropOffsets[1], cropOffsets[2], cropOffsets[3]);
+
+  const Vector2 leftOffset (cropOffsets[0], cropOffsets[1]);
+  const Vector2 rightOffset(cropOffsets[2], cropOffsets[3]);
+  for (size_t i=0; i<pixelVals.size(); ++i)
+  {
+    pixelVals.leftObsList [i] += leftOffset;
+    pixelVals.rightObsList[i] += rightOffset;
+  }
+  return true;
+}
+
 //-------------------------------------------------------------------------------------------
 
+/// Affine epipolar constraint n.(p - center) = 0 on p = [rightSample, rightLine, leftSample, leftLine]
+/// - This is the epipolar geometry of two affine cameras, which the narrow angle cameras are close to
+///   over a band of lines.  Terrain parallax moves pairs along the epipolar lines, so only the distance
+///   across them is used to judge a pair.
+struct AffineEpipolarModel
+{
+  Vector4 normal;
+  Vector4 center;
+
+  /// Distance in pixels from the right pixel to the epipolar line of the left pixel
+  double distance(const Vector4 &p) const
+  {
+    return fabs(dot_prod(normal, p - center)) / sqrt(normal[0]*normal[0] + normal[1]*normal[1]);
+  }
+};
+
+/// Total least squares fit of the affine epipolar constraint to the selected points
+/// - Returns false if the fit does not constrain the right image pixel.
+bool fitAffineEpipolar(const std::vector<Vector4> &points, const std::vector<size_t> &indices,
+                       AffineEpipolarModel &model)
+{
+  const double MIN_RIGHT_WEIGHT = 1e-3; // Smallest allowed norm of the right image part of the normal
+
+  model.center = Vector4();
+  for (size_t i=0; i<indices.size(); ++i)
+    model.center += points[indices[i]];
+  model.center /= static_cast<double>(indices.size());
+
+  Matrix<double,4,4> scatter;
+  for (size_t i=0; i<indices.size(); ++i)
+  {
+    Vector4 d = points[indices[i]] - model.center;
+    scatter += outer_prod(d, d);
+  }
+
+  // The normal is the direction of least spread
+  Matrix<double> U, VT;
+  Vector<double> S;
+  math::svd(scatter, U, S, VT);
+  model.normal = select_row(VT, 3);
+  return (sqrt(model.normal[0]*model.normal[0] + model.normal[1]*model.normal[1]) > MIN_RIGHT_WEIGHT);
+}
+
+/// Removes stereo pixel pairs that are too far from their epipolar lines
+/// - The pairs are split into bands of left image lines and RANSAC fits a separate affine epipolar
+///   constraint to each band, which follows the slowly changing pointing over the length of the image.
+///   Parallax from the terrain is along the epipolar lines so it does not count against a pair.
+/// - The random samples always start from the same seed so the result does not change between runs.
+/// - Bands with too few pairs or with no consistent constraint are left alone.
+/// - Returns the number of pairs that were removed.
+size_t filterPairOutliers(PointObsList &pixelVals, const double inlierThreshold, const int bandHeight)
+{
+  const size_t MIN_BAND_PAIRS  = 20;
+  const size_t SAMPLE_SIZE     = 4;
+  const int    NUM_ITERATIONS  = 100;
+
+  if ((inlierThreshold <= 0) || (bandHeight <= 0))
+    return 0;
+
+  // Sort the pairs into bands by left image line
+  std::map<int, std::vector<size_t> > bands;
+  for (size_t i=0; i<pixelVals.size(); ++i)
+    bands[static_cast<int>(floor(pixelVals.leftObsList[i][1] / bandHeight))].push_back(i);
+
+  boost::mt19937 randomEngine(0);
+  std::vector<bool> keep(pixelVals.size(), true);
+  std::map<int, std::vector<size_t> >::const_iterator band;
+  for (band=bands.begin(); band!=bands.end(); ++band)
+  {
+    const std::vector<size_t> &indices = band->second;
+    if (indices.size() < MIN_BAND_PAIRS)
+      continue;
+
+    std::vector<Vector4> points(indices.size());
+    for (size_t i=0; i<indices.size(); ++i)
+    {
+      const PixelObservation &left  = pixelVals.leftObsList [indices[i]];
+      const PixelObservation &right = pixelVals.rightObsList[indices[i]];
+      points[i] = Vector4(right[0], right[1], left[0], left[1]);
+    }
+
+    // Find the constraint the most pairs agree with
+    std::vector<size_t> bestInliers;
+    AffineEpipolarModel model;
+    for (int iter=0; iter<NUM_ITERATIONS; ++iter)
+    {
+      std::vector<size_t> sample;
+      while (sample.size() < SAMPLE_SIZE)
+      {
+        const size_t index = randomEngine() % points.size();
+        if (std::find(sample.begin(), sample.end(), index) == sample.end())
+          sample.push_back(index);
+      }
+      if (!fitAffineEpipolar(points, sample, model))
+        continue;
+
+      std::vector<size_t> inliers;
+      for (size_t i=0; i<points.size(); ++i)
+        if (model.distance(points[i]) <= inlierThreshold)
+          inliers.push_back(i);
+      if (inliers.size() > bestInliers.size())
+        bestInliers.swap(inliers);
+    }
+
+    // Require most of the band to agree so a cluster of blunders can't win, then refit to all of the agreeing pairs
+    if ((bestInliers.size() < indices.size()/2) || !fitAffineEpipolar(points, bestInliers, model))
+    {
+      printf("No consistent epipolar fit for pixel pairs in lines %d to %d, keeping all of them.\n",
+             band->first*bandHeight, (band->first+1)*bandHeight);
+      continue;
+    }
+
+    for (size_t i=0; i<indices.size(); ++i)
+      keep[indices[i]] = (model.distance(points[i]) <= inlierThreshold);
+  }
+
+  // Compact the lists, preserving the order of the kept pairs
+  size_t numKept = 0;
+  for (size_t i=0; i<pixelVals.size(); ++i)
+  {
+    if (!keep[i])
+      continue;
+    pixelVals.leftObsList [numKept] = pixelVals.leftObsList [i];
+    pixelVals.rightObsList[numKept] = pixelVals.rightObsList[i];
+    ++numKept;
+  }
+  const size_t numRemoved = pixelVals.size() - numKept;
+  pixelVals.leftObsList.resize (numKept);
+  pixelVals.rightObsList.resize(numKept);
+  return numRemoved;
+}
+
+/// Runs filterPairOutliers on one list of pairs and reports the result
+void filterPixelPairs(const Parameters &params, const std::string &name, PointObsList &pixelVals)
+{
+  if ((params.pairFilterThreshold <= 0) || (pixelVals.size() == 0))
+    return;
+  const size_t numInput   = pixelVals.size();
+  const size_t numRemoved = filterPairOutliers(pixelVals, params.pairFilterThreshold, params.pairFilterBandHeight);
+  printf("Pixel pair filter removed %lu of %lu %s pairs\n",
+         (unsigned long)numRemoved, (unsigned long)numInput, name.c_str());
+}
+
 /// Load all available points based on the input parameters
 /// - Returns the number of points loaded or zero if there is an error
 size_t loadInputPointPairs(const Parameters &params, PointObsList &leftPixelPairs,      PointObsList &rightPixelPairs,
@@ -342,6 +752,7 @@ size_t loadInputPointPairs(const Parameters &params, PointObsList &leftPixelPair
   // If these files already exist read them in, otherwise compute them and save them.
   std::string mainIpFindPath   = params.outputPrefix + "-mainIpFindPixels.csv";
   std::string stereoIpFindPath = params.outputPrefix + "-stereoIpFindPixels.csv";
+  const int numThreads = (params.num_threads > 0) ? params.num_threads : vw::vw_settings().default_num_threads();
 
   // -- Adjacent cubes section (ipfind based matches) --
   if (boost::filesystem::exists(boost::filesystem::path(mainIpFindPath)))
@@ -357,7 +768,7 @@ size_t loadInputPointPairs(const Parameters &params, PointObsList &leftPixelPair
     if ((params.leftFilePath.size() > 0) && (params.rightFilePath.size() > 0))
     {
       printf("Searching for matching pixels in image overlap region\n");
-      if (!findMatchingPixels(params.leftFilePath, params.rightFilePath, mainIpFindPath, params.cropWidth, overlapPairs))
+      if (!findMatchingPixels(params.leftFilePath, params.rightFilePath, mainIpFindPath, params.cropWidth, numThreads, params.ipCacheDir, overlapPairs))
         return 0;
     }
   }
@@ -374,7 +785,7 @@ size_t loadInputPointPairs(const Parameters &params, PointObsList &leftPixelPair
     if ((params.leftStereoFilePath.size() > 0) && (params.rightStereoFilePath.size() > 0))
     {
       printf("Searching for matching pixels in stereo image overlap region\n");
-      if (!findMatchingPixels(params.leftStereoFilePath, params.rightStereoFilePath, stereoIpFindPath, params.cropWidth, stereoOverlapPairs))
+      if (!findMatchingPixels(params.leftStereoFilePath, params.rightStereoFilePath, stereoIpFindPath, params.cropWidth, numThreads, params.ipCacheDir, stereoOverlapPairs))
         return 0;
     }
   }
@@ -397,20 +808,26 @@ size_t loadInputPointPairs(const Parameters &params, PointObsList &leftPixelPair
     printf("Loading list of matched pixels from file %s\n", params.matchingLeftCrossPointsPath.c_str());
     if (!loadMatchingPixels(params.matchingLeftCrossPointsPath, leftCrossPixelPairs))
       return false;
-    // Add in the offsets to the X (sample/column) location to account for the image crop
-    for (size_t i=0; i<leftCrossPixelPairs.leftObsList.size(); ++i)
-      leftCrossPixelPairs.leftObsList[i][0] += 2531; //TODO: READ IN THESE OFFSETS!
+    // Add in the offsets to account for the image crop
+    if (!applyCropOffsets(params.leftCrossCropOffsets, leftCrossPixelPairs))
+      return false;
   }
   if (params.matchingRightCrossPointsPath.size() > 0)
   {
     printf("Loading list of matched pixels from file %s\n", params.matchingRightCrossPointsPath.c_str());
     if (!loadMatchingPixels(params.matchingRightCrossPointsPath, rightCrossPixelPairs))
       return false;
-    // Add in the offsets to the X (sample/column) location to account for the image crop
-    for (size_t i=0; i<rightCrossPixelPairs.leftObsList.size(); ++i)
-      rightCrossPixelPairs.leftObsList[i][0] += 2531;
+    // Add in the offsets to account for the image crop
+    if (!applyCropOffsets(params.rightCrossCropOffsets, rightCrossPixelPairs))
+      return false;
   }
 
+  // Drop disparity blunders before they are added to the solver
+  filterPixelPairs(params, "left",        leftPixelPairs);
+  filterPixelPairs(params, "right",       rightPixelPairs);
+  filterPixelPairs(params, "left cross",  leftCrossPixelPairs);
+  filterPixelPairs(params, "right cross", rightCrossPixelPairs);
+
   // Total up all the loaded points
   const size_t totalNumPoints = overlapPairs.size()        + stereoOverlapPairs.size() +
                                 leftPixelPairs.size()      + rightPixelPairs.size() +
@@ -421,8 +838,544 @@ size_t loadInputPointPairs(const Parameters &params, PointObsList &leftPixelPair
 //-------------------------------------------------------------------------------------------
 //-------------------------------------------------------------------------------------------
 
+/// Triangulates a range of pixel pairs with one copy of the camera models, used by triangulatePairsParallel
+/// - The camera state tables must already be built so that this does not go through SPICE.
+void triangulatePairRange(LrocPairModel *model, LrocPairModel::FilePairType pairType,
+                          const double *cameraParams, const PointObsList *pairs,
+                          size_t startIndex, size_t stopIndex,
+                          double surfaceElevation, bool useStereo,
+                          std::vector<Vector3> *points, std::vector<double> *errors)
+{
+  for (size_t i=startIndex; i<stopIndex; ++i)
+  {
+    model->triangulateFilePair(pairType, cameraParams, pairs->leftObsList[i], pairs->rightObsList[i],
+                               surfaceElevation, useStereo, (*points)[i], (*errors)[i]);
+  }
+}
+
+/// Sets up a copy of the camera models for each thread with the camera parameters applied
+/// - The first thread uses lrocClass itself, the other copies are stored in clones.
+/// - The camera state tables are built here and shared by the copies, after this the triangulation
+///   only reads the tables and the threads do not need SPICE.
+std::vector<LrocPairModel*> makeThreadModels(LrocPairModel &lrocClass, int numThreads, const double *cameraParams,
+                                             std::vector<boost::shared_ptr<LrocPairModel> > &clones)
+{
+  if (numThreads < 1)
+    numThreads = 1;
+  lrocClass.prepareStateTables();
+  std::vector<LrocPairModel*> threadModels(1, &lrocClass);
+  for (int i=1; i<numThreads; ++i)
+  {
+    clones.push_back(boost::shared_ptr<LrocPairModel>(lrocClass.clone()));
+    threadModels.push_back(clones.back().get());
+  }
+  for (size_t i=0; i<threadModels.size(); ++i)
+    threadModels[i]->setGlobalTransform(cameraParams);
+  return threadModels;
+}
+
+/// Triangulates all of the pairs in a list, splitting them evenly between the thread models
+void triangulatePairsParallel(const std::vector<LrocPairModel*> &threadModels, LrocPairModel::FilePairType pairType,
+                              const double *cameraParams, const PointObsList &pairs,
+                              double surfaceElevation, bool useStereo,
+                              std::vector<Vector3> &points, std::vector<double> &errors)
+{
+  const size_t numPairs = pairs.size();
+  points.resize(numPairs);
+  errors.resize(numPairs);
+  const size_t pairsPerThread = (numPairs + threadModels.size() - 1) / threadModels.size();
+  boost::thread_group threads;
+  for (size_t t=0; t<threadModels.size(); ++t)
+  {
+    const size_t startIndex = t*pairsPerThread;
+    const size_t stopIndex  = std::min(numPairs, startIndex + pairsPerThread);
+    if (startIndex >= stopIndex)
+      break;
+    threads.create_thread(boost::bind(&triangulatePairRange, threadModels[t], pairType, cameraParams,
+                                      &pairs, startIndex, stopIndex, surfaceElevation, useStereo,
+                                      &points, &errors));
+  }
+  threads.join_all();
+}
+
+/// Computes the initial state for the pixel pair files without loading all of the pairs at once.
+/// - The files are read a chunk at a time.  Each chunk is split between threads with their own camera models
+///   and written out before the next chunk is read, so memory use does not grow with the number of pairs.
+/// - Writes the same initial state, GDC point and point error files as the normal --initialOnly mode.
+/// - The ipfind matches between adjacent cubes are not used.
+bool streamTriangulatePoints(const Parameters &params, LrocPairModel &lrocClass,
+                             const std::vector<double> &initialValues, int numThreads)
+{
+  const size_t NUM_CAMERA_PARAMS = SolverParameterStore::NUM_CAMERA_PARAMS;
+
+  // Camera parameters start at zero unless they were passed in
+  double cameraParams[NUM_CAMERA_PARAMS];
+  for (size_t i=0; i<NUM_CAMERA_PARAMS; ++i)
+    cameraParams[i] = (i < initialValues.size()) ? initialValues[i] : 0.0;
+  const bool useStereo = !initialValues.empty();
+
+  // Set up a copy of the camera models for each thread
+  std::vector<boost::shared_ptr<LrocPairModel> > clones;
+  std::vector<LrocPairModel*> threadModels = makeThreadModels(lrocClass, numThreads, cameraParams, clones);
+  printf("Triangulating pixel pairs in chunks of %d with %d threads\n", params.streamChunkSize, (int)threadModels.size());
+
+  // List the pixel pair files and which cameras they belong to
+  std::vector<std::string>                       pairPaths;
+  std::vector<LrocPairModel::FilePairType>       pairTypes;
+  std::vector<const std::vector<double>*>        pairCropOffsets;
+  if (!params.matchingLeftPointsPath.empty())
+  {
+    pairPaths.push_back(params.matchingLeftPointsPath);
+    pairTypes.push_back(LrocPairModel::LEFT_LEFTS_PAIRS);
+    pairCropOffsets.push_back(0);
+  }
+  if (!params.matchingRightPointsPath.empty())
+  {
+    pairPaths.push_back(params.matchingRightPointsPath);
+    pairTypes.push_back(LrocPairModel::RIGHT_RIGHTS_PAIRS);
+    pairCropOffsets.push_back(0);
+  }
+  if (!params.matchingLeftCrossPointsPath.empty())
+  {
+    pairPaths.push_back(params.matchingLeftCrossPointsPath);
+    pairTypes.push_back(LrocPairModel::LEFT_RIGHTS_PAIRS);
+    pairCropOffsets.push_back(&params.leftCrossCropOffsets);
+  }
+  if (!params.matchingRightCrossPointsPath.empty())
+  {
+    pairPaths.push_back(params.matchingRightCrossPointsPath);
+    pairTypes.push_back(LrocPairModel::LEFTS_RIGHT_PAIRS);
+    pairCropOffsets.push_back(&params.rightCrossCropOffsets);
+  }
+  if (pairPaths.empty())
+  {
+    printf("Error: --streamPoints needs at least one pixel pair file!\n");
+    return false;
+  }
+
+  // Open all of the output files
+  std::string initialStatePath    = params.outputPrefix + "-initialParamState.csv";
+  std::string initialGdcCoordPath = params.outputPrefix + "-initialGdcPoints.csv";
+  std::string initialErrorPath    = params.outputPrefix + "-initialPointError.csv";
+  printf("Writing initial state log to %s\n", initialStatePath.c_str());
+  printf("Writing initial error log to %s\n", initialErrorPath.c_str());
+  std::ofstream initialStateFile   (initialStatePath.c_str());
+  std::ofstream initialGdcCoordFile(initialGdcCoordPath.c_str());
+  std::ofstream initialErrorFile   (initialErrorPath.c_str());
+  initialGdcCoordFile.precision(12);
+  for (size_t i=0; i<NUM_CAMERA_PARAMS; ++i)
+    initialStateFile << cameraParams[i] << std::endl;
+
+  vw::cartography::Datum datum("D_MOON");
+
+  size_t totalNumPoints   = 0;
+  double totalPointError  = 0;
+  const size_t chunkSize  = (params.streamChunkSize > 0) ? params.streamChunkSize : 100000;
+  PointObsList        chunkPairs;
+  std::vector<Vector3> chunkPoints;
+  std::vector<double>  chunkErrors;
+  for (size_t f=0; f<pairPaths.size(); ++f)
+  {
+    printf("Triangulating pixel pairs from file %s\n", pairPaths[f].c_str());
+    PixelPairSource pairSource;
+    if (!pairSource.open(pairPaths[f]))
+      return false;
+
+    while (pairSource.read(chunkSize, chunkPairs) > 0)
+    {
+      // Add in the offsets to account for the image crop
+      if (pairCropOffsets[f] && !applyCropOffsets(*pairCropOffsets[f], chunkPairs))
+        return false;
+
+      // Split the chunk between the threads
+      const size_t numPairs = chunkPairs.size();
+      triangulatePairsParallel(threadModels, pairTypes[f], cameraParams, chunkPairs,
+                               params.expectedSurfaceElevation, useStereo, chunkPoints, chunkErrors);
+
+      // Write out this chunk in the same order as the input file
+      for (size_t i=0; i<numPairs; ++i)
+      {
+        const Vector3 &gccPoint = chunkPoints[i];
+        initialStateFile << gccPoint[0] << std::endl << gccPoint[1] << std::endl << gccPoint[2] << std::endl;
+
+        // Write lat, lon, height so pc_align tool can read these files
+        Vector3 gdcCoord = datum.cartesian_to_geodetic(gccPoint);
+        initialGdcCoordFile << gdcCoord[1] << ", " << gdcCoord[0] << ", " << gdcCoord[2] << std::endl;
+
+        initialErrorFile << chunkErrors[i] << std::endl;
+        totalPointError += chunkErrors[i];
+      }
+      totalNumPoints += numPairs;
+      printf("Triangulated %lu pixel pairs\n", (unsigned long)totalNumPoints);
+    }
+  }
+  initialStateFile.close();
+  initialGdcCoordFile.close();
+  initialErrorFile.close();
+
+  if (totalNumPoints == 0)
+  {
+    printf("Error: No pixel pairs were loaded!\n");
+    return false;
+  }
+  printf(">>>> Mean point error before optimization = %lf <<<<<<\n", totalPointError / totalNumPoints);
+  printf("Stopping after initial state calculation\n");
+  return true;
+}
+
+//-------------------------------------------------------------------------------------------
+
+/// Summary statistics of a point error list
+struct ErrorStatistics
+{
+  size_t numPoints;
+  double mean;
+  double median;
+  double max;
+};
+
+ErrorStatistics computeErrorStatistics(std::vector<double> errors)
+{
+  ErrorStatistics stats;
+  stats.numPoints = errors.size();
+  stats.mean      = 0;
+  stats.median    = 0;
+  stats.max       = 0;
+  if (errors.empty())
+    return stats;
+
+  for (size_t i=0; i<errors.size(); ++i)
+    stats.mean += errors[i];
+  stats.mean = stats.mean / errors.size();
+
+  std::sort(errors.begin(), errors.end());
+  size_t centralIndex = errors.size()/2;
+  if ((errors.size() % 2) == 0)
+    stats.median = (errors[centralIndex-1] + errors[centralIndex]) / 2.0;
+  else
+    stats.median = errors[centralIndex];
+  stats.max = errors.back();
+  return stats;
+}
+
+/// Camera model counters
+struct SolverCallCounts
+{
+  size_t spiceCalls;
+  size_t projections;
+  size_t timeSolveIterations;
+};
+
+/// Records the camera model counters at the end of every solver iteration
+class CallCountCallback : public ceres::IterationCallback
+{
+public:
+  CallCountCallback(LrocPairModelPool &modelPool) : _modelPool(modelPool)
+  {
+    _modelPool.getCallCounts(_start.spiceCalls, _start.projections, _start.timeSolveIterations);
+  }
+
+  virtual ceres::CallbackReturnType operator()(const ceres::IterationSummary& summary)
+  {
+    // The solver threads are idle while callbacks run
+    SolverCallCounts counts;
+    _modelPool.getCallCounts(counts.spiceCalls, counts.projections, counts.timeSolveIterations);
+    counts.spiceCalls          -= _start.spiceCalls;
+    counts.projections         -= _start.projections;
+    counts.timeSolveIterations -= _start.timeSolveIterations;
+    callCounts.push_back(counts);
+    return ceres::SOLVER_CONTINUE;
+  }
+
+  std::vector<SolverCallCounts> callCounts; ///< One entry per iteration starting with iteration zero, counted from construction
+
+private:
+  LrocPairModelPool &_modelPool;
+  SolverCallCounts   _start;
+};
+
+/// Returns a quoted JSON string
+std::string jsonString(const std::string &text)
+{
+  std::string output = "\"";
+  for (size_t i=0; i<text.size(); ++i)
+  {
+    if ((text[i] == '"') || (text[i] == '\\'))
+      output += '\\';
+    if (text[i] == '\n')
+      output += "\\n";
+    else
+      output += text[i];
+  }
+  return output + "\"";
+}
+
+/// Returns a JSON number, JSON has no NaN or infinity so these are written as null
+std::string jsonNumber(double value)
+{
+  if ((value != value) || (fabs(value) > std::numeric_limits<double>::max()))
+    return "null";
+  std::ostringstream text;
+  text.precision(12);
+  text << value;
+  return text.str();
+}
+
+void writeErrorStatistics(std::ofstream &file, const std::string &name, const ErrorStatistics &stats)
+{
+  file << "  " << jsonString(name) << ": {\"numPoints\": " << stats.numPoints
+       << ", \"mean\": "   << jsonNumber(stats.mean)
+       << ", \"median\": " << jsonNumber(stats.median)
+       << ", \"max\": "    << jsonNumber(stats.max) << "}";
+}
+
+/// Writes the error statistics and, if the solver was run, its timing and per-iteration progress to a JSON file
+/// - summary, callCounts, finalStats and linearSolver are null if only the initial state was computed.
+bool writeSolverTelemetry(const std::string &path, const ErrorStatistics &initialStats,
+                          const ceres::Solver::Summary *summary, const std::vector<SolverCallCounts> *callCounts,
+                          const ErrorStatistics *finalStats, const LinearSolverChoice *linearSolver=0)
+{
+  printf("Writing solver telemetry to %s\n", path.c_str());
+  std::ofstream file(path.c_str());
+  if (file.fail())
+  {
+    printf("Failed to open telemetry file %s\n", path.c_str());
+    return false;
+  }
+  file.precision(12);
+
+  file << "{\n";
+  writeErrorStatistics(file, "initialError", initialStats);
+  if (!summary)
+  {
+    file << "\n}\n";
+    file.close();
+    return true;
+  }
+  file << ",\n";
+  writeErrorStatistics(file, "finalError", *finalStats);
+  file << ",\n  \"meanErrorChange\": " << jsonNumber(finalStats->mean - initialStats.mean) << ",\n";
+
+  // Totals for the whole solve
+  SolverCallCounts totals = {0, 0, 0};
+  if (!callCounts->empty())
+    totals = callCounts->back();
+  file << "  \"solver\": {\n"
+       << "    \"termination\": "           << jsonString(ceres::TerminationTypeToString(summary->termination_type)) << ",\n";
+  if (linearSolver)
+    file << "    \"linearSolverType\": "      << jsonString(ceres::LinearSolverTypeToString(linearSolver->linearSolverType))     << ",\n"
+         << "    \"preconditionerType\": "    << jsonString(ceres::PreconditionerTypeToString(linearSolver->preconditionerType)) << ",\n"
+         << "    \"ordering\": "              << jsonString(linearSolver->schurOrdering ? "schur" : "ceres") << ",\n"
+         << "    \"linearSolverThreads\": "   << linearSolver->numThreads << ",\n"
+         << "    \"linearSolverAutomatic\": " << (linearSolver->automatic ? "true" : "false") << ",\n"
+         << "    \"linearSolverReason\": "    << jsonString(linearSolver->reason) << ",\n";
+  file << "    \"numSuccessfulSteps\": "    << summary->num_successful_steps   << ",\n"
+       << "    \"numUnsuccessfulSteps\": "  << summary->num_unsuccessful_steps << ",\n"
+       << "    \"numResidualBlocks\": "     << summary->num_residual_blocks    << ",\n"
+       << "    \"numParameterBlocks\": "    << summary->num_parameter_blocks   << ",\n"
+       << "    \"initialCost\": "           << jsonNumber(summary->initial_cost) << ",\n"
+       << "    \"finalCost\": "             << jsonNumber(summary->final_cost)   << ",\n"
+       << "    \"preprocessorTime\": "      << summary->preprocessor_time_in_seconds        << ",\n"
+       << "    \"minimizerTime\": "         << summary->minimizer_time_in_seconds           << ",\n"
+       << "    \"postprocessorTime\": "     << summary->postprocessor_time_in_seconds       << ",\n"
+       << "    \"totalTime\": "             << summary->total_time_in_seconds               << ",\n"
+       << "    \"residualEvaluationTime\": "<< summary->residual_evaluation_time_in_seconds << ",\n"
+       << "    \"jacobianEvaluationTime\": "<< summary->jacobian_evaluation_time_in_seconds << ",\n"
+       << "    \"linearSolverTime\": "      << summary->linear_solver_time_in_seconds       << ",\n"
+       << "    \"projections\": "           << totals.projections         << ",\n"
+       << "    \"spiceCalls\": "            << totals.spiceCalls          << ",\n"
+       << "    \"timeSolveIterations\": "   << totals.timeSolveIterations << ",\n"
+       << "    \"timeSolveIterationsPerProjection\": "
+       << ((totals.projections > 0) ? static_cast<double>(totals.timeSolveIterations)/totals.projections : 0.0) << "\n"
+       << "  },\n";
+
+  // One entry per iteration, the call counts are for that iteration only
+  file << "  \"iterations\": [";
+  SolverCallCounts previous = {0, 0, 0};
+  for (size_t i=0; i<summary->iterations.size(); ++i)
+  {
+    const ceres::IterationSummary &iteration = summary->iterations[i];
+    SolverCallCounts counts = previous;
+    if (i < callCounts->size())
+      counts = (*callCounts)[i];
+    const size_t projections = counts.projections - previous.projections;
+    const size_t iterations  = counts.timeSolveIterations - previous.timeSolveIterations;
+
+    file << ((i > 0) ? ",\n" : "\n")
+         << "    {\"iteration\": "            << iteration.iteration
+         << ", \"cost\": "                    << jsonNumber(iteration.cost)
+         << ", \"costChange\": "              << jsonNumber(iteration.cost_change)
+         << ", \"stepNorm\": "                << jsonNumber(iteration.step_norm)
+         << ", \"gradientMaxNorm\": "         << jsonNumber(iteration.gradient_max_norm)
+         << ", \"trustRegionRadius\": "       << iteration.trust_region_radius
+         << ", \"stepIsSuccessful\": "        << (iteration.step_is_successful ? "true" : "false")
+         << ", \"linearSolverIterations\": "  << iteration.linear_solver_iterations
+         << ", \"stepSolverTime\": "          << iteration.step_solver_time_in_seconds
+         << ", \"iterationTime\": "           << iteration.iteration_time_in_seconds
+         << ", \"cumulativeTime\": "          << iteration.cumulative_time_in_seconds
+         << ", \"projections\": "             << projections
+         << ", \"spiceCalls\": "              << counts.spiceCalls - previous.spiceCalls
+         << ", \"timeSolveIterations\": "     << iterations
+         << ", \"timeSolveIterationsPerProjection\": "
+         << ((projections > 0) ? static_cast<double>(iterations)/projections : 0.0) << "}";
+    previous = counts;
+  }
+  file << "\n  ]\n}\n";
+  file.close();
+  return true;
+}
+
+//-------------------------------------------------------------------------------------------
+
+/// Writes the solver problem with tabulated camera geometry so it can be replayed without ISIS.
+/// - pairLists are in the order the points are stored in the state.
+bool writeProblemSnapshot(const std::string &path, const LrocPairModel &lrocClass,
+                          const PointObsList* pairLists[SNAPSHOT_NUM_PAIR_TYPES], const Vector<double> &initialState)
+{
+  printf("Writing solver snapshot to %s\n", path.c_str());
+  SolverSnapshot snapshot;
+
+  const SolverLineScanCamera* cameras[SNAPSHOT_NUM_CAMERAS];
+  lrocClass.getCameraModels(cameras);
+  for (int c=0; c<SNAPSHOT_NUM_CAMERAS; ++c)
+  {
+    if (!cameras[c])
+      continue;
+    const IsisInterfaceLineScanRot* cubeCamera = dynamic_cast<const IsisInterfaceLineScanRot*>(cameras[c]);
+    if (!cubeCamera)
+    {
+      printf("Error: Snapshots can only be written from cube camera models\n");
+      return false;
+    }
+    std::vector<Vector3> positions, sampleLooks;
+    std::vector<Quat>    lookRotations;
+    cubeCamera->tabulate_geometry(positions, lookRotations, sampleLooks);
+
+    CameraGeometryTable &table = snapshot.cameras[c];
+    for (size_t i=0; i<positions.size(); ++i)
+    {
+      for (int j=0; j<3; ++j)
+        table.positions.push_back(positions[i][j]);
+      table.lookRotations.push_back(lookRotations[i].w());
+      table.lookRotations.push_back(lookRotations[i].x());
+      table.lookRotations.push_back(lookRotations[i].y());
+      table.lookRotations.push_back(lookRotations[i].z());
+    }
+    for (size_t i=0; i<sampleLooks.size(); ++i)
+      for (int j=0; j<3; ++j)
+        table.sampleLooks.push_back(sampleLooks[i][j]);
+  }
+
+  for (int p=0; p<SNAPSHOT_NUM_PAIR_TYPES; ++p)
+  {
+    const PointObsList &pairs = *(pairLists[p]);
+    snapshot.pairs[p].reserve(4*pairs.size());
+    for (size_t i=0; i<pairs.size(); ++i)
+    {
+      snapshot.pairs[p].push_back(pairs.leftObsList [i][0]);
+      snapshot.pairs[p].push_back(pairs.leftObsList [i][1]);
+      snapshot.pairs[p].push_back(pairs.rightObsList[i][0]);
+      snapshot.pairs[p].push_back(pairs.rightObsList[i][1]);
+    }
+  }
+  snapshot.state.assign(initialState.begin(), initialState.end());
+
+  if (!writeSolverSnapshot(path, snapshot))
+  {
+    printf("Error: Failed to write solver snapshot %s\n", path.c_str());
+    return false;
+  }
+  return true;
+}
+
+//-------------------------------------------------------------------------------------------
+
+/// Written next to a state file, holds the hash of the pixel pairs its points were solved from
+const std::string OBSERVATION_HASH_EXTENSION = ".obsHash";
+
+/// Returns a hash of the pixel pairs in the order their points are stored in the solver state
+/// - The points of a state file can only be reused for exactly the same pairs.
+std::string hashObservations(const PointObsList &overlapPairs,   const PointObsList &stereoOverlapPairs,
+                             const PointObsList &leftPixelPairs, const PointObsList &rightPixelPairs,
+                             const PointObsList &leftCrossPixelPairs, const PointObsList &rightCrossPixelPairs)
+{
+  const PointObsList* lists[6] = {&overlapPairs,        &stereoOverlapPairs,
+                                  &leftPixelPairs,      &rightPixelPairs,
+                                  &leftCrossPixelPairs, &rightCrossPixelPairs};
+  boost::uint64_t hash = FNV_OFFSET_BASIS;
+  for (int i=0; i<6; ++i)
+  {
+    const boost::uint64_t numPairs = lists[i]->size();
+    hash = addToHash(hash, &numPairs, sizeof(numPairs));
+    if (numPairs == 0)
+      continue;
+    hash = addToHash(hash, &(lists[i]->leftObsList [0]), numPairs*sizeof(PixelObservation));
+    hash = addToHash(hash, &(lists[i]->rightObsList[0]), numPairs*sizeof(PixelObservation));
+  }
+  std::ostringstream text;
+  text << std::hex << std::setw(16) << std::setfill('0') << hash;
+  return text.str();
+}
+
+//-------------------------------------------------------------------------------------------
+
+/// Checks the alignment of the LE/RE overlap matches against the current cubes without running the solver.
+/// - The matches are triangulated in parallel with the same starting estimate the solver would use.
+/// - Writes the GDC point file the solver writes, a point error file and the telemetry error statistics.
+bool checkPairAlignment(const Parameters &params, LrocPairModel &lrocClass, const std::vector<double> &initialValues,
+                        const PointObsList &overlapPairs, const PointObsList &stereoOverlapPairs, int numThreads)
+{
+  const size_t NUM_CAMERA_PARAMS = SolverParameterStore::NUM_CAMERA_PARAMS;
+
+  // Camera parameters start at zero unless they were passed in
+  double cameraParams[NUM_CAMERA_PARAMS];
+  for (size_t i=0; i<NUM_CAMERA_PARAMS; ++i)
+    cameraParams[i] = (i < initialValues.size()) ? initialValues[i] : 0.0;
+  const bool useStereo = !initialValues.empty();
+
+  std::vector<boost::shared_ptr<LrocPairModel> > clones;
+  std::vector<LrocPairModel*> threadModels = makeThreadModels(lrocClass, numThreads, cameraParams, clones);
+  printf("Checking alignment of %lu main and %lu stereo overlap pairs with %d threads\n",
+         (unsigned long)overlapPairs.size(), (unsigned long)stereoOverlapPairs.size(), (int)threadModels.size());
+
+  std::vector<Vector3> points, stereoPoints;
+  std::vector<double>  errors, stereoErrors;
+  triangulatePairsParallel(threadModels, LrocPairModel::LEFT_RIGHT_PAIRS, cameraParams, overlapPairs,
+                           params.expectedSurfaceElevation, useStereo, points, errors);
+  triangulatePairsParallel(threadModels, LrocPairModel::LEFTS_RIGHTS_PAIRS, cameraParams, stereoOverlapPairs,
+                           params.expectedSurfaceElevation, useStereo, stereoPoints, stereoErrors);
+  points.insert(points.end(), stereoPoints.begin(), stereoPoints.end());
+  errors.insert(errors.end(), stereoErrors.begin(), stereoErrors.end());
+
+  // Write lat, lon, height so pc_align tool can read these files
+  vw::cartography::Datum datum("D_MOON");
+  std::string outputGdcPath = params.outputPrefix + "-outputGdcPoints.csv";
+  std::string errorPath     = params.outputPrefix + "-checkPointError.csv";
+  printf("Writing check points to %s\n", outputGdcPath.c_str());
+  std::ofstream gdcCoordFile(outputGdcPath.c_str());
+  std::ofstream errorFile   (errorPath.c_str());
+  gdcCoordFile.precision(12);
+  for (size_t i=0; i<points.size(); ++i)
+  {
+    Vector3 gdcCoord = datum.cartesian_to_geodetic(points[i]);
+    gdcCoordFile << gdcCoord[1] << ", " << gdcCoord[0] << ", " << gdcCoord[2] << std::endl;
+    errorFile    << errors[i] << std::endl;
+  }
+  gdcCoordFile.close();
+  errorFile.close();
+
+  ErrorStatistics stats = computeErrorStatistics(errors);
+  printf(">>>> Mean check point error = %lf <<<<<<\n", stats.mean);
+  printf(">>>> Median check point error = %lf <<<<<<\n", stats.median);
+  writeSolverTelemetry(params.outputPrefix + "-solverTelemetry.json", stats, 0, 0, 0);
+  return true;
+}
+
+//-------------------------------------------------------------------------------------------
+
 // Main solver function
-bool optimizeRotations(Parameters & params)
+// - If a camera cache is passed in the camera models are taken from it so they can be shared between jobs.
+bool optimizeRotations(Parameters & params, CameraModelCache *cameraCache=0)
 {
   // This is the number of non-point parameters there are.
   int NUM_CAMERA_PARAMS = 12;
@@ -437,7 +1390,7 @@ bool optimizeRotations(Parameters & params)
   boost::filesystem::path rightStereoBoostPath(params.rightStereoFilePath);
   
   // Load each of the four input cubes into the solver if they are present
-  LrocPairModel lrocClass;
+  LrocPairModel lrocClass(cameraCache);
   if (params.leftFilePath.size() > 0)
   {
     if (boost::filesystem::exists(boost::filesystem::path(params.leftFilePath)))
@@ -498,21 +1451,11 @@ bool optimizeRotations(Parameters & params)
   }
 
  
-  // Now load up all of the pixel pairs
-  PointObsList leftPixelPairs, rightPixelPairs, overlapPairs, stereoOverlapPairs, leftCrossPixelPairs, rightCrossPixelPairs;
-  const size_t totalNumPoints = loadInputPointPairs(params, leftPixelPairs,      rightPixelPairs,
-                                                            overlapPairs,        stereoOverlapPairs,
-                                                            leftCrossPixelPairs, rightCrossPixelPairs);
-  if (totalNumPoints <= 40)
-  {
-    printf("Error: Did not load enough points to compute a solution!");
-    return false;
-  }
-  
-  //TODO: Can't really load point values without a rotation-modified pixel to vector function.
   // If a path to an initial value file was provided, load them
-  size_t estimatedNumParams = NUM_CAMERA_PARAMS;// + totalNumPoints*PARAMS_PER_POINT;
-  std::vector<double> initialValues;
+  // - The first values are the camera parameters.  A full state file from a previous solve also
+  //   contains the point coordinates, those are loaded into initialPoints.
+  size_t estimatedNumParams = NUM_CAMERA_PARAMS;
+  std::vector<double> initialValues, initialPoints;
   if (!params.initialValuePath.empty())
   {
     initialValues.reserve(estimatedNumParams);
@@ -527,17 +1470,59 @@ bool optimizeRotations(Parameters & params)
       initialValues.push_back(newVal);
       ++initialValueCount;
     }
-    initalValueFile.close();
     if ((initalValueFile.fail()) || (initialValueCount > estimatedNumParams))
     {
       printf("Error reading from initial value file %s\n", params.initialValuePath.c_str());
       printf("Read %d values, expected %d values\n", initialValueCount, estimatedNumParams);
       return false;
     }
+    double newVal;
+    while (initalValueFile >> newVal)
+      initialPoints.push_back(newVal);
+    initalValueFile.close();
+    if (!initialPoints.empty())
+      printf("Read %lu initial point coordinates\n", (unsigned long)initialPoints.size());
+
+    // The global transform may already be applied to the stereo cubes
+    if (params.resetGlobalTransform)
+    {
+      for (size_t i=3; i<9; ++i)
+        initialValues[i] = 0.0;
+    }
   }
 
   
   
+  // Large --initialOnly runs are triangulated a chunk at a time instead of loading every pair
+  if (params.streamPoints)
+  {
+    if (!params.initialOnly)
+    {
+      printf("Error: --streamPoints can only be used with --initialOnly!\n");
+      return false;
+    }
+    const int numThreads = (params.num_threads > 0) ? params.num_threads : vw::vw_settings().default_num_threads();
+    return streamTriangulatePoints(params, lrocClass, initialValues, numThreads);
+  }
+
+  // Now load up all of the pixel pairs
+  PointObsList leftPixelPairs, rightPixelPairs, overlapPairs, stereoOverlapPairs, leftCrossPixelPairs, rightCrossPixelPairs;
+  const size_t totalNumPoints = loadInputPointPairs(params, leftPixelPairs,      rightPixelPairs,
+                                                            overlapPairs,        stereoOverlapPairs,
+                                                            leftCrossPixelPairs, rightCrossPixelPairs);
+  if (totalNumPoints <= 40)
+  {
+    printf("Error: Did not load enough points to compute a solution!");
+    return false;
+  }
+
+  // Alignment checks only need the overlap matches triangulated against the current cubes
+  if (params.checkOnly)
+  {
+    const int numThreads = (params.num_threads > 0) ? params.num_threads : vw::vw_settings().default_num_threads();
+    return checkPairAlignment(params, lrocClass, initialValues, overlapPairs, stereoOverlapPairs, numThreads);
+  }
+  
   // Load the inital points into the solver
   printf("Initializing solver state...\n");
   Vector<double> initialState;
@@ -551,6 +1536,28 @@ bool optimizeRotations(Parameters & params)
   }
   // The initial state contains the camera parameters, then the point coordinates of each set of points in sequence
 
+  // Warm start from the points of a previous solve.  They are only valid if the same pixel pairs were loaded,
+  //  which is checked against the hash the previous solve wrote next to its state file.
+  const std::string observationHash = hashObservations(overlapPairs,        stereoOverlapPairs,
+                                                       leftPixelPairs,      rightPixelPairs,
+                                                       leftCrossPixelPairs, rightCrossPixelPairs);
+  if (!initialPoints.empty())
+  {
+    std::string inputHash;
+    std::ifstream inputHashFile((params.initialValuePath + OBSERVATION_HASH_EXTENSION).c_str());
+    inputHashFile >> inputHash;
+    if (initialPoints.size() != initialState.size() - NUM_CAMERA_PARAMS)
+      printf("Warning: Input file has %lu point coordinates but %lu points were loaded, triangulating the points instead\n",
+             (unsigned long)initialPoints.size(), (unsigned long)totalNumPoints);
+    else if (inputHash != observationHash)
+      printf("Warning: Input points were not solved from the same pixel pairs, triangulating the points instead\n");
+    else
+    {
+      printf("Starting from the input point coordinates\n");
+      std::copy(initialPoints.begin(), initialPoints.end(), initialState.begin()+NUM_CAMERA_PARAMS);
+    }
+  }
+
 
   // Set up georeference class with default moon datum
   vw::cartography::Datum datum("D_MOON");
@@ -607,12 +1614,23 @@ bool optimizeRotations(Parameters & params)
   initialErrorFile.close();
   meanInitialError = meanInitialError / currentError.size();
   printf(">>>> Mean point error before optimization = %lf <<<<<<\n", meanInitialError);
+  ErrorStatistics initialStats = computeErrorStatistics(currentError);
+  std::string telemetryPath = params.outputPrefix + "-solverTelemetry.json";
   
 
   //Vector<double> initialComputedObservations = lrocClass(initialState);
+
+  if (!params.snapshotPath.empty())
+  {
+    const PointObsList* pairLists[SNAPSHOT_NUM_PAIR_TYPES] = {&overlapPairs,        &stereoOverlapPairs,
+                                                              &leftPixelPairs,      &rightPixelPairs,
+                                                              &leftCrossPixelPairs, &rightCrossPixelPairs};
+    writeProblemSnapshot(params.snapshotPath, lrocClass, pairLists, initialState);
+  }
   
   if (params.initialOnly)
   {
+    writeSolverTelemetry(telemetryPath, initialStats, 0, 0, 0);
     printf("Stopping after initial state calculation\n");
     return true;
   }
@@ -623,215 +1641,150 @@ bool optimizeRotations(Parameters & params)
   printf("Using Ceres solver!\n");
   //TODO: Turn on Glog
   
-  // Create Ceres solver object
-  ceres::Problem problem;
-  
-  // Set up camera parameters for solver
-  double* localRotation       = &(initialState[0]);
-  double* globalRotation      = &(initialState[3]);
-  double* globalPosition      = &(initialState[6]);
-  double* localStereoRotation = &(initialState[9]);
-
-  problem.AddParameterBlock(localRotation,       3);
-  problem.AddParameterBlock(globalRotation,      3);
-  problem.AddParameterBlock(globalPosition,      3);
-  problem.AddParameterBlock(localStereoRotation, 3);
-
-  const int NUM_PARAMS_CAMERA_SECTION  = 3;
-  const int NUM_PARAMS_PER_POINT       = 3;
-  const int NUM_PARAMS_PER_OBSERVATION = 2;
-
-  size_t currentPointIndex = NUM_CAMERA_PARAMS;
-  ceres::LossFunction* lossFunction = new ceres::CauchyLoss(5.0);
-
-  if (overlapPairs.size() > 0)
-    printf("Loading parameters for main camera pair...\n");
-  for (size_t i=0; i<overlapPairs.size(); ++i) // For each input point
-  {
-    // Set up this point's parameters for the solver
-    double* pointParams = &(initialState[currentPointIndex]);
-    //printf("Loading L-R point %lf, %lf, %lf\n", pointParams[0], pointParams[1], pointParams[2]);
-    currentPointIndex += NUM_PARAMS_PER_POINT;
-    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
-    
-    // Add the function and residual block for the left camera
-    ceres::CostFunction* costFunctionLeft = 
-            new ceres::NumericDiffCostFunction<LeftCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_PER_POINT>(
-                  new LeftCostFunctor(&lrocClass, overlapPairs.leftObsList[i]));
-
-    problem.AddResidualBlock(costFunctionLeft, lossFunction, pointParams);
-
-    // Add the function and residual block for the right camera (slightly more complex)
-    ceres::CostFunction* costFunctionRight = 
-            new ceres::NumericDiffCostFunction<RightCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new RightCostFunctor(&lrocClass, overlapPairs.rightObsList[i]));
-    
-    problem.AddResidualBlock(costFunctionRight, lossFunction, localRotation, pointParams);
-    
-  } // End of loop through main camera pair points
-
-
-  //currentPointIndex += overlapPairs.size()*NUM_PARAMS_PER_POINT; //DEBUG!!!!!!
-
-  if (stereoOverlapPairs.size() > 0)
-    printf("Loading parameters for stereo camera pair...\n");
-  for (size_t i=0; i<stereoOverlapPairs.size(); ++i) // For each input point
-  {
-    // Set up this point's parameters for the solver
-    double* pointParams = &(initialState[currentPointIndex]);
-    currentPointIndex += NUM_PARAMS_PER_POINT;
-    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
-  
-    
-    // Add the function and residual block for the left camera
-    ceres::CostFunction* costFunctionLeft = 
-            new ceres::NumericDiffCostFunction<LeftStereoCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new LeftStereoCostFunctor(&lrocClass, stereoOverlapPairs.leftObsList[i]));
-
-    problem.AddResidualBlock(costFunctionLeft, lossFunction, globalRotation, globalPosition, pointParams);
-
-    // Add the function and residual block for the right camera (slightly more complex)
-    ceres::CostFunction* costFunctionRight = 
-            new ceres::NumericDiffCostFunction<RightStereoCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new RightStereoCostFunctor(&lrocClass, stereoOverlapPairs.rightObsList[i]));
-    
-    problem.AddResidualBlock(costFunctionRight, lossFunction, globalRotation, globalPosition, localStereoRotation, pointParams);
-    
-  } // End of loop through stereo camera pair points
-
-
-  //currentPointIndex += stereoOverlapPairs.size()*NUM_PARAMS_PER_POINT; //DEBUG!!!!!!
-
-  if (leftPixelPairs.size() > 0)
-    printf("Loading parameters for two left cameras...\n");
-  for (size_t i=0; i<leftPixelPairs.size(); ++i) // For each input point
-  {
-    // Set up this point's parameters for the solver
-    double* pointParams = &(initialState[currentPointIndex]);
-    //printf("Loading L-L point %lf, %lf, %lf\n", pointParams[0], pointParams[1], pointParams[2]);
-    currentPointIndex += NUM_PARAMS_PER_POINT;
-    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
-    
-    // Add the function and residual block for the left camera
-    ceres::CostFunction* costFunctionLeft = 
-            new ceres::NumericDiffCostFunction<LeftCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_PER_POINT>(
-                  new LeftCostFunctor(&lrocClass, leftPixelPairs.leftObsList[i]));
-
-    problem.AddResidualBlock(costFunctionLeft, lossFunction, pointParams);
-
-
-    // Add the function and residual block for the stereo left camera (slightly more complex)
-    ceres::CostFunction* costFunctionRight = 
-            new ceres::NumericDiffCostFunction<LeftStereoCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new LeftStereoCostFunctor(&lrocClass, leftPixelPairs.rightObsList[i]));
-    
-    problem.AddResidualBlock(costFunctionRight, lossFunction, globalRotation, globalPosition, pointParams);
-    
-  } // End of loop through both left camera points
-
-
-  //currentPointIndex += leftPixelPairs.size()*NUM_PARAMS_PER_POINT; //DEBUG!!!!!!
-
-  if (rightPixelPairs.size() > 0)
-    printf("Loading parameters for two right cameras...\n");
-  for (size_t i=0; i<rightPixelPairs.size(); ++i) // For each input point
-  {
-    // Set up this point's parameters for the solver
-    double* pointParams = &(initialState[currentPointIndex]);
-    currentPointIndex += NUM_PARAMS_PER_POINT;
-    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
-  
-    
-    // Add the function and residual block for the right camera
-    ceres::CostFunction* costFunctionLeft = 
-            new ceres::NumericDiffCostFunction<RightCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new RightCostFunctor(&lrocClass, rightPixelPairs.leftObsList[i]));
-
-    problem.AddResidualBlock(costFunctionLeft, lossFunction, localRotation, pointParams);
-
-    // Add the function and residual block for the stereo right camera (slightly more complex)
-    ceres::CostFunction* costFunctionRight = 
-            new ceres::NumericDiffCostFunction<RightStereoCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new RightStereoCostFunctor(&lrocClass, rightPixelPairs.rightObsList[i]));
-    
-    problem.AddResidualBlock(costFunctionRight, lossFunction, globalRotation, globalPosition, localStereoRotation, pointParams);
-    
-  } // End of loop through both right camera points
-
-
-  if (leftCrossPixelPairs.size() > 0)
-    printf("Loading parameters for left cross camera pair...\n");
-  for (size_t i=0; i<leftCrossPixelPairs.size(); ++i) // For each input point
-  {
-    // Set up this point's parameters for the solver
-    double* pointParams = &(initialState[currentPointIndex]);
-    //printf("Loading L-R point %lf, %lf, %lf\n", pointParams[0], pointParams[1], pointParams[2]);
-    currentPointIndex += NUM_PARAMS_PER_POINT;
-    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
-
-    // Add the function and residual block for the left camera
-    ceres::CostFunction* costFunctionLeft =
-            new ceres::NumericDiffCostFunction<LeftCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_PER_POINT>(
-                  new LeftCostFunctor(&lrocClass, leftCrossPixelPairs.leftObsList[i]));
-
-    problem.AddResidualBlock(costFunctionLeft, lossFunction, pointParams);
-
-    // Add the function and residual block for the stereo right camera (slightly more complex)
-    ceres::CostFunction* costFunctionRight =
-            new ceres::NumericDiffCostFunction<RightStereoCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new RightStereoCostFunctor(&lrocClass, leftCrossPixelPairs.rightObsList[i]));
-
-    problem.AddResidualBlock(costFunctionRight, lossFunction, globalRotation, globalPosition, localStereoRotation, pointParams);
-
-  } // End of loop through left cross camera pair points
-
-  if (rightCrossPixelPairs.size() > 0)
-    printf("Loading parameters for right cross camera pair...\n");
-  for (size_t i=0; i<rightCrossPixelPairs.size(); ++i) // For each input point
-  {
-    // Set up this point's parameters for the solver
-    double* pointParams = &(initialState[currentPointIndex]);
-    //printf("Loading L-R point %lf, %lf, %lf\n", pointParams[0], pointParams[1], pointParams[2]);
-    currentPointIndex += NUM_PARAMS_PER_POINT;
-    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
-
-    // Add the function and residual block for the left camera
-    ceres::CostFunction* costFunctionLeft =
-            new ceres::NumericDiffCostFunction<LeftStereoCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new LeftStereoCostFunctor(&lrocClass, rightCrossPixelPairs.leftObsList[i]));
-
-    problem.AddResidualBlock(costFunctionLeft, lossFunction, globalRotation, globalPosition, pointParams);
-
-    // Add the function and residual block for the right camera
-    ceres::CostFunction* costFunctionRight =
-            new ceres::NumericDiffCostFunction<RightCostFunctor, ceres::CENTRAL, NUM_PARAMS_PER_OBSERVATION, NUM_PARAMS_CAMERA_SECTION, NUM_PARAMS_PER_POINT>(
-                  new RightCostFunctor(&lrocClass, rightCrossPixelPairs.rightObsList[i]));
-
-    problem.AddResidualBlock(costFunctionRight, lossFunction, localRotation, pointParams);
-
-  } // End of loop through right cross camera pair points
-
-
-  printf("Finished loading points into the solver!\n");
-       
-  // TODO: Select solver options
+  // Each solver thread gets its own copy of the camera models
+  const int numSolverThreads = (params.num_threads > 0) ? params.num_threads : vw::vw_settings().default_num_threads();
+  printf("Evaluating residuals with %d threads\n", numSolverThreads);
+  LrocPairModelPool modelPool(&lrocClass, numSolverThreads);
+
+  // Move the state into the compact solver storage.  The packed vector is rebuilt after solving.
+  SolverParameterStore solverParams;
+  solverParams.unpack(initialState);
+  initialState.set_size(0);
+
+  // Every residual of a pair type shares one of these
+  PairObservationSources mainSources       (&modelPool, overlapPairs);
+  PairObservationSources stereoSources     (&modelPool, stereoOverlapPairs);
+  PairObservationSources leftSources       (&modelPool, leftPixelPairs);
+  PairObservationSources rightSources      (&modelPool, rightPixelPairs);
+  PairObservationSources leftCrossSources  (&modelPool, leftCrossPixelPairs);
+  PairObservationSources rightCrossSources (&modelPool, rightCrossPixelPairs);
+
+  // The linear solver settings are chosen for each solve below
   ceres::Solver::Options solverOptions;
-  solverOptions.max_num_iterations           = 100; //TODO: Play with these again!
-  //solverOptions.linear_solver_type           = ceres::DENSE_SCHUR;
-  solverOptions.linear_solver_type           = ceres::SPARSE_SCHUR;
+  solverOptions.max_num_iterations           = params.maxIterations; //TODO: Play with these again!
+  solverOptions.function_tolerance           = params.functionTolerance;
   solverOptions.minimizer_progress_to_stdout = true;
   solverOptions.max_num_line_search_direction_restarts = 8;
   solverOptions.use_nonmonotonic_steps = false; // Allow non-descent steps to try to find global minimum --> Seems to lead to bad results!
   solverOptions.max_num_consecutive_invalid_steps = 10;
-  solverOptions.num_threads = 1; // SPICE cannot handle multiple threads here!
-  solverOptions.num_linear_solver_threads = 8; 
+  solverOptions.num_threads = numSolverThreads; // Safe because every thread has its own camera models
   //solverOptions.solver_log = "~/data/ceresOutput.txt";
   // There are many more options to play with!
-  
-  // Execute the Ceres solver
-  printf("Starting the Ceres solver...\n");
+
+  // In progressive mode the first levels solve on sparse subsets of the points.  The camera parameters
+  //  and points live in solverParams so each level starts where the previous one stopped.
+  // - The last level uses every point unless the camera parameters stop changing first.
+  // - The telemetry describes the last solve, the call counts printed below cover all of them.
+  const int PROGRESSIVE_STRIDE_FACTOR = 4;
+  const int numLevels = std::max(1, params.progressiveLevels);
   ceres::Solver::Summary summary;
-  ceres::Solve(solverOptions, &problem, &summary);
+  boost::shared_ptr<CallCountCallback> callCountCallback;
+  LinearSolverChoice linearSolverChoice;
+  size_t levelStride = 1;
+  printf("Starting the Ceres solver...\n");
+  modelPool.resetCallCounts(); // Only count the calls made by the solver
+  for (int level=0; level<numLevels; ++level)
+  {
+    levelStride = 1;
+    for (int i=level+1; i<numLevels; ++i)
+      levelStride *= PROGRESSIVE_STRIDE_FACTOR;
+
+    double previousCameraParams[SolverParameterStore::NUM_CAMERA_PARAMS];
+    std::copy(solverParams.localRotation(), solverParams.localRotation()+SolverParameterStore::NUM_CAMERA_PARAMS,
+              previousCameraParams);
+
+    // Create Ceres solver object, it takes ownership of the loss and cost functions
+    ceres::Problem problem;
+    ceres::LossFunction* lossFunction = new ceres::CauchyLoss(5.0);
+    ceres::ParameterBlockOrdering *ordering = new ceres::ParameterBlockOrdering;
+    const size_t numLevelPoints = addPairResiduals(problem, solverParams, lossFunction,
+                                                   mainSources,      stereoSources,
+                                                   leftSources,      rightSources,
+                                                   leftCrossSources, rightCrossSources,
+                                                   levelStride, params.numericJacobians, ordering);
+    printf("Finished loading points into the solver!\n");
+    if (numLevels > 1)
+      printf("Progressive level %d of %d: solving with %lu points (about one in %lu pairs)\n",
+             level+1, numLevels, (unsigned long)numLevelPoints, (unsigned long)levelStride);
+
+    if (!chooseLinearSolver(params.linearSolverName, params.preconditionerName, params.orderingName,
+                            numLevelPoints, SolverParameterStore::NUM_CAMERA_PARAMS, numSolverThreads,
+                            linearSolverChoice))
+    {
+      printf("Error: Unknown linear solver %s, preconditioner %s or ordering %s\n", params.linearSolverName.c_str(),
+             params.preconditionerName.c_str(), params.orderingName.c_str());
+      delete ordering;
+      return false;
+    }
+    printf("Linear solver: %s\n", describeLinearSolverChoice(linearSolverChoice).c_str());
+
+    callCountCallback.reset(new CallCountCallback(modelPool));
+    ceres::Solver::Options levelOptions = solverOptions;
+    applyLinearSolverChoice(linearSolverChoice, ordering, levelOptions);
+    levelOptions.callbacks.push_back(callCountCallback.get());
+
+    // Execute the Ceres solver
+    ceres::Solve(levelOptions, &problem, &summary);
+    if (numLevels == 1)
+      break;
+    std::cout << summary.BriefReport() << "\n";
+
+    // Stop early once another level would barely move the cameras
+    // - Parameters 6-8 are the position in meters, the others are rotations in radians.
+    double maxRotationChange = 0, maxPositionChange = 0;
+    for (size_t i=0; i<SolverParameterStore::NUM_CAMERA_PARAMS; ++i)
+    {
+      const double change = fabs(solverParams.localRotation()[i] - previousCameraParams[i]);
+      if ((i >= 6) && (i <= 8))
+        maxPositionChange = std::max(maxPositionChange, change);
+      else
+        maxRotationChange = std::max(maxRotationChange, change);
+    }
+    printf("Progressive level %d changed the camera rotations by up to %lg radians and the position by up to %lg meters\n",
+           level+1, maxRotationChange, maxPositionChange);
+    if ((level > 0) && (level < numLevels-1) && (maxRotationChange < params.progressiveTolerance)
+                                             && (maxPositionChange < params.progressivePositionTolerance))
+    {
+      printf("Camera parameters converged, skipping the denser levels\n");
+      break;
+    }
+  }
+
+  // Points that were skipped by the last level still hold their starting estimates.  Solve for them
+  //  with the cameras held fixed, each point is independent so this is cheap.
+  if (levelStride > 1)
+  {
+    printf("Solving for the remaining points with fixed camera parameters\n");
+    ceres::Problem pointProblem;
+    ceres::LossFunction* lossFunction = new ceres::CauchyLoss(5.0);
+    const size_t numPoints = addPairResiduals(pointProblem, solverParams, lossFunction,
+                                              mainSources,      stereoSources,
+                                              leftSources,      rightSources,
+                                              leftCrossSources, rightCrossSources,
+                                              1, params.numericJacobians, 0);
+    pointProblem.SetParameterBlockConstant(solverParams.localRotation());
+    pointProblem.SetParameterBlockConstant(solverParams.globalRotation());
+    pointProblem.SetParameterBlockConstant(solverParams.globalPosition());
+    pointProblem.SetParameterBlockConstant(solverParams.localStereoRotation());
+    // The points are independent once the cameras are fixed, so Ceres picks the ordering
+    LinearSolverChoice pointChoice;
+    chooseLinearSolver(params.linearSolverName, params.preconditionerName, "ceres",
+                       numPoints, SolverParameterStore::NUM_CAMERA_PARAMS, numSolverThreads, pointChoice);
+    ceres::Solver::Options pointOptions = solverOptions;
+    applyLinearSolverChoice(pointChoice, 0, pointOptions);
+    ceres::Solver::Summary pointSummary;
+    ceres::Solve(pointOptions, &pointProblem, &pointSummary);
+    std::cout << pointSummary.BriefReport() << "\n";
+  }
+
+  size_t numSpiceCalls, numProjections, numTimeSolveIterations;
+  modelPool.getCallCounts(numSpiceCalls, numProjections, numTimeSolveIterations);
+  printf("Solver made %lu projections with %lu SPICE-backed calls (%.2lf per projection)\n",
+         (unsigned long)numProjections, (unsigned long)numSpiceCalls,
+         (numProjections > 0) ? static_cast<double>(numSpiceCalls)/numProjections : 0.0);
+  printf("Projection time solver made %lu iterations (%.2lf per projection)\n",
+         (unsigned long)numTimeSolveIterations,
+         (numProjections > 0) ? static_cast<double>(numTimeSolveIterations)/numProjections : 0.0);
   
   //std::ofstream ceresLog("/home/smcmich1/data/ceresOutput2.txt");
   std::cout << summary.FullReport() << "\n";
@@ -842,9 +1795,7 @@ bool optimizeRotations(Parameters & params)
 
   printf("Copying out Ceres solver results.\n");
   // Get the information back from the solver!
-  finalParams.set_size(initialState.size());
-  for (size_t i=0; i<initialState.size(); ++i)
-    finalParams[i] = initialState[i];
+  solverParams.pack(finalParams);
   
   //return true;
   
@@ -857,6 +1808,9 @@ bool optimizeRotations(Parameters & params)
   for (size_t i=0; i<finalParams.size(); ++i)
     finalStateFile << finalParams[i] << std::endl;
   finalStateFile.close();
+  std::ofstream finalHashFile((finalStatePath + OBSERVATION_HASH_EXTENSION).c_str());
+  finalHashFile << observationHash << std::endl;
+  finalHashFile.close();
 
 
   // The computeError() function calculates the mean euclidean distance from the observation points of the LE and RE cameras for each point.
@@ -890,13 +1844,8 @@ bool optimizeRotations(Parameters & params)
   //meanFinalError = meanFinalError / currentError.size(); 
   
   // Compute the median error
-  std::sort(finalError.begin(), finalError.end());
-  double medianError = 0;
-  size_t centralIndex = finalError.size()/2;
-  if ((finalError.size() % 2) == 0)
-    medianError = (finalError[centralIndex-1] + finalError[centralIndex]) / 2.0;
-  else
-    medianError = finalError[centralIndex];
+  ErrorStatistics finalStats = computeErrorStatistics(finalError);
+  double medianError = finalStats.median;
   printf(">>>> Median final error = %lf <<<<<<\n", medianError);
 
 
@@ -923,6 +1872,9 @@ bool optimizeRotations(Parameters & params)
   
   printf(">>>> Mean point error after optimization = %lf <<<<<<\n", meanFinalError);
   printf(">>>> Mean error change = %lf <<<<<<\n", meanFinalError - meanInitialError);
+
+  writeSolverTelemetry(telemetryPath, initialStats, &summary, &callCountCallback->callCounts, &finalStats,
+                       &linearSolverChoice);
   
   // --------------- Summary of results ------------------------------
   const double rad2deg = 180.0 / M_PI;
@@ -1019,6 +1971,69 @@ bool optimizeRotations(Parameters & params)
 }
 
 
+//-------------------------------------------------------------------------------------------
+
+/// Runs each job listed in a job file.
+/// - Each line holds the command line options for one job, including its own --outputPrefix.
+/// - Blank lines and lines starting with # are skipped.
+/// - Jobs run in order so a job can use the output files of an earlier job.
+/// - Returns the number of jobs that failed.
+int runJobFile(const std::string &jobFilePath)
+{
+  std::ifstream jobFile(jobFilePath.c_str());
+  if (!jobFile.is_open())
+  {
+    printf("Error: Failed to open job file %s\n", jobFilePath.c_str());
+    return 1;
+  }
+
+  CameraModelCache cameraCache;
+  int numJobs   = 0;
+  int numFailed = 0;
+  std::string line;
+  while (std::getline(jobFile, line))
+  {
+    boost::algorithm::trim(line);
+    if (line.empty() || (line[0] == '#'))
+      continue;
+    ++numJobs;
+    printf("=== Starting job %d: %s\n", numJobs, line.c_str());
+
+    // Parse the job line the same way as the command line
+    std::vector<std::string> jobArgs = po::split_unix(line);
+    jobArgs.insert(jobArgs.begin(), "lronacAngleDoubleSolver");
+    std::vector<char*> jobArgv;
+    for (size_t i=0; i<jobArgs.size(); ++i)
+      jobArgv.push_back(const_cast<char*>(jobArgs[i].c_str()));
+
+    bool success = false;
+    try
+    {
+      Parameters jobParams;
+      handle_arguments(static_cast<int>(jobArgv.size()), &(jobArgv[0]), jobParams);
+      if (!jobParams.jobFilePath.empty())
+        vw_throw( ArgumentErr() << "Job files cannot contain --jobFile!\n" );
+      if (jobParams.outputPrefix.empty())
+        vw_throw( ArgumentErr() << "Each job needs its own --outputPrefix!\n" );
+      success = optimizeRotations(jobParams, &cameraCache);
+    }
+    catch (const vw::Exception &e)
+    {
+      printf("Error: %s\n", e.what());
+    }
+    if (!success)
+    {
+      printf("=== Job %d failed!\n", numJobs);
+      ++numFailed;
+    }
+  }
+  jobFile.close();
+
+  printf("=== Finished %d jobs with %d failures, loaded %lu camera models\n",
+         numJobs, numFailed, (unsigned long)cameraCache.size());
+  return numFailed;
+}
+
 //-------------------------------------------------------------------------------------------
 
 int main(int argc, char* argv[]) 
@@ -1079,7 +2094,9 @@ int main(int argc, char* argv[])
       return 0;
     }
 
-    
+    if (!params.jobFilePath.empty())
+      return (runJobFile(params.jobFilePath) == 0) ? 0 : 1;
+
     optimizeRotations(params);
   } ASP_STANDARD_CATCHES;
 
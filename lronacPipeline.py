@@ -20,6 +20,8 @@ import sys
 
 import os, glob, optparse, re, shutil, subprocess, string, time
 
+import ResourceTools
+
 job_pool = [];
 
 def man(option, opt, value, parser):
@@ -170,7 +172,7 @@ def makeDem(demFolder):
     # Now feed the two merged images into the stereo function    
     if not os.path.exists(outputPcPath):
 #        cmd ='stereo --alignment affineepipolar --subpixel-mode 1 --disable-fill-holes ' + mosaicNameA +' '+ mosaicNameB +' '+ outputPrefix
-        cmd ='parallel_stereo --corr-timeout 400 --alignment affineepipolar --subpixel-mode 1 --disable-fill-holes ' + mosaicNameA +' '+ mosaicNameB +' '+ outputPrefix + ' --processes 8 --threads-multiprocess 4 --threads-singleprocess 32 --compute-error-vector' 
+        cmd ='parallel_stereo --corr-timeout 400 --alignment affineepipolar --subpixel-mode 1 --disable-fill-holes ' + mosaicNameA +' '+ mosaicNameB +' '+ outputPrefix + ResourceTools.getParallelStereoResourceOptions() + ' --compute-error-vector'
         add_job(cmd, numThreads)
         wait_on_all_jobs()
 #--nodes-list PBS_NODEFILE --processes 4 --threads-multiprocess 16 --threads-singleprocess 32
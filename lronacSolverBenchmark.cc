@@ -0,0 +1,227 @@
+// __BEGIN_LICENSE__
+//  Copyright (c) 2009-2013, United States Government as represented by the
+//  Administrator of the National Aeronautics and Space Administration. All
+//  rights reserved.
+//
+//  The NGT platform is licensed under the Apache License, Version 2.0 (the
+//  "License"); you may not use this file except in compliance with the
+//  License. You may obtain a copy of the License at
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+// __END_LICENSE__
+
+/// \file lronacSolverBenchmark.cc Solves a problem snapshot with the lronacAngleDoubleSolver solver model.
+///
+/// The cameras are rebuilt from the tabulated geometry in the snapshot and plugged into LrocPairModel in
+///  place of the ISIS camera models.  The problem is built by the same addPairResiduals call and evaluated
+///  by the same cost functions and thread model pool as lronacAngleDoubleSolver, so the solve time measures
+///  the production solver on problems without cubes or SPICE kernels.
+/// - The initial points are taken from the snapshot instead of being triangulated.
+/// - Each solve uses all of the points, like lronacAngleDoubleSolver without --progressiveLevels.
+
+#include <algorithm>
+#include <iostream>
+#include <fstream>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#include <boost/program_options.hpp>
+namespace po = boost::program_options;
+
+#include "ceres/ceres.h"
+#include "glog/logging.h"
+
+#include <lronacSolverSupport.h>
+#include <lronacSolverModelDouble.h>
+#include <solverSnapshot.h>
+#include <tabulatedCamera.h>
+#include <linearSolverChoice.h>
+
+using namespace vw;
+
+
+int main( int argc, char *argv[] ) {
+
+  std::string snapshotPath, outputPrefix, linearSolverName, preconditionerName, orderingName;
+  double functionTolerance=1e-6;
+  int numThreads=1, maxIterations=100;
+
+  po::options_description general_options("Options");
+  general_options.add_options()
+    ("help,h",        "Display this help message")
+    ("snapshot,s",          po::value<std::string>(&snapshotPath),                                 "Snapshot file from syntheticSnapshot or lronacAngleDoubleSolver --snapshot")
+    ("outputPrefix,o",      po::value<std::string>(&outputPrefix)->default_value(""),              "If set, write the solved state to <prefix>-finalParamState.csv")
+    ("linearSolver",        po::value<std::string>(&linearSolverName)->default_value("auto"),      "Ceres linear solver type (DENSE_SCHUR, SPARSE_SCHUR, ITERATIVE_SCHUR, DENSE_QR, ...) or auto to choose from the problem size")
+    ("preconditioner",      po::value<std::string>(&preconditionerName)->default_value("auto"),    "Ceres preconditioner type for the iterative linear solvers (JACOBI, SCHUR_JACOBI, ...) or auto")
+    ("ordering",            po::value<std::string>(&orderingName)->default_value("auto"),          "Parameter ordering: auto, schur (points eliminated first) or ceres (chosen by Ceres)")
+    ("threads,t",           po::value<int        >(&numThreads)->default_value(1),                 "Number of solver threads")
+    ("maxIterations",       po::value<int        >(&maxIterations)->default_value(100),            "Maximum number of solver iterations")
+    ("functionTolerance",   po::value<double     >(&functionTolerance)->default_value(1e-6),       "Stop solving when the relative cost change of an iteration is below this")
+    ("numericJacobians",    "Use central difference jacobians instead of the analytic cost functions, like lronacAngleDoubleSolver --numericJacobians");
+
+  po::positional_options_description positional_desc;
+  positional_desc.add("snapshot", 1);
+
+  std::ostringstream usage;
+  usage << "Usage: " << argv[0] << " [options] <snapshot>" << std::endl << std::endl;
+  usage << general_options << std::endl;
+
+  po::variables_map vm;
+  try {
+    po::store( po::command_line_parser( argc, argv ).options(general_options).positional(positional_desc).run(), vm );
+    po::notify( vm );
+  } catch (const po::error& e) {
+    std::cout << "An error occured while parsing command line arguments.\n";
+    std::cout << "\t" << e.what() << "\n\n";
+    std::cout << usage.str();
+    return 1;
+  }
+  if (vm.count("help") || snapshotPath.empty())
+  {
+    std::cout << usage.str();
+    return 1;
+  }
+  const bool numericJacobians = (vm.count("numericJacobians") > 0);
+
+  printf("Loading snapshot %s\n", snapshotPath.c_str());
+  SolverSnapshot snapshot;
+  if (!readSolverSnapshot(snapshotPath, snapshot))
+  {
+    printf("Error: Failed to read snapshot file %s\n", snapshotPath.c_str());
+    return 1;
+  }
+
+  // Copy the pixel pairs into the solver storage, the pair types are in the solver state order
+  PointObsList pairLists[SNAPSHOT_NUM_PAIR_TYPES];
+  bool cameraNeeded[SNAPSHOT_NUM_CAMERAS] = {false, false, false, false};
+  size_t numPoints = 0;
+  for (int p=0; p<SNAPSHOT_NUM_PAIR_TYPES; ++p)
+  {
+    const std::vector<float> &pairs = snapshot.pairs[p];
+    const size_t numPairs = snapshot.numPairs(p);
+    pairLists[p].leftObsList.resize (numPairs);
+    pairLists[p].rightObsList.resize(numPairs);
+    for (size_t i=0; i<numPairs; ++i)
+    {
+      pairLists[p].leftObsList [i] = PixelObservation(pairs[4*i  ], pairs[4*i+1]);
+      pairLists[p].rightObsList[i] = PixelObservation(pairs[4*i+2], pairs[4*i+3]);
+    }
+    numPoints += numPairs;
+    if (numPairs == 0)
+      continue;
+    cameraNeeded[SNAPSHOT_PAIR_CAMERAS[p][0]] = true;
+    cameraNeeded[SNAPSHOT_PAIR_CAMERAS[p][1]] = true;
+  }
+
+  // Rebuild the cameras that have pairs
+  boost::shared_ptr<TabulatedLineScanCamera> tables[SNAPSHOT_NUM_CAMERAS];
+  for (int c=0; c<SNAPSHOT_NUM_CAMERAS; ++c)
+  {
+    if (!cameraNeeded[c])
+      continue;
+    tables[c].reset(new TabulatedLineScanCamera());
+    if (!tables[c]->load(snapshot.cameras[c]))
+    {
+      printf("Error: Snapshot is missing the tables for camera %d\n", c);
+      return 1;
+    }
+  }
+
+  const size_t NUM_CAMERA_PARAMS = SolverParameterStore::NUM_CAMERA_PARAMS;
+  const size_t PARAMS_PER_POINT  = SolverParameterStore::PARAMS_PER_POINT;
+  if (snapshot.state.size() != NUM_CAMERA_PARAMS + numPoints*PARAMS_PER_POINT)
+  {
+    printf("Error: Snapshot has %lu state values for %lu points\n",
+           (unsigned long)snapshot.state.size(), (unsigned long)numPoints);
+    return 1;
+  }
+  printf("Loaded %lu points\n", (unsigned long)numPoints);
+
+  // The solver model owns the cameras
+  SolverLineScanCamera* cameras[SNAPSHOT_NUM_CAMERAS];
+  for (int c=0; c<SNAPSHOT_NUM_CAMERAS; ++c)
+    cameras[c] = tables[c] ? new TabulatedSolverCamera(tables[c]) : 0;
+  LrocPairModel lrocClass;
+  lrocClass.setCameras(cameras[SNAPSHOT_LEFT],        cameras[SNAPSHOT_RIGHT],
+                       cameras[SNAPSHOT_LEFT_STEREO], cameras[SNAPSHOT_RIGHT_STEREO]);
+
+  // Same solver setup as lronacAngleDoubleSolver
+  LrocPairModelPool modelPool(&lrocClass, numThreads);
+  SolverParameterStore solverParams;
+  Vector<double> initialState(snapshot.state.size());
+  std::copy(snapshot.state.begin(), snapshot.state.end(), initialState.begin());
+  solverParams.unpack(initialState);
+
+  PairObservationSources mainSources       (&modelPool, pairLists[0]);
+  PairObservationSources stereoSources     (&modelPool, pairLists[1]);
+  PairObservationSources leftSources       (&modelPool, pairLists[2]);
+  PairObservationSources rightSources      (&modelPool, pairLists[3]);
+  PairObservationSources leftCrossSources  (&modelPool, pairLists[4]);
+  PairObservationSources rightCrossSources (&modelPool, pairLists[5]);
+
+  ceres::Problem problem;
+  ceres::LossFunction* lossFunction = new ceres::CauchyLoss(5.0);
+  ceres::ParameterBlockOrdering *ordering = new ceres::ParameterBlockOrdering;
+  const size_t numSolverPoints = addPairResiduals(problem, solverParams, lossFunction,
+                                                  mainSources,      stereoSources,
+                                                  leftSources,      rightSources,
+                                                  leftCrossSources, rightCrossSources,
+                                                  1, numericJacobians, ordering);
+
+  LinearSolverChoice linearSolverChoice;
+  if (!chooseLinearSolver(linearSolverName, preconditionerName, orderingName, numSolverPoints, NUM_CAMERA_PARAMS,
+                          numThreads, linearSolverChoice))
+  {
+    printf("Error: Unknown linear solver %s, preconditioner %s or ordering %s\n", linearSolverName.c_str(),
+           preconditionerName.c_str(), orderingName.c_str());
+    delete ordering;
+    return 1;
+  }
+
+  ceres::Solver::Options solverOptions;
+  solverOptions.max_num_iterations           = maxIterations;
+  solverOptions.function_tolerance           = functionTolerance;
+  solverOptions.minimizer_progress_to_stdout = true;
+  solverOptions.max_num_line_search_direction_restarts = 8;
+  solverOptions.use_nonmonotonic_steps = false;
+  solverOptions.max_num_consecutive_invalid_steps = 10;
+  solverOptions.num_threads = numThreads;
+  applyLinearSolverChoice(linearSolverChoice, ordering, solverOptions);
+
+  printf("Linear solver: %s\n", describeLinearSolverChoice(linearSolverChoice).c_str());
+  printf("Solving with %s jacobians and %d threads\n", numericJacobians ? "numeric" : "analytic", numThreads);
+  ceres::Solver::Summary summary;
+  ceres::Solve(solverOptions, &problem, &summary);
+  std::cout << summary.FullReport() << "\n";
+
+  size_t numSpiceCalls, numProjections, numTimeSolveIterations;
+  modelPool.getCallCounts(numSpiceCalls, numProjections, numTimeSolveIterations);
+  printf("Projection time solver made %lu iterations for %lu projections (%.2lf per projection)\n",
+         (unsigned long)numTimeSolveIterations, (unsigned long)numProjections,
+         (numProjections > 0) ? static_cast<double>(numTimeSolveIterations)/numProjections : 0.0);
+
+  Vector<double> finalParams;
+  solverParams.pack(finalParams);
+  printf("Final camera parameters:\n");
+  for (size_t i=0; i<NUM_CAMERA_PARAMS; ++i)
+    printf("%lf\n", finalParams[i]);
+
+  if (!outputPrefix.empty())
+  {
+    std::string statePath = outputPrefix + "-finalParamState.csv";
+    printf("Writing final state to %s\n", statePath.c_str());
+    std::ofstream stateFile(statePath.c_str());
+    stateFile.precision(17);
+    for (size_t i=0; i<finalParams.size(); ++i)
+      stateFile << finalParams[i] << std::endl;
+    stateFile.close();
+  }
+
+  return 0;
+}
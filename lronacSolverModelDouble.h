@@ -19,12 +19,18 @@
 /// \file lronacSolverModel.cc
 ///
 
+#include <algorithm>
+#include <cmath>
 #include <iostream>
+#include <map>
+#include <vector>
 
 #include <iTime.h> // Isis time class
 
 #include <boost/shared_ptr.hpp>
 #include <boost/serialization/shared_ptr.hpp> // for null_deleter
+#include <boost/thread/mutex.hpp>
+#include <boost/thread/tss.hpp>
 
 #include <vw/InterestPoint.h>
 #include <vw/Image/MaskViews.h>
@@ -53,15 +59,95 @@
 #define __LRONACPIPELINE_SOLVERMODELDOUBLE_H__
 
 
+/// Pixel observations are stored in single precision to keep large point sets small.
+/// - This is still good to a few thousandths of a pixel on the longest LRONAC cubes.
+typedef vw::Vector2f PixelObservation;
+
 // Points are passed in four sets of pairs.  Could try more overlap in the future.
 struct PointObsList
 {
-  std::vector<vw::Vector2> leftObsList; // These need to be the same size
-  std::vector<vw::Vector2> rightObsList;
+  std::vector<PixelObservation> leftObsList; // These need to be the same size
+  std::vector<PixelObservation> rightObsList;
   
   size_t size() const {return leftObsList.size();} ///< Return the number of points
 };
 
+/// Copies a 2x3 block of pixel partials into a row-major Ceres jacobian block if it was requested
+inline void copyPartials(const vw::Matrix<double,2,3> &partials, double *jacobian)
+{
+  if (!jacobian)
+    return;
+  for (int r=0; r<2; ++r)
+    for (int c=0; c<3; ++c)
+      jacobian[r*3 + c] = partials(r,c);
+}
+
+/// Keeps loaded camera models so that later jobs in the same process can reuse them.
+/// - Loading a camera model reads the cube and furnishes its SPICE kernels, which is slow.
+/// - Camera models keep state between projections, so each one is handed to one user at a time.
+///   Several copies of the same cube are loaded if they are needed at once.
+class CameraModelCache
+{
+private:
+  struct Entry
+  {
+    boost::shared_ptr<IsisInterfaceLineScanRot> camera;
+    bool inUse;
+  };
+  typedef std::multimap<std::string, Entry> EntryMap;
+
+  boost::mutex _mutex; // Loading cameras goes through SPICE, which is not thread safe.
+  EntryMap     _cameras;
+
+public:
+
+  /// Returns a camera model for the cube that is not in use, loading one if needed.
+  IsisInterfaceLineScanRot* acquire(const std::string &cubePath)
+  {
+    boost::mutex::scoped_lock lock(_mutex);
+    std::pair<EntryMap::iterator, EntryMap::iterator> range = _cameras.equal_range(cubePath);
+    for (EntryMap::iterator iter=range.first; iter!=range.second; ++iter)
+    {
+      if (!iter->second.inUse)
+      {
+        iter->second.inUse = true;
+        return iter->second.camera.get();
+      }
+    }
+    Entry newEntry;
+    {
+      boost::mutex::scoped_lock spiceLock(IsisInterfaceLineScanRot::spice_mutex());
+      newEntry.camera.reset(new IsisInterfaceLineScanRot(cubePath));
+    }
+    newEntry.inUse = true;
+    _cameras.insert(std::make_pair(cubePath, newEntry));
+    return newEntry.camera.get();
+  }
+
+  /// Hands a camera model from acquire() back to the cache, returns false if it did not come from the cache
+  bool release(const SolverLineScanCamera* camera)
+  {
+    boost::mutex::scoped_lock lock(_mutex);
+    for (EntryMap::iterator iter=_cameras.begin(); iter!=_cameras.end(); ++iter)
+    {
+      if (iter->second.camera.get() == camera)
+      {
+        iter->second.inUse = false;
+        return true;
+      }
+    }
+    return false;
+  }
+
+  /// Returns the number of camera models that have been loaded
+  size_t size()
+  {
+    boost::mutex::scoped_lock lock(_mutex);
+    return _cameras.size();
+  }
+};
+
+
 /// Class for solving for the rotation between two LRONAC cameras
 class LrocPairModel : public vw::math::LeastSquaresModelBase<LrocPairModel>
 {
@@ -84,16 +170,37 @@ typedef vw::Matrix<double> jacobian_type;
 
 private: // Variables ---------------------------------------------------------------------------
 
-  // Camera models
-  IsisInterfaceLineScanRot* _leftCameraModel;
-  IsisInterfaceLineScanRot* _rightCameraModel;
+  // Camera models, loaded from the cubes or passed in with setCameras()
+  SolverLineScanCamera* _leftCameraModel;
+  SolverLineScanCamera* _rightCameraModel;
 
-  IsisInterfaceLineScanRot* _leftStereoCameraModel;
-  IsisInterfaceLineScanRot* _rightStereoCameraModel;
+  SolverLineScanCamera* _leftStereoCameraModel;
+  SolverLineScanCamera* _rightStereoCameraModel;
 
   mutable AdjustedCameraModelRot* _leftStereoCameraRotatedModel;
   mutable AdjustedCameraModelRot* _rightStereoCameraRotatedModel;
 
+  CameraModelCache *_cameraCache; // If set the camera models belong to this cache
+
+  // Cube paths, used to load copies of the camera models
+  std::string _leftCubePath;
+  std::string _rightCubePath;
+  std::string _leftStereoCubePath;
+  std::string _rightStereoCubePath;
+
+public: // Definitions
+
+  /// The pair types that can be triangulated one pair at a time
+  enum FilePairType { LEFT_LEFTS_PAIRS,   ///< LE   to LE_S
+                      RIGHT_RIGHTS_PAIRS, ///< RE   to RE_S
+                      LEFT_RIGHTS_PAIRS,  ///< LE   to RE_S
+                      LEFTS_RIGHT_PAIRS,  ///< LE_S to RE
+                      LEFT_RIGHT_PAIRS,   ///< LE   to RE,   the main pair overlap
+                      LEFTS_RIGHTS_PAIRS  ///< LE_S to RE_S, the stereo pair overlap
+                    };
+
+private:
+
   // Observation records
   const PointObsList *_leftRight;   // Main pair
   const PointObsList *_leftSRightS; // Stereo pair
@@ -106,8 +213,10 @@ private: // Variables ----------------------------------------------------------
 public: // Functions  -----------------------------------------------------------------------------------
 
 /// Default constructor, does not initialize anything!
-LrocPairModel()
+/// - If a camera cache is passed in camera models are taken from it instead of loaded directly.
+LrocPairModel(CameraModelCache *cameraCache=0)
 {
+  _cameraCache            = cameraCache;
   _leftCameraModel        = 0;
   _rightCameraModel       = 0;
   _leftStereoCameraModel  = 0;
@@ -120,18 +229,108 @@ LrocPairModel()
 ~LrocPairModel()
 {
   // Clean up all dynamically allocated objects if they have been allocated
-  if (!_leftStereoCameraRotatedModel)
+  if (_leftStereoCameraRotatedModel)
     delete _leftStereoCameraRotatedModel;
-  if (!_rightStereoCameraRotatedModel)
+  if (_rightStereoCameraRotatedModel)
     delete _rightStereoCameraRotatedModel;
-  if (!_leftStereoCameraModel)
-    delete _leftStereoCameraModel;
-  if (!_rightStereoCameraModel)
-    delete _leftCameraModel;
-  if (!_leftCameraModel)
-    delete _leftCameraModel;
-  if (!_rightCameraModel)
-    delete _rightCameraModel;
+  releaseCamera(_leftStereoCameraModel);
+  releaseCamera(_rightStereoCameraModel);
+  releaseCamera(_leftCameraModel);
+  releaseCamera(_rightCameraModel);
+}
+
+private:
+
+/// Loads a camera model or takes one from the cache
+IsisInterfaceLineScanRot* loadCamera(const std::string &cubePath)
+{
+  if (_cameraCache)
+    return _cameraCache->acquire(cubePath);
+  boost::mutex::scoped_lock lock(IsisInterfaceLineScanRot::spice_mutex());
+  return new IsisInterfaceLineScanRot(cubePath);
+}
+
+/// Cleans up a camera model from loadCamera() or setCameras()
+void releaseCamera(SolverLineScanCamera* camera)
+{
+  if (!camera)
+    return;
+  if (_cameraCache && _cameraCache->release(camera))
+    return;
+  delete camera;
+}
+
+/// Returns a copy of a camera for another thread that shares its state table
+SolverLineScanCamera* copyCamera(const SolverLineScanCamera* camera, const std::string &cubePath)
+{
+  if (!camera)
+    return 0;
+  SolverLineScanCamera* copy = camera->clone();
+  if (copy || cubePath.empty())
+    return copy;
+
+  // Cameras that were loaded from a cube are always ISIS camera models
+  IsisInterfaceLineScanRot* cubeCopy = loadCamera(cubePath);
+  cubeCopy->share_state_table(*static_cast<const IsisInterfaceLineScanRot*>(camera));
+  return cubeCopy;
+}
+
+/// Wraps a stereo camera so the global rotation and translation can be applied to it
+static AdjustedCameraModelRot* makeRotatedModel(SolverLineScanCamera* camera)
+{
+  return new AdjustedCameraModelRot(boost::shared_ptr<SolverLineScanCamera>(camera, boost::serialization::null_deleter()));
+}
+
+public:
+
+/// Uses the given camera models instead of loading them from cubes, the model takes ownership of them.
+/// - Any of them may be null if that camera is not used.
+void setCameras(SolverLineScanCamera* leftCamera,       SolverLineScanCamera* rightCamera,
+                SolverLineScanCamera* leftStereoCamera, SolverLineScanCamera* rightStereoCamera)
+{
+  _leftCameraModel        = leftCamera;
+  _rightCameraModel       = rightCamera;
+  _leftStereoCameraModel  = leftStereoCamera;
+  _rightStereoCameraModel = rightStereoCamera;
+  if (_leftStereoCameraModel)
+    _leftStereoCameraRotatedModel = makeRotatedModel(_leftStereoCameraModel);
+  if (_rightStereoCameraModel)
+    _rightStereoCameraRotatedModel = makeRotatedModel(_rightStereoCameraModel);
+}
+
+/// Returns a new model with its own copies of the camera models.
+/// - The camera models keep state between calls so each thread needs its own copy.
+/// - The observation lists and the camera state tables are shared, they are never modified.
+/// - Loading the cameras goes through SPICE so this should not run while other threads use the cameras.
+LrocPairModel* clone() const
+{
+  LrocPairModel* newModel = new LrocPairModel(_cameraCache);
+  newModel->_leftCubePath        = _leftCubePath;
+  newModel->_rightCubePath       = _rightCubePath;
+  newModel->_leftStereoCubePath  = _leftStereoCubePath;
+  newModel->_rightStereoCubePath = _rightStereoCubePath;
+  newModel->setCameras(newModel->copyCamera(_leftCameraModel,        _leftCubePath),
+                       newModel->copyCamera(_rightCameraModel,       _rightCubePath),
+                       newModel->copyCamera(_leftStereoCameraModel,  _leftStereoCubePath),
+                       newModel->copyCamera(_rightStereoCameraModel, _rightStereoCubePath));
+
+  newModel->_leftRight   = _leftRight;
+  newModel->_leftSRightS = _leftSRightS;
+  newModel->_leftLeftS   = _leftLeftS;
+  newModel->_rightRightS = _rightRightS;
+  newModel->_leftRightS  = _leftRightS;
+  newModel->_leftSRight  = _leftSRight;
+  return newModel;
+}
+
+/// Builds the camera state tables of all the loaded cameras so later calls do not need SPICE
+void prepareStateTables() const
+{
+  const SolverLineScanCamera* cameras[4];
+  getCameraModels(cameras);
+  for (int i=0; i<4; ++i)
+    if (cameras[i])
+      cameras[i]->prepare_state_table();
 }
 
 
@@ -139,39 +338,74 @@ LrocPairModel()
 bool loadLeftCamera(const std::string &cubePath)
 {
   printf("Loading left camera model from file %s\n", cubePath.c_str());
-  _leftCameraModel = new IsisInterfaceLineScanRot(cubePath);
+  _leftCubePath = cubePath;
+  _leftCameraModel = loadCamera(cubePath);
   return (_leftCameraModel != 0);
 }
 
 bool loadRightCamera(const std::string &cubePath)
 {
   printf("Loading right camera model from file %s\n", cubePath.c_str());
-  _rightCameraModel = new IsisInterfaceLineScanRot(cubePath);
+  _rightCubePath = cubePath;
+  _rightCameraModel = loadCamera(cubePath);
   return (_rightCameraModel != 0);
 }
 
 bool loadLeftStereoCamera(const std::string &cubePath)
 {
   printf("Loading left stereo camera model from file %s\n", cubePath.c_str());
-  _leftStereoCameraModel = new IsisInterfaceLineScanRot(cubePath);
+  _leftStereoCubePath = cubePath;
+  _leftStereoCameraModel = loadCamera(cubePath);
   if (!_leftStereoCameraModel)
     return false;
-  _leftStereoCameraRotatedModel = new AdjustedCameraModelRot(boost::shared_ptr<IsisInterfaceLineScanRot>(_leftStereoCameraModel,
-                                                                             boost::serialization::null_deleter()) );
+  _leftStereoCameraRotatedModel = makeRotatedModel(_leftStereoCameraModel);
   return true;
 }
 
 bool loadRightStereoCamera(const std::string &cubePath)
 {
   printf("Loading right stereo camera model from file %s\n", cubePath.c_str());
-  _rightStereoCameraModel = new IsisInterfaceLineScanRot(cubePath);
+  _rightStereoCubePath = cubePath;
+  _rightStereoCameraModel = loadCamera(cubePath);
   if (!_rightStereoCameraModel)
     return false;
-  _rightStereoCameraRotatedModel = new AdjustedCameraModelRot(boost::shared_ptr<IsisInterfaceLineScanRot>(_rightStereoCameraModel,
-                                                                             boost::serialization::null_deleter()) );
+  _rightStereoCameraRotatedModel = makeRotatedModel(_rightStereoCameraModel);
   return true;
 }
 
+/// Adds up the SPICE-backed call, projection and time solve iteration counters of all the loaded cameras
+void getCallCounts(size_t &spiceCalls, size_t &projections, size_t &timeSolveIterations) const
+{
+  const SolverLineScanCamera* cameras[4] = {_leftCameraModel,       _rightCameraModel,
+                                            _leftStereoCameraModel, _rightStereoCameraModel};
+  for (int i=0; i<4; ++i)
+  {
+    if (!cameras[i])
+      continue;
+    spiceCalls  += cameras[i]->spice_call_count();
+    projections += cameras[i]->projection_count();
+    timeSolveIterations += cameras[i]->time_solve_iteration_count();
+  }
+}
+
+void resetCallCounts()
+{
+  SolverLineScanCamera* cameras[4] = {_leftCameraModel,       _rightCameraModel,
+                                      _leftStereoCameraModel, _rightStereoCameraModel};
+  for (int i=0; i<4; ++i)
+    if (cameras[i])
+      cameras[i]->reset_call_counts();
+}
+
+/// Returns the camera models in the order left, right, left stereo, right stereo.  Missing ones are null.
+void getCameraModels(const SolverLineScanCamera* cameras[4]) const
+{
+  cameras[0] = _leftCameraModel;
+  cameras[1] = _rightCameraModel;
+  cameras[2] = _leftStereoCameraModel;
+  cameras[3] = _rightStereoCameraModel;
+}
+
 size_t getNumPoints() const
 {
   return _leftRight->size() + _leftSRightS->size() +
@@ -203,6 +437,23 @@ Vector2 getRightPixelRot(const Vector3& point, const Vector3& rot, const Vector3
 }
 */
 
+/// Applies the global rotation and translation in the camera parameters to the stereo camera models
+void setGlobalTransform(const double *cameraParams)
+{
+  vw::Vector3 globalRotVec(cameraParams[3], cameraParams[4], cameraParams[5]);
+  vw::Vector3 globalPosVec(cameraParams[6], cameraParams[7], cameraParams[8]);
+  if (_leftStereoCameraRotatedModel)
+  {
+    _leftStereoCameraRotatedModel->set_axis_angle_rotation (globalRotVec);
+    _leftStereoCameraRotatedModel->set_translation (globalPosVec);
+  }
+  if (_rightStereoCameraRotatedModel)
+  {
+    _rightStereoCameraRotatedModel->set_axis_angle_rotation(globalRotVec);
+    _rightStereoCameraRotatedModel->set_translation(globalPosVec);
+  }
+}
+
 /// Helper function used by getInitialStateEstimate
 /// - Computes the best estimate of a point location given two observations
 bool computePointLocation(const vw::camera::CameraModel *cam1,
@@ -270,6 +521,61 @@ bool computePointLocation(const vw::camera::CameraModel *cam1,
   return true;
 }
 
+/// Triangulates one pixel pair and computes its projection error.
+/// - Uses the same cameras as getInitialStateEstimate and computeError for this pair type.
+/// - The global transform must already have been applied with setGlobalTransform().
+/// - error is the mean distance in pixels between the two observations and the point projections.
+bool triangulateFilePair(FilePairType type, const double *cameraParams,
+                         const vw::Vector2 &leftPixel, const vw::Vector2 &rightPixel,
+                         const double surfaceElevation, const bool useStereo,
+                         vw::Vector3 &pointLocation, double &error)
+{
+  const vw::Vector3 localRotVec      (cameraParams[0], cameraParams[1],  cameraParams[2]);
+  const vw::Vector3 stereoLocalRotVec(cameraParams[9], cameraParams[10], cameraParams[11]);
+  const vw::Vector3 nullVec(0,0,0);
+
+  vw::Vector2 leftProjection, rightProjection;
+  switch (type)
+  {
+    case LEFT_LEFTS_PAIRS:
+      computePointLocation(_leftCameraModel, _leftStereoCameraRotatedModel, leftPixel, rightPixel, surfaceElevation, useStereo, pointLocation);
+      leftProjection  = _leftCameraModel->point_to_pixel_rotated             (pointLocation, nullVec, leftPixel[1]);
+      rightProjection = _leftStereoCameraRotatedModel->point_to_pixel_rotated(pointLocation, nullVec, rightPixel[1]);
+      break;
+    case RIGHT_RIGHTS_PAIRS:
+      computePointLocation(_rightCameraModel, _rightStereoCameraRotatedModel, leftPixel, rightPixel, surfaceElevation, useStereo, pointLocation);
+      leftProjection  = _rightCameraModel->point_to_pixel_rotated             (pointLocation, localRotVec,       leftPixel[1]);
+      rightProjection = _rightStereoCameraRotatedModel->point_to_pixel_rotated(pointLocation, stereoLocalRotVec, rightPixel[1]);
+      break;
+    case LEFT_RIGHTS_PAIRS:
+      computePointLocation(_leftCameraModel, _rightStereoCameraRotatedModel, leftPixel, rightPixel, surfaceElevation, useStereo, pointLocation);
+      leftProjection  = _leftCameraModel->point_to_pixel_rotated              (pointLocation, nullVec,           leftPixel[1]);
+      rightProjection = _rightStereoCameraRotatedModel->point_to_pixel_rotated(pointLocation, stereoLocalRotVec, rightPixel[1]);
+      break;
+    case LEFTS_RIGHT_PAIRS:
+      computePointLocation(_leftStereoCameraRotatedModel, _rightCameraModel, leftPixel, rightPixel, surfaceElevation, useStereo, pointLocation);
+      leftProjection  = _leftStereoCameraRotatedModel->point_to_pixel_rotated(pointLocation, nullVec,     leftPixel[1]);
+      rightProjection = _rightCameraModel->point_to_pixel_rotated            (pointLocation, localRotVec, rightPixel[1]);
+      break;
+    case LEFT_RIGHT_PAIRS:
+      computePointLocation(_leftCameraModel, _rightCameraModel, leftPixel, rightPixel, surfaceElevation, useStereo, pointLocation);
+      leftProjection  = _leftCameraModel->point_to_pixel_rotated (pointLocation, nullVec,     leftPixel[1]);
+      rightProjection = _rightCameraModel->point_to_pixel_rotated(pointLocation, localRotVec, rightPixel[1]);
+      break;
+    case LEFTS_RIGHTS_PAIRS:
+      computePointLocation(_leftStereoCameraRotatedModel, _rightStereoCameraRotatedModel, leftPixel, rightPixel, surfaceElevation, useStereo, pointLocation);
+      leftProjection  = _leftStereoCameraRotatedModel->point_to_pixel_rotated (pointLocation, nullVec,           leftPixel[1]);
+      rightProjection = _rightStereoCameraRotatedModel->point_to_pixel_rotated(pointLocation, stereoLocalRotVec, rightPixel[1]);
+      break;
+    default:
+      return false;
+  }
+
+  error = (vw::math::norm_2(leftProjection  - leftPixel) +
+           vw::math::norm_2(rightProjection - rightPixel)) / 2.0;
+  return true;
+}
+
 /// Given the pixel pair observations, compute the initial state estimate.
 /// - This also loads the observation vectors and returns a packed version of them.
 bool getInitialStateEstimate(const PointObsList &leftRight,   // Main pair
@@ -343,22 +649,10 @@ bool getInitialStateEstimate(const PointObsList &leftRight,   // Main pair
       stateEstimate[i] = inputState[i];
   }
 
-  // Set up initial state vectors
-  vw::Vector3 globalRotVec(stateEstimate[3], stateEstimate[4], stateEstimate[5]);
-  vw::Vector3 globalPosVec(stateEstimate[6], stateEstimate[7], stateEstimate[8]);
-  
   // Apply global transformation to the stereo pair
   if (_leftStereoCameraRotatedModel)
-  {
     printf("Rotating stereo left model...\n");
-    _leftStereoCameraRotatedModel->set_axis_angle_rotation (globalRotVec);
-    _leftStereoCameraRotatedModel->set_translation (globalPosVec);
-  }
-  if (_rightStereoCameraRotatedModel)
-  {
-    _rightStereoCameraRotatedModel->set_axis_angle_rotation(globalRotVec);
-    _rightStereoCameraRotatedModel->set_translation(globalPosVec);
-  }
+  setGlobalTransform(&(stateEstimate[0]));
 
   //DEBUG
   // Set up georeference class with default moon datum
@@ -507,22 +801,11 @@ std::vector<double> computeError(domain_type const& x)
 
   // Set up initial state vectors
   vw::Vector3 localRotVec      (x[0], x[1], x[2]);
-  vw::Vector3 globalRotVec     (x[3], x[4], x[5]);
-  vw::Vector3 globalPosVec     (x[6], x[7], x[8]);
   vw::Vector3 stereoLocalRotVec(x[9], x[10], x[11]);
   vw::Vector3 nullVec(0,0,0); // Just to use our custom rotation function
 
   // Apply global transformation to the stereo pair
-  if (_leftStereoCameraRotatedModel)
-  {
-    _leftStereoCameraRotatedModel->set_axis_angle_rotation (globalRotVec);
-    _leftStereoCameraRotatedModel->set_translation (globalPosVec);
-  }
-  if (_rightStereoCameraRotatedModel)
-  {
-    _rightStereoCameraRotatedModel->set_axis_angle_rotation(globalRotVec);
-    _rightStereoCameraRotatedModel->set_translation(globalPosVec);
-  }
+  setGlobalTransform(&(x[0]));
 
   const int PARAMS_PER_POINT = 3;
 
@@ -678,7 +961,10 @@ std::vector<double> computeError(domain_type const& x)
 
 /// For a given point, compute the left camera observation.
 /// - Returns false if the point is not visible.
-bool getLeftObservation(const double* const pointParams, double *observation, int guessRow=-1) const
+/// - guessTime holds the solved time from the previous call for this observation (zero if none).
+/// - If jacobians is provided it is filled in the Ceres layout: [point]
+bool getLeftObservation(const double* const pointParams, double *observation, int guessRow=-1, double** jacobians=0,
+                        double *guessTime=0) const
 {
   // Create a point object
   vw::Vector3 thisPoint(pointParams[0], pointParams[1], pointParams[2]);
@@ -686,7 +972,14 @@ bool getLeftObservation(const double* const pointParams, double *observation, in
   try // Project the point into the camera
   {
     vw::Vector3 nullVec(0,0,0); // Left camera not currently rotated
-    projection  = _leftCameraModel->point_to_pixel_rotated(thisPoint, nullVec, guessRow);
+    if (jacobians)
+    {
+      vw::Matrix<double,2,3> pointPartials, anglePartials;
+      projection = _leftCameraModel->point_to_pixel_rotated_partials(thisPoint, nullVec, guessRow, pointPartials, anglePartials, guessTime);
+      copyPartials(pointPartials, jacobians[0]);
+    }
+    else
+      projection = _leftCameraModel->point_to_pixel_rotated(thisPoint, nullVec, guessRow, guessTime);
   }
   catch(std::exception& e) // Handle errors
   {
@@ -704,7 +997,10 @@ bool getLeftObservation(const double* const pointParams, double *observation, in
 /// For a given point, compute the right camera observation.
 /// - Returns false if the point is not visible.
 /// - rotAngleParams points to parameters 0-2
-bool getRightObservation(const double* const rotAngleParams, const double* const pointParams, double *observation, int guessRow=-1)
+/// - guessTime holds the solved time from the previous call for this observation (zero if none).
+/// - If jacobians is provided it is filled in the Ceres layout: [angles, point]
+bool getRightObservation(const double* const rotAngleParams, const double* const pointParams, double *observation, int guessRow=-1,
+                         double** jacobians=0, double *guessTime=0)
 {
   // This function returns an error vector for a given set of parameters
 
@@ -716,7 +1012,15 @@ bool getRightObservation(const double* const rotAngleParams, const double* const
   vw::Vector2 projection;
   try // Project the point into the camera
   {
-    projection = _rightCameraModel->point_to_pixel_rotated(thisPoint, localRotVec, guessRow);
+    if (jacobians)
+    {
+      vw::Matrix<double,2,3> pointPartials, anglePartials;
+      projection = _rightCameraModel->point_to_pixel_rotated_partials(thisPoint, localRotVec, guessRow, pointPartials, anglePartials, guessTime);
+      copyPartials(anglePartials, jacobians[0]);
+      copyPartials(pointPartials, jacobians[1]);
+    }
+    else
+      projection = _rightCameraModel->point_to_pixel_rotated(thisPoint, localRotVec, guessRow, guessTime);
   }
   catch(std::exception& e)
   {
@@ -735,7 +1039,10 @@ bool getRightObservation(const double* const rotAngleParams, const double* const
 /// - Returns false if the point is not visible.
 /// - rotParams points to parameters 3-5
 /// - posParams points to parameters 6-8
-bool getLeftStereoObservation(const double* const rotParams, const double* const posParams, const double* const pointParams, double *observation, int guessRow=-1)
+/// - guessTime holds the solved time from the previous call for this observation (zero if none).
+/// - If jacobians is provided it is filled in the Ceres layout: [rotation, position, point]
+bool getLeftStereoObservation(const double* const rotParams, const double* const posParams, const double* const pointParams, double *observation, int guessRow=-1,
+                              double** jacobians=0, double *guessTime=0)
 {
   // This function returns an error vector for a given set of parameters
 
@@ -755,7 +1062,18 @@ bool getLeftStereoObservation(const double* const rotParams, const double* const
   try // Project the point into the camera
   {
     vw::Vector3 nullVec(0,0,0); // Left camera not currently rotated
-    projection = _leftStereoCameraRotatedModel->point_to_pixel_rotated(thisPoint, nullVec, guessRow);
+    if (jacobians)
+    {
+      vw::Matrix<double,2,3> pointPartials, anglePartials, rotationPartials, translationPartials;
+      projection = _leftStereoCameraRotatedModel->point_to_pixel_rotated_partials(thisPoint, nullVec, guessRow,
+                                                                                 pointPartials,    anglePartials,
+                                                                                 rotationPartials, translationPartials, guessTime);
+      copyPartials(rotationPartials,    jacobians[0]);
+      copyPartials(translationPartials, jacobians[1]);
+      copyPartials(pointPartials,       jacobians[2]);
+    }
+    else
+      projection = _leftStereoCameraRotatedModel->point_to_pixel_rotated(thisPoint, nullVec, guessRow, guessTime);
   }
   catch(std::exception& e)
   {
@@ -775,10 +1093,13 @@ bool getLeftStereoObservation(const double* const rotParams, const double* const
 /// - rotParams points to parameters 3-5
 /// - posParams points to parameters 6-8
 /// - localRotParams points to parameters 9-11
+/// - guessTime holds the solved time from the previous call for this observation (zero if none).
+/// - If jacobians is provided it is filled in the Ceres layout: [rotation, position, local rotation, point]
 bool getRightStereoObservation(const double* const rotParams, 
                                const double* const posParams,
                                const double* const localRotParams,
-                               const double* const pointParams, double *observation, int guessRow=-1)
+                               const double* const pointParams, double *observation, int guessRow=-1,
+                               double** jacobians=0, double *guessTime=0)
 {
   // This function returns an error vector for a given set of parameters
 
@@ -798,7 +1119,19 @@ bool getRightStereoObservation(const double* const rotParams,
   vw::Vector2 projection;
   try // Project the point into the camera
   {
-    projection = _rightStereoCameraRotatedModel->point_to_pixel_rotated(thisPoint, localRotVec, guessRow);
+    if (jacobians)
+    {
+      vw::Matrix<double,2,3> pointPartials, anglePartials, rotationPartials, translationPartials;
+      projection = _rightStereoCameraRotatedModel->point_to_pixel_rotated_partials(thisPoint, localRotVec, guessRow,
+                                                                                  pointPartials,    anglePartials,
+                                                                                  rotationPartials, translationPartials, guessTime);
+      copyPartials(rotationPartials,    jacobians[0]);
+      copyPartials(translationPartials, jacobians[1]);
+      copyPartials(anglePartials,       jacobians[2]);
+      copyPartials(pointPartials,       jacobians[3]);
+    }
+    else
+      projection = _rightStereoCameraRotatedModel->point_to_pixel_rotated(thisPoint, localRotVec, guessRow, guessTime);
   }
   catch(std::exception& e)
   {
@@ -817,34 +1150,225 @@ bool getRightStereoObservation(const double* const rotParams,
 //===================================================================================================
 //===================================================================================================
 
+/// Hands out a separate LrocPairModel to each thread that evaluates residuals.
+/// - With one thread the base model is used directly.
+/// - All of the copies are made in the constructor, one at a time, because loading cameras goes
+///   through SPICE, which is not thread safe.  Each thread keeps the model it was given until it exits.
+class LrocPairModelPool
+{
+private:
+
+  /// Models that have not been given to a thread
+  struct FreeModels
+  {
+    boost::mutex                mutex;
+    std::vector<LrocPairModel*> models;
+  };
+
+  /// The model given to a thread, it goes back on the free list when the thread exits
+  struct ThreadModel
+  {
+    boost::shared_ptr<FreeModels> freeModels;
+    LrocPairModel                *model;
+
+    ~ThreadModel()
+    {
+      boost::mutex::scoped_lock lock(freeModels->mutex);
+      freeModels->models.push_back(model);
+    }
+  };
+
+  /// Shared by all pools so that it outlives the solver threads
+  static boost::thread_specific_ptr<ThreadModel>& threadModel()
+  {
+    static boost::thread_specific_ptr<ThreadModel> model;
+    return model;
+  }
+
+  LrocPairModel *_baseModel; // Make sure this does not go out of scope!
+  int            _numThreads;
+  std::vector<boost::shared_ptr<LrocPairModel> > _clones; // Protected by the free list mutex
+  boost::shared_ptr<FreeModels>                  _freeModels;
+
+public:
+
+  /// Sets up a model for each thread.
+  /// - The base model is one of them and the others share its camera state tables.  There is one
+  ///   more model than threads in case the thread that calls ceres::Solve also evaluates residuals.
+  LrocPairModelPool(LrocPairModel *baseModel, int numThreads)
+    : _baseModel(baseModel), _numThreads(numThreads), _freeModels(new FreeModels())
+  {
+    if (numThreads <= 1)
+      return;
+    _baseModel->prepareStateTables();
+    _freeModels->models.push_back(_baseModel);
+    for (int i=0; i<numThreads; ++i)
+    {
+      _clones.push_back(boost::shared_ptr<LrocPairModel>(_baseModel->clone()));
+      _freeModels->models.push_back(_clones.back().get());
+    }
+  }
+
+  /// Adds up the profiling counters of the base model and all the thread models
+  void getCallCounts(size_t &spiceCalls, size_t &projections, size_t &timeSolveIterations)
+  {
+    boost::mutex::scoped_lock lock(_freeModels->mutex);
+    spiceCalls  = 0;
+    projections = 0;
+    timeSolveIterations = 0;
+    _baseModel->getCallCounts(spiceCalls, projections, timeSolveIterations);
+    for (size_t i=0; i<_clones.size(); ++i)
+      _clones[i]->getCallCounts(spiceCalls, projections, timeSolveIterations);
+  }
+
+  void resetCallCounts()
+  {
+    boost::mutex::scoped_lock lock(_freeModels->mutex);
+    _baseModel->resetCallCounts();
+    for (size_t i=0; i<_clones.size(); ++i)
+      _clones[i]->resetCallCounts();
+  }
+
+  /// Returns the model belonging to the calling thread, giving it one on its first call.
+  LrocPairModel* get()
+  {
+    if (_numThreads <= 1)
+      return _baseModel;
+
+    ThreadModel* entry = threadModel().get();
+    if (entry && (entry->freeModels == _freeModels))
+      return entry->model;
+
+    // Take a model no other thread has.  An entry from an older pool is handed back by reset().
+    LrocPairModel* model = 0;
+    {
+      boost::mutex::scoped_lock lock(_freeModels->mutex);
+      if (_freeModels->models.empty())
+      {
+        // Only happens if the thread library swaps out its threads.  Loading the cameras
+        //  holds the SPICE lock so this is slow but safe.
+        printf("Warning: Making an extra copy of the camera models for a new solver thread\n");
+        _clones.push_back(boost::shared_ptr<LrocPairModel>(_baseModel->clone()));
+        _freeModels->models.push_back(_clones.back().get());
+      }
+      model = _freeModels->models.back();
+      _freeModels->models.pop_back();
+    }
+    entry = new ThreadModel();
+    entry->freeModels = _freeModels;
+    entry->model      = model;
+    threadModel().reset(entry);
+    return model;
+  }
+};
+
+
+//===================================================================================================
+// Solver storage.  Large problems have hundreds of thousands of points so the per-observation
+//  objects are kept small: they only hold an index into the shared observation list.
+
+/// The state shared by every residual of one camera in one pair type
+struct ObservationSource
+{
+  LrocPairModelPool *modelPool; // Make sure this does not go out of scope!
+  const std::vector<PixelObservation> *observations;
+
+  ObservationSource(LrocPairModelPool *pool, const std::vector<PixelObservation> &obsList)
+    : modelPool(pool), observations(&obsList) {}
+
+  /// Computes the residuals of observation i from a projected pixel
+  void computeResiduals(size_t i, const double *projection, double *residuals) const
+  {
+    const PixelObservation &obs = (*observations)[i];
+    residuals[0] = projection[0] - obs[0];
+    residuals[1] = projection[1] - obs[1];
+  }
+
+  /// Returns the row of observation i, used as the starting guess for the projection
+  int guessRow(size_t i) const { return static_cast<int>((*observations)[i][1]); }
+};
+
+/// Observation sources for both sides of a pair list
+struct PairObservationSources
+{
+  ObservationSource left, right;
+
+  PairObservationSources(LrocPairModelPool *pool, const PointObsList &pairs)
+    : left(pool, pairs.leftObsList), right(pool, pairs.rightObsList) {}
+
+  /// Returns the number of pairs
+  size_t size() const { return left.observations->size(); }
+};
+
+
+/// Structure-of-arrays storage for the solver parameters.
+/// - The camera parameters are in one fixed block and all the points are in one contiguous buffer,
+///   the solver parameter blocks point straight into them.
+class SolverParameterStore
+{
+public:
+  static const size_t NUM_CAMERA_PARAMS = 12;
+  static const size_t PARAMS_PER_POINT  = 3;
+
+  SolverParameterStore()
+  {
+    for (size_t i=0; i<NUM_CAMERA_PARAMS; ++i)
+      _cameraParams[i] = 0;
+  }
+
+  /// Loads a packed state vector, the camera parameters followed by the points.
+  void unpack(const vw::Vector<double> &packedState)
+  {
+    for (size_t i=0; i<NUM_CAMERA_PARAMS; ++i)
+      _cameraParams[i] = packedState[i];
+    _points.assign(packedState.begin()+NUM_CAMERA_PARAMS, packedState.end());
+  }
+
+  /// Writes the parameters back out in the packed state vector format
+  void pack(vw::Vector<double> &packedState) const
+  {
+    packedState.set_size(NUM_CAMERA_PARAMS + _points.size());
+    std::copy(_cameraParams, _cameraParams+NUM_CAMERA_PARAMS, packedState.begin());
+    std::copy(_points.begin(), _points.end(), packedState.begin()+NUM_CAMERA_PARAMS);
+  }
+
+  size_t numPoints() const { return _points.size() / PARAMS_PER_POINT; }
+
+  double* localRotation      () { return &(_cameraParams[0]); }
+  double* globalRotation     () { return &(_cameraParams[3]); }
+  double* globalPosition     () { return &(_cameraParams[6]); }
+  double* localStereoRotation() { return &(_cameraParams[9]); }
+
+  /// Returns the x/y/z parameters of point i
+  double* point(size_t i) { return &(_points[PARAMS_PER_POINT*i]); }
+
+private:
+  double _cameraParams[NUM_CAMERA_PARAMS];
+  std::vector<double> _points; // x/y/z of each point in sequence
+};
+
+
 /// Functor to evaluate the residuals for left point observations (no camera parameters used)
 struct LeftCostFunctor
 {
 private: // Variables
-  LrocPairModel *_baseModel; // Make sure this does not go out of scope!
-  vw::Vector2 _observation;
+  const ObservationSource *_source;
+  size_t _index;
+  mutable double _solvedTime; // Starting time for the next projection of this observation
   
 public:  // Functions
   
   /// Constructor
-  LeftCostFunctor(LrocPairModel *baseModel, const vw::Vector2 observation)
-  {
-    _baseModel   = baseModel;
-    _observation = observation;
-  }
+  LeftCostFunctor(const ObservationSource *source, size_t index)
+    : _source(source), _index(index), _solvedTime(0) {}
   
   /// Wrapper for left observation function
   bool operator()(const double* const point, double* residuals) const 
   {
     double observations[2];
-    if (!_baseModel->getLeftObservation(point, observations, _observation[1]))
+    if (!_source->modelPool->get()->getLeftObservation(point, observations, _source->guessRow(_index), 0, &_solvedTime))
       return false;
-    //std::ofstream file("/home/smcmich1/logDoubleL.csv", std::ofstream::app);
-    ////printf("observations = %lf, %lf\n", observations[0], observations[1]);
-    //file << observations[0] << ", " << observations[1] << std::endl;
-    //file.close();
-    residuals[0] = observations[0] - _observation[0];
-    residuals[1] = observations[1] - _observation[1];
+    _source->computeResiduals(_index, observations, residuals);
     return true;
   }
 }; // end struct LeftCostFunctor
@@ -854,26 +1378,23 @@ public:  // Functions
 struct RightCostFunctor
 {
 private: // Variables
-  LrocPairModel *_baseModel; // Make sure this does not go out of scope!
-  vw::Vector2 _observation;
+  const ObservationSource *_source;
+  size_t _index;
+  mutable double _solvedTime; // Starting time for the next projection of this observation
   
 public:  // Functions
   
   /// Constructor
-  RightCostFunctor(LrocPairModel *baseModel, const vw::Vector2 observation)
-  {
-    _baseModel   = baseModel;
-    _observation = observation;
-  }
+  RightCostFunctor(const ObservationSource *source, size_t index)
+    : _source(source), _index(index), _solvedTime(0) {}
   
   /// Wrapper for right observation function
   bool operator()(const double* const camera, const double* const point, double* residuals) const 
   {
     double observations[2];
-    if (!_baseModel->getRightObservation(camera, point, observations, _observation[1]))
+    if (!_source->modelPool->get()->getRightObservation(camera, point, observations, _source->guessRow(_index), 0, &_solvedTime))
       return false;
-    residuals[0] = observations[0] - _observation[0];
-    residuals[1] = observations[1] - _observation[1];
+    _source->computeResiduals(_index, observations, residuals);
     return true;
   }
 }; // end struct RightCostFunctor
@@ -882,32 +1403,24 @@ public:  // Functions
 struct LeftStereoCostFunctor
 {
 private: // Variables
-  LrocPairModel *_baseModel; // Make sure this does not go out of scope!
-  vw::Vector2 _observation;
+  const ObservationSource *_source;
+  size_t _index;
+  mutable double _solvedTime; // Starting time for the next projection of this observation
   
 public:  // Functions
   
   /// Constructor
-  LeftStereoCostFunctor(LrocPairModel *baseModel, const vw::Vector2 observation)
-  {
-    _baseModel   = baseModel;
-    _observation = observation;
-  }
+  LeftStereoCostFunctor(const ObservationSource *source, size_t index)
+    : _source(source), _index(index), _solvedTime(0) {}
   
   /// Wrapper for left stereo observation function
   bool operator()(const double* const rotParams, const double* const posParams, const double* const point, double* residuals) const
-  //bool operator()(const double* const rotParams, const double* const point, double* residuals) const
   {
-    //const double* const posParams = &(rotParams[3]);
     double observations[2];
-    if (!_baseModel->getLeftStereoObservation(rotParams, posParams, point, observations, _observation[1]))
+    if (!_source->modelPool->get()->getLeftStereoObservation(rotParams, posParams, point, observations,
+                                                             _source->guessRow(_index), 0, &_solvedTime))
       return false;
-    //std::ofstream file("/home/smcmich1/logDoubleLS.csv", std::ofstream::app);
-    ////printf("observations = %lf, %lf\n", observations[0], observations[1]);
-    //file << observations[0] << ", " << observations[1] << std::endl;
-    //file.close();
-    residuals[0] = observations[0] - _observation[0];
-    residuals[1] = observations[1] - _observation[1];
+    _source->computeResiduals(_index, observations, residuals);
     return true;
   }
 }; // end struct LeftStereoCostFunctor
@@ -917,17 +1430,15 @@ public:  // Functions
 struct RightStereoCostFunctor
 {
 private: // Variables
-  LrocPairModel *_baseModel; // Make sure this does not go out of scope!
-  vw::Vector2 _observation;
+  const ObservationSource *_source;
+  size_t _index;
+  mutable double _solvedTime; // Starting time for the next projection of this observation
   
 public:  // Functions
   
   /// Constructor
-  RightStereoCostFunctor(LrocPairModel *baseModel, const vw::Vector2 observation)
-  {
-    _baseModel   = baseModel;
-    _observation = observation;
-  }
+  RightStereoCostFunctor(const ObservationSource *source, size_t index)
+    : _source(source), _index(index), _solvedTime(0) {}
   
   /// Wrapper for right stereo observation function
   bool operator()(const double* const rotParams, 
@@ -936,14 +1447,428 @@ public:  // Functions
                   const double* const point, double* residuals) const 
   {
     double observations[2];
-    if (!_baseModel->getRightStereoObservation(rotParams, posParams, localRotParams, point, observations, _observation[1]))
+    if (!_source->modelPool->get()->getRightStereoObservation(rotParams, posParams, localRotParams, point, observations,
+                                                              _source->guessRow(_index), 0, &_solvedTime))
       return false;
-    residuals[0] = observations[0] - _observation[0];
-    residuals[1] = observations[1] - _observation[1];
+    _source->computeResiduals(_index, observations, residuals);
     return true;
   }
 }; // end struct RightStereoCostFunctor
 
+//===================================================================================================
+// Cost functions with analytic jacobians.  These evaluate the same residuals as the functors above
+//  but only solve for the projection time once per evaluation instead of once per parameter.
+// - Like the functors, each one remembers the last solved time of its observation.  Ceres evaluates
+//   a residual block from one thread at a time so this needs no locking.
+
+/// Analytic cost function for left point observations
+class LeftCostFunction : public ceres::SizedCostFunction<2, 3>
+{
+private: // Variables
+  const ObservationSource *_source;
+  size_t _index;
+  mutable double _solvedTime; // Starting time for the next projection of this observation
+
+public:  // Functions
+
+  LeftCostFunction(const ObservationSource *source, size_t index)
+    : _source(source), _index(index), _solvedTime(0) {}
+
+  virtual bool Evaluate(double const* const* parameters, double* residuals, double** jacobians) const
+  {
+    double observations[2];
+    if (!_source->modelPool->get()->getLeftObservation(parameters[0], observations, _source->guessRow(_index),
+                                                       jacobians, &_solvedTime))
+      return false;
+    _source->computeResiduals(_index, observations, residuals);
+    return true;
+  }
+}; // end class LeftCostFunction
+
+/// Analytic cost function for right point observations
+class RightCostFunction : public ceres::SizedCostFunction<2, 3, 3>
+{
+private: // Variables
+  const ObservationSource *_source;
+  size_t _index;
+  mutable double _solvedTime; // Starting time for the next projection of this observation
+
+public:  // Functions
+
+  RightCostFunction(const ObservationSource *source, size_t index)
+    : _source(source), _index(index), _solvedTime(0) {}
+
+  virtual bool Evaluate(double const* const* parameters, double* residuals, double** jacobians) const
+  {
+    double observations[2];
+    if (!_source->modelPool->get()->getRightObservation(parameters[0], parameters[1], observations, _source->guessRow(_index),
+                                                        jacobians, &_solvedTime))
+      return false;
+    _source->computeResiduals(_index, observations, residuals);
+    return true;
+  }
+}; // end class RightCostFunction
+
+/// Analytic cost function for left stereo point observations
+class LeftStereoCostFunction : public ceres::SizedCostFunction<2, 3, 3, 3>
+{
+private: // Variables
+  const ObservationSource *_source;
+  size_t _index;
+  mutable double _solvedTime; // Starting time for the next projection of this observation
+
+public:  // Functions
+
+  LeftStereoCostFunction(const ObservationSource *source, size_t index)
+    : _source(source), _index(index), _solvedTime(0) {}
+
+  virtual bool Evaluate(double const* const* parameters, double* residuals, double** jacobians) const
+  {
+    double observations[2];
+    if (!_source->modelPool->get()->getLeftStereoObservation(parameters[0], parameters[1], parameters[2], observations,
+                                                             _source->guessRow(_index), jacobians, &_solvedTime))
+      return false;
+    _source->computeResiduals(_index, observations, residuals);
+    return true;
+  }
+}; // end class LeftStereoCostFunction
+
+/// Analytic cost function for right stereo point observations
+class RightStereoCostFunction : public ceres::SizedCostFunction<2, 3, 3, 3, 3>
+{
+private: // Variables
+  const ObservationSource *_source;
+  size_t _index;
+  mutable double _solvedTime; // Starting time for the next projection of this observation
+
+public:  // Functions
+
+  RightStereoCostFunction(const ObservationSource *source, size_t index)
+    : _source(source), _index(index), _solvedTime(0) {}
+
+  virtual bool Evaluate(double const* const* parameters, double* residuals, double** jacobians) const
+  {
+    double observations[2];
+    if (!_source->modelPool->get()->getRightStereoObservation(parameters[0], parameters[1], parameters[2], parameters[3],
+                                                              observations, _source->guessRow(_index), jacobians, &_solvedTime))
+      return false;
+    _source->computeResiduals(_index, observations, residuals);
+    return true;
+  }
+}; // end class RightStereoCostFunction
+
+
+// Cost function factories used by the solver.
+// - index selects the observation from source.
+// - If numericJacobians is set the central difference versions are returned instead.
+
+inline ceres::CostFunction* makeLeftCostFunction(const ObservationSource *source, size_t index, bool numericJacobians)
+{
+  if (numericJacobians)
+    return new ceres::NumericDiffCostFunction<LeftCostFunctor, ceres::CENTRAL, 2, 3>(
+                 new LeftCostFunctor(source, index));
+  return new LeftCostFunction(source, index);
+}
+
+inline ceres::CostFunction* makeRightCostFunction(const ObservationSource *source, size_t index, bool numericJacobians)
+{
+  if (numericJacobians)
+    return new ceres::NumericDiffCostFunction<RightCostFunctor, ceres::CENTRAL, 2, 3, 3>(
+                 new RightCostFunctor(source, index));
+  return new RightCostFunction(source, index);
+}
+
+inline ceres::CostFunction* makeLeftStereoCostFunction(const ObservationSource *source, size_t index, bool numericJacobians)
+{
+  if (numericJacobians)
+    return new ceres::NumericDiffCostFunction<LeftStereoCostFunctor, ceres::CENTRAL, 2, 3, 3, 3>(
+                 new LeftStereoCostFunctor(source, index));
+  return new LeftStereoCostFunction(source, index);
+}
+
+inline ceres::CostFunction* makeRightStereoCostFunction(const ObservationSource *source, size_t index, bool numericJacobians)
+{
+  if (numericJacobians)
+    return new ceres::NumericDiffCostFunction<RightStereoCostFunctor, ceres::CENTRAL, 2, 3, 3, 3, 3>(
+                 new RightStereoCostFunctor(source, index));
+  return new RightStereoCostFunction(source, index);
+}
+
+
+//===================================================================================================
+// Problem builder, shared by lronacAngleDoubleSolver and lronacSolverBenchmark
+
+/// Returns the indices of about one in stride pairs, spread evenly over the left image
+/// - The left pixels are binned on a grid with about one cell per selected pair and the pair closest to
+///   the middle of each occupied cell is kept.  Taking every stride-th pair in file order instead can keep
+///   a single column of a row-major disparity grid.
+/// - The indices are in increasing order, all of them are returned if stride is one.
+inline std::vector<size_t> selectSpreadPairs(const PairObservationSources &sources, const size_t stride)
+{
+  const std::vector<PixelObservation> &pixels = *sources.left.observations;
+  std::vector<size_t> selected;
+  if ((stride <= 1) || pixels.empty())
+  {
+    selected.resize(pixels.size());
+    for (size_t i=0; i<pixels.size(); ++i)
+      selected[i] = i;
+    return selected;
+  }
+
+  // Bounding box of the left pixels
+  double minSample = pixels[0][0], maxSample = pixels[0][0];
+  double minLine   = pixels[0][1], maxLine   = pixels[0][1];
+  for (size_t i=1; i<pixels.size(); ++i)
+  {
+    minSample = std::min(minSample, pixels[i][0]);
+    maxSample = std::max(maxSample, pixels[i][0]);
+    minLine   = std::min(minLine,   pixels[i][1]);
+    maxLine   = std::max(maxLine,   pixels[i][1]);
+  }
+  const double width  = std::max(maxSample - minSample, 1.0);
+  const double height = std::max(maxLine   - minLine,   1.0);
+
+  // Roughly square cells, one per pair to keep
+  const double numCells = std::max(1.0, static_cast<double>(pixels.size()) / stride);
+  const int    numCols  = std::max(1, static_cast<int>(floor(sqrt(numCells*width/height) + 0.5)));
+  const int    numRows  = std::max(1, static_cast<int>(ceil(numCells / numCols)));
+  const double cellWidth  = width  / numCols;
+  const double cellHeight = height / numRows;
+
+  const size_t NO_PAIR = pixels.size();
+  std::vector<size_t> cellPairs    (numCols*numRows, NO_PAIR);
+  std::vector<double> cellDistances(numCols*numRows, 0);
+  for (size_t i=0; i<pixels.size(); ++i)
+  {
+    const int col = std::min(numCols-1, static_cast<int>((pixels[i][0] - minSample) / cellWidth ));
+    const int row = std::min(numRows-1, static_cast<int>((pixels[i][1] - minLine  ) / cellHeight));
+    const double ds = pixels[i][0] - (minSample + (col+0.5)*cellWidth );
+    const double dl = pixels[i][1] - (minLine   + (row+0.5)*cellHeight);
+    const double distance = ds*ds + dl*dl;
+    const size_t cell = row*numCols + col;
+    if ((cellPairs[cell] == NO_PAIR) || (distance < cellDistances[cell]))
+    {
+      cellPairs    [cell] = i;
+      cellDistances[cell] = distance;
+    }
+  }
+
+  for (size_t c=0; c<cellPairs.size(); ++c)
+    if (cellPairs[c] != NO_PAIR)
+      selected.push_back(cellPairs[c]);
+  std::sort(selected.begin(), selected.end());
+  return selected;
+}
+
+/// Adds the residuals for about one in stride pairs of each pair type to a problem
+/// - The pairs are chosen by selectSpreadPairs.
+/// - The point parameter blocks are taken from solverParams, which stores the points of each pair type in sequence.
+/// - If ordering is not null the points are added to group 0 and the camera parameters to group 1.
+/// - Returns the number of points that were added.
+inline size_t addPairResiduals(ceres::Problem &problem, SolverParameterStore &solverParams, ceres::LossFunction *lossFunction,
+                               const PairObservationSources &mainSources,      const PairObservationSources &stereoSources,
+                               const PairObservationSources &leftSources,      const PairObservationSources &rightSources,
+                               const PairObservationSources &leftCrossSources, const PairObservationSources &rightCrossSources,
+                               const size_t stride, const bool numericJacobians,
+                               ceres::ParameterBlockOrdering *ordering)
+{
+  const int NUM_PARAMS_PER_POINT = 3;
+
+  // Set up camera parameters for solver
+  double* localRotation       = solverParams.localRotation();
+  double* globalRotation      = solverParams.globalRotation();
+  double* globalPosition      = solverParams.globalPosition();
+  double* localStereoRotation = solverParams.localStereoRotation();
+
+  problem.AddParameterBlock(localRotation,       3);
+  problem.AddParameterBlock(globalRotation,      3);
+  problem.AddParameterBlock(globalPosition,      3);
+  problem.AddParameterBlock(localStereoRotation, 3);
+  if (ordering)
+  {
+    ordering->AddElementToGroup(localRotation,       1);
+    ordering->AddElementToGroup(globalRotation,      1);
+    ordering->AddElementToGroup(globalPosition,      1);
+    ordering->AddElementToGroup(localStereoRotation, 1);
+  }
+
+  size_t pointOffset = 0;
+
+  if (mainSources.size() > 0)
+    printf("Loading parameters for main camera pair...\n");
+  const std::vector<size_t> mainSelected = selectSpreadPairs(mainSources, stride);
+  for (size_t s=0; s<mainSelected.size(); ++s) // For each selected input point
+  {
+    const size_t i = mainSelected[s];
+
+    // Set up this point's parameters for the solver
+    double* pointParams = solverParams.point(pointOffset + i);
+    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
+    if (ordering)
+      ordering->AddElementToGroup(pointParams, 0);
+    
+    // Add the function and residual block for the left camera
+    ceres::CostFunction* costFunctionLeft = 
+            makeLeftCostFunction(&mainSources.left, i, numericJacobians);
+
+    problem.AddResidualBlock(costFunctionLeft, lossFunction, pointParams);
+
+    // Add the function and residual block for the right camera (slightly more complex)
+    ceres::CostFunction* costFunctionRight = 
+            makeRightCostFunction(&mainSources.right, i, numericJacobians);
+    
+    problem.AddResidualBlock(costFunctionRight, lossFunction, localRotation, pointParams);
+    
+  } // End of loop through main camera pair points
+  pointOffset += mainSources.size();
+
+
+  if (stereoSources.size() > 0)
+    printf("Loading parameters for stereo camera pair...\n");
+  const std::vector<size_t> stereoSelected = selectSpreadPairs(stereoSources, stride);
+  for (size_t s=0; s<stereoSelected.size(); ++s) // For each selected input point
+  {
+    const size_t i = stereoSelected[s];
+
+    // Set up this point's parameters for the solver
+    double* pointParams = solverParams.point(pointOffset + i);
+    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
+    if (ordering)
+      ordering->AddElementToGroup(pointParams, 0);
+    
+    // Add the function and residual block for the left camera
+    ceres::CostFunction* costFunctionLeft = 
+            makeLeftStereoCostFunction(&stereoSources.left, i, numericJacobians);
+
+    problem.AddResidualBlock(costFunctionLeft, lossFunction, globalRotation, globalPosition, pointParams);
+
+    // Add the function and residual block for the right camera (slightly more complex)
+    ceres::CostFunction* costFunctionRight = 
+            makeRightStereoCostFunction(&stereoSources.right, i, numericJacobians);
+    
+    problem.AddResidualBlock(costFunctionRight, lossFunction, globalRotation, globalPosition, localStereoRotation, pointParams);
+    
+  } // End of loop through stereo camera pair points
+  pointOffset += stereoSources.size();
+
+
+  if (leftSources.size() > 0)
+    printf("Loading parameters for two left cameras...\n");
+  const std::vector<size_t> leftSelected = selectSpreadPairs(leftSources, stride);
+  for (size_t s=0; s<leftSelected.size(); ++s) // For each selected input point
+  {
+    const size_t i = leftSelected[s];
+
+    // Set up this point's parameters for the solver
+    double* pointParams = solverParams.point(pointOffset + i);
+    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
+    if (ordering)
+      ordering->AddElementToGroup(pointParams, 0);
+    
+    // Add the function and residual block for the left camera
+    ceres::CostFunction* costFunctionLeft = 
+            makeLeftCostFunction(&leftSources.left, i, numericJacobians);
+
+    problem.AddResidualBlock(costFunctionLeft, lossFunction, pointParams);
+
+    // Add the function and residual block for the stereo left camera (slightly more complex)
+    ceres::CostFunction* costFunctionRight = 
+            makeLeftStereoCostFunction(&leftSources.right, i, numericJacobians);
+    
+    problem.AddResidualBlock(costFunctionRight, lossFunction, globalRotation, globalPosition, pointParams);
+    
+  } // End of loop through both left camera points
+  pointOffset += leftSources.size();
+
+
+  if (rightSources.size() > 0)
+    printf("Loading parameters for two right cameras...\n");
+  const std::vector<size_t> rightSelected = selectSpreadPairs(rightSources, stride);
+  for (size_t s=0; s<rightSelected.size(); ++s) // For each selected input point
+  {
+    const size_t i = rightSelected[s];
+
+    // Set up this point's parameters for the solver
+    double* pointParams = solverParams.point(pointOffset + i);
+    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
+    if (ordering)
+      ordering->AddElementToGroup(pointParams, 0);
+    
+    // Add the function and residual block for the right camera
+    ceres::CostFunction* costFunctionLeft = 
+            makeRightCostFunction(&rightSources.left, i, numericJacobians);
+
+    problem.AddResidualBlock(costFunctionLeft, lossFunction, localRotation, pointParams);
+
+    // Add the function and residual block for the stereo right camera (slightly more complex)
+    ceres::CostFunction* costFunctionRight = 
+            makeRightStereoCostFunction(&rightSources.right, i, numericJacobians);
+    
+    problem.AddResidualBlock(costFunctionRight, lossFunction, globalRotation, globalPosition, localStereoRotation, pointParams);
+    
+  } // End of loop through both right camera points
+  pointOffset += rightSources.size();
+
+
+  if (leftCrossSources.size() > 0)
+    printf("Loading parameters for left cross camera pair...\n");
+  const std::vector<size_t> leftCrossSelected = selectSpreadPairs(leftCrossSources, stride);
+  for (size_t s=0; s<leftCrossSelected.size(); ++s) // For each selected input point
+  {
+    const size_t i = leftCrossSelected[s];
+
+    // Set up this point's parameters for the solver
+    double* pointParams = solverParams.point(pointOffset + i);
+    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
+    if (ordering)
+      ordering->AddElementToGroup(pointParams, 0);
+
+    // Add the function and residual block for the left camera
+    ceres::CostFunction* costFunctionLeft =
+            makeLeftCostFunction(&leftCrossSources.left, i, numericJacobians);
+
+    problem.AddResidualBlock(costFunctionLeft, lossFunction, pointParams);
+
+    // Add the function and residual block for the stereo right camera (slightly more complex)
+    ceres::CostFunction* costFunctionRight =
+            makeRightStereoCostFunction(&leftCrossSources.right, i, numericJacobians);
+
+    problem.AddResidualBlock(costFunctionRight, lossFunction, globalRotation, globalPosition, localStereoRotation, pointParams);
+
+  } // End of loop through left cross camera pair points
+  pointOffset += leftCrossSources.size();
+
+  if (rightCrossSources.size() > 0)
+    printf("Loading parameters for right cross camera pair...\n");
+  const std::vector<size_t> rightCrossSelected = selectSpreadPairs(rightCrossSources, stride);
+  for (size_t s=0; s<rightCrossSelected.size(); ++s) // For each selected input point
+  {
+    const size_t i = rightCrossSelected[s];
+
+    // Set up this point's parameters for the solver
+    double* pointParams = solverParams.point(pointOffset + i);
+    problem.AddParameterBlock(pointParams, NUM_PARAMS_PER_POINT);
+    if (ordering)
+      ordering->AddElementToGroup(pointParams, 0);
+
+    // Add the function and residual block for the left camera
+    ceres::CostFunction* costFunctionLeft =
+            makeLeftStereoCostFunction(&rightCrossSources.left, i, numericJacobians);
+
+    problem.AddResidualBlock(costFunctionLeft, lossFunction, globalRotation, globalPosition, pointParams);
+
+    // Add the function and residual block for the right camera
+    ceres::CostFunction* costFunctionRight =
+            makeRightCostFunction(&rightCrossSources.right, i, numericJacobians);
+
+    problem.AddResidualBlock(costFunctionRight, lossFunction, localRotation, pointParams);
+
+  } // End of loop through right cross camera pair points
+  pointOffset += rightCrossSources.size();
+
+  return problem.NumParameterBlocks() - 4;
+}
+
 
 #endif
 
@@ -0,0 +1,327 @@
+// __BEGIN_LICENSE__
+//  Copyright (c) 2009-2013, United States Government as represented by the
+//  Administrator of the National Aeronautics and Space Administration. All
+//  rights reserved.
+//
+//  The NGT platform is licensed under the Apache License, Version 2.0 (the
+//  "License"); you may not use this file except in compliance with the
+//  License. You may obtain a copy of the License at
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+// __END_LICENSE__
+
+
+/// \file lronacSolverReplay.cc Solves a problem snapshot written by lronacAngleDoubleSolver --snapshot
+///
+/// The cameras are rebuilt from the tabulated geometry in the snapshot, so no ISIS installation, cubes
+///  or SPICE kernels are needed.  The problem has the same parameter and residual blocks as the one
+///  built by lronacAngleDoubleSolver, which makes this useful for comparing solver settings.
+/// - The residuals use central difference jacobians of the tabulated cameras.
+
+#include <iostream>
+#include <fstream>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#include <boost/program_options.hpp>
+namespace po = boost::program_options;
+
+#include "ceres/ceres.h"
+#include "glog/logging.h"
+
+#include <solverSnapshot.h>
+#include <tabulatedCamera.h>
+#include <linearSolverChoice.h>
+
+using namespace vw;
+
+
+//-------------------------------------------------------------------------------------------
+// Residual functors, with the same parameter blocks as the lronacAngleDoubleSolver cost functions.
+
+/// Computes the residuals of a projection, returns false if the projection failed
+bool projectionResiduals(const TabulatedLineScanCamera &camera, Vector3 const& point, Matrix3x3 const& R_offset,
+                         const Vector2 &observation, double* residuals)
+{
+  Vector2 pixel;
+  if (!camera.project(point, R_offset, observation[1], pixel))
+    return false;
+  residuals[0] = pixel[0] - observation[0];
+  residuals[1] = pixel[1] - observation[1];
+  return true;
+}
+
+/// LE observations: [point]
+struct ReplayLeftFunctor
+{
+  const TabulatedLineScanCamera *camera;
+  Vector2 observation;
+  ReplayLeftFunctor(const TabulatedLineScanCamera *c, Vector2 const& obs) : camera(c), observation(obs) {}
+
+  bool operator()(const double* const point, double* residuals) const
+  {
+    Matrix3x3 noRotation;
+    noRotation.set_identity();
+    return projectionResiduals(*camera, Vector3(point[0], point[1], point[2]), noRotation, observation, residuals);
+  }
+};
+
+/// RE observations: [local rotation, point]
+struct ReplayRightFunctor
+{
+  const TabulatedLineScanCamera *camera;
+  Vector2 observation;
+  ReplayRightFunctor(const TabulatedLineScanCamera *c, Vector2 const& obs) : camera(c), observation(obs) {}
+
+  bool operator()(const double* const angles, const double* const point, double* residuals) const
+  {
+    return projectionResiduals(*camera, Vector3(point[0], point[1], point[2]), offsetRotation(angles),
+                               observation, residuals);
+  }
+};
+
+/// LE_S observations: [global rotation, global position, point]
+struct ReplayLeftStereoFunctor
+{
+  const TabulatedLineScanCamera *camera;
+  Vector2 observation;
+  ReplayLeftStereoFunctor(const TabulatedLineScanCamera *c, Vector2 const& obs) : camera(c), observation(obs) {}
+
+  bool operator()(const double* const rotParams, const double* const posParams, const double* const point,
+                  double* residuals) const
+  {
+    Matrix3x3 noRotation;
+    noRotation.set_identity();
+    Vector3 adjusted = adjustStereoPoint(*camera, rotParams, posParams, Vector3(point[0], point[1], point[2]));
+    return projectionResiduals(*camera, adjusted, noRotation, observation, residuals);
+  }
+};
+
+/// RE_S observations: [global rotation, global position, local stereo rotation, point]
+struct ReplayRightStereoFunctor
+{
+  const TabulatedLineScanCamera *camera;
+  Vector2 observation;
+  ReplayRightStereoFunctor(const TabulatedLineScanCamera *c, Vector2 const& obs) : camera(c), observation(obs) {}
+
+  bool operator()(const double* const rotParams, const double* const posParams, const double* const angles,
+                  const double* const point, double* residuals) const
+  {
+    Vector3 adjusted = adjustStereoPoint(*camera, rotParams, posParams, Vector3(point[0], point[1], point[2]));
+    return projectionResiduals(*camera, adjusted, offsetRotation(angles), observation, residuals);
+  }
+};
+
+//-------------------------------------------------------------------------------------------
+
+/// Adds the residual block for one observation of a point
+void addObservation(ceres::Problem &problem, ceres::LossFunction *lossFunction,
+                    const TabulatedLineScanCamera *cameras, SnapshotCamera camera,
+                    double *cameraParams, double *point, Vector2 const& observation)
+{
+  double* localRotation       = cameraParams;
+  double* globalRotation      = cameraParams + 3;
+  double* globalPosition      = cameraParams + 6;
+  double* localStereoRotation = cameraParams + 9;
+  const TabulatedLineScanCamera *c = &(cameras[camera]);
+  switch (camera)
+  {
+    case SNAPSHOT_LEFT:
+      problem.AddResidualBlock(new ceres::NumericDiffCostFunction<ReplayLeftFunctor, ceres::CENTRAL, 2, 3>(
+                                 new ReplayLeftFunctor(c, observation)),
+                               lossFunction, point);
+      break;
+    case SNAPSHOT_RIGHT:
+      problem.AddResidualBlock(new ceres::NumericDiffCostFunction<ReplayRightFunctor, ceres::CENTRAL, 2, 3, 3>(
+                                 new ReplayRightFunctor(c, observation)),
+                               lossFunction, localRotation, point);
+      break;
+    case SNAPSHOT_LEFT_STEREO:
+      problem.AddResidualBlock(new ceres::NumericDiffCostFunction<ReplayLeftStereoFunctor, ceres::CENTRAL, 2, 3, 3, 3>(
+                                 new ReplayLeftStereoFunctor(c, observation)),
+                               lossFunction, globalRotation, globalPosition, point);
+      break;
+    default: // SNAPSHOT_RIGHT_STEREO
+      problem.AddResidualBlock(new ceres::NumericDiffCostFunction<ReplayRightStereoFunctor, ceres::CENTRAL, 2, 3, 3, 3, 3>(
+                                 new ReplayRightStereoFunctor(c, observation)),
+                               lossFunction, globalRotation, globalPosition, localStereoRotation, point);
+  }
+}
+
+/// Returns a new loss function by name, or null for plain least squares
+ceres::LossFunction* makeLossFunction(const std::string &name, double scale)
+{
+  if (name == "cauchy")
+    return new ceres::CauchyLoss(scale);
+  if (name == "huber")
+    return new ceres::HuberLoss(scale);
+  if (name == "softl1")
+    return new ceres::SoftLOneLoss(scale);
+  if (name == "arctan")
+    return new ceres::ArctanLoss(scale);
+  if (name != "none")
+    std::cout << "Unknown loss function " << name << ", using none" << std::endl;
+  return 0;
+}
+
+
+
+int main( int argc, char *argv[] ) {
+
+  std::string snapshotPath, outputPrefix, linearSolverName, preconditionerName, orderingName, lossName;
+  double lossScale=5.0, functionTolerance=1e-6;
+  int numThreads=1, maxIterations=100;
+
+  po::options_description general_options("Options");
+  general_options.add_options()
+    ("help,h",        "Display this help message")
+    ("snapshot,s",          po::value<std::string>(&snapshotPath),                                 "Snapshot file written by lronacAngleDoubleSolver --snapshot")
+    ("outputPrefix,o",      po::value<std::string>(&outputPrefix)->default_value(""),              "If set, write the solved state to <prefix>-replayParamState.csv")
+    ("linearSolver",        po::value<std::string>(&linearSolverName)->default_value("auto"),      "Ceres linear solver type (DENSE_SCHUR, SPARSE_SCHUR, ITERATIVE_SCHUR, DENSE_QR, ...) or auto to choose from the problem size")
+    ("preconditioner",      po::value<std::string>(&preconditionerName)->default_value("auto"),    "Ceres preconditioner type for the iterative linear solvers (JACOBI, SCHUR_JACOBI, ...) or auto")
+    ("ordering",            po::value<std::string>(&orderingName)->default_value("auto"),          "Parameter ordering: auto, schur (points eliminated first) or ceres (chosen by Ceres)")
+    ("loss",                po::value<std::string>(&lossName)->default_value("cauchy"),            "Loss function: none, cauchy, huber, softl1 or arctan")
+    ("lossScale",           po::value<double     >(&lossScale)->default_value(5.0),                "Scale of the loss function in pixels")
+    ("threads,t",           po::value<int        >(&numThreads)->default_value(1),                 "Number of solver threads")
+    ("maxIterations",       po::value<int        >(&maxIterations)->default_value(100),            "Maximum number of solver iterations")
+    ("functionTolerance",   po::value<double     >(&functionTolerance)->default_value(1e-6),       "Stop solving when the relative cost change of an iteration is below this");
+
+  po::positional_options_description positional_desc;
+  positional_desc.add("snapshot", 1);
+
+  std::ostringstream usage;
+  usage << "Usage: " << argv[0] << " [options] <snapshot>" << std::endl << std::endl;
+  usage << general_options << std::endl;
+
+  po::variables_map vm;
+  try {
+    po::store( po::command_line_parser( argc, argv ).options(general_options).positional(positional_desc).run(), vm );
+    po::notify( vm );
+  } catch (const po::error& e) {
+    std::cout << "An error occured while parsing command line arguments.\n";
+    std::cout << "\t" << e.what() << "\n\n";
+    std::cout << usage.str();
+    return 1;
+  }
+  if (vm.count("help") || snapshotPath.empty())
+  {
+    std::cout << usage.str();
+    return 1;
+  }
+
+  printf("Loading snapshot %s\n", snapshotPath.c_str());
+  SolverSnapshot snapshot;
+  if (!readSolverSnapshot(snapshotPath, snapshot))
+  {
+    printf("Error: Failed to read snapshot file %s\n", snapshotPath.c_str());
+    return 1;
+  }
+
+  // Rebuild the cameras that have pairs
+  TabulatedLineScanCamera cameras[SNAPSHOT_NUM_CAMERAS];
+  bool cameraNeeded[SNAPSHOT_NUM_CAMERAS] = {false, false, false, false};
+  size_t numPoints = 0;
+  for (int p=0; p<SNAPSHOT_NUM_PAIR_TYPES; ++p)
+  {
+    numPoints += snapshot.numPairs(p);
+    if (snapshot.numPairs(p) == 0)
+      continue;
+    cameraNeeded[SNAPSHOT_PAIR_CAMERAS[p][0]] = true;
+    cameraNeeded[SNAPSHOT_PAIR_CAMERAS[p][1]] = true;
+  }
+  for (int c=0; c<SNAPSHOT_NUM_CAMERAS; ++c)
+  {
+    if (cameraNeeded[c] && !cameras[c].load(snapshot.cameras[c]))
+    {
+      printf("Error: Snapshot is missing the tables for camera %d\n", c);
+      return 1;
+    }
+  }
+
+  const size_t NUM_CAMERA_PARAMS = 12;
+  const size_t PARAMS_PER_POINT  = 3;
+  std::vector<double> state = snapshot.state;
+  if (state.size() != NUM_CAMERA_PARAMS + numPoints*PARAMS_PER_POINT)
+  {
+    printf("Error: Snapshot has %lu state values for %lu points\n",
+           (unsigned long)state.size(), (unsigned long)numPoints);
+    return 1;
+  }
+  printf("Loaded %lu points\n", (unsigned long)numPoints);
+
+  // Build the problem the same way lronacAngleDoubleSolver does
+  ceres::Problem problem;
+  ceres::LossFunction* lossFunction = makeLossFunction(lossName, lossScale);
+  double *cameraParams = &(state[0]);
+  for (int i=0; i<4; ++i)
+    problem.AddParameterBlock(cameraParams + 3*i, 3);
+
+  ceres::ParameterBlockOrdering *ordering = new ceres::ParameterBlockOrdering;
+  for (int i=0; i<4; ++i)
+    ordering->AddElementToGroup(cameraParams + 3*i, 1);
+
+  size_t pointIndex = 0;
+  for (int p=0; p<SNAPSHOT_NUM_PAIR_TYPES; ++p)
+  {
+    const std::vector<float> &pairs = snapshot.pairs[p];
+    for (size_t i=0; i<snapshot.numPairs(p); ++i)
+    {
+      double *point = &(state[NUM_CAMERA_PARAMS + PARAMS_PER_POINT*pointIndex++]);
+      problem.AddParameterBlock(point, PARAMS_PER_POINT);
+      ordering->AddElementToGroup(point, 0);
+      addObservation(problem, lossFunction, cameras, SNAPSHOT_PAIR_CAMERAS[p][0], cameraParams, point,
+                     Vector2(pairs[4*i  ], pairs[4*i+1]));
+      addObservation(problem, lossFunction, cameras, SNAPSHOT_PAIR_CAMERAS[p][1], cameraParams, point,
+                     Vector2(pairs[4*i+2], pairs[4*i+3]));
+    }
+  }
+
+  LinearSolverChoice linearSolverChoice;
+  if (!chooseLinearSolver(linearSolverName, preconditionerName, orderingName, numPoints, NUM_CAMERA_PARAMS,
+                          numThreads, linearSolverChoice))
+  {
+    printf("Error: Unknown linear solver %s, preconditioner %s or ordering %s\n", linearSolverName.c_str(),
+           preconditionerName.c_str(), orderingName.c_str());
+    delete ordering;
+    return 1;
+  }
+
+  ceres::Solver::Options solverOptions;
+  solverOptions.max_num_iterations           = maxIterations;
+  solverOptions.function_tolerance           = functionTolerance;
+  solverOptions.minimizer_progress_to_stdout = true;
+  solverOptions.max_num_line_search_direction_restarts = 8;
+  solverOptions.use_nonmonotonic_steps = false;
+  solverOptions.max_num_consecutive_invalid_steps = 10;
+  solverOptions.num_threads = numThreads;
+  applyLinearSolverChoice(linearSolverChoice, ordering, solverOptions);
+
+  printf("Linear solver: %s\n", describeLinearSolverChoice(linearSolverChoice).c_str());
+  printf("Solving with %s loss and %d threads\n", lossName.c_str(), numThreads);
+  ceres::Solver::Summary summary;
+  ceres::Solve(solverOptions, &problem, &summary);
+  std::cout << summary.FullReport() << "\n";
+
+  printf("Final camera parameters:\n");
+  for (size_t i=0; i<NUM_CAMERA_PARAMS; ++i)
+    printf("%lf\n", state[i]);
+
+  if (!outputPrefix.empty())
+  {
+    std::string statePath = outputPrefix + "-replayParamState.csv";
+    printf("Writing final state to %s\n", statePath.c_str());
+    std::ofstream stateFile(statePath.c_str());
+    stateFile.precision(17);
+    for (size_t i=0; i<state.size(); ++i)
+      stateFile << state[i] << std::endl;
+    stateFile.close();
+  }
+
+  return 0;
+}
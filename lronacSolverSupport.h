@@ -41,6 +41,9 @@
 #include <vw/Math/EulerAngles.h>
 
 #include <asp/Core/IntegralAutoGainDetector.h>
+
+#include "ceres/jet.h"
+#include "ceres/rotation.h"
 //#include <asp/IsisIO/IsisInterfaceLineScan.h>
 #include <IsisInterfaceLineScanRot.h>
 
@@ -101,23 +104,44 @@ class AdjustedCameraModelRot : public vw::camera::CameraModel
 {
 private:
   
-  boost::shared_ptr<IsisInterfaceLineScanRot> m_camera;
+  boost::shared_ptr<SolverLineScanCamera> m_camera;
   vw::Vector3 m_translation;
   vw::Quat m_rotation;
   vw::Quat m_rotation_inverse;
 
+  // The rotation is applied around the camera center at the first pixel.  This only
+  //  depends on the camera so it is looked up once.
+  mutable bool        m_pivot_valid;
+  mutable vw::Vector3 m_pivot;
+
+  /// Returns the point the rotation is applied around
+  vw::Vector3 const& rotation_pivot() const {
+    if (!m_pivot_valid) {
+      m_pivot       = m_camera->camera_center(vw::Vector2(0,0));
+      m_pivot_valid = true;
+    }
+    return m_pivot;
+  }
+
 public:
-  AdjustedCameraModelRot(){}
+  AdjustedCameraModelRot() : m_pivot_valid(false) {}
   
-  AdjustedCameraModelRot(boost::shared_ptr<IsisInterfaceLineScanRot> camera_model) : m_camera(camera_model) 
+  AdjustedCameraModelRot(boost::shared_ptr<SolverLineScanCamera> camera_model) : m_camera(camera_model), m_pivot_valid(false)
   {
     m_rotation         = vw::Quat(vw::math::identity_matrix<3>());
     m_rotation_inverse = vw::Quat(vw::math::identity_matrix<3>());
   }
 
-  AdjustedCameraModelRot(boost::shared_ptr<IsisInterfaceLineScanRot> camera_model,
+  AdjustedCameraModelRot(boost::shared_ptr<SolverLineScanCamera> camera_model,
                       vw::Vector3 const& translation, vw::Quat const& rotation) :
-    m_camera(camera_model), m_translation(translation), m_rotation(rotation), m_rotation_inverse(inverse(rotation)) {}
+    m_camera(camera_model), m_translation(translation), m_rotation(rotation), m_rotation_inverse(inverse(rotation)),
+    m_pivot_valid(false) {}
+
+  /// Replace the underlying camera model
+  void set_camera(boost::shared_ptr<SolverLineScanCamera> camera_model) {
+    m_camera      = camera_model;
+    m_pivot_valid = false;
+  }
 
   virtual ~AdjustedCameraModelRot() {}
   virtual std::string type() const { return "Adjusted"; }
@@ -156,17 +180,60 @@ void set_rotation(vw::Quat const& rotation) {
 }
 
 vw::Vector2 point_to_pixel (vw::Vector3 const& point) const {
-  vw::Vector3 offset_pt = point-m_camera->camera_center(vw::Vector2(0,0))-m_translation;
-  vw::Vector3 new_pt = m_rotation_inverse.rotate(offset_pt) + m_camera->camera_center(vw::Vector2(0,0));
+  vw::Vector3 const& center = rotation_pivot();
+  vw::Vector3 offset_pt = point-center-m_translation;
+  vw::Vector3 new_pt = m_rotation_inverse.rotate(offset_pt) + center;
   return m_camera->point_to_pixel(new_pt);
 }
 
 /// New code to support passing local rotation angles into this function
-vw::Vector2 point_to_pixel_rotated( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine) const
+vw::Vector2 point_to_pixel_rotated( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine, double *guessTime=0) const
+{
+  vw::Vector3 const& center = rotation_pivot();
+  vw::Vector3 offset_pt = point-center-m_translation;
+  vw::Vector3 new_pt = m_rotation_inverse.rotate(offset_pt) + center;
+  return m_camera->point_to_pixel_rotated(new_pt, rotAngles, guessLine, guessTime);
+}
+
+/// Same as point_to_pixel_rotated, but also computes the partial derivatives of the pixel with respect to
+/// the point, the local rotation angles, the axis-angle rotation and the translation of this model.
+vw::Vector2 point_to_pixel_rotated_partials( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine,
+                                             vw::Matrix<double,2,3> &pixel_point_partials,
+                                             vw::Matrix<double,2,3> &pixel_angle_partials,
+                                             vw::Matrix<double,2,3> &pixel_rotation_partials,
+                                             vw::Matrix<double,2,3> &pixel_translation_partials,
+                                             double *guessTime=0) const
 {
-  vw::Vector3 offset_pt = point-m_camera->camera_center(vw::Vector2(0,0))-m_translation;
-  vw::Vector3 new_pt = m_rotation_inverse.rotate(offset_pt) + m_camera->camera_center(vw::Vector2(0,0));
-  return m_camera->point_to_pixel_rotated(new_pt, rotAngles, guessLine);
+  vw::Vector3 const& center = rotation_pivot();
+  vw::Vector3 offset_pt = point-center-m_translation;
+
+  // Apply the inverse rotation with Jets to get its derivative with respect to the axis-angle vector
+  typedef ceres::Jet<double,3> JetT;
+  vw::Vector3 axisAngle = this->axis_angle_rotation();
+  JetT inverseAxisAngle[3], offsetJet[3], rotatedJet[3];
+  for (int i=0; i<3; ++i)
+  {
+    inverseAxisAngle[i] = -JetT(axisAngle[i], i);
+    offsetJet[i]        = JetT(offset_pt[i]);
+  }
+  ceres::AngleAxisRotatePoint(inverseAxisAngle, offsetJet, rotatedJet);
+
+  vw::Matrix3x3 new_pt_rotation_partials;
+  for (int r=0; r<3; ++r)
+    for (int c=0; c<3; ++c)
+      new_pt_rotation_partials(r,c) = rotatedJet[r].v[c];
+
+  vw::Vector3 new_pt = m_rotation_inverse.rotate(offset_pt) + center;
+
+  vw::Matrix<double,2,3> pixel_new_pt_partials;
+  vw::Vector2 pixel = m_camera->point_to_pixel_rotated_partials(new_pt, rotAngles, guessLine,
+                                                                pixel_new_pt_partials, pixel_angle_partials, guessTime);
+
+  // Chain through the rigid transform applied by this model
+  pixel_point_partials       = pixel_new_pt_partials*m_rotation_inverse.rotation_matrix();
+  pixel_translation_partials = -pixel_point_partials;
+  pixel_rotation_partials    = pixel_new_pt_partials*new_pt_rotation_partials;
+  return pixel;
 }
 
 vw::Vector3 pixel_to_vector (vw::Vector2 const& pix) const {
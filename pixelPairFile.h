@@ -0,0 +1,158 @@
+// __BEGIN_LICENSE__
+//  Copyright (c) 2009-2013, United States Government as represented by the
+//  Administrator of the National Aeronautics and Space Administration. All
+//  rights reserved.
+//
+//  The NGT platform is licensed under the Apache License, Version 2.0 (the
+//  "License"); you may not use this file except in compliance with the
+//  License. You may obtain a copy of the License at
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+// __END_LICENSE__
+
+#ifndef PIXEL_PAIR_FILE_H
+#define PIXEL_PAIR_FILE_H
+
+/// \file pixelPairFile.h Binary pixel pair file format shared by pixelPairsFromStereo and the solver
+///
+/// The file is a fixed size header followed by one record per pair.
+/// - Each record is four float32 values: sample1, line1, sample2, line2
+/// - All values are little endian.
+/// - PixelPairTools.py reads the same format.
+
+#include <cstring>
+#include <fstream>
+#include <string>
+
+#include <boost/cstdint.hpp>
+#include <boost/iostreams/device/mapped_file.hpp>
+
+/// Header at the start of every binary pixel pair file, 512 bytes with no padding
+struct PixelPairFileHeader
+{
+  char            magic[8];        ///< Always PIXPAIRS
+  boost::uint32_t version;
+  boost::uint32_t headerSize;      ///< The pair records start at this offset
+  boost::uint64_t numPairs;        ///< Number of pair records in the file
+  boost::uint64_t numSampled;      ///< Number of disparity pixels that were checked, valid or not
+  boost::int32_t  pointSpacing;    ///< Spacing in pixels between sampled disparity pixels
+  boost::int32_t  imageCols;       ///< Size of the source disparity image
+  boost::int32_t  imageRows;
+  boost::int32_t  reserved;
+  char            sourcePath[464]; ///< Path of the source disparity image, null terminated
+};
+
+const char            PIXEL_PAIR_FILE_MAGIC[8]  = {'P','I','X','P','A','I','R','S'};
+const boost::uint32_t PIXEL_PAIR_FILE_VERSION   = 1;
+const size_t          PIXEL_PAIR_RECORD_SIZE    = 4*sizeof(float);
+
+/// Returns true if the file at this path is a binary pixel pair file
+inline bool isPixelPairFile(const std::string &path)
+{
+  std::ifstream file(path.c_str(), std::ios::binary);
+  char magic[sizeof(PIXEL_PAIR_FILE_MAGIC)];
+  if (!file.read(magic, sizeof(magic)))
+    return false;
+  return (memcmp(magic, PIXEL_PAIR_FILE_MAGIC, sizeof(magic)) == 0);
+}
+
+
+/// Writes a binary pixel pair file.
+/// - The pair count is filled in by close(), so the header is only valid after that.
+class PixelPairFileWriter
+{
+public:
+
+  PixelPairFileWriter()
+  {
+    memset(&_header, 0, sizeof(_header));
+    memcpy(_header.magic, PIXEL_PAIR_FILE_MAGIC, sizeof(PIXEL_PAIR_FILE_MAGIC));
+    _header.version    = PIXEL_PAIR_FILE_VERSION;
+    _header.headerSize = sizeof(PixelPairFileHeader);
+  }
+
+  /// Opens the output file and writes a placeholder header
+  bool open(const std::string &path, const std::string &sourcePath,
+            int pointSpacing, int imageCols, int imageRows)
+  {
+    _header.pointSpacing = pointSpacing;
+    _header.imageCols    = imageCols;
+    _header.imageRows    = imageRows;
+    strncpy(_header.sourcePath, sourcePath.c_str(), sizeof(_header.sourcePath)-1);
+
+    _file.open(path.c_str(), std::ios::binary | std::ios::trunc);
+    if (_file.fail())
+      return false;
+    _file.write(reinterpret_cast<const char*>(&_header), sizeof(_header));
+    return !_file.fail();
+  }
+
+  /// Appends one pixel pair
+  void addPair(float sample1, float line1, float sample2, float line2)
+  {
+    const float record[4] = {sample1, line1, sample2, line2};
+    _file.write(reinterpret_cast<const char*>(record), PIXEL_PAIR_RECORD_SIZE);
+    ++_header.numPairs;
+  }
+
+  /// Records how many disparity pixels were checked, including invalid ones
+  void setNumSampled(boost::uint64_t numSampled) { _header.numSampled = numSampled; }
+
+  /// Writes the final header and closes the file
+  bool close()
+  {
+    _file.seekp(0);
+    _file.write(reinterpret_cast<const char*>(&_header), sizeof(_header));
+    _file.close();
+    return !_file.fail();
+  }
+
+  boost::uint64_t size() const { return _header.numPairs; }
+
+private:
+  PixelPairFileHeader _header;
+  std::ofstream       _file;
+};
+
+
+/// Reads a binary pixel pair file by memory mapping it
+class PixelPairFileReader
+{
+public:
+
+  PixelPairFileReader() : _header(0), _records(0) {}
+
+  /// Maps the file, returns false if it is not a valid pixel pair file
+  bool open(const std::string &path)
+  {
+    if (!isPixelPairFile(path))
+      return false;
+    _file.open(path);
+    if (!_file.is_open() || (_file.size() < sizeof(PixelPairFileHeader)))
+      return false;
+    _header  = reinterpret_cast<const PixelPairFileHeader*>(_file.data());
+    if (_file.size() < _header->headerSize + _header->numPairs*PIXEL_PAIR_RECORD_SIZE)
+      return false; // Truncated file
+    _records = reinterpret_cast<const float*>(_file.data() + _header->headerSize);
+    return true;
+  }
+
+  const PixelPairFileHeader& header() const { return *_header; }
+
+  size_t size() const { return _header ? _header->numPairs : 0; }
+
+  /// Returns the four values of pair i: sample1, line1, sample2, line2
+  const float* pair(size_t i) const { return _records + 4*i; }
+
+private:
+  boost::iostreams::mapped_file_source _file;
+  const PixelPairFileHeader *_header;
+  const float               *_records;
+};
+
+#endif
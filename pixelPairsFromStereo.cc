@@ -51,6 +51,8 @@ namespace po = boost::program_options;
 //#include <asp/Tools/stereo.h>
 #include <stereo.h> // Using local copy
 
+#include <pixelPairFile.h>
+
 /// \file pixelPairsFromStereo.cc Generates a list of pixel point pairs from the output of the stereo tool
 
 
@@ -62,13 +64,15 @@ int main( int argc, char *argv[] ) {
 
   std::string inputImagePath, outputPath="";
   int pointSpacing=0;
+  bool writeCsv=false;
 
   po::options_description general_options("Options");
   general_options.add_options()
     ("help,h",        "Display this help message")  
     ("input-file,i",   po::value<std::string>(&inputImagePath),                "The input stereo file (xxx-D.tif)")
-    ("output-file,o",  po::value<std::string>(&outputPath)->default_value(""), "Specify an output text file to store the program output")
-    ("pointSpacing,p", po::value<int        >(&pointSpacing)->default_value(100), "Selected pixels are this far apart");
+    ("output-file,o",  po::value<std::string>(&outputPath)->default_value(""), "Specify an output file to store the program output")
+    ("pointSpacing,p", po::value<int        >(&pointSpacing)->default_value(100), "Selected pixels are this far apart")
+    ("csv",            po::bool_switch(&writeCsv)->default_value(false),           "Write a text CSV file instead of the binary pixel pair format");
     
   po::positional_options_description positional_desc;
 
@@ -90,18 +94,28 @@ int main( int argc, char *argv[] ) {
 
   try {
   
-    std::ofstream outputFile(outputPath.c_str());
-    if (outputFile.fail())
-    {
-      printf("Failed to open output file for writing\n");
-      return 0;
-    }
-    
     printf("Loading image\n");
 
     vw::ImageViewRef<vw::PixelMask<vw::Vector2i> > inputImage = vw::DiskImageView<vw::PixelMask<vw::Vector2i> >(inputImagePath);
 
     printf("Done loading image\n");
+
+    // The binary format is the default, the CSV format is kept for exporting to other tools
+    std::ofstream       outputFile;
+    PixelPairFileWriter pairWriter;
+    bool openOk = false;
+    if (writeCsv)
+    {
+      outputFile.open(outputPath.c_str());
+      openOk = !outputFile.fail();
+    }
+    else
+      openOk = pairWriter.open(outputPath, inputImagePath, pointSpacing, inputImage.cols(), inputImage.rows());
+    if (!openOk)
+    {
+      printf("Failed to open output file for writing\n");
+      return 0;
+    }
     
     //if (!inputImage.is_valid_image())
     //{
@@ -113,7 +127,7 @@ int main( int argc, char *argv[] ) {
     vw::ImageViewRef<vw::PixelMask<vw::Vector2i> >::iterator iter = inputImage.begin();
     
     // First pass computes min, max, mean, and std_dev
-    int count = 0;
+    int count = 0, numSampled = 0;
     for (int row=0; row<inputImage.rows(); row+=1)
     {
     
@@ -121,6 +135,7 @@ int main( int argc, char *argv[] ) {
       {
         if ((row % pointSpacing == 0) && (col % pointSpacing == 0))
         {
+          ++numSampled;
           //printf("%d, %d\n", row, col);
           if (vw::is_valid(*iter)) // Skip invalid pixels
           {
@@ -132,7 +147,10 @@ int main( int argc, char *argv[] ) {
             int rightRow = floor(0.5 + row + (*iter)[1]);
 
             // Write to file and record total
-            outputFile << col <<","<< row <<","<< rightCol <<","<< rightRow << std::endl;
+            if (writeCsv)
+              outputFile << col <<","<< row <<","<< rightCol <<","<< rightRow << "\n";
+            else
+              pairWriter.addPair(col, row, rightCol, rightRow);
             ++count;
           } // End valid check
         } // End spacing check
@@ -142,9 +160,15 @@ int main( int argc, char *argv[] ) {
     } // End loop through rows
 
     // Done writing the output file
-    outputFile.close();
+    if (writeCsv)
+      outputFile.close();
+    else
+    {
+      pairWriter.setNumSampled(numSampled);
+      pairWriter.close();
+    }
 
-    printf("Wrote %d pixel pairs\n", count);
+    printf("Wrote %d pixel pairs out of %d sampled pixels\n", count, numSampled);
     
   }
   catch (const vw::Exception& e) {
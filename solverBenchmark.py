@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# __BEGIN_LICENSE__
+#  Copyright (c) 2009-2013, United States Government as represented by the
+#  Administrator of the National Aeronautics and Space Administration. All
+#  rights reserved.
+#
+#  The NGT platform is licensed under the Apache License, Version 2.0 (the
+#  "License"); you may not use this file except in compliance with the
+#  License. You may obtain a copy of the License at
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+# __END_LICENSE__
+
+import sys
+
+import os, optparse, subprocess, time, math
+
+def man(option, opt, value, parser):
+    print >>sys.stderr, parser.usage
+    print >>sys.stderr, '''\
+Measures how the solver scales with the number of points.
+For each problem size a synthetic snapshot with known camera parameters is generated
+with syntheticSnapshot and solved with lronacSolverBenchmark.  The solve time, peak memory
+and the error of the solution against the ground truth are reported for each size.
+
+lronacSolverBenchmark builds the problem and evaluates the residuals with the same solver
+model and cost functions as lronacAngleDoubleSolver, only the ISIS camera models are replaced
+by cameras rebuilt from the tabulated orbit in the snapshot.  The times do not include loading
+the cubes, finding the pixel pairs or the progressive solve levels.
+'''
+    sys.exit()
+
+class Usage(Exception):
+    def __init__(self, msg):
+        self.msg = msg
+
+#--------------------------------------------------------------------------------
+
+# Must match the state layout of lronacAngleDoubleSolver
+NUM_CAMERA_PARAMS   = 12
+ROTATION_INDICES    = [0, 1, 2, 3, 4, 5, 9, 10, 11]
+POSITION_INDICES    = [6, 7, 8]
+
+DEFAULT_SIZES = '100,1000,10000,100000,1000000'
+
+RESULT_COLUMNS = ['numPoints', 'solveSeconds', 'peakMemoryMB', 'maxRotationError', 'positionError', 'pointRmsError']
+
+
+def readStateFile(path):
+    """Reads a parameter state file, one value per line"""
+    values = []
+    for line in open(path, 'r'):
+        if line.strip():
+            values.append(float(line))
+    return values
+
+
+def compareStates(solved, truth):
+    """Returns the max rotation error in radians, the position error and the point RMS error in meters"""
+    if len(solved) != len(truth):
+        raise Exception('Solved state has ' + str(len(solved)) + ' values but the truth has ' + str(len(truth)))
+
+    maxRotationError = max([abs(solved[i] - truth[i]) for i in ROTATION_INDICES])
+    positionError    = math.sqrt(sum([(solved[i] - truth[i])**2 for i in POSITION_INDICES]))
+
+    numPoints = (len(truth) - NUM_CAMERA_PARAMS) / 3
+    if numPoints == 0:
+        return (maxRotationError, positionError, 0.0)
+    sumSquared = 0.0
+    for i in range(NUM_CAMERA_PARAMS, len(truth)):
+        sumSquared += (solved[i] - truth[i])**2
+    return (maxRotationError, positionError, math.sqrt(sumSquared / numPoints))
+
+
+def runTimed(cmd, logPath):
+    """Runs a command with its output sent to a log file.
+       Returns the wall time in seconds and the peak memory in megabytes."""
+    logFile   = open(logPath, 'w')
+    startTime = time.time()
+    p = subprocess.Popen(cmd, stdout=logFile, stderr=subprocess.STDOUT)
+    (pid, status, usage) = os.wait4(p.pid, 0)
+    elapsed = time.time() - startTime
+    logFile.close()
+    if status != 0:
+        raise Exception('Command failed, see ' + logPath + ': ' + ' '.join(cmd))
+    return (elapsed, usage.ru_maxrss / 1024.0) # Linux reports kilobytes
+
+
+def runBenchmark(numPoints, options):
+    """Generates and solves one problem, returns a dictionary of results"""
+    prefix = os.path.join(options.workDir, 'synthetic-' + str(numPoints))
+    snapshotPath = prefix + '.snap'
+
+    cmd = ['syntheticSnapshot', '--outputPrefix', prefix, '--numPoints', str(numPoints),
+           '--jitterAmplitude', str(options.jitterAmplitude), '--pixelNoise', str(options.pixelNoise),
+           '--seed', str(options.seed)]
+    runTimed(cmd, prefix + '-generate.log')
+
+    cmd = ['lronacSolverBenchmark', snapshotPath, '--outputPrefix', prefix,
+           '--linearSolver', options.linearSolver, '--ordering', options.ordering,
+           '--threads', str(options.threads)]
+    if options.numericJacobians:
+        cmd.append('--numericJacobians')
+    (solveSeconds, peakMemoryMB) = runTimed(cmd, prefix + '-solve.log')
+
+    (maxRotationError, positionError, pointRmsError) = compareStates(
+                                                          readStateFile(prefix + '-finalParamState.csv'),
+                                                          readStateFile(prefix + '-truthParamState.csv'))
+
+    if not options.keep:
+        os.remove(snapshotPath)
+
+    return {'numPoints'        : numPoints,
+            'solveSeconds'     : solveSeconds,
+            'peakMemoryMB'     : peakMemoryMB,
+            'maxRotationError' : maxRotationError,
+            'positionError'    : positionError,
+            'pointRmsError'    : pointRmsError}
+
+
+def formatResult(result):
+    return '%10d %12.2f %12.1f %16.3e %13.3f %13.3f' % tuple([result[c] for c in RESULT_COLUMNS])
+
+
+#--------------------------------------------------------------------------------
+
+def main():
+
+    try:
+        try:
+            usage = "usage: solverBenchmark.py [--sizes <list>][--workDir <path>][--manual]\n  "
+            parser = optparse.OptionParser(usage=usage)
+            parser.add_option("--sizes", dest="sizes", default=DEFAULT_SIZES,
+                              help="Comma separated list of point counts to test.")
+            parser.add_option("--workDir", dest="workDir", default="solverBenchmark",
+                              help="Folder for the generated problems and logs.")
+            parser.add_option("--output", dest="outputPath", default="",
+                              help="Write the results to this CSV file.")
+            parser.add_option("--threads", dest="threads", type="int", default=1,
+                              help="Number of solver threads.")
+            parser.add_option("--linearSolver", dest="linearSolver", default="auto",
+                              help="Ceres linear solver type, or auto to let the solver choose.")
+            parser.add_option("--ordering", dest="ordering", default="auto",
+                              help="Parameter ordering passed to lronacSolverBenchmark.")
+            parser.add_option("--numericJacobians", action="store_true", dest="numericJacobians", default=False,
+                              help="Solve with numeric instead of analytic jacobians.")
+            parser.add_option("--jitter", dest="jitterAmplitude", type="float", default=0.0,
+                              help="Amplitude in radians of the unmodeled camera jitter.")
+            parser.add_option("--pixelNoise", dest="pixelNoise", type="float", default=0.1,
+                              help="Standard deviation in pixels of the observation noise.")
+            parser.add_option("--seed", dest="seed", type="int", default=0,
+                              help="Random number seed for the generated problems.")
+            parser.add_option("--keep", action="store_true", dest="keep", default=False,
+                              help="Keep the generated snapshot files.")
+            parser.add_option("--manual", action="callback", callback=man,
+                              help="Read the manual.")
+            (options, args) = parser.parse_args()
+
+        except optparse.OptionError, msg:
+            raise Usage(msg)
+
+        sizes = [int(s) for s in options.sizes.split(',') if s.strip()]
+        if not sizes:
+            parser.error("need at least one problem size")
+
+        if not os.path.exists(options.workDir):
+            os.makedirs(options.workDir)
+
+        outputFile = None
+        if options.outputPath:
+            outputFile = open(options.outputPath, 'w')
+            outputFile.write(','.join(RESULT_COLUMNS) + '\n')
+
+        print ' numPoints  solveSeconds  peakMemoryMB  maxRotationError  positionError  pointRmsError'
+        for numPoints in sizes:
+            result = runBenchmark(numPoints, options)
+            print formatResult(result)
+            sys.stdout.flush()
+            if outputFile:
+                outputFile.write(','.join([str(result[c]) for c in RESULT_COLUMNS]) + '\n')
+                outputFile.flush()
+
+        if outputFile:
+            outputFile.close()
+
+        return 0
+
+    except Usage, err:
+        print >>sys.stderr, err.msg
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
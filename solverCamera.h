@@ -0,0 +1,111 @@
+// __BEGIN_LICENSE__
+//  Copyright (c) 2009-2013, United States Government as represented by the
+//  Administrator of the National Aeronautics and Space Administration. All
+//  rights reserved.
+//
+//  The NGT platform is licensed under the Apache License, Version 2.0 (the
+//  "License"); you may not use this file except in compliance with the
+//  License. You may obtain a copy of the License at
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+// __END_LICENSE__
+
+#ifndef SOLVER_CAMERA_H
+#define SOLVER_CAMERA_H
+
+/// \file solverCamera.h The camera calls made by LrocPairModel and its cost functions.
+///
+/// IsisInterfaceLineScanRot implements these for the cubes and TabulatedSolverCamera for tabulated
+///  geometry, so the same solver model runs on snapshots and synthetic problems without ISIS data.
+
+#include <cmath>
+#include <string>
+
+#include <vw/Math/Vector.h>
+#include <vw/Math/Matrix.h>
+#include <vw/Math/EulerAngles.h>
+#include <vw/Camera/CameraModel.h>
+
+
+/// Line scan camera used by the solver.
+/// - Pixels are zero-based [sample, line].
+/// - The rotation angles are euler angles applied in the instrument frame, see euler_xyz_partials().
+/// - guessTime is the solved time of the previous projection of the same observation, zero if there is
+///   none.  Only the camera that wrote it interprets it.
+class SolverLineScanCamera : public vw::camera::CameraModel
+{
+public:
+  SolverLineScanCamera() : m_spice_call_count(0), m_projection_count(0), m_time_solve_iteration_count(0) {}
+  virtual ~SolverLineScanCamera() {}
+
+  /// Projects a point with an extra rotation applied in the instrument frame
+  /// - If guessTime is provided and not zero it is used as the starting time instead of guessLine.
+  ///   The solved time is written back to it.
+  virtual vw::Vector2
+    point_to_pixel_rotated( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine=-1,
+                            double *guessTime=0 ) const = 0;
+
+  /// Same as point_to_pixel_rotated, but also computes the partial derivatives of the
+  /// pixel with respect to the point and with respect to the rotation angles.
+  virtual vw::Vector2
+    point_to_pixel_rotated_partials( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine,
+                                     vw::Matrix<double,2,3> &pixel_point_partials,
+                                     vw::Matrix<double,2,3> &pixel_angle_partials,
+                                     double *guessTime=0 ) const = 0;
+
+  /// Returns a copy for another solver thread that shares everything that is never modified.
+  /// - Returns null if the camera can not copy itself, the caller then loads another one.
+  virtual SolverLineScanCamera* clone() const { return 0; }
+
+  /// Builds any lookup tables now instead of on first use, so that worker threads only read them
+  virtual void prepare_state_table() const {}
+
+  /// Number of SPICE-backed ISIS calls (time changes, position and rotation lookups) made so far
+  size_t spice_call_count() const { return m_spice_call_count; }
+  /// Number of point to pixel projections made so far
+  size_t projection_count() const { return m_projection_count; }
+  /// Number of line residual evaluations made by the projection time solver so far
+  size_t time_solve_iteration_count() const { return m_time_solve_iteration_count; }
+  void reset_call_counts() { m_spice_call_count = 0; m_projection_count = 0; m_time_solve_iteration_count = 0; }
+
+protected:
+
+  // Profiling counters
+  mutable size_t m_spice_call_count;
+  mutable size_t m_projection_count;
+  mutable size_t m_time_solve_iteration_count;
+};
+
+
+/// Derivatives of euler_to_rotation_matrix(a, b, c, "xyz") = Rx(a)*Ry(b)*Rz(c) with respect to a, b and c.
+/// - A rotation about a fixed axis is R(t) = I + sin(t)K + (1-cos(t))K^2, so its derivative is
+///   R(t + pi/2) - (I + K^2) and I + K^2 = n*n^T for the unit axis n.  The partials are exact and use
+///   the same function, so they follow its sign convention.
+inline void euler_xyz_partials( vw::Vector3 const& angles, vw::Matrix3x3 partials[3] ) {
+  const double HALF_PI = 0.5*M_PI;
+  const double a = angles[0], b = angles[1], c = angles[2];
+  const vw::Matrix3x3 R_bc = vw::math::euler_to_rotation_matrix(0, b, c, "xyz"); // Ry*Rz
+  const vw::Matrix3x3 R_ab = vw::math::euler_to_rotation_matrix(a, b, 0, "xyz"); // Rx*Ry
+  const vw::Matrix3x3 R_a  = vw::math::euler_to_rotation_matrix(a, 0, 0, "xyz");
+  const vw::Matrix3x3 R_c  = vw::math::euler_to_rotation_matrix(0, 0, c, "xyz");
+
+  partials[0] = vw::math::euler_to_rotation_matrix(a + HALF_PI, b, c, "xyz");
+  partials[1] = vw::math::euler_to_rotation_matrix(a, b + HALF_PI, c, "xyz");
+  partials[2] = vw::math::euler_to_rotation_matrix(a, b, c + HALF_PI, "xyz");
+  for (int i=0; i<3; ++i) {
+    for (int j=0; j<3; ++j) {
+      if (i == 0)
+        partials[0](i,j) -= R_bc(i,j);      // e_x*e_x^T*Ry*Rz
+      if (j == 2)
+        partials[2](i,j) -= R_ab(i,j);      // Rx*Ry*e_z*e_z^T
+      partials[1](i,j) -= R_a(i,1)*R_c(1,j); // Rx*e_y*e_y^T*Rz
+    }
+  }
+}
+
+#endif
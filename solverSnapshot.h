@@ -0,0 +1,163 @@
+// __BEGIN_LICENSE__
+//  Copyright (c) 2009-2013, United States Government as represented by the
+//  Administrator of the National Aeronautics and Space Administration. All
+//  rights reserved.
+//
+//  The NGT platform is licensed under the Apache License, Version 2.0 (the
+//  "License"); you may not use this file except in compliance with the
+//  License. You may obtain a copy of the License at
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+// __END_LICENSE__
+
+#ifndef SOLVER_SNAPSHOT_H
+#define SOLVER_SNAPSHOT_H
+
+/// \file solverSnapshot.h Self contained copy of a solver problem, written by lronacAngleDoubleSolver
+///                        and solved by lronacSolverReplay without ISIS or the cubes.
+///
+/// The file is a fixed size header followed by these sections, all values in native byte order:
+/// - For each camera: the tabulated line positions, line rotations and sample look vectors.
+/// - For each pair type: sample1, line1, sample2, line2 as float32 for each pair.
+/// - The initial state: the camera parameters followed by the x/y/z of every point.
+
+#include <cstring>
+#include <fstream>
+#include <string>
+#include <vector>
+
+#include <boost/cstdint.hpp>
+
+const int SNAPSHOT_NUM_CAMERAS    = 4; ///< LE, RE, LE_S, RE_S
+const int SNAPSHOT_NUM_PAIR_TYPES = 6; ///< LE-RE, LE_S-RE_S, LE-LE_S, RE-RE_S, LE-RE_S, LE_S-RE (the state order)
+
+/// Camera slots in the snapshot
+enum SnapshotCamera { SNAPSHOT_LEFT = 0, SNAPSHOT_RIGHT = 1, SNAPSHOT_LEFT_STEREO = 2, SNAPSHOT_RIGHT_STEREO = 3 };
+
+/// The two cameras of each pair type, in the snapshot pair type order
+const SnapshotCamera SNAPSHOT_PAIR_CAMERAS[SNAPSHOT_NUM_PAIR_TYPES][2] = {
+  {SNAPSHOT_LEFT,        SNAPSHOT_RIGHT       }, // LE   - RE
+  {SNAPSHOT_LEFT_STEREO, SNAPSHOT_RIGHT_STEREO}, // LE_S - RE_S
+  {SNAPSHOT_LEFT,        SNAPSHOT_LEFT_STEREO }, // LE   - LE_S
+  {SNAPSHOT_RIGHT,       SNAPSHOT_RIGHT_STEREO}, // RE   - RE_S
+  {SNAPSHOT_LEFT,        SNAPSHOT_RIGHT_STEREO}, // LE   - RE_S
+  {SNAPSHOT_LEFT_STEREO, SNAPSHOT_RIGHT       }  // LE_S - RE
+};
+
+const char            SOLVER_SNAPSHOT_MAGIC[8] = {'L','R','O','S','N','A','P','S'};
+const boost::uint32_t SOLVER_SNAPSHOT_VERSION  = 1;
+
+/// Header at the start of every snapshot file
+struct SolverSnapshotHeader
+{
+  char            magic[8];         ///< Always LROSNAPS
+  boost::uint32_t version;
+  boost::uint32_t reserved;
+  boost::uint64_t numLines  [SNAPSHOT_NUM_CAMERAS];    ///< Zero if the camera was not loaded
+  boost::uint64_t numSamples[SNAPSHOT_NUM_CAMERAS];
+  boost::uint64_t numPairs  [SNAPSHOT_NUM_PAIR_TYPES];
+  boost::uint64_t numStateValues;
+};
+
+/// Camera geometry tabulated from an ISIS line scan camera model
+struct CameraGeometryTable
+{
+  std::vector<double> positions;     ///< Instrument position x/y/z in meters at the center of each cube line
+  std::vector<double> lookRotations; ///< Instrument_from_Body quaternion w/x/y/z at the center of each cube line
+  std::vector<double> sampleLooks;   ///< Undistorted focal plane look vector x/y/z of each cube sample
+
+  size_t numLines  () const { return positions.size()   / 3; }
+  size_t numSamples() const { return sampleLooks.size() / 3; }
+  bool   empty     () const { return positions.empty(); }
+};
+
+/// Everything needed to rebuild the solver problem
+struct SolverSnapshot
+{
+  CameraGeometryTable cameras[SNAPSHOT_NUM_CAMERAS];
+  std::vector<float>  pairs  [SNAPSHOT_NUM_PAIR_TYPES]; ///< sample1, line1, sample2, line2 of each pair
+  std::vector<double> state;                            ///< Camera parameters followed by the points
+
+  size_t numPairs(int pairType) const { return pairs[pairType].size() / 4; }
+};
+
+
+/// Writes the contents of a vector to a binary file
+template <typename T>
+void writeSnapshotVector(std::ofstream &file, const std::vector<T> &values)
+{
+  if (!values.empty())
+    file.write(reinterpret_cast<const char*>(&(values[0])), values.size()*sizeof(T));
+}
+
+/// Reads a vector of known size from a binary file
+template <typename T>
+void readSnapshotVector(std::ifstream &file, size_t size, std::vector<T> &values)
+{
+  values.resize(size);
+  if (size > 0)
+    file.read(reinterpret_cast<char*>(&(values[0])), size*sizeof(T));
+}
+
+/// Writes a snapshot file, returns false on failure
+inline bool writeSolverSnapshot(const std::string &path, const SolverSnapshot &snapshot)
+{
+  SolverSnapshotHeader header;
+  memset(&header, 0, sizeof(header));
+  memcpy(header.magic, SOLVER_SNAPSHOT_MAGIC, sizeof(SOLVER_SNAPSHOT_MAGIC));
+  header.version = SOLVER_SNAPSHOT_VERSION;
+  for (int i=0; i<SNAPSHOT_NUM_CAMERAS; ++i)
+  {
+    header.numLines  [i] = snapshot.cameras[i].numLines();
+    header.numSamples[i] = snapshot.cameras[i].numSamples();
+  }
+  for (int i=0; i<SNAPSHOT_NUM_PAIR_TYPES; ++i)
+    header.numPairs[i] = snapshot.numPairs(i);
+  header.numStateValues = snapshot.state.size();
+
+  std::ofstream file(path.c_str(), std::ios::binary | std::ios::trunc);
+  if (file.fail())
+    return false;
+  file.write(reinterpret_cast<const char*>(&header), sizeof(header));
+  for (int i=0; i<SNAPSHOT_NUM_CAMERAS; ++i)
+  {
+    writeSnapshotVector(file, snapshot.cameras[i].positions);
+    writeSnapshotVector(file, snapshot.cameras[i].lookRotations);
+    writeSnapshotVector(file, snapshot.cameras[i].sampleLooks);
+  }
+  for (int i=0; i<SNAPSHOT_NUM_PAIR_TYPES; ++i)
+    writeSnapshotVector(file, snapshot.pairs[i]);
+  writeSnapshotVector(file, snapshot.state);
+  file.close();
+  return !file.fail();
+}
+
+/// Reads a snapshot file, returns false if it is missing, truncated or not a snapshot
+inline bool readSolverSnapshot(const std::string &path, SolverSnapshot &snapshot)
+{
+  std::ifstream file(path.c_str(), std::ios::binary);
+  SolverSnapshotHeader header;
+  if (!file.read(reinterpret_cast<char*>(&header), sizeof(header)))
+    return false;
+  if ((memcmp(header.magic, SOLVER_SNAPSHOT_MAGIC, sizeof(SOLVER_SNAPSHOT_MAGIC)) != 0) ||
+      (header.version != SOLVER_SNAPSHOT_VERSION))
+    return false;
+
+  for (int i=0; i<SNAPSHOT_NUM_CAMERAS; ++i)
+  {
+    readSnapshotVector(file, 3*header.numLines  [i], snapshot.cameras[i].positions);
+    readSnapshotVector(file, 4*header.numLines  [i], snapshot.cameras[i].lookRotations);
+    readSnapshotVector(file, 3*header.numSamples[i], snapshot.cameras[i].sampleLooks);
+  }
+  for (int i=0; i<SNAPSHOT_NUM_PAIR_TYPES; ++i)
+    readSnapshotVector(file, 4*header.numPairs[i], snapshot.pairs[i]);
+  readSnapshotVector(file, header.numStateValues, snapshot.state);
+  return !file.fail();
+}
+
+#endif
@@ -18,9 +18,12 @@
 
 import sys
 
-import os, glob, optparse, re, shutil, subprocess, string, time, math, logging
+import os, glob, optparse, re, shutil, subprocess, string, time, math, logging, pipes, json
 
 import IsisTools
+import FootprintTools
+import ResourceTools
+import PixelPairTools
 
 def man(option, opt, value, parser):
     print >>sys.stderr, parser.usage
@@ -100,6 +103,7 @@ def applyInterCameraPositionOffset(inputCubePath, outputCubePath, workingDirecto
 
 
 # Samples pixels pairs for bundle adjustment from the output of the stereo command.
+# - The output is a binary pixel pair file, use PixelPairTools.py to export it to CSV.
 # - Returns the output path.
 def extractPixelPairsFromStereoResults(disparityImagePath, outputDirectory, outputFileName, 
                                        sampleInterval, forceOperation):
@@ -121,6 +125,10 @@ def extractPixelPairsFromStereoResults(disparityImagePath, outputDirectory, outp
         raise Exception('Pixel sampling failed to create output file ' + outputPixelPath + 
                         ' from input file ' + disparityImagePath)
 
+    header = PixelPairTools.readPixelPairHeader(outputPixelPath)
+    print ('Sampled %d valid pixel pairs out of %d pixels from %s' %
+           (header['numPairs'], header['numSampled'], disparityImagePath))
+
     return outputPixelPath
 
 
@@ -157,43 +165,82 @@ def applyNavTransform(inputCubePath, outputCubePath, transformMatrixPath, workDi
     return True
 
 
-# Tries to compute the internal angle between an LE/RE image pair.
-# - Output GDC points serve as a check to make sure the images are in roughly the correct place.
-def checkAdjacentPairAlignment(leftInputPath, rightInputPath, outputDirectory,  surfaceElevation=0, forceOperation=False):
-
-    # Figure out output paths
-    if not os.path.exists(outputDirectory):
-        os.mkdir(outputDirectory)
-    sbaOutputPrefix = os.path.join(outputDirectory, 'SBA_check')
-    defaultGdcPath  = sbaOutputPrefix + '-outputGdcPoints.csv'
+# Runs several lronacAngleDoubleSolver jobs in a single process.
+# - Each job is a list of command line arguments and must contain its own --outputPrefix.
+# - Cameras shared between jobs are only loaded once.
+# - If ipCacheFolder is set, interest point matches in the image overlaps are cached there.
+# - Returns a list containing the text printed for each job.
+def runSolverJobs(jobs, jobFilePath, ipCacheFolder=''):
 
-    # Quit immediately if the output file already exists
-    if (not forceOperation) and (os.path.exists(defaultGdcPath)):
-        return True
+    jobFile = open(jobFilePath, 'w')
+    for job in jobs:
+        if ipCacheFolder:
+            job = job + ['--ipCacheDir', ipCacheFolder]
+        jobFile.write(' '.join([pipes.quote(arg) for arg in job]) + '\n')
+    jobFile.close()
 
-    # Run the process
-    #cmd = 'lronacAngleSolver --outputPath dummy.txt --gdcPointsOutPath ' + outputGdcPath + ' ' + leftInputPath + ' ' + rightInputPath
-#    cmd = ('lronacAngleDoubleSolver --outputPrefix '  + sbaOutputPrefix + 
-#                                  ' --leftCubePath '  + leftInputPath   + 
-#                                  ' --rightCubePath ' + rightInputPath + 
-#                                  ' --elevation '     + str(surfaceElevation))
-#    print cmd
-#    os.system(cmd)
-    cmd = ['lronacAngleDoubleSolver',  '--outputPrefix',            sbaOutputPrefix, 
-                                       '--leftCubePath',            leftInputPath, 
-                                       '--rightCubePath',           rightInputPath, 
-                                       '--elevation',               str(surfaceElevation)]
+    cmd = ['lronacAngleDoubleSolver', '--jobFile', jobFilePath]
+    print cmd
     p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
     outputText, err = p.communicate()
 
-    # Check to make sure we actually created the file
-    if not os.path.exists(defaultGdcPath):
-        raise Exception('Adjacency check failed to create output file ' + defaultGdcPath + 
-                        ' from input files ' + leftInputPath + ' and ' + rightInputPath)
+    # The solver prints a marker line before starting each job
+    jobTexts = outputText.split('=== Starting job ')[1:]
+    while len(jobTexts) < len(jobs):
+        jobTexts.append('')
+    return jobTexts
+
+
+# Tries to compute the internal angle between LE/RE image pairs.
+# - checkList contains (leftInputPath, rightInputPath, outputDirectory) for each pair.
+# - Output GDC points serve as a check to make sure the images are in roughly the correct place.
+# - All of the checks are run by one solver process.
+# - The solver only triangulates the overlap matches against the current cubes, it does not optimize anything.
+def checkAdjacentPairAlignments(checkList, jobFilePath, surfaceElevation=0, forceOperation=False, ipCacheFolder=''):
+
+    jobs     = []
+    expected = []
+    for (leftInputPath, rightInputPath, outputDirectory) in checkList:
+
+        # Figure out output paths
+        if not os.path.exists(outputDirectory):
+            os.mkdir(outputDirectory)
+        sbaOutputPrefix = os.path.join(outputDirectory, 'SBA_check')
+        defaultGdcPath  = sbaOutputPrefix + '-outputGdcPoints.csv'
+
+        # Skip checks that have already been run
+        if (not forceOperation) and (os.path.exists(defaultGdcPath)):
+            continue
+
+        jobs.append(['--outputPrefix',  sbaOutputPrefix, 
+                     '--leftCubePath',  leftInputPath, 
+                     '--rightCubePath', rightInputPath, 
+                     '--elevation',     str(surfaceElevation), 
+                     '--checkOnly'])
+        expected.append((defaultGdcPath, leftInputPath, rightInputPath))
+
+    if not jobs:
+        return True
+    runSolverJobs(jobs, jobFilePath, ipCacheFolder)
+
+    # Check to make sure we actually created the files
+    for (defaultGdcPath, leftInputPath, rightInputPath) in expected:
+        if not os.path.exists(defaultGdcPath):
+            raise Exception('Adjacency check failed to create output file ' + defaultGdcPath + 
+                            ' from input files ' + leftInputPath + ' and ' + rightInputPath)
 
     return True
 
 
+# Tries to compute the internal angle between an LE/RE image pair.
+# - Output GDC points serve as a check to make sure the images are in roughly the correct place.
+def checkAdjacentPairAlignment(leftInputPath, rightInputPath, outputDirectory,  surfaceElevation=0, forceOperation=False,
+                               ipCacheFolder=''):
+    return checkAdjacentPairAlignments([(leftInputPath, rightInputPath, outputDirectory)],
+                                       os.path.join(outputDirectory, 'solverJobs.txt'),
+                                       surfaceElevation, forceOperation, ipCacheFolder)
+
+
 # Generate a modified IK kernel to adjust the rotation between an LE/RE camera pair.
 def applyInterCameraPairRotation(leftInputPath, rightInputPath, newRotationPath, outputCubePath, 
                                  ckPath, spkPath, forceOperation):
@@ -218,8 +265,97 @@ def applyInterCameraPairRotation(leftInputPath, rightInputPath, newRotationPath,
     return True
 
 
+# Margin in pixels added around the footprint overlap when cropping cross-pair cubes
+CROSS_CROP_MARGIN = 200
+
+# Determines the pixel window in each of two cubes that covers the ground overlap between them.
+# - Each window is [startSample, startLine, numSamples, numLines] in one-based ISIS pixels.
+# - Returns [leftWindow, rightWindow]
+def computeOverlapCropWindows(leftInputPath, rightInputPath, margin, workDir=''):
+
+    overlap, overlapArea = FootprintTools.getCubeOverlap(leftInputPath, rightInputPath, 
+                                                         FootprintTools.DEFAULT_BORDER_STEP, workDir)
+    if not overlap:
+        raise Exception('Cubes ' + leftInputPath + ' and ' + rightInputPath + ' do not overlap!')
+
+    # Project the overlap polygon into each cube and take the bounding box plus a margin
+    windows = []
+    for cubePath in [leftInputPath, rightInputPath]:
+        numSamples, numLines = IsisTools.getCubeSize(cubePath)
+        pixels = FootprintTools.runCamptBatch(cubePath, overlap, 'ground', workDir, True)
+        if not pixels:
+            raise Exception('Failed to project footprint overlap into cube ' + cubePath)
+        samples = [p[0] for p in pixels]
+        lines   = [p[1] for p in pixels]
+
+        startSample = max(1,          int(math.floor(min(samples))) - margin)
+        stopSample  = min(numSamples, int(math.ceil (max(samples))) + margin)
+        startLine   = max(1,          int(math.floor(min(lines  ))) - margin)
+        stopLine    = min(numLines,   int(math.ceil (max(lines  ))) + margin)
+        if (stopSample <= startSample) or (stopLine <= startLine):
+            raise Exception('Footprint overlap falls outside of cube ' + cubePath)
+        windows.append([startSample, startLine, stopSample-startSample+1, stopLine-startLine+1])
+
+    return windows
+
+
+# One-based first sample of the LE cube crop that was hard coded before overlap windows were computed.
+# - lronacAngleDoubleSolver uses the matching zero-based offset of 2530 when no crop offsets are passed in.
+DEFAULT_CROSS_CROP_START_SAMPLE = 2531
+
+# Returns the crop windows that were hard coded before overlap windows were computed
+# - Right half of the LE cube and left half of the RE cube, full height.
+def getDefaultCrossCropWindows(leftInputPath, rightInputPath):
+    leftSize  = IsisTools.getCubeSize(leftInputPath)
+    rightSize = IsisTools.getCubeSize(rightInputPath)
+    leftStart = DEFAULT_CROSS_CROP_START_SAMPLE
+    return [[leftStart, 1, leftSize[0]-leftStart+1, leftSize[1]], [1, 1, 2532, rightSize[1]]]
+
+
+# Crops a cube to a window as computed by computeOverlapCropWindows.
+# - The window is recorded next to the output so a changed window triggers a new crop.
+def cropCubeToWindow(inputCubePath, outputCubePath, window, forceOperation):
+
+    # Quit immediately if the output file already exists with the same window
+    windowPath   = outputCubePath + '.cropWindow.txt'
+    windowString = ' '.join([str(int(w)) for w in window])
+    if (not forceOperation) and os.path.exists(outputCubePath) and os.path.exists(windowPath):
+        f = open(windowPath, 'r')
+        existingWindow = f.read().strip()
+        f.close()
+        if existingWindow == windowString:
+            print 'File ' + outputCubePath + ' already exists, skipping crop.'
+            return True
+
+    if os.path.exists(outputCubePath):
+        os.remove(outputCubePath)
+    cmd = ('crop from= ' + inputCubePath + ' to= ' + outputCubePath + 
+           ' sample= '   + str(window[0]) + ' line= '   + str(window[1]) + 
+           ' nsamples= ' + str(window[2]) + ' nlines= ' + str(window[3]))
+    print cmd
+    os.system(cmd)
+
+    # Check to make sure we actually created the file
+    if not os.path.exists(outputCubePath):
+        raise Exception('Crop failed to create output file ' + outputCubePath + 
+                        ' from input file ' + inputCubePath)
+
+    f = open(windowPath, 'w')
+    f.write(windowString + '\n')
+    f.close()
+
+    return True
+
+
+# Returns the solver arguments giving the zero-based pixel offsets of two crop windows
+def getCropOffsetArgs(leftWindow, rightWindow):
+    return [str(leftWindow[0]-1), str(leftWindow[1]-1), str(rightWindow[0]-1), str(rightWindow[1]-1)]
+
+
 # Calls stereo functions to generate a disparity image and returns the path to it.
-def callStereoCorrelation(leftInputPath, rightInputPath, outputPrefix, correlationTimeout, forceOperation):
+# - numStereoStages is the total number of stereo stages expected to share this node, including this one.
+def callStereoCorrelation(leftInputPath, rightInputPath, outputPrefix, correlationTimeout, forceOperation,
+                          numStereoStages=1):
 
     # Quit immediately if the output file already exists
     disparityImagePath = outputPrefix + '-D.tif'
@@ -228,9 +364,10 @@ def callStereoCorrelation(leftInputPath, rightInputPath, outputPrefix, correlati
         return disparityImagePath
 
     # Use parallel stereo call, steps 0 and 1 only.  Other options to try and increase speed.
+    # - Process, thread and tile counts are sized to the node this is running on.
     cmd = ('parallel_stereo  --corr-max-levels 3 --compute-error-vector --entry-point 0 --stop-point 2' + 
-           ' --alignment none --subpixel-mode 1 --disable-fill-holes --processes 8 ' + 
-           ' --threads-multiprocess 4 --threads-singleprocess 32 --cost-mode 0 --corr-timeout ' + 
+           ' --alignment none --subpixel-mode 1 --disable-fill-holes ' + 
+           ResourceTools.getParallelStereoResourceOptions(numStereoStages) + ' --cost-mode 0 --corr-timeout ' + 
            str(correlationTimeout) + ' ' + leftInputPath + ' ' + rightInputPath + ' ' + outputPrefix)
     # TODO: Alignment methods mess up the disparity numbers without some further processing!
 #    cmd = 'parallel_stereo --compute-error-vector --entry-point 0 --stop-point 2 --alignment affineepipolar --subpixel-mode 1 --disable-fill-holes --processes 8 --threads-multiprocess 4 --threads-singleprocess 32 --cost-mode 0 --corr-timeout ' + str(correlationTimeout) + ' ' + leftInputPath + ' ' + rightInputPath + ' ' + outputPrefix
@@ -255,13 +392,93 @@ def callStereoCorrelation(leftInputPath, rightInputPath, outputPrefix, correlati
 
     return disparityImagePath
 
-# Counts the number of lines in a file
-def getFileLineCount(filePath):
-    f = open(filePath)
-    i = 0
-    for line in f:
-        i = i + 1
-    return i
+# Cross-pair pixel files need more pairs than this to be used by the solver
+MIN_CROSS_PAIRS = 100
+
+# Spacing in pixels between the pixel pairs extracted from the cross-pair disparity images
+CROSS_PAIR_SPACING = 400
+
+# Fraction of the overlap area expected to produce valid disparities in a cross-pair stereo run
+EXPECTED_CROSS_VALID_FRACTION = 0.5
+
+# Predicts how many pixel pairs a stereo run on two cubes can produce before running it.
+# - pixelPairsFromStereo samples every sampleInterval'th row and column of the left cube, starting
+#   at zero, so the prediction is that grid size times the fraction of the left cube in the overlap.
+# - The run is feasible if more than minNumPairs pairs are predicted, the same test used on the result.
+# - Returns [isFeasible, predictedNumPairs, overlapArea, reason]
+def predictStereoPairFeasibility(leftInputPath, rightInputPath, sampleInterval, minNumPairs, workDir=''):
+
+    try:
+        leftFootprint  = FootprintTools.getCubeFootprint(leftInputPath,  FootprintTools.DEFAULT_BORDER_STEP, workDir)
+        rightFootprint = FootprintTools.getCubeFootprint(rightInputPath, FootprintTools.DEFAULT_BORDER_STEP, workDir)
+    except Exception, err: # Without footprints we have no basis to skip the run
+        return [True, -1, -1, 'Footprint unavailable (' + str(err) + '), running stereo anyway']
+
+    overlap     = FootprintTools.getFootprintIntersection(leftFootprint, rightFootprint)
+    overlapArea = FootprintTools.getPolygonArea(overlap)
+
+    # Fraction of the left cube that falls in the overlap
+    leftArea        = FootprintTools.getPolygonArea(leftFootprint)
+    overlapFraction = 0.0
+    if leftArea > 0:
+        overlapFraction = min(1.0, overlapArea / leftArea)
+
+    # Number of pixels on the sampling grid of the left cube
+    numSamples, numLines = IsisTools.getCubeSize(leftInputPath)
+    numSampled = (int(math.ceil(numSamples / float(sampleInterval))) *
+                  int(math.ceil(numLines   / float(sampleInterval))))
+    predictedPairs = int(numSampled * overlapFraction * EXPECTED_CROSS_VALID_FRACTION)
+
+    reason = ('Overlap area %.3f km^2 (%.1f%% of the left cube), predicted %d pairs at spacing %d (need more than %d)' %
+              (overlapArea / 1.0e6, 100.0*overlapFraction, predictedPairs, sampleInterval, minNumPairs))
+    return [predictedPairs > minNumPairs, predictedPairs, overlapArea, reason]
+
+
+# Loads the JSON telemetry file written by lronacAngleDoubleSolver
+def readSolverTelemetry(outputPrefix):
+    telemetryPath = outputPrefix + '-solverTelemetry.json'
+    if not os.path.exists(telemetryPath):
+        raise Exception('Solver telemetry file ' + telemetryPath + ' not found!')
+    f = open(telemetryPath, 'r')
+    telemetry = json.load(f)
+    f.close()
+    return telemetry
+
+
+# Formats a telemetry value, the solver writes null in place of NaN or infinity
+def formatTelemetryNumber(value):
+    if value is None:
+        return 'unknown'
+    return '%lf' % value
+
+
+# Logs the error statistics and solver timing from a solver telemetry file
+# - Returns None if the solver did not write the file.
+def logSolverTelemetry(outputPrefix):
+    if not os.path.exists(outputPrefix + '-solverTelemetry.json'):
+        logging.warning('No solver telemetry found for ' + outputPrefix)
+        return None
+    telemetry = readSolverTelemetry(outputPrefix)
+    logging.info('Mean point error before optimization = ' + formatTelemetryNumber(telemetry['initialError']['mean']))
+    if 'solver' not in telemetry:
+        return telemetry
+
+    logging.info('Median final error = ' + formatTelemetryNumber(telemetry['finalError']['median']))
+    logging.info('Mean point error after optimization = ' + formatTelemetryNumber(telemetry['finalError']['mean']))
+    logging.info('Mean error change = ' + formatTelemetryNumber(telemetry['meanErrorChange']))
+
+    solver = telemetry['solver']
+    logging.info('Solver stopped with %s after %d iterations in %.1lf seconds' %
+                 (solver['termination'], len(telemetry['iterations']) - 1, solver['totalTime']))
+    if 'linearSolverType' in solver:
+        logging.info('Linear solver %s with %s ordering and %d threads (%s)' %
+                     (solver['linearSolverType'], solver['ordering'], solver['linearSolverThreads'],
+                      solver['linearSolverReason']))
+    logging.info('Residual evaluation %.1lf s, Jacobian evaluation %.1lf s, linear solver %.1lf s' %
+                 (solver['residualEvaluationTime'], solver['jacobianEvaluationTime'], solver['linearSolverTime']))
+    logging.info('%d projections, %.2lf time solve iterations per projection' %
+                 (solver['projections'], solver['timeSolveIterationsPerProjection']))
+    return telemetry
 
 
 # Compares the backprojected locations of matched pixel pairs
@@ -272,16 +489,15 @@ def evaluateAccuracy(leftCubePath, rightCubePath, ipFindOutputPath, workDir=''):
     # Run check every N lines in the file
     lineSkip = 15
     
-    f = open(ipFindOutputPath)
     i = 0
     sumDistance = 0.0
     count       = 0.0
-    for line in f:
+    for pair in PixelPairTools.readPixelPairs(ipFindOutputPath):
         i = i + 1
         if i % lineSkip == 0: # Compare locations on a sampling of lines
             i = 0
             # Get the matching pixel coordinates from this line
-            leftSample, leftLine, rightSample, rightLine = line.split(',')
+            leftSample, leftLine, rightSample, rightLine = pair
             
             #print 'LeftPixel =  ' + leftSample  + ', ' + leftLine
             #print 'RightPixel = ' + rightSample + ', ' + rightLine
@@ -344,6 +560,9 @@ def main():
   
             # The default working directory path is kind of ugly...
             parser.add_option("--workDir", dest="workDir",  help="Folder to store temporary files in")
+
+            parser.add_option("--stereo-stages", dest="stereoStages", type="int", default=1,
+                              help="Total number of stereo stages expected to share this node, including this one, used to size parallel_stereo.")
           
             parser.add_option("--manual", action="callback", callback=man,
                               help="Read the manual.")
@@ -390,6 +609,9 @@ def main():
         if not os.path.exists(tempFolder):
             os.mkdir(tempFolder)
 
+        # Interest point matches in the LE/RE overlaps are shared by all of the solver runs
+        ipCacheFolder = os.path.join(tempFolder, 'ipMatchCache')
+
         # Set up logging
         if not options.logPath:
             options.logPath = options.workDir + '/stereoDoubleCalLog.txt'
@@ -408,7 +630,7 @@ def main():
         # DEBUG: Check angle solver on input LE/RE images!
         checkAdjacentPairAlignment(spiceInitLeftPath, spiceInitRightPath, 
                                    os.path.join(tempFolder, 'initialGdcCheck'), 
-                                   expectedSurfaceElevation, carry)
+                                   expectedSurfaceElevation, carry, ipCacheFolder)
 
         # Apply LE/RE LRONAC position offsets to each of the input files
         posOffsetCorrectedLeftPath = os.path.join(tempFolder, 'left.posOffsetCorrected.cub')
@@ -430,12 +652,12 @@ def main():
                                        thisWorkDir, carry)
 
         # DEBUG: Check angle solver on input LE/RE images!
-        checkAdjacentPairAlignment(posOffsetCorrectedLeftPath, posOffsetCorrectedRightPath, 
-                                   os.path.join(tempFolder, 'posCorrectGdcCheck'), 
-                                   expectedSurfaceElevation, carry)
-        checkAdjacentPairAlignment(posOffsetCorrectedStereoLeftPath, posOffsetCorrectedStereoRightPath, 
-                                   os.path.join(tempFolder, 'posCorrectStereoGdcCheck'), 
-                                   expectedSurfaceElevation, carry)
+        checkAdjacentPairAlignments([(posOffsetCorrectedLeftPath, posOffsetCorrectedRightPath, 
+                                      os.path.join(tempFolder, 'posCorrectGdcCheck')),
+                                     (posOffsetCorrectedStereoLeftPath, posOffsetCorrectedStereoRightPath, 
+                                      os.path.join(tempFolder, 'posCorrectStereoGdcCheck'))],
+                                    os.path.join(tempFolder, 'posCorrectCheckJobs.txt'),
+                                    expectedSurfaceElevation, carry, ipCacheFolder)
 
         print '\n-------------------------------------------------------------------------\n'
 
@@ -443,7 +665,7 @@ def main():
         stereoPrefixLeft   = os.path.join(tempFolder, 'stereoOutputLeft/out')
         disparityImageLeft = callStereoCorrelation(posOffsetCorrectedLeftPath, 
                                                    posOffsetCorrectedStereoLeftPath, 
-                                                   stereoPrefixLeft, 400, carry)
+                                                   stereoPrefixLeft, 400, carry, options.stereoStages)
 
         #raise Exception('Done running left stereo!')
 
@@ -451,102 +673,122 @@ def main():
         stereoPrefixRight   = os.path.join(tempFolder, 'stereoOutputRight/out')
         disparityImageRight = callStereoCorrelation(posOffsetCorrectedRightPath, 
                                                     posOffsetCorrectedStereoRightPath, 
-                                                    stereoPrefixRight, 400, carry)
+                                                    stereoPrefixRight, 400, carry, options.stereoStages)
 
 
         # Extract a small number of matching pixel locations from the LE and RE disparity images ( < 300 pairs)
         pixelPairsLeftSmall  = extractPixelPairsFromStereoResults(disparityImageLeft, tempFolder, 
-                                                                  'stereoPixelPairsLeftSmall.csv', 
+                                                                  'stereoPixelPairsLeftSmall.pairs', 
                                                                   800, carry)
         pixelPairsRightSmall = extractPixelPairsFromStereoResults(disparityImageRight, tempFolder, 
-                                                                  'stereoPixelPairsRightSmall.csv', 
+                                                                  'stereoPixelPairsRightSmall.pairs', 
                                                                   800, carry)
 
         print '\n-------------------------------------------------------------------------\n'
 
         # Perform cross-stereo matching of LE/RE cubes from opposite pairs
 
-        # Crop each input cube to half its width
-        # - Take the right half of the LE cubes and the left half of the RE cubes
+        # Crop each cross pair to the overlap of their ground footprints
+        # - If the footprints can't be computed, take the right half of the LE cubes and the left half of the RE cubes
         leftPosCorrectedCropped        = os.path.join(tempFolder, 'leftCropped.cub')
         rightPosCorrectedCropped       = os.path.join(tempFolder, 'rightCropped.cub')
         leftStereoPosCorrectedCropped  = os.path.join(tempFolder, 'leftStereoCropped.cub')
         rightStereoPosCorrectedCropped = os.path.join(tempFolder, 'rightStereoCropped.cub')
 
-        if not os.path.exists(leftPosCorrectedCropped):
-            cmd = ('crop sample=2531 from= ' + posOffsetCorrectedLeftPath + 
-                                     ' to= ' + leftPosCorrectedCropped)
-            print cmd
-            os.system(cmd)
-        if not os.path.exists(rightPosCorrectedCropped):
-            cmd = ('crop nsamples=2532 from= ' + posOffsetCorrectedRightPath + 
-                                       ' to= ' + rightPosCorrectedCropped)
-            print cmd
-            os.system(cmd)
-        if not os.path.exists(leftStereoPosCorrectedCropped):
-            cmd = ('crop sample=2531 from= ' + posOffsetCorrectedStereoLeftPath + 
-                                     ' to= ' + leftStereoPosCorrectedCropped)
-            print cmd
-            os.system(cmd)
-        if not os.path.exists(rightStereoPosCorrectedCropped):
-            cmd = ('crop nsamples=2532 from= ' + posOffsetCorrectedStereoRightPath + 
-                                      ' to= ' + rightStereoPosCorrectedCropped)
-            print cmd
-            os.system(cmd)
+        try:
+            leftCrossWindows = computeOverlapCropWindows(posOffsetCorrectedLeftPath, 
+                                                         posOffsetCorrectedStereoRightPath, 
+                                                         CROSS_CROP_MARGIN, tempFolder)
+        except Exception, err:
+            print 'Failed to compute left-cross overlap (' + str(err) + '), using default crop.'
+            leftCrossWindows = getDefaultCrossCropWindows(posOffsetCorrectedLeftPath, 
+                                                          posOffsetCorrectedStereoRightPath)
+        try:
+            rightCrossWindows = computeOverlapCropWindows(posOffsetCorrectedStereoLeftPath, 
+                                                          posOffsetCorrectedRightPath, 
+                                                          CROSS_CROP_MARGIN, tempFolder)
+        except Exception, err:
+            print 'Failed to compute right-cross overlap (' + str(err) + '), using default crop.'
+            rightCrossWindows = getDefaultCrossCropWindows(posOffsetCorrectedStereoLeftPath, 
+                                                           posOffsetCorrectedRightPath)
+        logging.info('Left-cross crop windows  (sample, line, nsamples, nlines): %s', str(leftCrossWindows))
+        logging.info('Right-cross crop windows (sample, line, nsamples, nlines): %s', str(rightCrossWindows))
+
+        cropCubeToWindow(posOffsetCorrectedLeftPath,        leftPosCorrectedCropped,        leftCrossWindows[0],  carry)
+        cropCubeToWindow(posOffsetCorrectedStereoRightPath, rightStereoPosCorrectedCropped, leftCrossWindows[1],  carry)
+        cropCubeToWindow(posOffsetCorrectedStereoLeftPath,  leftStereoPosCorrectedCropped,  rightCrossWindows[0], carry)
+        cropCubeToWindow(posOffsetCorrectedRightPath,       rightPosCorrectedCropped,       rightCrossWindows[1], carry)
 
 
         # Use stereo command on two cross-pair cubes
         # - Timeouts are shorter on these since there is probably less image overlap
+        # - Runs that cannot produce enough usable pairs are skipped before calling stereo
         
         # First is left in main pair to right in the stereo pair
         stereoPrefixLeftCross   = os.path.join(tempFolder, 'stereoOutputLeftCross/out')
-        try:
-            disparityImageLeftCross = callStereoCorrelation(leftPosCorrectedCropped, 
-                                                            rightStereoPosCorrectedCropped, 
-                                                            stereoPrefixLeftCross, 100, carry)
-            usingLeftCross = True
-        except:
-            print 'Failed to find left-cross match, ignoring this data source.'
-            usingLeftCross = False
+        usingLeftCross, numPredicted, overlapArea, reason = \
+            predictStereoPairFeasibility(leftPosCorrectedCropped, rightStereoPosCorrectedCropped,
+                                         CROSS_PAIR_SPACING, MIN_CROSS_PAIRS, tempFolder)
+        logging.info('Left-cross pre-check: %s', reason)
+        if not usingLeftCross:
+            print 'Skipping left-cross stereo: ' + reason
+            logging.info('- Skipping left-cross stereo run')
+        else:
+            try:
+                disparityImageLeftCross = callStereoCorrelation(leftPosCorrectedCropped, 
+                                                                rightStereoPosCorrectedCropped, 
+                                                                stereoPrefixLeftCross, 100, carry,
+                                                                options.stereoStages)
+            except:
+                print 'Failed to find left-cross match, ignoring this data source.'
+                usingLeftCross = False
 
         # Next is left in the stereo pair to right in the main pair
         stereoPrefixRightCross   = os.path.join(tempFolder, 'stereoOutputRightCross/out')
-        try:
-            disparityImageRightCross = callStereoCorrelation(leftStereoPosCorrectedCropped, 
-                                                             rightPosCorrectedCropped, 
-                                                             stereoPrefixRightCross, 100, carry)
-            usingRightCross = True
-        except:
-            print 'Failed to find right-cross match, ignoring this data source.'
-            usingRightCross = False
+        usingRightCross, numPredicted, overlapArea, reason = \
+            predictStereoPairFeasibility(leftStereoPosCorrectedCropped, rightPosCorrectedCropped,
+                                         CROSS_PAIR_SPACING, MIN_CROSS_PAIRS, tempFolder)
+        logging.info('Right-cross pre-check: %s', reason)
+        if not usingRightCross:
+            print 'Skipping right-cross stereo: ' + reason
+            logging.info('- Skipping right-cross stereo run')
+        else:
+            try:
+                disparityImageRightCross = callStereoCorrelation(leftStereoPosCorrectedCropped, 
+                                                                 rightPosCorrectedCropped, 
+                                                                 stereoPrefixRightCross, 100, carry,
+                                                                 options.stereoStages)
+            except:
+                print 'Failed to find right-cross match, ignoring this data source.'
+                usingRightCross = False
 
         # Extract a small number of matching pixel locations from the disparity images ( < 300 pairs)
         # - The pixels are extracted more densely because there is much less overlap area to work with.
         if usingLeftCross:
             pixelPairsLeftCrossSmall = extractPixelPairsFromStereoResults(disparityImageLeftCross, 
                                                                           tempFolder, 
-                                                                          'stereoPixelPairsLeftCrossSmall.csv', 
-                                                                          400, carry)
-            numLeftCrossPairs = getFileLineCount(pixelPairsLeftCrossSmall)
+                                                                          'stereoPixelPairsLeftCrossSmall.pairs', 
+                                                                          CROSS_PAIR_SPACING, carry)
+            numLeftCrossPairs = PixelPairTools.getPixelPairCount(pixelPairsLeftCrossSmall)
         if usingRightCross:
             pixelPairsRightCrossSmall = extractPixelPairsFromStereoResults(disparityImageRightCross, 
                                                                            tempFolder, 
-                                                                           'stereoPixelPairsRightCrossSmall.csv', 
-                                                                           400, carry)
-            numRightCrossPairs = getFileLineCount(pixelPairsRightCrossSmall)
+                                                                           'stereoPixelPairsRightCrossSmall.pairs', 
+                                                                           CROSS_PAIR_SPACING, carry)
+            numRightCrossPairs = PixelPairTools.getPixelPairCount(pixelPairsRightCrossSmall)
 
         # Left and right cross pixels may not be used depending on the image overlap
         # - If a small number of pixel pairs was found that suggests we may have a high ratio of bad pixels
-        leftCrossString  = ''
-        rightCrossString = ''
         leftCrossElems   = []
         rightCrossElems  = []
-        if usingLeftCross and (numLeftCrossPairs > 100):
-            leftCrossString  = ' --matchingPixelsLeftCrossPath '  + pixelPairsLeftCrossSmall
-            leftCrossElems   = ['--matchingPixelsLeftCrossPath', pixelPairsLeftCrossSmall]
-        if usingRightCross and (numRightCrossPairs > 100):
-            rightCrossString = ' --matchingPixelsRightCrossPath ' + pixelPairsRightCrossSmall
-            rightCrossElems  = ['--matchingPixelsRightCrossPath', pixelPairsRightCrossSmall]
+        if usingLeftCross and (numLeftCrossPairs > MIN_CROSS_PAIRS):
+            leftCrossOffsets = getCropOffsetArgs(leftCrossWindows[0], leftCrossWindows[1])
+            leftCrossElems   = ['--matchingPixelsLeftCrossPath', pixelPairsLeftCrossSmall, 
+                                '--leftCrossCropOffsets'] + leftCrossOffsets
+        if usingRightCross and (numRightCrossPairs > MIN_CROSS_PAIRS):
+            rightCrossOffsets = getCropOffsetArgs(rightCrossWindows[0], rightCrossWindows[1])
+            rightCrossElems   = ['--matchingPixelsRightCrossPath', pixelPairsRightCrossSmall, 
+                                 '--rightCrossCropOffsets'] + rightCrossOffsets
 
         print '\n-------------------------------------------------------------------------\n'
 
@@ -563,46 +805,65 @@ def main():
         solvedParamsPath    = sbaOutputPrefix + "-finalParamState.csv"
         mainIpFindPath      = sbaOutputPrefix + "-mainIpFindPixels.csv"
         stereoIpFindPath    = sbaOutputPrefix + "-stereoIpFindPixels.csv"
+
+        # Extract a large number of matching pixel locations (many thousands) from the LE/LE and RE/RE.
+        # - The skip number is a row and column skip.
+        pixelPairsLeftLarge = extractPixelPairsFromStereoResults(disparityImageLeft, tempFolder, 
+                                                                 'stereoPixelPairsLeftLarge.pairs', 8, carry)
+
+        # TODO: Many changes needed before RE images can be used here!
+        #pixelPairsRightLarge = extractPixelPairsFromStereoResults(disparityImageRight, tempFolder, 'stereoPixelPairsRightLarge.csv', 16, False)
+
+        # Compute the 3d coordinates for each pixel pair using the rotation and offset computed by the SBA step
+        # - All this step does is use stereo intersection to determine a lat/lon/alt coordinate for each pixel pair in the large data set.  No optimization is performed.
+        # - It uses the same cubes as the SBA step so both are run in one solver process.
+        largeGdcFolder = os.path.join(tempFolder, 'gdcPointsLargeComp/')
+        if not os.path.exists(largeGdcFolder):
+            os.mkdir(largeGdcFolder)
+        largeGdcPrefix = os.path.join(tempFolder, 'gdcPointsLargeComp/out')
+        largeGdcFile   = largeGdcPrefix + '-initialGdcPoints.csv'
+
+        sbaJobs = []
         if not os.path.exists(globalTransformPath):
-#            cmd = 'lronacAngleDoubleSolver --outputPrefix ' + sbaOutputPrefix + ' --matchingPixelsLeftPath ' + pixelPairsLeftSmall + ' --matchingPixelsRightPath ' + pixelPairsRightSmall + leftCrossString + rightCrossString + ' --leftCubePath ' + posOffsetCorrectedLeftPath + ' --rightCubePath ' + posOffsetCorrectedRightPath + ' --leftStereoCubePath ' + posOffsetCorrectedStereoLeftPath + ' --rightStereoCubePath ' + posOffsetCorrectedStereoRightPath + ' --elevation ' + str(expectedSurfaceElevation)
-#            print cmd
-#            os.system(cmd)           
-         
             # TODO: Extract selected text for easier debugging?
-            cmd = ['lronacAngleDoubleSolver',  '--outputPrefix',            sbaOutputPrefix, 
-                                               '--matchingPixelsLeftPath',  pixelPairsLeftSmall, 
-                                               '--matchingPixelsRightPath', pixelPairsRightSmall, 
-                                               '--leftCubePath',            posOffsetCorrectedLeftPath, 
-                                               '--rightCubePath',           posOffsetCorrectedRightPath, 
-                                               '--leftStereoCubePath',      posOffsetCorrectedStereoLeftPath, 
-                                               '--rightStereoCubePath',     posOffsetCorrectedStereoRightPath, 
-                                               '--elevation',               str(expectedSurfaceElevation)]
-            cmd = cmd + leftCrossElems + rightCrossElems
-            print cmd
+            sbaJob = ['--outputPrefix',            sbaOutputPrefix, 
+                      '--matchingPixelsLeftPath',  pixelPairsLeftSmall, 
+                      '--matchingPixelsRightPath', pixelPairsRightSmall, 
+                      '--leftCubePath',            posOffsetCorrectedLeftPath, 
+                      '--rightCubePath',           posOffsetCorrectedRightPath, 
+                      '--leftStereoCubePath',      posOffsetCorrectedStereoLeftPath, 
+                      '--rightStereoCubePath',     posOffsetCorrectedStereoRightPath, 
+                      '--elevation',               str(expectedSurfaceElevation),
+                      '--progressiveLevels',       '3'] # Solve on 1/16, 1/4, then all of the points
+            sbaJobs.append(sbaJob + leftCrossElems + rightCrossElems)
+        else:
+            print 'Skipping stereo transform calculation step'
+        if not os.path.exists(largeGdcFile):
+            sbaJobs.append(['--outputPrefix',           largeGdcPrefix, 
+                            '--matchingPixelsLeftPath', pixelPairsLeftLarge, 
+                            '--leftCubePath',           posOffsetCorrectedLeftPath, 
+                            '--leftStereoCubePath',     posOffsetCorrectedStereoLeftPath, 
+                            '--initialOnly', '--streamPoints', '--initialValues', solvedParamsPath, 
+                            '--elevation', str(expectedSurfaceElevation)])
+        else:
+            print 'Skipping large GDC file creation step'
+
+        if sbaJobs:
+            print sbaJobs
             print '-------'
-            p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            outputText, err = p.communicate()
-            
-            # Extract pertinent output information and log it
-            initialErrorLine = outputText.find('>>>>')
-            initialLineEnd   = outputText.find('\n', initialErrorLine)
-            medianErrorLine  = outputText.find('>>>>', initialLineEnd)
-            medianLineEnd    = outputText.find('\n', medianErrorLine)
-            meanErrorLine    = outputText.find('>>>>', medianLineEnd)
-            meanLineEnd      = outputText.find('\n', meanErrorLine)
-            changeErrorLine  = outputText.find('>>>>', meanLineEnd)
-            changeLineEnd    = outputText.find('\n', changeErrorLine)            
-            
-            logging.info(outputText[initialErrorLine:initialLineEnd])
-            logging.info(outputText[medianErrorLine :medianLineEnd ])
-            logging.info(outputText[meanErrorLine   :meanLineEnd   ])
-            logging.info(outputText[changeErrorLine :changeLineEnd ])
-            
+            jobTexts = runSolverJobs(sbaJobs, os.path.join(tempFolder, 'sbaSolverJobs.txt'), ipCacheFolder)
+
+        if not os.path.exists(globalTransformPath):
+            raise Exception('SBA solver failed to create ' + globalTransformPath)
+
+        if sbaJobs and (sbaJobs[0][1] == sbaOutputPrefix):
+            outputText = jobTexts[0]
+
+            # Log the error statistics the solver recorded
+            logSolverTelemetry(sbaOutputPrefix)
             
             print '====='
             print outputText
-        else:
-            print 'Skipping stereo transform calculation step'
 
 #        # DEBUG - Confirm output results are roughly the same
 #        zeroParamsPath           = '/byss/moon/lronacPipeline_V2/zeroParamsFile.csv'
@@ -647,61 +908,56 @@ def main():
         applyNavTransform(posOffsetCorrectedStereoRightPath, rightStereoAdjustedPath, 
                           globalTransformPath, thisWorkDir, '', '', carry)
 
-        # DEBUG: Check angle solver on stereo adjusted LE/RE images!
-        checkAdjacentPairAlignment(leftStereoAdjustedPath, rightStereoAdjustedPath, 
-                                   os.path.join(tempFolder, 'stereoGlobalAdjustGdcCheck'), 
-                                   expectedSurfaceElevation, carry)
-
-
+        # DEBUG: Check angle solver on stereo adjusted LE/RE images.
         # DEBUG: Re-run the SBA solver with the global adjustment applied to the stereo images.
         # - Since we just applied the solved for transform, we expect global transform parameters to be near zero.
+        # - Both use the adjusted stereo cubes so they are run in one solver process.
+        checkJobs = []
+        stereoAdjustCheckFolder = os.path.join(tempFolder, 'stereoGlobalAdjustGdcCheck')
+        if not os.path.exists(stereoAdjustCheckFolder):
+            os.mkdir(stereoAdjustCheckFolder)
+        stereoAdjustCheckPrefix = os.path.join(stereoAdjustCheckFolder, 'SBA_check')
+        stereoAdjustCheckGdcPath = stereoAdjustCheckPrefix + '-outputGdcPoints.csv'
+        if carry or (not os.path.exists(stereoAdjustCheckGdcPath)):
+            checkJobs.append(['--outputPrefix',  stereoAdjustCheckPrefix, 
+                              '--leftCubePath',  leftStereoAdjustedPath, 
+                              '--rightCubePath', rightStereoAdjustedPath, 
+                              '--elevation',     str(expectedSurfaceElevation), 
+                              '--checkOnly'])
+
         sbaGlobalCheckFolder = os.path.join(tempFolder, 'globalSbaCheck/')
         sbaGlobalCheckOutputPrefix   = os.path.join(tempFolder, 'globalSbaCheck/SBA_solution')
         globalSbaCheckTransformPath = sbaGlobalCheckOutputPrefix + "-globalTransformMatrix.csv"
         if not os.path.exists(globalSbaCheckTransformPath):
             if not os.path.exists(sbaGlobalCheckFolder):
                 os.mkdir(sbaGlobalCheckFolder)
-            cmd = ('lronacAngleDoubleSolver --outputPrefix '            + sbaGlobalCheckOutputPrefix + 
-                                          ' --matchingPixelsLeftPath '  + pixelPairsLeftSmall + 
-                                          ' --matchingPixelsRightPath ' + pixelPairsRightSmall + 
-                                          ' --leftCubePath '            + posOffsetCorrectedLeftPath + 
-                                          ' --rightCubePath '           + posOffsetCorrectedRightPath + 
-                                          ' --leftStereoCubePath '      + leftStereoAdjustedPath + 
-                                          ' --rightStereoCubePath '     + rightStereoAdjustedPath + 
-                                          ' --elevation '               + str(expectedSurfaceElevation) +
-                                          leftCrossString + rightCrossString)
-            print cmd
-            os.system(cmd)
+            # Reuse the overlap matches of the main solve so its points can be used as the starting points.
+            # - The stereo cubes only differ in their nav data so the matches are still valid.
+            for (sourcePath, suffix) in [(mainIpFindPath,   '-mainIpFindPixels.csv'),
+                                         (stereoIpFindPath, '-stereoIpFindPixels.csv')]:
+                if os.path.exists(sourcePath):
+                    shutil.copy(sourcePath, sbaGlobalCheckOutputPrefix + suffix)
+            checkJobs.append(['--outputPrefix',            sbaGlobalCheckOutputPrefix, 
+                              '--matchingPixelsLeftPath',  pixelPairsLeftSmall, 
+                              '--matchingPixelsRightPath', pixelPairsRightSmall, 
+                              '--leftCubePath',            posOffsetCorrectedLeftPath, 
+                              '--rightCubePath',           posOffsetCorrectedRightPath, 
+                              '--leftStereoCubePath',      leftStereoAdjustedPath, 
+                              '--rightStereoCubePath',     rightStereoAdjustedPath, 
+                              '--elevation',               str(expectedSurfaceElevation),
+                              # Start from the main solution, its global transform is already in the stereo cubes
+                              '--initialValues',           solvedParamsPath,
+                              '--resetGlobalTransform',
+                              '--functionTolerance',       '1e-4'] +
+                             leftCrossElems + rightCrossElems)
+        if checkJobs:
+            runSolverJobs(checkJobs, os.path.join(tempFolder, 'globalCheckSolverJobs.txt'), ipCacheFolder)
+        if not os.path.exists(stereoAdjustCheckGdcPath):
+            raise Exception('Adjacency check failed to create output file ' + stereoAdjustCheckGdcPath + 
+                            ' from input files ' + leftStereoAdjustedPath + ' and ' + rightStereoAdjustedPath)
 
         print '\n-------------------------------------------------------------------------\n'
 
-        # Extract a large number of matching pixel locations (many thousands) from the LE/LE and RE/RE.
-        # - The skip number is a row and column skip.
-        pixelPairsLeftLarge = extractPixelPairsFromStereoResults(disparityImageLeft, tempFolder, 
-                                                                 'stereoPixelPairsLeftLarge.csv', 8, carry)
-
-        # TODO: Many changes needed before RE images can be used here!
-        #pixelPairsRightLarge = extractPixelPairsFromStereoResults(disparityImageRight, tempFolder, 'stereoPixelPairsRightLarge.csv', 16, False)
-
-        # Compute the 3d coordinates for each pixel pair using the rotation and offset computed earlier
-        # - All this step does is use stereo intersection to determine a lat/lon/alt coordinate for each pixel pair in the large data set.  No optimization is performed.
-        largeGdcFolder = os.path.join(tempFolder, 'gdcPointsLargeComp/')
-        if not os.path.exists(largeGdcFolder):
-            os.mkdir(largeGdcFolder)
-        largeGdcPrefix = os.path.join(tempFolder, 'gdcPointsLargeComp/out')
-        largeGdcFile   = largeGdcPrefix + '-initialGdcPoints.csv'
-        if not os.path.exists(largeGdcFile):
-            cmd = ('lronacAngleDoubleSolver --outputPrefix '           + largeGdcPrefix + 
-                                          ' --matchingPixelsLeftPath ' + pixelPairsLeftLarge + 
-                                          ' --leftCubePath '           + posOffsetCorrectedLeftPath + 
-                                          ' --leftStereoCubePath '     + posOffsetCorrectedStereoLeftPath + 
-                                          ' --initialOnly --initialValues ' + solvedParamsPath + 
-                                          ' --elevation ' + str(expectedSurfaceElevation))
-            print cmd
-            os.system(cmd)
-        else:
-            print 'Skipping large GDC file creation step'
-
         # TODO: Why does rotation always move the points somewhere else?
         # Use pc-align to compare points to LOLA DEM, compute rotation and offset
         pcAlignOutputPrefix   = os.path.join(tempFolder, 'pcAlignOutput/dem')
@@ -760,7 +1016,7 @@ def main():
         # DEBUG: Check angle solver on stereo adjusted LE/RE images!
         checkAdjacentPairAlignment(options.outputPathStereoLeft, partialCorrectedStereoRightPath, 
                                    os.path.join(tempFolder, 'pcAlignStereoGdcCheck'), 
-                                   expectedSurfaceElevation, carry)
+                                   expectedSurfaceElevation, carry, ipCacheFolder)
 
 
         print '\n-------------------------------------------------------------------------\n'
@@ -778,15 +1034,13 @@ def main():
                                      rightStereoCkPath, rightStereoSpkPath, carry)
 
 
-        # DEBUG: Check angle solver on adjusted LE/RE images!
-        checkAdjacentPairAlignment(options.outputPathLeft, options.outputPathRight, 
-                                   os.path.join(tempFolder, 'finalGdcCheck'), 
-                                   expectedSurfaceElevation, carry)
-
-        # DEBUG: Check angle solver on stereo adjusted LE/RE images!
-        checkAdjacentPairAlignment(options.outputPathStereoLeft, options.outputPathStereoRight, 
-                                   os.path.join(tempFolder, 'finalStereoGdcCheck'), 
-                                   expectedSurfaceElevation, carry)
+        # DEBUG: Check angle solver on adjusted LE/RE images and on stereo adjusted LE/RE images!
+        checkAdjacentPairAlignments([(options.outputPathLeft, options.outputPathRight, 
+                                      os.path.join(tempFolder, 'finalGdcCheck')),
+                                     (options.outputPathStereoLeft, options.outputPathStereoRight, 
+                                      os.path.join(tempFolder, 'finalStereoGdcCheck'))],
+                                    os.path.join(tempFolder, 'finalCheckJobs.txt'),
+                                    expectedSurfaceElevation, carry, ipCacheFolder)
         
         print '\n-------------------------------------------------------------------------\n'
 
@@ -0,0 +1,380 @@
+// __BEGIN_LICENSE__
+//  Copyright (c) 2009-2013, United States Government as represented by the
+//  Administrator of the National Aeronautics and Space Administration. All
+//  rights reserved.
+//
+//  The NGT platform is licensed under the Apache License, Version 2.0 (the
+//  "License"); you may not use this file except in compliance with the
+//  License. You may obtain a copy of the License at
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+// __END_LICENSE__
+
+
+/// \file syntheticSnapshot.cc Generates a synthetic four camera problem snapshot with known solution.
+///
+/// The cameras are ideal LRO-NAC like pushbrooms on a circular polar orbit:
+/// - LE and RE share one orbit and are rolled apart so their footprints overlap slightly.
+/// - LE_S and RE_S are on an orbit offset in longitude and are pointed back at the main ground track.
+/// - Optional sinusoidal jitter is added to the cameras that generate the observations but not to
+///   the cameras written to the snapshot, so it acts as unmodeled attitude error.
+/// The observations are generated with the ground truth camera parameters applied and the snapshot
+///  starts from zero camera parameters and noisy points, like lronacAngleDoubleSolver does.
+/// The snapshot is solved with lronacSolverBenchmark, which runs the solver model and cost functions of
+///  lronacAngleDoubleSolver on cameras rebuilt from the tables, and solverBenchmark.py compares the result
+///  to the <prefix>-truthParamState.csv file written here.
+
+#include <iostream>
+#include <fstream>
+#include <sstream>
+#include <string>
+#include <vector>
+
+#include <boost/program_options.hpp>
+namespace po = boost::program_options;
+
+#include <boost/random/mersenne_twister.hpp>
+#include <boost/random/uniform_01.hpp>
+#include <boost/random/normal_distribution.hpp>
+#include <boost/random/variate_generator.hpp>
+
+#include <solverSnapshot.h>
+#include <tabulatedCamera.h>
+
+using namespace vw;
+
+
+const double MOON_RADIUS = 1737400.0; // Meters
+const size_t NUM_CAMERA_PARAMS = 12;
+
+typedef boost::variate_generator<boost::mt19937&, boost::uniform_01<> >          UniformGenerator;
+typedef boost::variate_generator<boost::mt19937&, boost::normal_distribution<> > NormalGenerator;
+
+
+/// Settings shared by all of the synthetic cameras
+struct SyntheticCameraSettings
+{
+  int    numLines;
+  int    numSamples;
+  double altitude;        ///< Meters above the mean radius
+  double focalLength;     ///< Millimeters
+  double pixelPitch;      ///< Millimeters
+  double jitterAmplitude; ///< Radians
+  double jitterPeriod;    ///< Lines
+};
+
+/// Fills in the tables of one synthetic camera.
+/// - orbitLongitude is the longitude of the orbit plane in radians.
+/// - roll is the rotation of the camera around its along track axis in radians.
+/// - If aimAtTrack is set the camera points at the ground track on the zero longitude
+///   meridian instead of straight down.
+/// - jitterPhase is only used if the jitter amplitude is not zero.
+void makeCameraTable(const SyntheticCameraSettings &settings, double orbitLongitude, double roll,
+                     bool aimAtTrack, double jitterAmplitude, double jitterPhase, CameraGeometryTable &table)
+{
+  const double orbitRadius  = MOON_RADIUS + settings.altitude;
+  const double groundSample = settings.altitude * settings.pixelPitch / settings.focalLength;
+  const double lineAngle    = groundSample / MOON_RADIUS;
+  const double lineCenter   = (settings.numLines - 1) / 2.0;
+
+  Matrix3x3 R_mount = math::euler_to_rotation_matrix(0, roll, 0, "xyz");
+
+  table.positions.resize    (3*settings.numLines);
+  table.lookRotations.resize(4*settings.numLines);
+  for (int i=0; i<settings.numLines; ++i)
+  {
+    // Moving north along the orbit, centered on the equator
+    const double latitude = (i - lineCenter) * lineAngle;
+    Vector3 position(orbitRadius*cos(latitude)*cos(orbitLongitude),
+                     orbitRadius*cos(latitude)*sin(orbitLongitude),
+                     orbitRadius*sin(latitude));
+    Vector3 alongTrack(-sin(latitude)*cos(orbitLongitude), -sin(latitude)*sin(orbitLongitude), cos(latitude));
+
+    // Instrument z looks at the target, y is along track and x completes the frame
+    Vector3 target = aimAtTrack ? Vector3(MOON_RADIUS*cos(latitude), 0, MOON_RADIUS*sin(latitude))
+                                : Vector3(0, 0, 0);
+    Vector3 zAxis = normalize(target - position);
+    Vector3 yAxis = normalize(alongTrack - dot_prod(alongTrack, zAxis)*zAxis);
+    Vector3 xAxis = cross_prod(yAxis, zAxis);
+    Matrix3x3 R_inst; // Instrument_from_Body
+    for (int c=0; c<3; ++c)
+    {
+      R_inst(0,c) = xAxis[c];
+      R_inst(1,c) = yAxis[c];
+      R_inst(2,c) = zAxis[c];
+    }
+    R_inst = R_mount*R_inst;
+
+    if (jitterAmplitude != 0)
+    {
+      const double phase = 2.0*M_PI*i/settings.jitterPeriod + jitterPhase;
+      R_inst = math::euler_to_rotation_matrix(jitterAmplitude*sin(phase),
+                                              jitterAmplitude*sin(phase + 1.0),
+                                              jitterAmplitude*sin(phase + 2.0), "xyz") * R_inst;
+    }
+
+    Quat q(R_inst);
+    for (int c=0; c<3; ++c)
+      table.positions[3*i+c] = position[c];
+    table.lookRotations[4*i  ] = q.w();
+    table.lookRotations[4*i+1] = q.x();
+    table.lookRotations[4*i+2] = q.y();
+    table.lookRotations[4*i+3] = q.z();
+  }
+
+  // Straight detector along the instrument x axis
+  const double sampleCenter = (settings.numSamples - 1) / 2.0;
+  table.sampleLooks.resize(3*settings.numSamples);
+  for (int s=0; s<settings.numSamples; ++s)
+  {
+    table.sampleLooks[3*s  ] = (s - sampleCenter) * settings.pixelPitch;
+    table.sampleLooks[3*s+1] = 0;
+    table.sampleLooks[3*s+2] = settings.focalLength;
+  }
+}
+
+//-------------------------------------------------------------------------------------------
+
+/// One of the four cameras with its ground truth adjustment
+struct TrueCamera
+{
+  const TabulatedLineScanCamera *camera;
+  Matrix3x3     R_offset;  ///< Local rotation, identity for LE and LE_S
+  bool          isStereo;  ///< If set the global rotation and position are applied
+  const double *rotParams;
+  const double *posParams;
+};
+
+/// Returns the ray seen by a pixel of an adjusted camera
+void trueRay(const TrueCamera &c, Vector2 const& pixel, Vector3 &origin, Vector3 &direction)
+{
+  c.camera->pixelRay(pixel, c.R_offset, origin, direction);
+  if (c.isStereo)
+    adjustStereoRay(*c.camera, c.rotParams, c.posParams, origin, direction);
+}
+
+/// Projects a point into an adjusted camera, returns false if it is not in the image
+bool trueProject(const TrueCamera &c, Vector3 const& point, double guessLine, Vector2 &pixel)
+{
+  Vector3 adjusted = c.isStereo ? adjustStereoPoint(*c.camera, c.rotParams, c.posParams, point) : point;
+  if (!c.camera->project(adjusted, c.R_offset, guessLine, pixel))
+    return false;
+  return ((pixel[0] >= 0) && (pixel[0] <= c.camera->numSamples()-1) &&
+          (pixel[1] >= 0) && (pixel[1] <= c.camera->numLines  ()-1));
+}
+
+/// Intersects a ray with a sphere around the body center, returns false on a miss
+bool intersectSphere(Vector3 const& origin, Vector3 const& direction, double radius, Vector3 &point)
+{
+  const double b = dot_prod(origin, direction);
+  const double c = dot_prod(origin, origin) - radius*radius;
+  const double discriminant = b*b - c;
+  if (discriminant < 0)
+    return false;
+  point = origin + (-b - sqrt(discriminant))*direction;
+  return true;
+}
+
+/// Finds the range of first camera samples at the center line that are also seen by the second camera.
+/// - Returns false if the cameras do not overlap.
+bool findOverlapSamples(const TrueCamera &a, const TrueCamera &b, double &minSample, double &maxSample)
+{
+  const int    STEP = 16;
+  const double centerLine = (a.camera->numLines() - 1) / 2.0;
+  const int    numSamples = static_cast<int>(a.camera->numSamples());
+  minSample = numSamples;
+  maxSample = -1;
+  for (int s=0; s<numSamples; s+=STEP)
+  {
+    Vector3 origin, direction, point;
+    Vector2 pixel;
+    trueRay(a, Vector2(s, centerLine), origin, direction);
+    if (!intersectSphere(origin, direction, MOON_RADIUS, point) || !trueProject(b, point, centerLine, pixel))
+      continue;
+    minSample = std::min(minSample, static_cast<double>(s));
+    maxSample = std::max(maxSample, static_cast<double>(s));
+  }
+  if (maxSample < minSample)
+    return false;
+
+  // Pad by one step, the terrain and the ends of the strip can widen the overlap
+  minSample = std::max(minSample - STEP, 0.0);
+  maxSample = std::min(maxSample + STEP, numSamples - 1.0);
+  return true;
+}
+
+
+int main( int argc, char *argv[] ) {
+
+  std::string outputPrefix;
+  std::vector<double> truth;
+  SyntheticCameraSettings settings;
+  double overlap=0.1, stereoOffset=15000, pixelNoise=0.1, pointNoise=10, elevationRange=2000;
+  int numPoints=1000, seed=0;
+
+  po::options_description general_options("Options");
+  general_options.add_options()
+    ("help,h",        "Display this help message")
+    ("outputPrefix,o",      po::value<std::string>(&outputPrefix),                                "Write <prefix>.snap and <prefix>-truthParamState.csv")
+    ("numPoints,n",         po::value<int        >(&numPoints)->default_value(1000),              "Number of points, split evenly between the six pair types")
+    ("lines",               po::value<int        >(&settings.numLines)->default_value(20000),     "Number of lines in each image")
+    ("samples",             po::value<int        >(&settings.numSamples)->default_value(5064),    "Number of samples in each image")
+    ("altitude",            po::value<double     >(&settings.altitude)->default_value(50000),     "Orbit altitude in meters")
+    ("focalLength",         po::value<double     >(&settings.focalLength)->default_value(699.6),  "Focal length in millimeters")
+    ("pixelPitch",          po::value<double     >(&settings.pixelPitch)->default_value(0.007),   "Detector pixel pitch in millimeters")
+    ("overlap",             po::value<double     >(&overlap)->default_value(0.1),                 "Fraction of the field of view shared by LE and RE")
+    ("stereoOffset",        po::value<double     >(&stereoOffset)->default_value(15000),          "Cross track distance in meters between the main and stereo orbits")
+    ("jitterAmplitude",     po::value<double     >(&settings.jitterAmplitude)->default_value(0),  "Amplitude in radians of the unmodeled attitude jitter")
+    ("jitterPeriod",        po::value<double     >(&settings.jitterPeriod)->default_value(1000),  "Period in lines of the unmodeled attitude jitter")
+    ("pixelNoise",          po::value<double     >(&pixelNoise)->default_value(0.1),              "Standard deviation in pixels of the observation noise")
+    ("pointNoise",          po::value<double     >(&pointNoise)->default_value(10),               "Standard deviation in meters of the error in the initial points")
+    ("elevationRange",      po::value<double     >(&elevationRange)->default_value(2000),         "Points are placed at random elevations within +/- half of this")
+    ("seed",                po::value<int        >(&seed)->default_value(0),                      "Random number seed")
+    ("truth",               po::value<std::vector<double> >(&truth)->multitoken(),                "The 12 ground truth camera parameters, in the solver state order");
+
+  std::ostringstream usage;
+  usage << "Usage: " << argv[0] << " --outputPrefix <prefix> [options]" << std::endl << std::endl;
+  usage << general_options << std::endl;
+
+  po::variables_map vm;
+  try {
+    po::store( po::command_line_parser( argc, argv ).options(general_options).run(), vm );
+    po::notify( vm );
+  } catch (const po::error& e) {
+    std::cout << "An error occured while parsing command line arguments.\n";
+    std::cout << "\t" << e.what() << "\n\n";
+    std::cout << usage.str();
+    return 1;
+  }
+  if (vm.count("help") || outputPrefix.empty())
+  {
+    std::cout << usage.str();
+    return 1;
+  }
+
+  if (truth.empty())
+  {
+    // Errors of the size seen in the real LRO-NAC solutions
+    const double DEFAULT_TRUTH[NUM_CAMERA_PARAMS] = { 2e-4, -1e-4,  3e-4,   // RE local rotation
+                                                      1e-5, -2e-5,  1e-5,   // Global rotation
+                                                      20,   -15,    40,     // Global position
+                                                     -2e-4,  1e-4, -3e-4 }; // RE_S local rotation
+    truth.assign(DEFAULT_TRUTH, DEFAULT_TRUTH + NUM_CAMERA_PARAMS);
+  }
+  if (truth.size() != NUM_CAMERA_PARAMS)
+  {
+    printf("Error: --truth needs %lu values\n", (unsigned long)NUM_CAMERA_PARAMS);
+    return 1;
+  }
+
+  // Build the nominal cameras that go in the snapshot and the jittered cameras that make the observations
+  const double halfFov         = atan(0.5*settings.numSamples*settings.pixelPitch / settings.focalLength);
+  const double roll            = halfFov*(1.0 - overlap);
+  const double stereoLongitude = stereoOffset / (MOON_RADIUS + settings.altitude);
+  const double CAMERA_LONGITUDE[SNAPSHOT_NUM_CAMERAS] = {0, 0, stereoLongitude, stereoLongitude};
+  const double CAMERA_ROLL     [SNAPSHOT_NUM_CAMERAS] = {roll, -roll, roll, -roll};
+
+  printf("Generating cameras with %d lines and %d samples\n", settings.numLines, settings.numSamples);
+  SolverSnapshot snapshot;
+  CameraGeometryTable     trueTables [SNAPSHOT_NUM_CAMERAS];
+  TabulatedLineScanCamera trueCameras[SNAPSHOT_NUM_CAMERAS];
+  for (int c=0; c<SNAPSHOT_NUM_CAMERAS; ++c)
+  {
+    const bool aimAtTrack = (c == SNAPSHOT_LEFT_STEREO) || (c == SNAPSHOT_RIGHT_STEREO);
+    makeCameraTable(settings, CAMERA_LONGITUDE[c], CAMERA_ROLL[c], aimAtTrack, 0, 0, snapshot.cameras[c]);
+    makeCameraTable(settings, CAMERA_LONGITUDE[c], CAMERA_ROLL[c], aimAtTrack,
+                    settings.jitterAmplitude, c*M_PI/2.0, trueTables[c]);
+    if (!trueCameras[c].load(trueTables[c]))
+    {
+      printf("Error: Need at least two lines and two samples\n");
+      return 1;
+    }
+  }
+
+  TrueCamera cameras[SNAPSHOT_NUM_CAMERAS];
+  Matrix3x3 noRotation;
+  noRotation.set_identity();
+  for (int c=0; c<SNAPSHOT_NUM_CAMERAS; ++c)
+  {
+    cameras[c].camera    = &(trueCameras[c]);
+    cameras[c].R_offset  = noRotation;
+    cameras[c].isStereo  = (c == SNAPSHOT_LEFT_STEREO) || (c == SNAPSHOT_RIGHT_STEREO);
+    cameras[c].rotParams = &(truth[3]);
+    cameras[c].posParams = &(truth[6]);
+  }
+  cameras[SNAPSHOT_RIGHT       ].R_offset = offsetRotation(&(truth[0]));
+  cameras[SNAPSHOT_RIGHT_STEREO].R_offset = offsetRotation(&(truth[9]));
+
+  // Generate the points by casting rays from the first camera of each pair into the second one
+  boost::mt19937 randomEngine(seed);
+  UniformGenerator uniform(randomEngine, boost::uniform_01<>());
+  NormalGenerator  normal (randomEngine, boost::normal_distribution<>());
+
+  const int MAX_ATTEMPTS_PER_POINT = 1000;
+  std::vector<double> truePoints;
+  for (int p=0; p<SNAPSHOT_NUM_PAIR_TYPES; ++p)
+  {
+    const TrueCamera &a = cameras[SNAPSHOT_PAIR_CAMERAS[p][0]];
+    const TrueCamera &b = cameras[SNAPSHOT_PAIR_CAMERAS[p][1]];
+    const int numPairPoints = numPoints/SNAPSHOT_NUM_PAIR_TYPES + ((p < numPoints%SNAPSHOT_NUM_PAIR_TYPES) ? 1 : 0);
+
+    double minSample, maxSample;
+    if (!findOverlapSamples(a, b, minSample, maxSample))
+    {
+      printf("Warning: No overlap for pair type %d, skipping its %d points\n", p, numPairPoints);
+      continue;
+    }
+
+    int numAttempts = 0;
+    while ((static_cast<int>(snapshot.numPairs(p)) < numPairPoints) &&
+           (numAttempts < MAX_ATTEMPTS_PER_POINT*numPairPoints))
+    {
+      ++numAttempts;
+      Vector2 pixelA(minSample + uniform()*(maxSample - minSample), uniform()*(a.camera->numLines()-1));
+      Vector3 origin, direction, point;
+      Vector2 pixelB;
+      trueRay(a, pixelA, origin, direction);
+      const double radius = MOON_RADIUS + (uniform() - 0.5)*elevationRange;
+      if (!intersectSphere(origin, direction, radius, point) || !trueProject(b, point, pixelA[1], pixelB))
+        continue;
+
+      snapshot.pairs[p].push_back(pixelA[0] + pixelNoise*normal());
+      snapshot.pairs[p].push_back(pixelA[1] + pixelNoise*normal());
+      snapshot.pairs[p].push_back(pixelB[0] + pixelNoise*normal());
+      snapshot.pairs[p].push_back(pixelB[1] + pixelNoise*normal());
+      for (int i=0; i<3; ++i)
+        truePoints.push_back(point[i]);
+    }
+    printf("Generated %lu points for pair type %d\n", (unsigned long)snapshot.numPairs(p), p);
+  }
+
+  // The solver starts from unadjusted cameras and noisy points
+  snapshot.state.assign(NUM_CAMERA_PARAMS, 0.0);
+  for (size_t i=0; i<truePoints.size(); ++i)
+    snapshot.state.push_back(truePoints[i] + pointNoise*normal());
+
+  std::string snapshotPath = outputPrefix + ".snap";
+  printf("Writing snapshot to %s\n", snapshotPath.c_str());
+  if (!writeSolverSnapshot(snapshotPath, snapshot))
+  {
+    printf("Error: Failed to write snapshot file %s\n", snapshotPath.c_str());
+    return 1;
+  }
+
+  std::string truthPath = outputPrefix + "-truthParamState.csv";
+  printf("Writing ground truth state to %s\n", truthPath.c_str());
+  std::ofstream truthFile(truthPath.c_str());
+  truthFile.precision(17);
+  for (size_t i=0; i<NUM_CAMERA_PARAMS; ++i)
+    truthFile << truth[i] << std::endl;
+  for (size_t i=0; i<truePoints.size(); ++i)
+    truthFile << truePoints[i] << std::endl;
+  truthFile.close();
+
+  return 0;
+}
@@ -0,0 +1,411 @@
+// __BEGIN_LICENSE__
+//  Copyright (c) 2009-2013, United States Government as represented by the
+//  Administrator of the National Aeronautics and Space Administration. All
+//  rights reserved.
+//
+//  The NGT platform is licensed under the Apache License, Version 2.0 (the
+//  "License"); you may not use this file except in compliance with the
+//  License. You may obtain a copy of the License at
+//  http://www.apache.org/licenses/LICENSE-2.0
+//
+//  Unless required by applicable law or agreed to in writing, software
+//  distributed under the License is distributed on an "AS IS" BASIS,
+//  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+//  See the License for the specific language governing permissions and
+//  limitations under the License.
+// __END_LICENSE__
+
+#ifndef TABULATED_CAMERA_H
+#define TABULATED_CAMERA_H
+
+/// \file tabulatedCamera.h Line scan camera model built from the tables in a solver snapshot.
+///
+/// Used by lronacSolverReplay to solve snapshots, by syntheticSnapshot to generate them and through
+///  TabulatedSolverCamera by lronacSolverBenchmark to run the solver model on them.
+
+#include <algorithm>
+#include <cmath>
+#include <string>
+#include <vector>
+
+#include <boost/shared_ptr.hpp>
+
+#include <vw/Math/Vector.h>
+#include <vw/Math/Matrix.h>
+#include <vw/Math/Quaternion.h>
+#include <vw/Math/EulerAngles.h>
+
+#include <solverSnapshot.h>
+#include <solverCamera.h>
+
+
+/// Line scan camera rebuilt from a CameraGeometryTable.
+/// - Line positions and rotations are interpolated between the tabulated cube lines.
+/// - The detector is the curve traced by the tabulated sample look vectors on the focal plane.
+/// - All functions are const so one camera can be shared by every solver thread.
+class TabulatedLineScanCamera
+{
+public:
+
+  TabulatedLineScanCamera() : _sampleAxis(0), _pixelPitch(0) {}
+
+  /// Loads the tables, returns false if there is not enough data to use
+  bool load(const CameraGeometryTable &table)
+  {
+    const size_t numLines   = table.numLines();
+    const size_t numSamples = table.numSamples();
+    if ((numLines < 2) || (numSamples < 2))
+      return false;
+
+    _positions.resize(numLines);
+    _rotations.resize(numLines);
+    for (size_t i=0; i<numLines; ++i)
+    {
+      _positions[i] = vw::Vector3(table.positions[3*i], table.positions[3*i+1], table.positions[3*i+2]);
+      _rotations[i] = vw::Quat(table.lookRotations[4*i  ], table.lookRotations[4*i+1],
+                               table.lookRotations[4*i+2], table.lookRotations[4*i+3]);
+    }
+
+    // The samples run along whichever focal plane axis changes the most across the detector
+    std::vector<vw::Vector2> looks(numSamples);
+    for (size_t i=0; i<numSamples; ++i)
+      looks[i] = vw::Vector2(table.sampleLooks[3*i  ] / table.sampleLooks[3*i+2],
+                             table.sampleLooks[3*i+1] / table.sampleLooks[3*i+2]);
+    const vw::Vector2 span = looks[numSamples-1] - looks[0];
+    _sampleAxis = (fabs(span[0]) >= fabs(span[1])) ? 0 : 1;
+    _sampleCoords.resize  (numSamples);
+    _detectorCoords.resize(numSamples);
+    for (size_t i=0; i<numSamples; ++i)
+    {
+      _sampleCoords  [i] = looks[i][_sampleAxis];
+      _detectorCoords[i] = looks[i][1-_sampleAxis];
+    }
+    _pixelPitch = fabs(span[_sampleAxis]) / (numSamples - 1);
+    return (_pixelPitch > 0);
+  }
+
+  /// The point that camera adjustments rotate around, the camera center at the first line
+  vw::Vector3 const& pivot() const { return _positions[0]; }
+
+  /// Projects a point to a zero-based pixel.
+  /// - R_offset is the extra rotation applied in the instrument frame.
+  /// - Returns false if the line solve does not converge.
+  /// - If numResiduals is provided the number of line residual evaluations is added to it.
+  bool project(vw::Vector3 const& point, vw::Matrix3x3 const& R_offset, double guessLine, vw::Vector2 &pixel,
+               size_t *numResiduals=0) const
+  {
+    const double LINE_TOLERANCE = 1.0e-8; // Pixels
+    const int    MAX_ITERATIONS = 30;
+    const double maxLine        = 2.0*_positions.size();
+
+    // Secant solve for the line at which the point falls on the detector
+    double sample;
+    double line0 = guessLine;
+    double r0    = lineResidual(point, R_offset, line0, sample);
+    size_t count = 1;
+    pixel = vw::Vector2(sample, line0);
+    bool   found = (fabs(r0) < LINE_TOLERANCE);
+    if (!found)
+    {
+      double line1 = line0 + 1.0;
+      double r1    = lineResidual(point, R_offset, line1, sample);
+      ++count;
+      for (int i=0; i<MAX_ITERATIONS; ++i)
+      {
+        pixel = vw::Vector2(sample, line1);
+        if (fabs(r1) < LINE_TOLERANCE)
+        {
+          found = true;
+          break;
+        }
+        if ((r1 == r0) || (fabs(line1) > maxLine))
+          break;
+        const double next = line1 - r1*(line1 - line0)/(r1 - r0);
+        line0 = line1;
+        r0    = r1;
+        line1 = next;
+        r1    = lineResidual(point, R_offset, line1, sample);
+        ++count;
+      }
+    }
+    if (numResiduals)
+      *numResiduals += count;
+    return found;
+  }
+
+  /// Same as project() but also computes the partial derivatives of the pixel with respect to the point
+  ///  and to the three angles of R_offset, given the partials of R_offset with respect to them.
+  /// - The derivatives are taken at the solved line and corrected for the change in the solved line using
+  ///   the implicit function theorem on the line residual.  The only finite difference is along the line.
+  bool projectPartials(vw::Vector3 const& point, vw::Matrix3x3 const& R_offset, const vw::Matrix3x3 R_offset_partials[3],
+                       double guessLine, vw::Vector2 &pixel,
+                       vw::Matrix<double,2,3> &pointPartials, vw::Matrix<double,2,3> &anglePartials,
+                       size_t *numResiduals=0) const
+  {
+    const double LINE_STEP = 1.0e-3; // Lines
+
+    if (!project(point, R_offset, guessLine, pixel, numResiduals))
+      return false;
+    const double line = pixel[1];
+
+    // Residual and sample at the solved line and one step later, the point and angles held constant
+    double sample, laterSample;
+    const double residual      = lineResidual(point, R_offset, line,             sample);
+    const double laterResidual = lineResidual(point, R_offset, line + LINE_STEP, laterSample);
+    if (numResiduals)
+      *numResiduals += 2;
+    const double residualLinePartial = (laterResidual - residual) / LINE_STEP;
+    const double sampleLinePartial   = (laterSample   - sample  ) / LINE_STEP;
+    if (residualLinePartial == 0)
+      return false;
+
+    vw::Vector3   position;
+    vw::Matrix3x3 rotation;
+    lineState(line, position, rotation);
+    const vw::Vector3 instLook = rotation*(point - position);
+    const vw::Vector3 look     = R_offset*instLook;
+
+    // Partials of the focal plane coordinates along and across the sample axis with respect to the look vector
+    const double coord = look[_sampleAxis]/look[2];
+    const double cross = look[1-_sampleAxis]/look[2];
+    vw::Vector3 coordLookPartials(0, 0, -coord/look[2]);
+    vw::Vector3 crossLookPartials(0, 0, -cross/look[2]);
+    coordLookPartials[_sampleAxis]   = 1.0/look[2];
+    crossLookPartials[1-_sampleAxis] = 1.0/look[2];
+
+    // Partials of the sample and the line residual with respect to the look vector
+    double detectorCoord, sampleSlope, detectorSlope;
+    sampleAt(coord, detectorCoord, &sampleSlope, &detectorSlope);
+    const vw::Vector3 sampleLookPartials   = sampleSlope*coordLookPartials;
+    const vw::Vector3 residualLookPartials = (crossLookPartials - detectorSlope*coordLookPartials) / _pixelPitch;
+
+    // Chain to the point and the angles, moving the line to keep the residual at zero
+    const vw::Matrix3x3 lookPointPartials = R_offset*rotation;
+    for (int i=0; i<3; ++i)
+    {
+      const vw::Vector3 lookPointColumn = select_col(lookPointPartials, i);
+      const vw::Vector3 lookAngleColumn = R_offset_partials[i]*instLook;
+
+      double linePartial = -dot_prod(residualLookPartials, lookPointColumn) / residualLinePartial;
+      pointPartials(0,i) = dot_prod(sampleLookPartials, lookPointColumn) + sampleLinePartial*linePartial;
+      pointPartials(1,i) = linePartial;
+
+      linePartial = -dot_prod(residualLookPartials, lookAngleColumn) / residualLinePartial;
+      anglePartials(0,i) = dot_prod(sampleLookPartials, lookAngleColumn) + sampleLinePartial*linePartial;
+      anglePartials(1,i) = linePartial;
+    }
+    return true;
+  }
+
+  /// Returns the ray through a zero-based pixel in body coordinates.
+  /// - R_offset is the same extra instrument frame rotation project() takes.
+  void pixelRay(vw::Vector2 const& pixel, vw::Matrix3x3 const& R_offset, vw::Vector3 &origin, vw::Vector3 &direction) const
+  {
+    vw::Matrix3x3 rotation;
+    lineState(pixel[1], origin, rotation);
+
+    // Same interpolation sampleAt() inverts
+    size_t i;
+    double alpha;
+    findSegment(pixel[0], _sampleCoords.size(), i, alpha);
+    vw::Vector3 look(0, 0, 1);
+    look[_sampleAxis]   = (1.0-alpha)*_sampleCoords  [i] + alpha*_sampleCoords  [i+1];
+    look[1-_sampleAxis] = (1.0-alpha)*_detectorCoords[i] + alpha*_detectorCoords[i+1];
+    direction = normalize(transpose(R_offset*rotation)*look);
+  }
+
+  size_t numLines  () const { return _positions.size(); }
+  size_t numSamples() const { return _sampleCoords.size(); }
+
+private:
+
+  std::vector<vw::Vector3> _positions;      ///< Instrument position at each cube line
+  std::vector<vw::Quat>    _rotations;      ///< Instrument_from_Body at each cube line
+  std::vector<double>  _sampleCoords;   ///< Focal plane coordinate of each sample along the sample axis
+  std::vector<double>  _detectorCoords; ///< Focal plane coordinate of each sample across the sample axis
+  int                  _sampleAxis;
+  double               _pixelPitch;     ///< Mean focal plane spacing of the samples, in look vector units
+
+  /// Finds the table segment used for a fractional index, the weight may be outside 0-1 past the ends
+  static void findSegment(double index, size_t size, size_t &i, double &alpha)
+  {
+    const double start = std::min(std::max(floor(index), 0.0), static_cast<double>(size-2));
+    i     = static_cast<size_t>(start);
+    alpha = index - start;
+  }
+
+  /// Instrument position and Instrument_from_Body rotation at a fractional zero-based line
+  void lineState(double line, vw::Vector3 &position, vw::Matrix3x3 &rotation) const
+  {
+    size_t i;
+    double alpha;
+    findSegment(line, _positions.size(), i, alpha);
+    position = (1.0-alpha)*_positions[i] + alpha*_positions[i+1];
+
+    // Neighboring lines are so close that normalized linear interpolation is enough
+    vw::Quat const& a = _rotations[i];
+    vw::Quat const& b = _rotations[i+1];
+    const double weightB = (a.w()*b.w() + a.x()*b.x() + a.y()*b.y() + a.z()*b.z() < 0) ? -alpha : alpha;
+    vw::Quat q((1.0-alpha)*a.w() + weightB*b.w(), (1.0-alpha)*a.x() + weightB*b.x(),
+               (1.0-alpha)*a.y() + weightB*b.y(), (1.0-alpha)*a.z() + weightB*b.z());
+    rotation = normalize(q).rotation_matrix();
+  }
+
+  /// Fractional zero-based sample at a focal plane coordinate along the sample axis.
+  /// - Also returns the detector coordinate across the sample axis at that sample.
+  /// - If sampleSlope and detectorSlope are provided they are set to the derivatives of the sample
+  ///   and of the detector coordinate with respect to coord.
+  double sampleAt(double coord, double &detectorCoord, double *sampleSlope=0, double *detectorSlope=0) const
+  {
+    // The coordinates are monotonic but may run in either direction
+    const size_t numSamples = _sampleCoords.size();
+    const bool   increasing = (_sampleCoords[numSamples-1] > _sampleCoords[0]);
+    size_t low = 0, high = numSamples-1;
+    while (high - low > 1)
+    {
+      const size_t middle = (low + high) / 2;
+      if ((_sampleCoords[middle] < coord) == increasing)
+        low = middle;
+      else
+        high = middle;
+    }
+    const double span  = _sampleCoords[high] - _sampleCoords[low];
+    const double alpha = (coord - _sampleCoords[low]) / span;
+    detectorCoord = (1.0-alpha)*_detectorCoords[low] + alpha*_detectorCoords[high];
+    if (sampleSlope)
+      *sampleSlope = 1.0 / span;
+    if (detectorSlope)
+      *detectorSlope = (_detectorCoords[high] - _detectorCoords[low]) / span;
+    return low + alpha;
+  }
+
+  /// Returns the offset in pixels of the point from the detector when imaged at a fractional line
+  double lineResidual(vw::Vector3 const& point, vw::Matrix3x3 const& R_offset, double line, double &sample) const
+  {
+    vw::Vector3   position;
+    vw::Matrix3x3 rotation;
+    lineState(line, position, rotation);
+    const vw::Vector3 look = R_offset*rotation*(point - position);
+    double detectorCoord;
+    sample = sampleAt(look[_sampleAxis]/look[2], detectorCoord);
+    return (look[1-_sampleAxis]/look[2] - detectorCoord) / _pixelPitch;
+  }
+};
+
+
+/// Applies the global rotation and translation of the stereo cameras to a point, like AdjustedCameraModelRot
+inline vw::Vector3 adjustStereoPoint(const TabulatedLineScanCamera &camera, const double* const rotParams,
+                          const double* const posParams, vw::Vector3 const& point)
+{
+  vw::Quat rotation = vw::math::axis_angle_to_quaternion(vw::Vector3(rotParams[0], rotParams[1], rotParams[2]));
+  vw::Vector3 const& center = camera.pivot();
+  return inverse(rotation).rotate(point - center - vw::Vector3(posParams[0], posParams[1], posParams[2])) + center;
+}
+
+/// Moves a ray of the unadjusted stereo camera to where the adjusted camera sees it, the inverse of adjustStereoPoint
+inline void adjustStereoRay(const TabulatedLineScanCamera &camera, const double* const rotParams,
+                            const double* const posParams, vw::Vector3 &origin, vw::Vector3 &direction)
+{
+  vw::Quat rotation = vw::math::axis_angle_to_quaternion(vw::Vector3(rotParams[0], rotParams[1], rotParams[2]));
+  vw::Vector3 const& center = camera.pivot();
+  origin    = rotation.rotate(origin - center) + center + vw::Vector3(posParams[0], posParams[1], posParams[2]);
+  direction = rotation.rotate(direction);
+}
+
+/// Euler angle rotation applied in the instrument frame, like IsisInterfaceLineScanRot::point_to_pixel_rotated
+inline vw::Matrix3x3 offsetRotation(const double* const angles)
+{
+  return vw::math::euler_to_rotation_matrix(angles[0], angles[1], angles[2], "xyz");
+}
+
+
+/// Solver camera interface on a tabulated camera, so LrocPairModel and its cost functions can run on
+///  snapshot and synthetic geometry.
+/// - The table is shared by the clones and never modified, each clone has its own call counters.
+/// - The solved time written to guessTime is the one-based line, so zero still means no guess.
+class TabulatedSolverCamera : public SolverLineScanCamera
+{
+public:
+
+  TabulatedSolverCamera(boost::shared_ptr<const TabulatedLineScanCamera> camera) : m_camera(camera) {}
+  virtual ~TabulatedSolverCamera() {}
+
+  virtual std::string type() const { return "Tabulated"; }
+
+  virtual SolverLineScanCamera* clone() const { return new TabulatedSolverCamera(m_camera); }
+
+  virtual vw::Vector2 point_to_pixel( vw::Vector3 const& point ) const
+  {
+    return point_to_pixel_rotated(point, vw::Vector3(0,0,0));
+  }
+
+  virtual vw::Vector3 pixel_to_vector( vw::Vector2 const& pix ) const
+  {
+    vw::Vector3 origin, direction;
+    m_camera->pixelRay(pix, no_rotation(), origin, direction);
+    return direction;
+  }
+
+  virtual vw::Vector3 camera_center( vw::Vector2 const& pix = vw::Vector2(0,0) ) const
+  {
+    vw::Vector3 origin, direction;
+    m_camera->pixelRay(pix, no_rotation(), origin, direction);
+    return origin;
+  }
+
+  virtual vw::Vector2
+    point_to_pixel_rotated( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine=-1,
+                            double *guessTime=0 ) const
+  {
+    ++m_projection_count;
+    vw::Vector2 pixel;
+    if (!m_camera->project(point, offsetRotation(&(rotAngles[0])), start_line(guessLine, guessTime), pixel,
+                           &m_time_solve_iteration_count))
+      vw_throw( vw::camera::PointToPixelErr() << "Tabulated camera line solve did not converge" );
+    if (guessTime)
+      *guessTime = pixel[1] + 1.0;
+    return pixel;
+  }
+
+  virtual vw::Vector2
+    point_to_pixel_rotated_partials( vw::Vector3 const& point, vw::Vector3 const& rotAngles, int guessLine,
+                                     vw::Matrix<double,2,3> &pixel_point_partials,
+                                     vw::Matrix<double,2,3> &pixel_angle_partials,
+                                     double *guessTime=0 ) const
+  {
+    ++m_projection_count;
+    vw::Matrix3x3 R_offset_partials[3];
+    euler_xyz_partials(rotAngles, R_offset_partials);
+    vw::Vector2 pixel;
+    if (!m_camera->projectPartials(point, offsetRotation(&(rotAngles[0])), R_offset_partials,
+                                   start_line(guessLine, guessTime), pixel,
+                                   pixel_point_partials, pixel_angle_partials, &m_time_solve_iteration_count))
+      vw_throw( vw::camera::PointToPixelErr() << "Tabulated camera line solve did not converge" );
+    if (guessTime)
+      *guessTime = pixel[1] + 1.0;
+    return pixel;
+  }
+
+private:
+
+  boost::shared_ptr<const TabulatedLineScanCamera> m_camera;
+
+  static vw::Matrix3x3 no_rotation()
+  {
+    vw::Matrix3x3 identity;
+    identity.set_identity();
+    return identity;
+  }
+
+  /// Starting line of the line solve: the previous solution, the guess line or the middle line
+  double start_line( int guessLine, const double *guessTime ) const
+  {
+    if (guessTime && (*guessTime != 0))
+      return *guessTime - 1.0;
+    if (guessLine >= 0)
+      return guessLine;
+    return 0.5*(m_camera->numLines() - 1);
+  }
+};
+
+#endif